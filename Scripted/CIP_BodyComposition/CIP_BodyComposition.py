@@ -30,7 +30,7 @@ except Exception as ex:
     from CIP.logic.SlicerUtil import SlicerUtil
 
 from CIP.logic import Util
-from CIP_BodyComposition_logic import BodyCompositionParameters
+from CIP_BodyComposition_logic import BodyCompositionParameters, LabelSliceIndex, LabelStatistics, SliceClosing
 from CIP.ui import CaseReportsWidget
 import CIP.ui as CIPUI
 
@@ -107,7 +107,13 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
 
         self.colorTableNode = None
         self.disableEvents = False
-        self.labelMapSlices = {}  # Dict. with the slices that contain data for each label in a label map volume
+        self.labelSliceIndexes = {}  # Dict. with the index of the slices that contain each label in a label map volume
+        self.labelmapObservers = {}  # Dict. with the observers of the label map volumes that are indexed
+        self.editedSlices = set()  # Slices of the current label map that the current editor stroke can modify
+        self.editedSliceNodes = {}  # Slice nodes where the current editor stroke is done, with their displayed slices
+        self.fullSliceCheckingPending = False  # The current editor stroke could modify any slice of the label map
+        # Editor effects that modify just the slice where the user is working
+        self.editorEffects = ("PaintEffect", "DrawEffect", "LevelTracingEffect", "RectangleEffect")
         self.statistics = {}  # Dictionary with all the statistics calculated for a volume
 
 
@@ -294,6 +300,7 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
         self.refreshGUI()
 
         self.__setupCompositeNodes__()
+        self.__setupSliceViewObservers__()
 
     def __setupCompositeNodes__(self):
         """Init the CompositeNodes so that the first one (typically Red) listen to events when the node is modified,
@@ -315,6 +322,24 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
 
         slicer.app.applicationLogic().PropagateVolumeSelection(0)
 
+    def __setupSliceViewObservers__(self):
+        """Listen to the clicks and keys in the slice views, in order to know the slices of the label map that the
+        editor effects are going to modify, and to the changes of slice in the views"""
+        self.sliceViewObservers = []
+        self.sliceNodeObservers = []
+        layoutManager = slicer.app.layoutManager()
+        for sliceViewName in layoutManager.sliceViewNames():
+            sliceWidget = layoutManager.sliceWidget(sliceViewName)
+            interactor = sliceWidget.sliceView().interactorStyle().GetInteractor()
+            for event in ("LeftButtonPressEvent", "RightButtonPressEvent", "KeyPressEvent",
+                          "LeftButtonReleaseEvent", "RightButtonReleaseEvent", "KeyReleaseEvent"):
+                # Higher priority than the editor effects, that could abort the event
+                tag = interactor.AddObserver(event, self.onSliceViewInteraction, 2.0)
+                self.sliceViewObservers.append((interactor, tag))
+            sliceNode = sliceWidget.sliceLogic().GetSliceNode()
+            tag = sliceNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onSliceNodeModified)
+            self.sliceNodeObservers.append((sliceNode, tag))
+
     def __createEditorWidget__(self):
         """Create and initialize a customize Slicer Editor which contains just some the tools that we need for the segmentation"""
         self.editorWidget = CIPUI.CIP_EditorWidget(self.parent, False)
@@ -569,17 +594,42 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
 
     def __sliceChecking__(self, labelMapNode, forceRefresh=False):
         """Calculate the slices that contain the different label maps for a certain labelmap node Id.
-        If forceRefresh == false, it will try to return the value from cache"""
+        If forceRefresh == false, it will try to return the value from cache.
+        Once the index is calculated, it is updated every time that the label map is modified (see
+        onLabelmapImageDataModified)"""
         volumeID = labelMapNode.GetID()
 
-        if self.labelMapSlices.has_key(volumeID) and not forceRefresh:
+        if self.labelSliceIndexes.has_key(volumeID) and not forceRefresh:
             # The values were already calculated for this volume
             # if SlicerUtil.IsDevelopment: print("Slices for volume {0} already calculated".format(volumeID))
             return
 
         # Calculate the values
         # if SlicerUtil.IsDevelopment: print("Calculating slices for Volume " + volumeID)
-        self.labelMapSlices[volumeID] = self.logic.getLabelmapSlices(labelMapNode)
+        self.labelSliceIndexes[volumeID] = LabelSliceIndex(slicer.util.array(volumeID))
+        if not self.labelmapObservers.has_key(volumeID):
+            self.labelmapObservers[volumeID] = (labelMapNode, labelMapNode.AddObserver(
+                slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onLabelmapImageDataModified))
+
+    def __getLabelSliceIndex__(self, labelMapNode):
+        """Get the index of the slices that contain each label in a label map node (calculated if neccesary)"""
+        self.__sliceChecking__(labelMapNode)
+        return self.labelSliceIndexes[labelMapNode.GetID()]
+
+    def __getSliceViewSlices__(self, sliceNode, labelMapNode):
+        """Get the slices (K coordinate) of a label map that are displayed in a slice view.
+        Return None if the view is not aligned with the slices of the volume (ex: a sagittal view), because in that case
+        it displays a part of all the slices"""
+        transformationMatrix = vtk.vtkMatrix4x4()
+        labelMapNode.GetRASToIJKMatrix(transformationMatrix)
+        sliceToRAS = sliceNode.GetSliceToRAS()
+        normal = transformationMatrix.MultiplyPoint([sliceToRAS.GetElement(i, 2) for i in range(3)] + [0])
+        if abs(normal[0]) + abs(normal[1]) > 0.001 * abs(normal[2]):
+            return None
+        origin = transformationMatrix.MultiplyPoint([sliceToRAS.GetElement(i, 3) for i in range(3)] + [1])
+        sliceK = int(round(origin[2]))
+        # Include the neighbour slices because of the rounding errors
+        return [sliceK - 1, sliceK, sliceK + 1]
 
     def getCurrentGrayscaleNode(self):
         """Get the grayscale node that is currently active in the widget"""
@@ -608,8 +658,9 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
         self.progressBar.labelText = "Starting analysis of BodyComposition structures."
         self.progressBar.show()
 
-        # Refresh the calculation of the slices
+        # Count again all the slices, so that the analysis does not depend on the partial updates of the index
         self.__sliceChecking__(self.getCurrentLabelMapNode(), forceRefresh=True)
+        labelmapSlices = self.__getLabelSliceIndex__(self.getCurrentLabelMapNode()).getLabelmapSlices()
         self.statisticsTableModel = qt.QStandardItemModel()
         self.tableView.setModel(self.statisticsTableModel)
         self.tableView.verticalHeader().visible = False
@@ -620,8 +671,7 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
             # Perform the analysis (the result will be a list of StatsWrapper objects
             self.lastAnalysisResults = self.logic.calculateStatistics(self.editorWidget.masterVolume,
                                                                       self.editorWidget.labelmapVolume,
-                                                                      labelmapSlices=self.labelMapSlices[
-                                                                          self.editorWidget.labelmapVolume.GetID()],
+                                                                      labelmapSlices=labelmapSlices,
                                                                       callbackStepFunction=self.updateProgressBar)
 
             # Load rows
@@ -799,14 +849,8 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
                 # Empty label
                 return None
 
-            # Get a dictionary of [labelCode:array of slices] for the current labelmap volume
-            slices = self.labelMapSlices[self.getCurrentLabelMapNode().GetID()]
-
-            if not slices.has_key(labelCode):
-                # Label not present
-                return None
-            # Return the array with the number of slices
-            return slices[labelCode]
+            # Get the array of slices from the index of the current labelmap volume (None if the label is not present)
+            return self.__getLabelSliceIndex__(self.getCurrentLabelMapNode()).getSlices(labelCode)
 
         except:
             return None
@@ -830,20 +874,12 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
         slices = self.getCurrentSlicesForCurrentLabel()
         if slices is None:
             # If the label is not present (or there is none selected) take all the slices with any label
-            labelmap = self.getCurrentLabelMapNode()
-            allLabels = self.labelMapSlices[labelmap.GetID()]
-            if len(allLabels) == 0:
-                # Try to sync the labelmaps
-                logging.debug("No values in labelmap. Trying to sync...")
-                self.__sliceChecking__(labelmap, forceRefresh=True)
-                # Retry
-                allLabels = self.labelMapSlices[labelmap.GetID()]
-                if len(allLabels) == 0:
-                    # Still no labels
-                    qt.QMessageBox.warning(slicer.util.mainWindow(), 'Warning',
+            slices = self.__getLabelSliceIndex__(self.getCurrentLabelMapNode()).getLabeledSlices()
+            if len(slices) == 0:
+                # No labels (the index is kept up to date, so there is no need to scan the labelmap again)
+                qt.QMessageBox.warning(slicer.util.mainWindow(), 'Warning',
                                        'There are no any values in the labelmap. Please press "Refresh labelmap info" button.')
-                    return
-            slices = np.unique(np.concatenate([x for x in allLabels.values()]))
+                return
 
         # Get the tolerance as an error factor when converting RAS-IJK. The value will depend on
         # the transformation matrix for this node
@@ -891,6 +927,12 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
 
     def cleanup(self):
         self.editorWidget.helper.masterSelector.disconnect("currentNodeChanged(vtkMRMLNode*)", self.onMasterNodeSelect)
+        for interactor, tag in self.sliceViewObservers:
+            interactor.RemoveObserver(tag)
+        for sliceNode, tag in self.sliceNodeObservers:
+            sliceNode.RemoveObserver(tag)
+        for labelMapNode, tag in self.labelmapObservers.itervalues():
+            labelMapNode.RemoveObserver(tag)
 
     #############################################
     # SIGNALS
@@ -956,6 +998,72 @@ class CIP_BodyCompositionWidget(ScriptedLoadableModuleWidget):
 
         self.checkMasterAndLabelMapNodes(forceSlicesReload=True)
 
+    def onSliceViewInteraction(self, interactor, event):
+        """Click or key in a slice view. If the user is editing the labelmap, keep the slices that are going to be
+        modified during this editor stroke (the editor effects just modify the slice that is displayed in the view).
+        The slices are forgotten as soon as the stroke finishes (button or key released)"""
+        if event in ("LeftButtonReleaseEvent", "RightButtonReleaseEvent", "KeyReleaseEvent"):
+            # The effect applies the stroke while it processes this event, so wait until the event is processed
+            qt.QTimer.singleShot(0, self.__resetEditedSlices__)
+            return
+        labelMapNode = self.getCurrentLabelMapNode()
+        if labelMapNode is None:
+            return
+        parameterNode = self.editorWidget.toolsBox.parameterNode
+        effect = parameterNode.GetParameter("effect")
+        if effect not in self.editorEffects:
+            return
+        if event == "KeyPressEvent" and (effect != "DrawEffect" or interactor.GetControlKey()
+                                         or interactor.GetKeySym() not in ("a", "Return")):
+            # Just the "apply" keys of the Draw effect modify the displayed slice. Any other key (ex: undo/redo
+            # shortcuts) could modify any slice
+            self.fullSliceCheckingPending = True
+            return
+        if effect == "PaintEffect" and parameterNode.GetParameter("PaintEffect,sphere") == "1":
+            # The sphere brush paints in several slices
+            self.fullSliceCheckingPending = True
+            return
+        layoutManager = slicer.app.layoutManager()
+        for sliceViewName in layoutManager.sliceViewNames():
+            sliceWidget = layoutManager.sliceWidget(sliceViewName)
+            if sliceWidget.sliceView().interactorStyle().GetInteractor() == interactor:
+                sliceNode = sliceWidget.sliceLogic().GetSliceNode()
+                slices = self.__getSliceViewSlices__(sliceNode, labelMapNode)
+                if slices is None:
+                    self.fullSliceCheckingPending = True
+                else:
+                    self.editedSlices.update(slices)
+                    self.editedSliceNodes[sliceNode.GetID()] = slices
+
+    def onSliceNodeModified(self, sliceNode, event):
+        """A slice view changed. If the current editor stroke was done in that view and it displays other slices now,
+        the slices of the stroke are not valid anymore"""
+        if not self.editedSliceNodes.has_key(sliceNode.GetID()) or self.getCurrentLabelMapNode() is None:
+            return
+        if self.__getSliceViewSlices__(sliceNode, self.getCurrentLabelMapNode()) != \
+                self.editedSliceNodes[sliceNode.GetID()]:
+            self.__resetEditedSlices__()
+            self.fullSliceCheckingPending = True
+
+    def __resetEditedSlices__(self):
+        """Forget the slices of the editor stroke that has just finished"""
+        self.editedSlices = set()
+        self.editedSliceNodes = {}
+        self.fullSliceCheckingPending = False
+
+    def onLabelmapImageDataModified(self, labelMapNode, event):
+        """The data of an indexed labelmap changed. Update just the slices of its index that were edited if the
+        modification comes from an editor stroke on the current labelmap that can only modify those slices. Otherwise
+        (ex: undo/redo, load, edits from other modules, sphere brush), update all of them"""
+        volumeID = labelMapNode.GetID()
+        if not self.labelSliceIndexes.has_key(volumeID) or labelMapNode.GetImageData() is None:
+            return
+        slices = None
+        if labelMapNode == self.getCurrentLabelMapNode() and len(self.editedSlices) > 0 \
+                and not self.fullSliceCheckingPending:
+            slices = self.editedSlices
+        self.labelSliceIndexes[volumeID].update(slicer.util.array(volumeID), slices)
+
     def onBtnPrevClicked(self):
         self.jumpSlice(backwards=True)
 
@@ -1040,7 +1148,7 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
         """For each label map, get the slices where it appears. Store the result in labelmapSlices object
         (it will be used later for statistics)"""
         numpyArray = slicer.util.array(labelmapNode.GetID())
-        self.labelmapSlices = Util.get_labelmap_slices(numpyArray)
+        self.labelmapSlices = LabelSliceIndex(numpyArray).getLabelmapSlices()
         return self.labelmapSlices
 
     def calculateStatistics(self, grayscaleNode, labelNode, labelmapSlices=None, callbackStepFunction=None):
@@ -1066,7 +1174,28 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
         # Get the spacial resolution to calculate areas
         spacing = grayscaleNode.GetSpacing()
 
-        for item in (x for x in self.params.allowedCombinationsParameters if self.getIntCodeItem(x) != 0):
+        items = [x for x in self.params.allowedCombinationsParameters if self.getIntCodeItem(x) != 0]
+        # All the labels are analyzed at once, using just the slices that contain data
+        labelCodes = [self.getIntCodeItem(item) for item in items if self.labelmapSlices.has_key(self.getIntCodeItem(item))]
+        if len(labelCodes) > 0:
+            slices = np.unique(np.concatenate([self.labelmapSlices[labelCode] for labelCode in labelCodes]))
+            labelsStats = self.performAnalysisForItems(labelCodes, intensityArray[slices, :, :],
+                                                       labelMapArray[slices, :, :], spacing[0], spacing[1])
+        else:
+            labelsStats = dict()
+
+        # Tissues that must also be preprocessed before performing the analysis, grouped by the kind of preprocessing
+        preprocessingLabelCodes = dict()
+        for item in items:
+            preprocessingCode = self.params.getPreprocessingType(item)
+            if preprocessingCode != 0 and self.getIntCodeItem(item) in labelsStats:
+                preprocessingLabelCodes.setdefault(preprocessingCode, []).append(self.getIntCodeItem(item))
+        preprocessedStats = dict()
+        for preprocessingCode, codes in preprocessingLabelCodes.iteritems():
+            preprocessedStats[preprocessingCode] = self.performAnalysisWithPreprocessingForItems(
+                preprocessingCode, codes, intensityArray, labelMapArray, spacing[0], spacing[1])
+
+        for item in items:
             # Description of the label
             labelCode = self.getIntCodeItem(item)
             label = self.getFullStringDescriptionItem(item)
@@ -1074,12 +1203,8 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
             if callbackStepFunction:
                 callbackStepFunction("Calculating {0}...".format(label))
 
-                # Use just the slices that contain data
-            if self.labelmapSlices.has_key(labelCode):
-                trimmedIntensityArray = intensityArray[self.labelmapSlices[labelCode], :, :]
-                trimmedLabelmapArray = labelMapArray[self.labelmapSlices[labelCode], :, :]
-                stat = self.performAnalysisForItem(labelCode, trimmedIntensityArray, trimmedLabelmapArray, spacing[0],
-                                                   spacing[1])
+            if labelCode in labelsStats:
+                stat = labelsStats[labelCode]
                 stat.NumSlices = len(self.labelmapSlices[labelCode])
             else:
                 # The label is not present in the label map. Return empty stats object
@@ -1100,8 +1225,7 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
                     # No need to perform any analysis if the label does not exist in the labelmap
                     stat = StatsWrapper()
                 else:
-                    stat = self.performAnalysisWithPreprocessing(preprocessingCode, labelCode, intensityArray,
-                                                                 self.labelmapImageData, spacing[0], spacing[1])
+                    stat = preprocessedStats[preprocessingCode][labelCode]
                     stat.NumSlices = len(self.labelmapSlices[labelCode])
 
                 # Same label but adding "(not lean)" to the region-Type
@@ -1122,93 +1246,77 @@ class CIP_BodyCompositionLogic(ScriptedLoadableModuleLogic):
             - labelMapArray: numpy array with the whole label map
             - spacingX,spacingY: spacial resolution
             It returns a StatsWrapper object with the numerical data"""
+        return self.performAnalysisForItems([labelCode], intensityArray, labelMapArray, spacingX, spacingY)[labelCode]
 
-        stats = StatsWrapper()
-
-        # Get all pixels with this label
-        t = (labelMapArray == labelCode)
-        count = t.sum()
-        stats.Count = count
-
-        if count == 0:
-            # All the values are 0. Not neccesary to calculate anything else (just return an empty object)
-            return stats
-        else:
-            # Perform the calulations. No need to make any projection because we already have filtered the slices with data
-            # Filter the pixels that have this label in the grayscale node
-            f = intensityArray[t]
+    def performAnalysisForItems(self, labelCodes, intensityArray, labelMapArray, spacingX, spacingY):
+        """Perform the numeric operations for several labels in a single pass (see LabelStatistics).
+            Parameters:
+            - labelCodes: list of label codes
+            - intensityArray: numpy array with gray levels image
+            - labelMapArray: numpy array with the whole label map
+            - spacingX,spacingY: spacial resolution
+            It returns a dictionary of LabelCode-StatsWrapper with the numerical data (an empty StatsWrapper for the
+            labels that are not in the label map)"""
+        labelStatistics = LabelStatistics(labelCodes, intensityArray, labelMapArray)
+        result = dict((labelCode, StatsWrapper()) for labelCode in labelStatistics.labelCodes)
+
+        for i, labelCode in enumerate(labelStatistics.labelCodes):
+            if labelStatistics.counts[i] == 0:
+                # All the values are 0. Not neccesary to calculate anything else (just return an empty object)
+                continue
+            stats = result[labelCode]
+            stats.Count = labelStatistics.counts[i]
             stats.AreaMm2 = stats.Count * spacingX * spacingY  # In case that horizontal and vertical are differents
+            stats.Min = labelStatistics.mins[i]
+            stats.Max = labelStatistics.maxs[i]
+            stats.Mean = labelStatistics.means[i]
+            stats.StdDev = labelStatistics.stdDevs[i]
+            stats.Median = labelStatistics.medians[i]
 
-            stats.Min = f.min()
-            stats.Max = f.max()
-            stats.Mean = f.mean()
-            stats.StdDev = f.std()
-            stats.Median = np.median(f)
-
-            return stats
+        return result
 
     def performAnalysisWithPreprocessing(self, preprocessingCode, labelCode, grayScaleArray, labelmapImageData,
                                          spacingX, spacingY):
         """Preprocess a label map image and calculates a new intensity image.
         The kind of preprocessing depends on preprocessingCode (see BodyCompositionParameters).
         It assumes that "labelmapSlices" has been already calculated (see 'calculateStatistics' function)"""
+        shape = list(labelmapImageData.GetDimensions())
+        shape.reverse()
+        labelMapArray = vtk.util.numpy_support.vtk_to_numpy(labelmapImageData.GetPointData().GetScalars()).reshape(shape)
+        return self.performAnalysisWithPreprocessingForItems(preprocessingCode, [labelCode], grayScaleArray,
+                                                             labelMapArray, spacingX, spacingY)[labelCode]
 
-        if preprocessingCode == 1:
-            if self.labelmapSlices.has_key(labelCode):
-                # Get the slices for this labelCode
-                slices = self.labelmapSlices[labelCode]
-
-                # Slicing filter. We will use this filter to extract just the slices with data in a vtk format
-                resliceFilter = vtk.vtkImageReslice()
-                resliceFilter.SetInputData(labelmapImageData)
-                resliceFilter.SetOutputDimensionality(2)
-                resliceFilter.SetInterpolationModeToNearestNeighbor()
-                mm = vtk.vtkMatrix4x4()
-                width = labelmapImageData.GetDimensions()[0]
-                height = labelmapImageData.GetDimensions()[1]
-                centerX = width / 2
-                centerY = height / 2
-                center = [centerX, centerY, 0]
-                mm.DeepCopy(((1, 0, 0, center[0], 0, 1, 0, center[1], 0, 0, 1, center[2], 0, 0, 0, 1)))
-                resliceFilter.SetResliceAxes(mm)
-
-                # Closing vtkFilter (general)
-                closeFilter = vtk.vtkImageOpenClose3D()
-                closeFilter.SetKernelSize(3, 3, 1)
-                # filter.ReleaseDataFlagOff()
-                closeFilter.SetOpenValue(0)
-                closeFilter.SetCloseValue(labelCode)
-                # The input for this filter will be updated dynamically with the output from the slicing filter
-                closeFilter.SetInputConnection(resliceFilter.GetOutputPort())
-
-                # Init a numpy array where we will store an array per slice
-                label_compound = np.zeros([len(slices), height, width])
-                i = 0
-                for slice in slices:
-                    # Configure the slicing values
-                    mm.SetElement(2, 3, slice)
-                    # Update the closing filter for this slice. It will execute the close just in this slice
-                    closeFilter.Update()
-                    # Get the labelmapImageData object for this slice
-                    imData = closeFilter.GetOutput()
-
-                    # Convert imData in a numpy array
-                    shape = list(imData.GetDimensions())
-                    shape.reverse()
-                    lArray = vtk.util.numpy_support.vtk_to_numpy(imData.GetPointData().GetScalars()).reshape(shape)
-
-                    # Add to the matrix of numpy arrays
-                    label_compound[i, :, :] = lArray[0, :, :]
-                    i = + 1
-
-                # Extract the corresponding slices from the grayscale image
-                slicedGrayscaleArray = grayScaleArray[slices, :, :]
-
-                # Perform the stats just for this array
-                return self.performAnalysisForItem(labelCode, slicedGrayscaleArray, label_compound, spacingX, spacingY)
-            else:
-                # The label is not present in the labelmap. Return an empty object
-                return StatsWrapper()
+    def performAnalysisWithPreprocessingForItems(self, preprocessingCode, labelCodes, grayScaleArray, labelMapArray,
+                                                 spacingX, spacingY):
+        """Preprocess the label map for several labels and calculate their statistics.
+        The kind of preprocessing depends on preprocessingCode (see BodyCompositionParameters).
+        The slices that contain any of the labels are extracted just once, and every label is preprocessed with a
+        single vtk pass over that stack of slices.
+        It assumes that "labelmapSlices" has been already calculated (see 'calculateStatistics' function)
+            Parameters:
+            - labelCodes: list of label codes
+            - grayScaleArray: numpy array with the whole gray levels image
+            - labelMapArray: numpy array with the whole label map
+            - spacingX,spacingY: spacial resolution
+            It returns a dictionary of LabelCode-StatsWrapper (an empty StatsWrapper for the labels that are not
+            present in the labelmap)"""
+        result = dict((labelCode, StatsWrapper()) for labelCode in labelCodes)
+        labelCodes = [labelCode for labelCode in labelCodes if self.labelmapSlices.has_key(labelCode)]
+        if preprocessingCode != 1 or len(labelCodes) == 0:
+            return result
+
+        # Extract the slices with data for any of the labels, both from the labelmap and from the grayscale image
+        slices = np.unique(np.concatenate([self.labelmapSlices[labelCode] for labelCode in labelCodes]))
+        slicedGrayscaleArray = grayScaleArray[slices, :, :]
+        sliceClosing = SliceClosing(labelMapArray[slices, :, :])
+
+        for labelCode in labelCodes:
+            closedArray = sliceClosing.close(labelCode)
+
+            # Perform the stats just for this array
+            result[labelCode] = self.performAnalysisForItem(labelCode, slicedGrayscaleArray, closedArray, spacingX,
+                                                            spacingY)
+        return result
 
 
                 #         ##### Previous code before reducing the active slices
@@ -0,0 +1,82 @@
+import numpy as np
+
+
+class LabelSliceIndex(object):
+    def __init__(self, npArray=None):
+        """ Index of the slices that contain each label of a labelmap, kept as a histogram of labels per slice
+        (number of voxels of each label in each slice).
+        When the labelmap is modified just the slices that changed have to be counted again (see "update"), so that
+        the slices of a label are available without scanning the whole volume
+        :param npArray: numpy array (Z, Y, X) of the labelmap. If None, the index is empty until "update" is called
+        """
+        self.labels = np.zeros(0, np.int64)     # Sorted array with the labels in the columns of "counts"
+        self.counts = np.zeros((0, 0), np.int64)  # Matrix Slice x Label with the number of voxels
+        self.__labelmapSlices__ = None          # Cache of the dictionary returned by getLabelmapSlices
+        if npArray is not None:
+            self.update(npArray)
+
+    @property
+    def numberOfSlices(self):
+        return self.counts.shape[0]
+
+    def update(self, npArray, slices=None):
+        """ Count again the labels of some slices of the labelmap
+        :param npArray: numpy array (Z, Y, X) of the labelmap
+        :param slices: iterable with the slices (Z) that were modified. If None (or the number of slices of the
+        labelmap changed), all the slices are counted
+        """
+        if slices is None or npArray.shape[0] != self.numberOfSlices:
+            slices = range(npArray.shape[0])
+            self.labels = np.zeros(0, np.int64)
+            self.counts = np.zeros((npArray.shape[0], 0), np.int64)
+        else:
+            slices = [s for s in np.unique(np.asarray(slices, np.int64)) if 0 <= s < self.numberOfSlices]
+
+        for s in slices:
+            # Histogram of the labels of the slice (just the labels that are present)
+            sliceArray = npArray[s]
+            sliceCounts = np.bincount(sliceArray[sliceArray > 0])
+            sliceLabels = np.nonzero(sliceCounts)[0]
+            self.__addLabels__(sliceLabels)
+            self.counts[s, :] = 0
+            self.counts[s, np.searchsorted(self.labels, sliceLabels)] = sliceCounts[sliceLabels]
+        self.__labelmapSlices__ = None
+
+    def getSlices(self, label):
+        """ Slices that contain a label
+        :param label: code of the label
+        :return: sorted numpy array with the slices, or None if the label is not present in the labelmap
+        """
+        return self.getLabelmapSlices().get(label)
+
+    def getLabeledSlices(self):
+        """ Slices that contain any label
+        :return: sorted numpy array with the slices
+        """
+        return np.nonzero(self.counts.any(axis=1))[0]
+
+    def getLabelmapSlices(self):
+        """ Slices that contain each one of the labels of the labelmap, in the same format as
+        Util.get_labelmap_slices
+        :return: dictionary of [label_Code: numpy array of slices]
+        """
+        if self.__labelmapSlices__ is None:
+            result = {}
+            for i in range(len(self.labels)):
+                slices = np.nonzero(self.counts[:, i])[0]
+                if len(slices) > 0:
+                    result[self.labels[i]] = slices
+            self.__labelmapSlices__ = result
+        return self.__labelmapSlices__
+
+    def __addLabels__(self, labels):
+        """ Add a column to the histograms for the labels that were not present in the labelmap yet
+        """
+        newLabels = np.setdiff1d(labels, self.labels)
+        if len(newLabels) == 0:
+            return
+        allLabels = np.union1d(self.labels, newLabels)
+        counts = np.zeros((self.numberOfSlices, len(allLabels)), np.int64)
+        counts[:, np.searchsorted(allLabels, self.labels)] = self.counts
+        self.labels = allLabels
+        self.counts = counts
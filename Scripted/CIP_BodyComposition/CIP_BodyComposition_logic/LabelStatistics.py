@@ -0,0 +1,46 @@
+import numpy as np
+
+
+class LabelStatistics(object):
+    def __init__(self, labelCodes, intensityArray, labelMapArray):
+        """ Statistics of the intensities of several labels, calculated in a single pass.
+        The pixels of all the labels are grouped by label and sorted by intensity just once, so that every label is
+        a sorted segment where the min, max and median are read directly. The mean and std. dev. of all the labels
+        are calculated together with bincount.
+        The results are arrays aligned with "labelCodes" (sorted and without repetitions)
+        :param labelCodes: list of label codes
+        :param intensityArray: numpy array with gray levels image
+        :param labelMapArray: numpy array with the label map (same shape as intensityArray)
+        """
+        self.labelCodes = np.unique(labelCodes)
+
+        # Get all pixels with any of the labels
+        labels = labelMapArray.ravel()
+        t = np.in1d(labels, self.labelCodes)
+        # Position of the label of every pixel in labelCodes, and intensity of the pixel in the grayscale image
+        groups = np.searchsorted(self.labelCodes, labels[t])
+        values = intensityArray.ravel()[t]
+        order = np.lexsort((values, groups))
+        groups = groups[order]
+        values = values[order]
+
+        numLabels = self.labelCodes.size
+        self.counts = np.bincount(groups, minlength=numLabels)
+        divisors = np.maximum(self.counts, 1).astype(np.float64)
+        self.means = np.bincount(groups, weights=values, minlength=numLabels) / divisors
+        deviations = values - self.means[groups]
+        self.stdDevs = np.sqrt(np.bincount(groups, weights=deviations * deviations, minlength=numLabels) / divisors)
+
+        # First and last pixel of every segment (the values of the missing labels are 0)
+        present = self.counts > 0
+        first = np.cumsum(self.counts) - self.counts
+        last = first + self.counts - 1
+        self.mins = np.zeros(numLabels, values.dtype)
+        self.maxs = np.zeros(numLabels, values.dtype)
+        self.medians = np.zeros(numLabels, np.float64)
+        self.mins[present] = values[first[present]]
+        self.maxs[present] = values[last[present]]
+        # The two central values of the segment (the same one when the number of pixels is odd)
+        self.medians[present] = (values[(first + last)[present] // 2].astype(np.float64) +
+                                 values[(first + last + 1)[present] // 2]) / 2
+
@@ -0,0 +1,34 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+
+class SliceClosing(object):
+    def __init__(self, labelStackArray):
+        """ Morphological closing (3x3 kernel) of the labels of a stack of labelmap slices.
+        The kernel does not cross the slices (size 1 in Z), so the whole stack is closed in a single vtk pass and the
+        result is the same as closing every slice separately
+        :param labelStackArray: numpy array (Z, Y, X) with the slices of the labelmap
+        """
+        self.shape = labelStackArray.shape
+
+        # vtk image with the stack of slices
+        self.labelStackImageData = vtk.vtkImageData()
+        self.labelStackImageData.SetDimensions(self.shape[2], self.shape[1], self.shape[0])
+        self.labelStackImageData.GetPointData().SetScalars(
+            numpy_support.numpy_to_vtk(np.ascontiguousarray(labelStackArray).ravel(), deep=True))
+
+        # Closing vtkFilter (general)
+        self.closeFilter = vtk.vtkImageOpenClose3D()
+        self.closeFilter.SetKernelSize(3, 3, 1)
+        self.closeFilter.SetOpenValue(0)
+        self.closeFilter.SetInputData(self.labelStackImageData)
+
+    def close(self, labelCode):
+        """ Close a label in all the slices of the stack
+        :param labelCode: code of the label
+        :return: numpy array (Z, Y, X) with the closed stack. It is overwritten in the next call to "close"
+        """
+        self.closeFilter.SetCloseValue(labelCode)
+        self.closeFilter.Update()
+        return numpy_support.vtk_to_numpy(self.closeFilter.GetOutput().GetPointData().GetScalars()).reshape(self.shape)
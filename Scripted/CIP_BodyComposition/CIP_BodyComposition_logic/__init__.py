@@ -1 +1,4 @@
-from BodyCompositionParameters import *
\ No newline at end of file
+from BodyCompositionParameters import *
+from LabelSliceIndex import *
+from LabelStatistics import *
+from SliceClosing import *
\ No newline at end of file
@@ -0,0 +1,85 @@
+import os, sys
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from CIP_BodyComposition_logic import LabelSliceIndex
+
+
+def getLabelmap():
+    labelmap = np.zeros((9, 14, 15), np.uint16)
+    labelmap[1:4, 2:6, 3:9] = 7451
+    labelmap[3:7, 8:12, 1:5] = 7196
+    labelmap[6, 0, 0] = 20504
+    return labelmap
+
+
+def baselineSlices(labelmap):
+    """ Slices of every label scanning the whole labelmap (as in Util.get_labelmap_slices)
+    """
+    positions = np.where(labelmap > 0)
+    slices = np.unique(positions[0])
+    boundArray = labelmap[slices, :, :]
+    result = {}
+    for label in (label for label in np.unique(boundArray) if label > 0):
+        s = np.where(boundArray == label)
+        result[label] = slices[np.unique(s[0])]
+    return result
+
+
+def checkIndex(index, labelmap):
+    expected = baselineSlices(labelmap)
+    labelmapSlices = index.getLabelmapSlices()
+    assert sorted(labelmapSlices.keys()) == sorted(expected.keys())
+    for label in expected:
+        assert labelmapSlices[label].tolist() == expected[label].tolist(), label
+        assert index.getSlices(label).tolist() == expected[label].tolist(), label
+    assert index.getLabeledSlices().tolist() == np.unique(np.where(labelmap > 0)[0]).tolist()
+
+
+def test_index_matches_the_baseline():
+    labelmap = getLabelmap()
+    checkIndex(LabelSliceIndex(labelmap), labelmap)
+    assert LabelSliceIndex(labelmap).getSlices(99) is None
+    checkIndex(LabelSliceIndex(np.zeros((3, 4, 5), np.uint8)), np.zeros((3, 4, 5), np.uint8))
+
+
+def test_update_of_the_modified_slices():
+    labelmap = getLabelmap()
+    index = LabelSliceIndex(labelmap)
+    # Paint a new label, extend a label to a new slice and erase a label from a slice
+    labelmap[8, 3:5, 3:5] = 10776
+    labelmap[4, 2:4, 3:5] = 7451
+    labelmap[1] = 0
+    index.update(labelmap, [8, 4, 1])
+    checkIndex(index, labelmap)
+    # Erase a label completely. Slices out of the labelmap are ignored
+    labelmap[labelmap == 20504] = 0
+    index.update(labelmap, [5, 6, 7, -1, 9])
+    checkIndex(index, labelmap)
+
+
+def test_update_of_all_the_slices():
+    labelmap = getLabelmap()
+    index = LabelSliceIndex(labelmap)
+    # Modifications in any slice (ex: undo)
+    labelmap[:] = 0
+    labelmap[0:9:2, 5, 5] = 7196
+    index.update(labelmap)
+    checkIndex(index, labelmap)
+    # The number of slices changed (ex: new labelmap loaded with the same node)
+    labelmap = getLabelmap()[2:]
+    index.update(labelmap, [0])
+    checkIndex(index, labelmap)
+
+
+def test_update_of_wrong_slices_leaves_the_index_stale():
+    # The index just counts the slices that it is told, so the caller must pass every modified slice
+    labelmap = getLabelmap()
+    index = LabelSliceIndex(labelmap)
+    labelmap[8, 0, 0] = 7451
+    index.update(labelmap, [7])
+    assert 8 not in index.getSlices(7451).tolist()
+    index.update(labelmap)
+    checkIndex(index, labelmap)
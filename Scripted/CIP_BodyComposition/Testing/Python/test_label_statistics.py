@@ -0,0 +1,69 @@
+import os, sys
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from CIP_BodyComposition_logic import LabelStatistics
+
+
+def getCase():
+    """ Gray levels image and labelmap with some body composition codes (some slices without any label)
+    """
+    random = np.random.RandomState(4)
+    intensityArray = random.randint(-1000, 400, (6, 20, 22)).astype(np.int16)
+    labelMapArray = random.choice([0, 0, 0, 7451, 7196, 6936], size=intensityArray.shape).astype(np.uint16)
+    labelMapArray[2] = 0
+    # A label with a single pixel and another one with just 2 (median between 2 values)
+    labelMapArray[4, 3, 3] = 20504
+    labelMapArray[1, 5, 6] = labelMapArray[5, 8, 9] = 10776
+    return intensityArray, labelMapArray
+
+
+def baselineStatistics(labelCode, intensityArray, labelMapArray):
+    """ Statistics of a label calculated separately (one comparison and one pass per statistic)
+    """
+    t = (labelMapArray == labelCode)
+    f = intensityArray[t]
+    if f.size == 0:
+        return 0, 0, 0, 0, 0, 0
+    return t.sum(), f.min(), f.max(), f.mean(), f.std(), np.median(f)
+
+
+def checkStatistics(labelCodes, intensityArray, labelMapArray):
+    labelStatistics = LabelStatistics(labelCodes, intensityArray, labelMapArray)
+    assert labelStatistics.labelCodes.tolist() == sorted(set(labelCodes))
+    for i, labelCode in enumerate(labelStatistics.labelCodes):
+        count, minimum, maximum, mean, stdDev, median = baselineStatistics(labelCode, intensityArray, labelMapArray)
+        assert labelStatistics.counts[i] == count, labelCode
+        assert labelStatistics.mins[i] == minimum, labelCode
+        assert labelStatistics.maxs[i] == maximum, labelCode
+        assert np.isclose(labelStatistics.means[i], mean, rtol=1e-12), labelCode
+        assert np.isclose(labelStatistics.stdDevs[i], stdDev, rtol=1e-12), labelCode
+        assert np.isclose(labelStatistics.medians[i], median, rtol=1e-12), labelCode
+
+
+def test_statistics_match_the_baseline():
+    intensityArray, labelMapArray = getCase()
+    # Labels that are not in the labelmap, repeated labels and labels in any order
+    checkStatistics([7451, 6936, 7196, 20504, 10776, 99, 7196], intensityArray, labelMapArray)
+    checkStatistics([7196], intensityArray, labelMapArray)
+
+
+def test_statistics_of_a_stack_of_slices():
+    # calculateStatistics analyzes just the slices that contain some label
+    intensityArray, labelMapArray = getCase()
+    slices = np.array([0, 1, 3, 5])
+    checkStatistics([7451, 10776], intensityArray[slices], labelMapArray[slices])
+
+
+def test_float_image():
+    intensityArray, labelMapArray = getCase()
+    checkStatistics([7451, 6936, 20504], intensityArray * 0.37, labelMapArray)
+
+
+def test_empty_labelmap():
+    intensityArray, labelMapArray = getCase()
+    labelStatistics = LabelStatistics([7451, 6936], intensityArray, np.zeros_like(labelMapArray))
+    assert labelStatistics.counts.tolist() == [0, 0]
+    assert labelStatistics.medians.tolist() == [0, 0]
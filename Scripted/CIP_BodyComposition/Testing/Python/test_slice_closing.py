@@ -0,0 +1,82 @@
+import os, sys
+import numpy as np
+import pytest
+
+vtk = pytest.importorskip("vtk")
+from vtk.util import numpy_support
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from CIP_BodyComposition_logic import SliceClosing
+
+LABELS = [7451, 7196]
+
+
+def getLabelmap():
+    """ Labelmap with holes and gaps of 1 pixel, labels touching each other and labels in the borders of the slices
+    """
+    random = np.random.RandomState(9)
+    labelMapArray = np.zeros((7, 16, 18), np.uint16)
+    labelMapArray[1:6, 2:12, 3:15] = 7451
+    labelMapArray[random.uniform(size=labelMapArray.shape) < 0.25] = 0
+    labelMapArray[2:5, 8:16, 0:6] = 7196
+    labelMapArray[3, 10, 2] = labelMapArray[4, 15, 4] = 0
+    labelMapArray[:, 12, :] = 0
+    labelMapArray[5, 0, :] = 7196
+    return labelMapArray
+
+
+def baselineClosing(labelMapArray, slices, labelCode):
+    """ Closing of every slice separately, extracting the slices from the whole labelmap with vtkImageReslice.
+    A new pipeline is built for every slice: when just the reslice axes of the same pipeline change, the closing
+    returns the previous slice
+    """
+    labelmapImageData = vtk.vtkImageData()
+    labelmapImageData.SetDimensions(labelMapArray.shape[2], labelMapArray.shape[1], labelMapArray.shape[0])
+    labelmapImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(labelMapArray.ravel(), deep=True))
+    width = labelmapImageData.GetDimensions()[0]
+    height = labelmapImageData.GetDimensions()[1]
+
+    result = np.zeros([len(slices), height, width], labelMapArray.dtype)
+    for i, s in enumerate(slices):
+        resliceFilter = vtk.vtkImageReslice()
+        resliceFilter.SetInputData(labelmapImageData)
+        resliceFilter.SetOutputDimensionality(2)
+        resliceFilter.SetInterpolationModeToNearestNeighbor()
+        mm = vtk.vtkMatrix4x4()
+        mm.DeepCopy(((1, 0, 0, width / 2, 0, 1, 0, height / 2, 0, 0, 1, s, 0, 0, 0, 1)))
+        resliceFilter.SetResliceAxes(mm)
+
+        closeFilter = vtk.vtkImageOpenClose3D()
+        closeFilter.SetKernelSize(3, 3, 1)
+        closeFilter.SetOpenValue(0)
+        closeFilter.SetCloseValue(labelCode)
+        closeFilter.SetInputConnection(resliceFilter.GetOutputPort())
+        closeFilter.Update()
+
+        imData = closeFilter.GetOutput()
+        shape = list(imData.GetDimensions())
+        shape.reverse()
+        result[i] = numpy_support.vtk_to_numpy(imData.GetPointData().GetScalars()).reshape(shape)[0]
+    return result
+
+
+def test_closing_matches_the_closing_per_slice():
+    labelMapArray = getLabelmap()
+    slices = np.nonzero(labelMapArray.any(axis=(1, 2)))[0]
+    sliceClosing = SliceClosing(labelMapArray[slices])
+    for labelCode in LABELS:
+        closedArray = sliceClosing.close(labelCode)
+        expected = baselineClosing(labelMapArray, slices, labelCode)
+        # The closing fills some pixels (the test is not trivial)
+        assert (closedArray != labelMapArray[slices]).any(), labelCode
+        assert np.array_equal(closedArray, expected), labelCode
+
+
+def test_slices_are_independent():
+    # Closing a subset of the slices gives the same slices as closing the whole labelmap
+    labelMapArray = getLabelmap()
+    closedArray = SliceClosing(labelMapArray).close(LABELS[0]).copy()
+    slices = [1, 3, 4]
+    assert np.array_equal(SliceClosing(labelMapArray[slices]).close(LABELS[0]), closedArray[slices])
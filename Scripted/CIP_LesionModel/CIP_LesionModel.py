@@ -5,9 +5,8 @@ import collections
 import itertools
 import numpy as np
 import time
-import SimpleITK as sitk
 
-from FeatureWidgetHelperLib import FeatureExtractionLogic
+from FeatureWidgetHelperLib import FeatureExtractionLogic, MultiNoduleExtractionLogic
 # Add the CIP common library to the path if it has not been loaded yet
 # try:
 from CIP.logic.SlicerUtil import SlicerUtil
@@ -83,10 +82,18 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         self.__featureClasses__ = None
         self.__storedColumnNames__ = None
         self.__analyzedSpheres__ = set()
+        self.__analyzedNoduleKeys__ = list()  # Results keys of the last multi-nodule analysis
+        self.__analysisQuantization__ = None  # Quantization of the gray levels used in the last analysis
+        self.__analysisDiskCache__ = None  # FeatureDiskCache used in the last analysis (None if disabled)
         # Timer for dynamic zooming
         self.timer = qt.QTimer()
         self.timer.setInterval(150)
         self.timer.timeout.connect(self.__updateFOV__)
+        # Timer to refresh the labelmap and the model when the threshold slider settles
+        self.refreshModelsTimer = qt.QTimer()
+        self.refreshModelsTimer.setSingleShot(True)
+        self.refreshModelsTimer.setInterval(300)
+        self.refreshModelsTimer.timeout.connect(self.checkAndRefreshModels)
 
     @property
     def storedColumnNames(self):
@@ -95,8 +102,14 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         """
         if self.__storedColumnNames__ is None:
             self.__storedColumnNames__ = ["CaseId", "Date", "Threshold", "LesionType", "Seeds_LPS"]
+            # The rows of the reports are stored without header, so the new columns go after the existing ones,
+            # whatever their position in the feature classes
+            newColumnNames = ["Maximum 2D Diameter Axial", "Maximum 2D Diameter Coronal",
+                              "Maximum 2D Diameter Sagittal", "Quantization", "SkippedFeatures"]
             # Create a single features list with all the "child" features
-            self.__storedColumnNames__.extend(itertools.chain.from_iterable(self.featureClasses.itervalues()))
+            self.__storedColumnNames__.extend(f for f in itertools.chain.from_iterable(self.featureClasses.itervalues())
+                                              if f not in newColumnNames)
+            self.__storedColumnNames__.extend(newColumnNames)
         return self.__storedColumnNames__
 
     @property
@@ -105,36 +118,7 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         :return:
         """
         if self.__featureClasses__ is None:
-            self.__featureClasses__ = collections.OrderedDict()
-            self.__featureClasses__["First-Order Statistics"] = ["Voxel Count", "Gray Levels", "Energy", "Entropy",
-                                                                 "Minimum Intensity", "Maximum Intensity",
-                                                                 "Mean Intensity",
-                                                                 "Median Intensity", "Range", "Mean Deviation",
-                                                                 "Root Mean Square", "Standard Deviation",
-                                                                 "Ventilation Heterogeneity",
-                                                                 "Skewness", "Kurtosis", "Variance", "Uniformity"]
-            self.__featureClasses__["Morphology and Shape"] = ["Volume mm^3", "Volume cc", "Surface Area mm^2",
-                                                               "Surface:Volume Ratio", "Compactness 1", "Compactness 2",
-                                                               "Maximum 3D Diameter", "Spherical Disproportion",
-                                                               "Sphericity"]
-            self.__featureClasses__["Texture: GLCM"] = ["Autocorrelation", "Cluster Prominence", "Cluster Shade",
-                                                        "Cluster Tendency", "Contrast", "Correlation",
-                                                        "Difference Entropy",
-                                                        "Dissimilarity", "Energy (GLCM)", "Entropy(GLCM)",
-                                                        "Homogeneity 1",
-                                                        "Homogeneity 2", "IMC1", "IDMN", "IDN", "Inverse Variance",
-                                                        "Maximum Probability", "Sum Average", "Sum Entropy",
-                                                        "Sum Variance",
-                                                        "Variance (GLCM)"]  # IMC2 missing
-            self.__featureClasses__["Texture: GLRL"] = ["SRE", "LRE", "GLN", "RLN", "RP", "LGLRE", "HGLRE", "SRLGLE",
-                                                        "SRHGLE", "LRLGLE", "LRHGLE"]
-            self.__featureClasses__["Geometrical Measures"] = ["Extruded Surface Area", "Extruded Volume",
-                                                               "Extruded Surface:Volume Ratio"]
-            self.__featureClasses__["Renyi Dimensions"] = ["Box-Counting Dimension", "Information Dimension",
-                                                           "Correlation Dimension"]
-
-            self.__featureClasses__[
-                "Parenchymal Volume"] = FeatureExtractionLib.ParenchymalVolume.getAllEmphysemaDescriptions()
+            self.__featureClasses__ = FeatureExtractionLib.FeatureExtractionEngine.getAllFeatureClasses()
 
         return self.__featureClasses__
 
@@ -241,6 +225,17 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         self.addFiducialButton.setFixedSize(qt.QSize(115, 30))
         self.noduleSegmentationLayout.addWidget(self.addFiducialButton, row, 1, 1, 3)
 
+        # Nodule of the new seeds (several nodules can be segmented and analyzed at the same time)
+        row += 1
+        self.noduleIdLabel = qt.QLabel("Nodule of the new seeds:")
+        self.noduleIdLabel.setStyleSheet("margin: 10px 0 0 5px")
+        self.noduleSegmentationLayout.addWidget(self.noduleIdLabel, row, 0)
+        self.noduleIdSpinbox = qt.QSpinBox()
+        self.noduleIdSpinbox.minimum = 1
+        self.noduleIdSpinbox.maximum = 99
+        self.noduleIdSpinbox.toolTip = "Use a different number for the seeds of every nodule in the volume"
+        self.noduleSegmentationLayout.addWidget(self.noduleIdSpinbox, row, 1)
+
         # Container for the fiducials
         row += 1
         self.fiducialsContainerFrame = qt.QFrame()
@@ -317,6 +312,16 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         self.segmentButton.setFixedHeight(40)
         self.noduleSegmentationLayout.addWidget(self.segmentButton, row, 1, 1, 2)
 
+        row += 1
+        self.segmentAllNodulesButton = qt.QPushButton()
+        self.segmentAllNodulesButton.text = "Segment all nodules"
+        self.segmentAllNodulesButton.toolTip = "Segment every nodule (group of seeds) at the same time. " \
+                                               "All the nodules will be stored in a single labelmap"
+        self.segmentAllNodulesButton.setIcon(qt.QIcon("{0}/Reload.png".format(SlicerUtil.CIP_ICON_DIR)))
+        self.segmentAllNodulesButton.setIconSize(qt.QSize(20, 20))
+        self.segmentAllNodulesButton.setVisible(False)
+        self.noduleSegmentationLayout.addWidget(self.segmentAllNodulesButton, row, 1, 1, 2)
+
         # CLI progress bar
         row += 1
         self.progressBar = slicer.qSlicerCLIProgressBar()
@@ -336,6 +341,10 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         self.distanceLevelSlider.setStyleSheet("margin-top:10px;padding-top:20px")
         self.distanceLevelSlider.setToolTip("Move the slider for a fine tuning segmentation")
         self.noduleSegmentationLayout.addWidget(self.distanceLevelSlider, row, 1, 1, 3)
+        row += 1
+        self.noduleVolumeLabel = qt.QLabel()
+        self.noduleVolumeLabel.setToolTip("Volume of the nodule for the current threshold")
+        self.noduleSegmentationLayout.addWidget(self.noduleVolumeLabel, row, 1, 1, 3)
 
         #####
         ## RADIOMICS SECTION
@@ -527,6 +536,63 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         self.saveTimeCostCheckbox = qt.QCheckBox()
         self.saveTimeCostCheckbox.setText("Save time cost of every operation")
         self.advancedParametersLayout.addWidget(self.saveTimeCostCheckbox)
+        self.incrementalSpheresCheckbox = qt.QCheckBox()
+        self.incrementalSpheresCheckbox.setText("Incremental analysis of the spheres (concentric shells)")
+        self.incrementalSpheresCheckbox.toolTip = "Calculate the first-order statistics, the volume, the surface, the GLCM " \
+            "features and the parenchymal volume of all the spheres at once, accumulating the statistics of the shells " \
+            "between consecutive radii. The rest of the features are calculated for every sphere"
+        self.advancedParametersLayout.addWidget(self.incrementalSpheresCheckbox)
+
+        # Quantization of the gray levels before the texture features are calculated
+        self.quantizationFrame = qt.QFrame()
+        quantizationLayout = qt.QHBoxLayout(self.quantizationFrame)
+        quantizationLayout.setContentsMargins(0, 0, 0, 0)
+        self.quantizationComboBox = qt.QComboBox()
+        self.quantizationComboBox.addItem("Every HU value", "none")
+        self.quantizationComboBox.addItem("Fixed bin width (HU)", FeatureExtractionLib.GrayLevelQuantization.FIXED_BIN_WIDTH)
+        self.quantizationComboBox.addItem("Fixed number of bins", FeatureExtractionLib.GrayLevelQuantization.FIXED_BIN_COUNT)
+        self.quantizationComboBox.addItem("HU window", FeatureExtractionLib.GrayLevelQuantization.HU_WINDOW)
+        self.quantizationComboBox.toolTip = "Gray levels used to calculate the GLCM and GLRL texture features. " \
+            "Quantizing the intensities makes the texture features much faster and comparable between scanners"
+        quantizationLayout.addWidget(self.quantizationComboBox)
+        self.quantizationWindowLowerSpinbox = qt.QSpinBox()
+        self.quantizationWindowLowerSpinbox.minimum = -3000
+        self.quantizationWindowLowerSpinbox.maximum = 3000
+        self.quantizationWindowLowerSpinbox.value = -1000
+        self.quantizationWindowLowerSpinbox.toolTip = "Lower limit of the HU window"
+        quantizationLayout.addWidget(self.quantizationWindowLowerSpinbox)
+        self.quantizationWindowUpperSpinbox = qt.QSpinBox()
+        self.quantizationWindowUpperSpinbox.minimum = -3000
+        self.quantizationWindowUpperSpinbox.maximum = 3000
+        self.quantizationWindowUpperSpinbox.value = 400
+        self.quantizationWindowUpperSpinbox.toolTip = "Upper limit of the HU window"
+        quantizationLayout.addWidget(self.quantizationWindowUpperSpinbox)
+        self.quantizationBinSpinbox = qt.QDoubleSpinBox()
+        self.quantizationBinSpinbox.minimum = 1
+        self.quantizationBinSpinbox.maximum = 5000
+        self.quantizationBinSpinbox.decimals = 1
+        self.quantizationBinSpinbox.value = 25
+        self.quantizationBinSpinbox.toolTip = "Width of the bins in HU (number of bins for a fixed number of bins)"
+        quantizationLayout.addWidget(self.quantizationBinSpinbox)
+        self.advancedParametersLayout.addRow("Texture gray levels:", self.quantizationFrame)
+        self.__loadQuantizationSetting__()
+
+        # Features stored on disk, reused when the same ROI is analyzed again
+        self.featureCacheFrame = qt.QFrame()
+        featureCacheLayout = qt.QHBoxLayout(self.featureCacheFrame)
+        featureCacheLayout.setContentsMargins(0, 0, 0, 0)
+        self.useFeatureCacheCheckbox = qt.QCheckBox()
+        self.useFeatureCacheCheckbox.setText("Reuse the features calculated in previous sessions")
+        self.useFeatureCacheCheckbox.toolTip = "Store the features of every analyzed region on disk, so that they " \
+            "are not calculated again when the same region (same voxels and spacing) is analyzed"
+        self.useFeatureCacheCheckbox.checked = \
+            SlicerUtil.settingGetOrSetDefault(self.moduleName, "useFeatureCache", "true") == "true"
+        featureCacheLayout.addWidget(self.useFeatureCacheCheckbox)
+        self.clearFeatureCacheButton = ctk.ctkPushButton()
+        self.clearFeatureCacheButton.text = "Clear feature cache"
+        self.clearFeatureCacheButton.toolTip = "Remove all the features stored on disk"
+        featureCacheLayout.addWidget(self.clearFeatureCacheButton)
+        self.advancedParametersLayout.addRow(self.featureCacheFrame)
 
         # Add vertical spacer
         self.layout.addStretch(1)
@@ -538,7 +604,9 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         self.addFiducialButton.connect('clicked(bool)', self.__onAddFiducialButtonClicked__)
         self.enhanceVisualizationCheckbox.connect("stateChanged(int)", self.__onEnhanceVisualizationCheckChanged__)
         self.segmentButton.connect('clicked()', self.__onSegmentButtonClicked__)
+        self.segmentAllNodulesButton.connect('clicked()', self.__onSegmentAllNodulesButtonClicked__)
         self.distanceLevelSlider.connect('sliderReleased()', self.checkAndRefreshModels)
+        self.distanceLevelSlider.connect('valueChanged(int)', self.__onDistanceLevelSliderValueChanged__)
 
         self.showSpheresButtonGroup.connect("buttonClicked(int)", self.__onShowSphereCheckboxClicked__)
         # runAnalysisButton.connect("clicked()", self.__onRunAnalysisButtonClicked__)
@@ -549,6 +617,12 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         self.saveSeedsButton.connect("clicked()", self.saveCurrentSeedsToXML)
         self.loadSeedsButton.connect("clicked()", self.loadSeedsFromXML)
         self.saveTimeCostCheckbox.connect("stateChanged(int)", self.__onSaveTimeCostCheckboxClicked__)
+        self.quantizationComboBox.connect("currentIndexChanged(int)", self.__onQuantizationChanged__)
+        self.quantizationBinSpinbox.connect("valueChanged(double)", self.__onQuantizationChanged__)
+        self.quantizationWindowLowerSpinbox.connect("valueChanged(int)", self.__onQuantizationChanged__)
+        self.quantizationWindowUpperSpinbox.connect("valueChanged(int)", self.__onQuantizationChanged__)
+        self.useFeatureCacheCheckbox.connect("stateChanged(int)", self.__onUseFeatureCacheCheckboxClicked__)
+        self.clearFeatureCacheButton.connect("clicked()", self.__onClearFeatureCacheButtonClicked__)
 
         slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, self.__onSceneClosed__)
 
@@ -572,11 +646,18 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         if self.inputVolumeSelector.currentNodeID != "" and \
                         self.logic.getNumberOfFiducials(self.inputVolumeSelector.currentNodeID) > 0:
             self.segmentButton.setVisible(True)
+            # Several nodules can be segmented at the same time when there are seeds for more than one nodule
+            self.segmentAllNodulesButton.setVisible(len(self.logic.getSeedGroups()) > 1)
         else:
             self.segmentButton.setVisible(False)
+            self.segmentAllNodulesButton.setVisible(False)
 
-        # Level slider and Features Selection section active after running the segmentation algorithm
-        self.selectThresholdLabel.visible = self.distanceLevelSlider.visible = self.logic.cliOutputScalarNode is not None
+        # Level slider and Features Selection section active after running the segmentation algorithm. The threshold
+        # can not be changed in a labelmap with several nodules (see runMultiNoduleSegmentation)
+        thresholdActive = self.logic.cliOutputScalarNode is not None and \
+                          self.logic.getNoduleIds(self.logic.currentLabelmap) is None
+        self.selectThresholdLabel.visible = self.distanceLevelSlider.visible = thresholdActive
+        self.noduleVolumeLabel.visible = thresholdActive and self.logic.levelSetThreshold is not None
 
         # Show spheres buttons just visible for the analyzed spheres
         for mode in self.logic.spheresDict.iterkeys():
@@ -628,11 +709,12 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
             frame.setLayout(frameLayout)
 
             n = fiducialsNode.GetNumberOfFiducials() - 1
+            noduleId = self.noduleIdSpinbox.value
 
             # Checkbox to select/unselect
             selectFiducialsCheckbox = qt.QCheckBox()
             selectFiducialsCheckbox.checked = True
-            selectFiducialsCheckbox.text = "Seed " + str(n + 1)
+            selectFiducialsCheckbox.text = "Seed {0} (nodule {1})".format(n + 1, noduleId)
             selectFiducialsCheckbox.toolTip = "Check/uncheck to include/exclude this seed"
             selectFiducialsCheckbox.objectName = n
             frameLayout.addWidget(selectFiducialsCheckbox)
@@ -644,6 +726,8 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
 
             # Avoid duplicated events for this fiducial node
             self.semaphoreOpen = False
+            # Assign the seed to the nodule (once the semaphore is closed, because the node is modified again)
+            self.logic.setSeedNoduleId(fiducialsNode, n, noduleId)
             self.refreshUI()
 
 
@@ -673,6 +757,33 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
             # Calculate meshgrid in parallel
             # self.logic.buildMeshgrid(self.inputVolumeSelector.currentNode())
 
+    def runMultiNoduleSegmentation(self):
+        """ Segment all the nodules (groups of seeds) of the volume at the same time
+        """
+        maximumRadius = self.maximumRadiusSpinbox.value
+        if self.__validateInputVolumeSelection__():
+            cliNodes = self.logic.callMultiNoduleSegmentationCLI(self.inputVolumeSelector.currentNodeID, maximumRadius,
+                                                                 self.__onMultiNoduleSegmentationFinished__)
+            # All the CLIs run at the same time, so the progress of the first one is representative
+            self.progressBar.setCommandLineModuleNode(cliNodes[0])
+            self.progressBar.visible = True
+            SlicerUtil.setSetting(self.moduleName, "maximumRadius", maximumRadius)
+
+    def getQuantization(self):
+        """ Quantization of the gray levels selected for the texture features.
+        A ValueError is raised if the parameters are not valid (ex: empty HU window)
+        :return: FeatureExtractionLib.GrayLevelQuantization, or None when every HU value is a gray level
+        """
+        scheme = self.quantizationComboBox.itemData(self.quantizationComboBox.currentIndex)
+        if scheme == FeatureExtractionLib.GrayLevelQuantization.FIXED_BIN_WIDTH:
+            return FeatureExtractionLib.GrayLevelQuantization(scheme, binWidth=self.quantizationBinSpinbox.value)
+        if scheme == FeatureExtractionLib.GrayLevelQuantization.FIXED_BIN_COUNT:
+            return FeatureExtractionLib.GrayLevelQuantization(scheme, binCount=int(self.quantizationBinSpinbox.value))
+        if scheme == FeatureExtractionLib.GrayLevelQuantization.HU_WINDOW:
+            return FeatureExtractionLib.GrayLevelQuantization(scheme, binWidth=self.quantizationBinSpinbox.value,
+                window=(self.quantizationWindowLowerSpinbox.value, self.quantizationWindowUpperSpinbox.value))
+        return None
+
     def runAnalysis(self):
         """ Compute all the features that are currently selected, for the nodule and/or for
         the surrounding spheres
@@ -683,6 +794,7 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         self.analysisResults = dict()
         self.analysisResultsTiming = dict()
         self.__analyzedSpheres__ = set()
+        self.__analyzedNoduleKeys__ = list()
 
         for featureClass in self.featureWidgets:
             for widget in self.featureWidgets[featureClass]:
@@ -709,12 +821,27 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
                                    "Please select a segmented emphysema labelmap in the Parenchymal Volume tab")
             return
 
+        try:
+            quantization = self.getQuantization()
+        except ValueError as ex:
+            qt.QMessageBox.warning(slicer.util.mainWindow(), "Invalid value",
+                                   "Invalid texture gray levels: {0}".format(ex))
+            return
+        self.__analysisQuantization__ = quantization
+        self.__analysisDiskCache__ = self.logic.featureDiskCache if self.useFeatureCacheCheckbox.checked else None
+
         if self.otherRadiusCheckbox.checked and int(self.otherRadiusTextbox.text) > self.logic.MAX_TUMOR_RADIUS:
             qt.QMessageBox.warning(slicer.util.mainWindow(), "Invalid value",
                                    "The radius of the sphere must have a maximum value of {0}".format(
                                        self.logic.MAX_TUMOR_RADIUS))
             return
 
+        noduleIds = self.logic.getNoduleIds(self.logic.currentLabelmap)
+        if noduleIds is not None and len(noduleIds) > 1:
+            # Labelmap with several nodules
+            self.runMultiNoduleAnalysis(noduleIds)
+            return
+
         try:
             # Analysis for the volume and the nodule:
             keyName = self.inputVolumeSelector.currentNode().GetName()
@@ -724,7 +851,9 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
                                                self.logic.currentLabelmapArray,
                                                self.selectedMainFeaturesKeys.difference(["Parenchymal Volume"]),
                                                self.selectedFeatureKeys.difference(
-                                                   self.featureClasses["Parenchymal Volume"]))
+                                                   self.featureClasses["Parenchymal Volume"]),
+                                               roiContextCache=self.logic.roiContextCache,
+                                               quantization=quantization, diskCache=self.__analysisDiskCache__)
 
                 print("******** Nodule analysis results...")
                 t1 = start
@@ -733,7 +862,7 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
 
                 self.analysisResults[keyName] = collections.OrderedDict()
                 self.analysisResultsTiming[keyName] = collections.OrderedDict()
-                logic.run(self.analysisResults[keyName], self.logic.printTiming, self.analysisResultsTiming[keyName])
+                self.__runFeatureExtractionLogic__(logic, keyName)
 
                 # Print analysis results
                 print(self.analysisResults[keyName])
@@ -758,18 +887,37 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
                     # If the parenchymal volume analysis is required, we need the numpy array represeting the whole
                     # emphysema segmentation labelmap
                     labelmapWholeVolumeArray = slicer.util.array(self.parenchymaLabelmapSelector.currentNode().GetName())
+                    labelmapWholeVolumeCounts = self.logic.getLabelCounts(self.parenchymaLabelmapSelector.currentNode())
                 else:
-                    labelmapWholeVolumeArray = None
+                    labelmapWholeVolumeArray = labelmapWholeVolumeCounts = None
 
                 # print("DEBUG: analyzing spheres...")
                 t1 = time.time()
                 self.logic.getCurrentDistanceMap()
                 if self.logic.printTiming:
                     print("Time to get the current distance map: {0} seconds".format(time.time() - t1))
-                for r in self.logic.spheresDict[self.workingMode]:
-                    if self.spheresButtonGroup.button(r*10).isChecked():
-                        self.runAnalysisSphere(r, labelmapWholeVolumeArray)
-                        self.__analyzedSpheres__.add(r)
+                radii = [r for r in self.logic.spheresDict[self.workingMode]
+                         if self.spheresButtonGroup.button(r*10).isChecked()]
+                if self.otherRadiusCheckbox.checked:
+                    radii.append(int(self.otherRadiusTextbox.text))
+                if self.incrementalSpheresCheckbox.checked:
+                    # Accumulate the statistics of the shells between consecutive radii just once
+                    t1 = time.time()
+                    shells = FeatureExtractionLib.ConcentricShells(self.logic.currentVolumeArray,
+                                self.logic.currentDistanceMap, self.logic.currentDistanceMapOffset, radii,
+                                self.logic.currentLabelmapArray, self.logic.currentVolume.GetSpacing(), labelId=1,
+                                parenchymaLabelmapArray=labelmapWholeVolumeArray,
+                                parenchymaLabelCounts=labelmapWholeVolumeCounts,
+                                quantization=self.__analysisQuantization__)
+                    if self.logic.printTiming:
+                        print("Time to build the concentric shells: {0} seconds".format(time.time() - t1))
+                else:
+                    shells = None
+                for r in radii:
+                    # The sphere is added before the analysis, so that its partial results are saved if the
+                    # process is cancelled
+                    self.__analyzedSpheres__.add(r)
+                    self.runAnalysisSphere(r, labelmapWholeVolumeArray, shells, labelmapWholeVolumeCounts)
                 # if self.r15Checkbox.checked:
                 #     self.runAnalysisSphere(15, labelmapWholeVolumeArray)
                 #     self.__analyzedSpheres__.add(15)
@@ -779,10 +927,6 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
                 # if self.r25Checkbox.checked:
                 #     self.runAnalysisSphere(25, labelmapWholeVolumeArray)
                 #     self.__analyzedSpheres__.add(25)
-                if self.otherRadiusCheckbox.checked:
-                    r = int(self.otherRadiusTextbox.text)
-                    self.runAnalysisSphere(r, labelmapWholeVolumeArray)
-                    self.__analyzedSpheres__.add(r)
 
             t = time.time() - start
             if self.logic.printTiming:
@@ -793,20 +937,105 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
                                        "Analysis finished. Total time: {0} seconds. Click the \"Open\" button to see the results".format(t))
 
             self.refreshUI()
+        except StopIteration:
+            qt.QMessageBox.warning(slicer.util.mainWindow(), "Process cancelled",
+                                   "The process has been cancelled by the user. The features already calculated have "
+                                   "been saved (the rest of them are listed in the SkippedFeatures column). Run the "
+                                   "analysis again to calculate just the missing features")
+        finally:
+            self.saveReport(showConfirmation=False)
+
+    def __runFeatureExtractionLogic__(self, logic, keyName):
+        """ Run the analysis of a ROI and store the results in self.analysisResults[keyName].
+        If the user cancels the process, the features already calculated are kept and the rest of them are recorded
+        in the SkippedFeatures column of the report (the exception is raised again)
+        :param logic: FeatureExtractionLogic of the ROI
+        :param keyName: CaseId[__rXX] where XX = sphere radius
+        """
+        try:
+            logic.run(self.analysisResults[keyName], self.logic.printTiming, self.analysisResultsTiming[keyName])
+        except FeatureExtractionLib.AnalysisCancelled as ex:
+            self.analysisResults[keyName]["SkippedFeatures"] = ";".join(ex.skipped)
+            raise
+
+    def runMultiNoduleAnalysis(self, noduleIds):
+        """ Compute all the features that are currently selected for all the nodules of the current labelmap
+        (one label per nodule) and the spheres around each one of them.
+        The nodules are analyzed in parallel (worker processes), each one in its own crop of the volume.
+        The results are stored with the keys VolumeName__nXX[__rYY], where XX is the nodule and YY the sphere radius
+        :param noduleIds: labels of the nodules
+        """
+        volumeName = self.inputVolumeSelector.currentNode().GetName()
+        radii = [r for r in self.logic.spheresDict[self.workingMode] if self.spheresButtonGroup.button(r*10).isChecked()]
+        if self.otherRadiusCheckbox.checked and self.otherRadiusTextbox.text != "":
+            radii.append(int(self.otherRadiusTextbox.text))
+        if "Parenchymal Volume" in self.selectedMainFeaturesKeys:
+            labelmapWholeVolumeArray = slicer.util.array(self.parenchymaLabelmapSelector.currentNode().GetName())
+        else:
+            labelmapWholeVolumeArray = None
+        # Worker processes are forked from Slicer, which is just safe in Linux
+        processes = None if sys.platform.startswith("linux") else 1
+
+        try:
+            start = time.time()
+            logic = MultiNoduleExtractionLogic(self.logic.currentVolume, self.logic.currentVolumeArray,
+                                               slicer.util.array(self.logic.currentLabelmap.GetName()),
+                                               self.selectedMainFeaturesKeys, self.selectedFeatureKeys, radii,
+                                               labelmapWholeVolumeArray, noduleIds,
+                                               quantization=self.__analysisQuantization__,
+                                               diskCache=self.__analysisDiskCache__,
+                                               analyzeNodules=self.noduleCheckbox.checked)
+            results = logic.run(processes)
+            self.__storeMultiNoduleResults__(volumeName, results)
+
+            t = time.time() - start
+            if self.logic.printTiming:
+                print("********* TOTAL ANALYSIS TIME: {0} SECONDS".format(t))
+            qt.QMessageBox.information(slicer.util.mainWindow(), "Process finished",
+                                       "Analysis of {0} nodules finished. Total time: {1} seconds. Click the \"Open\" "
+                                       "button to see the results".format(len(noduleIds), t))
+            self.refreshUI()
+        except FeatureExtractionLib.AnalysisCancelled as ex:
+            # Keep the nodules that were finished
+            self.__storeMultiNoduleResults__(volumeName, ex.results)
+            qt.QMessageBox.warning(slicer.util.mainWindow(), "Process cancelled",
+                                   "The process has been cancelled by the user. The results of the {0} nodules "
+                                   "already finished have been saved".format(len(ex.results)))
         except StopIteration:
             qt.QMessageBox.warning(slicer.util.mainWindow(), "Process cancelled",
                                    "The process has been cancelled by the user")
         finally:
             self.saveReport(showConfirmation=False)
 
-    def runAnalysisSphere(self, radius, labelmapWholeVolumeArray):
+    def __storeMultiNoduleResults__(self, volumeName, results):
+        """ Store the results of a multi-nodule analysis with the keys VolumeName__nXX[__rYY]
+        :param volumeName: name of the volume
+        :param results: OrderedDict of NoduleId-(OrderedDict of Region-Results) (see MultiNoduleAnalysis)
+        """
+        for noduleId, regions in results.iteritems():
+            for region, regionResults in regions.iteritems():
+                if region == "Nodule":
+                    keyName = "{0}__n{1}".format(volumeName, noduleId)
+                else:
+                    keyName = "{0}__n{1}__r{2}".format(volumeName, noduleId, region)
+                self.analysisResults[keyName] = regionResults
+                self.__analyzedNoduleKeys__.append(keyName)
+                print("********* Results for {0}:".format(keyName))
+                print(regionResults)
+
+    def runAnalysisSphere(self, radius, labelmapWholeVolumeArray, shells=None, labelmapWholeVolumeCounts=None):
         """ Run the selected features for an sphere of radius r (excluding the nodule itself)
         :param radius:
+        :param labelmapWholeVolumeArray: emphysema labelmap array (needed for the Parenchymal Volume)
+        :param shells: ConcentricShells that contains this radius. When not None, the incremental features are
+            obtained from the shells and just the rest of the features are calculated for the sphere
+        :param labelmapWholeVolumeCounts: number of voxels of every label of labelmapWholeVolumeArray, shared by all
+            the spheres (see CIP_LesionModelLogic.getLabelCounts)
         :return:
         """
         keyName = "{0}__r{1}".format(self.inputVolumeSelector.currentNode().GetName(), radius)
         t1 = time.time()
-        labelmapArray = self.logic.getSphereLabelMapArray(radius)
+        labelmapArray, offset = self.logic.getSphereLabelMapArray(radius)
         getSphereTime = time.time() - t1
         if self.logic.printTiming:
             print("Time elapsed to get a sphere labelmap of radius {0}: {1} seconds".format(radius, getSphereTime))
@@ -818,13 +1047,29 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
                 results[key] = 0
             self.analysisResults[keyName] = results
         else:
-            logic = FeatureExtractionLogic(self.logic.currentVolume, self.logic.currentVolumeArray,
-                                           labelmapArray, self.selectedMainFeaturesKeys, self.selectedFeatureKeys,
-                                           "__r{0}".format(radius), labelmapWholeVolumeArray)
             t1 = time.time()
             self.analysisResults[keyName] = collections.OrderedDict()
             self.analysisResultsTiming[keyName] = collections.OrderedDict()
-            logic.run(self.analysisResults[keyName], self.logic.printTiming, self.analysisResultsTiming[keyName])
+            featureKeys = self.selectedFeatureKeys
+            mainFeaturesKeys = self.selectedMainFeaturesKeys
+            if shells is not None:
+                results = shells.EvaluateFeatures(radius, featureKeys, True)
+                self.analysisResults[keyName].update(results[0])
+                self.analysisResultsTiming[keyName].update(results[1])
+                featureKeys = featureKeys.difference(results[0].keys())
+                mainFeaturesKeys = set(c for c in mainFeaturesKeys
+                                       if len(featureKeys.intersection(self.featureClasses[c])) > 0)
+            if len(featureKeys) > 0:
+                # Just the bounding box of the sphere is analyzed
+                volumeArray = self.logic.currentVolumeArray[FeatureExtractionLib.SphereROI.cropSlices(offset, labelmapArray.shape)]
+                logic = FeatureExtractionLogic(self.logic.currentVolume, volumeArray,
+                                               labelmapArray, mainFeaturesKeys, featureKeys,
+                                               "__r{0}".format(radius), labelmapWholeVolumeArray,
+                                               self.logic.roiContextCache, labelmapROIOffset=offset,
+                                               quantization=self.__analysisQuantization__,
+                                               diskCache=self.__analysisDiskCache__,
+                                               labelmapWholeVolumeCounts=labelmapWholeVolumeCounts)
+                self.__runFeatureExtractionLogic__(logic, keyName)
             t2 = time.time()
 
             print("********* Results for the sphere of radius {0}:".format(radius))
@@ -850,6 +1095,8 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         for r in self.__analyzedSpheres__:
             keyName = "{0}__r{1}".format(self.inputVolumeSelector.currentNode().GetName(), r)
             self.__saveSubReport__(keyName)
+        for keyName in self.__analyzedNoduleKeys__:
+            self.__saveSubReport__(keyName)
         # keyName = self.inputVolumeSelector.currentNode().GetName() + "__r15"
         # self.__saveSubReport__(keyName)
         # keyName = self.inputVolumeSelector.currentNode().GetName() + "__r20"
@@ -920,6 +1167,8 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
             slicer.mrmlScene.RemoveNode(self.logic.currentModelNode)
         if self.logic.cliOutputScalarNode is not None:
             slicer.mrmlScene.RemoveNode(self.logic.cliOutputScalarNode)
+        if self.logic.cliInputScalarNode is not None:
+            slicer.mrmlScene.RemoveNode(self.logic.cliInputScalarNode)
 
         # Uncheck MIP
         self.enhanceVisualizationCheckbox.setChecked(False)
@@ -977,6 +1226,39 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
 
 
 
+    def __loadQuantizationSetting__(self):
+        """ Select the quantization of the gray levels that was used the last time
+        """
+        try:
+            quantization = FeatureExtractionLib.GrayLevelQuantization.fromString(
+                SlicerUtil.settingGetOrSetDefault(self.moduleName, "quantization", "none"))
+        except ValueError:
+            quantization = None
+        if quantization is not None:
+            self.quantizationComboBox.currentIndex = self.quantizationComboBox.findData(quantization.scheme)
+            if quantization.scheme == FeatureExtractionLib.GrayLevelQuantization.FIXED_BIN_COUNT:
+                self.quantizationBinSpinbox.value = quantization.binCount
+            else:
+                self.quantizationBinSpinbox.value = quantization.binWidth
+            if quantization.window is not None:
+                self.quantizationWindowLowerSpinbox.value = quantization.window[0]
+                self.quantizationWindowUpperSpinbox.value = quantization.window[1]
+        self.__refreshQuantizationWidgets__()
+
+    def __refreshQuantizationWidgets__(self):
+        """ Show just the parameters of the selected quantization scheme
+        """
+        scheme = self.quantizationComboBox.itemData(self.quantizationComboBox.currentIndex)
+        self.quantizationBinSpinbox.visible = scheme != "none"
+        self.quantizationWindowLowerSpinbox.visible = self.quantizationWindowUpperSpinbox.visible = \
+            scheme == FeatureExtractionLib.GrayLevelQuantization.HU_WINDOW
+        if scheme == FeatureExtractionLib.GrayLevelQuantization.FIXED_BIN_COUNT:
+            self.quantizationBinSpinbox.decimals = 0
+            self.quantizationBinSpinbox.suffix = " bins"
+        else:
+            self.quantizationBinSpinbox.decimals = 1
+            self.quantizationBinSpinbox.suffix = " HU"
+
     def __removeFiducialsFrames__(self):
         """ Remove all the possible fiducial frames that can remain obsolete (for example after closing a scene)
         """
@@ -994,7 +1276,7 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
             self.__saveBasicData__(keyName)
             self.reportsWidget.saveCurrentValues(**self.analysisResults[keyName])
 
-            if self.logic.printTiming:
+            if self.logic.printTiming and keyName in self.analysisResultsTiming:
                 # Save also timing report
                 # self.analysisResultsTiming[keyName]["CaseId"] = keyName + "_timing"
                 # self.analysisResultsTiming[keyName]["Date"] = date
@@ -1024,6 +1306,8 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         d[keyName]["Threshold"] = threshold
         d[keyName]["LesionType"] = self.lesionType
         d[keyName]["Seeds_LPS"] = coordsList.__str__()
+        d[keyName]["Quantization"] = str(self.__analysisQuantization__) if self.__analysisQuantization__ is not None \
+            else "none"
 
     def __updateFOV__(self):
         """ Dynamic zoom to the center of the current view in all the 2D windows
@@ -1113,6 +1397,24 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
         self.segmentButton.setEnabled(False)
         self.runNoduleSegmentation()
 
+    def __onSegmentAllNodulesButtonClicked__(self):
+        self.segmentAllNodulesButton.setEnabled(False)
+        self.runMultiNoduleSegmentation()
+
+    def __onMultiNoduleSegmentationFinished__(self, errorMessage):
+        """ All the CLIs of runMultiNoduleSegmentation have finished
+        :param errorMessage: None if all the nodules have been segmented
+        """
+        self.progressBar.hide()
+        self.segmentAllNodulesButton.setEnabled(True)
+        if errorMessage is not None:
+            qt.QMessageBox.warning(slicer.util.mainWindow(), "Segmentation failed", errorMessage)
+            return
+        self.noduleLabelmapSelector.setCurrentNode(self.logic.currentLabelmap)
+        self.__activateCurrentLabelmap__()
+        SlicerUtil.refreshActiveWindows()
+        self.refreshUI()
+
 
     def __onFiducialsNodeModified__(self, nodeID, event):
         """ The active fiducials node has been modified because we added or removed a fiducial
@@ -1179,8 +1481,49 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
     def __onSaveTimeCostCheckboxClicked__(self, checked):
         self.logic.printTiming = (checked == 2)
 
+    def __onQuantizationChanged__(self, *args):
+        self.__refreshQuantizationWidgets__()
+        try:
+            quantization = self.getQuantization()
+        except ValueError:
+            # Invalid parameters (the user is still editing them)
+            return
+        SlicerUtil.setSetting(self.moduleName, "quantization", str(quantization) if quantization is not None else "none")
+
+    def __onUseFeatureCacheCheckboxClicked__(self, state):
+        SlicerUtil.setSetting(self.moduleName, "useFeatureCache", "true" if state == 2 else "false")
+
+    def __onClearFeatureCacheButtonClicked__(self):
+        if qt.QMessageBox.question(slicer.util.mainWindow(), "Clear feature cache",
+                                   "All the features stored on disk will be removed. Are you sure?",
+                                   qt.QMessageBox.Yes | qt.QMessageBox.No) == qt.QMessageBox.Yes:
+            self.logic.featureDiskCache.clear()
+
     def __onAnalyzeButtonClicked__(self):
-        self.runAnalysis()
+        # The progress dialog processes the Slicer events while the analysis runs, so the buttons that start a new
+        # analysis or segmentation (or remove the cached features) are disabled until it finishes
+        buttons = [button for button in (self.runAnalysisButton, self.segmentButton, self.segmentAllNodulesButton,
+                                         self.clearFeatureCacheButton) if button.enabled]
+        for button in buttons:
+            button.setEnabled(False)
+        try:
+            self.runAnalysis()
+        finally:
+            for button in buttons:
+                button.setEnabled(True)
+
+    def __onDistanceLevelSliderValueChanged__(self, value):
+        """ Preview the volume of the nodule for the new threshold (binary search in the sorted level set values).
+        The labelmap and the model are not refreshed until the slider settles
+        """
+        if self.logic.levelSetThreshold is None:
+            return
+        threshold = float(value) / 100
+        self.noduleVolumeLabel.text = "Nodule volume: {0:.2f} mm3 ({1} voxels)".format(
+            self.logic.levelSetThreshold.getVolume(threshold), self.logic.levelSetThreshold.getVoxelCount(threshold))
+        if not self.distanceLevelSlider.isSliderDown():
+            # Changed with the keyboard/mouse wheel. When the slider is dragged, the models are refreshed on release
+            self.refreshModelsTimer.start()
 
     def __onSceneClosed__(self, arg1, arg2):
         # self.timer.stop()
@@ -1216,6 +1559,8 @@ class CIP_LesionModelWidget(ScriptedLoadableModuleWidget):
 #############################
 class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
     MAX_TUMOR_RADIUS = 30
+    NODULE_DESCRIPTION_PREFIX = "Nodule "  # Description of the seeds that belong to a nodule (ex: "Nodule 2")
+    NODULE_IDS_ATTRIBUTE = "CIP_LesionModel.NoduleIds"  # Attribute of the labelmaps that contain several nodules
     WORKING_MODE_HUMAN = 0
     WORKING_MODE_SMALL_ANIMAL = 1
 
@@ -1224,7 +1569,14 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
         self.__currentVolumeArray__ = None  # Numpy array that represents the current volume
         self.currentLabelmap = None  # Current label map that contains the nodule segmentation for the current threshold (same size as the volume)
         self.__currentLabelmapArray__ = None  # Numpy array that represents the current label map
+        self.cliInputScalarNode = None  # Crop of the current volume around the seeds that is segmented by the CLI
         self.cliOutputScalarNode = None  # Scalar volume that the CLI returns. This will be a cropped volume
+        self.cliOutputOffset = None  # Offset (ZYX) of the CLI input/output crop in the current volume
+        self.multiNoduleSegmentations = collections.OrderedDict()  # CLI node id-(NoduleId, output node, offset)
+        self.__finishedMultiNoduleSegmentations__ = set()  # CLI nodes (ids) already finished
+        self.__failedMultiNoduleSegmentations__ = []  # Nodules whose CLI failed
+        self.__multiNoduleSegmentationObservers__ = []  # (CLI node, observer tag)
+        self.onMultiNoduleSegmentationFinishedCallback = None
 
         self.currentModelNodeId = None  # 3D model volume id
         self.defaultThreshold = 0  # Default threshold for the map distance used in the nodule segmentation
@@ -1232,7 +1584,8 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
         self.invokedCLI = False  # Semaphore to avoid duplicated events
 
         # self.origin = None                  # Current origin (centroid of the nodule)
-        self.currentDistanceMap = None  # Current distance map from the specified origin
+        self.currentDistanceMap = None  # Current distance map from the specified origin (cropped)
+        self.currentDistanceMapOffset = None  # Offset (ZYX) of the cropped distance map in the volume
         self.currentCentroid = None  # Centroid of the nodule
         self.spheresLabelmaps = dict()  # Labelmap of spheres for a particular radius
 
@@ -1242,9 +1595,17 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
         self.spheresDict[self.WORKING_MODE_HUMAN] = (15, 20, 25)  # Humans
         self.spheresDict[self.WORKING_MODE_SMALL_ANIMAL] = (1.5, 2, 2.5)  # Mouse
 
-        self.thresholdFilter = None
+        self.levelSetThreshold = None  # Threshold of the evolved region of the level set returned by the CLI
+        self.levelSetTranslationFilter = None  # CLI output placed in the IJK coordinates of the whole volume
+        self.levelSetVOIFilter = None  # Evolved region of the level set, used to build the model
         self.marchingCubesFilter = None
 
+        # Preprocessed data and calculated features for the analyzed ROIs (nodule and spheres)
+        self.roiContextCache = FeatureExtractionLib.ROIContextCache()
+        self.__featureDiskCache__ = None
+        # Number of voxels of every label of the labelmaps used in the analysis. NodeId-(Modified time, counts)
+        self.__labelCounts__ = dict()
+
         self.printTiming = SlicerUtil.IsDevelopment
 
     @property
@@ -1275,6 +1636,15 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
         """
         return "^(.)+{0}$".format(self.__SUFFIX__SEGMENTED_LABELMAP)
 
+    @property
+    def featureDiskCache(self):
+        """ Features stored on disk for the ROIs analyzed in any session (see FeatureExtractionLib.FeatureDiskCache)
+        """
+        if self.__featureDiskCache__ is None:
+            self.__featureDiskCache__ = FeatureExtractionLib.FeatureDiskCache(
+                os.path.join(SlicerUtil.getSettingsDataFolder("CIP_LesionModel"), "FeatureCache"))
+        return self.__featureDiskCache__
+
     @property
     def currentModelNode(self):
         if self.currentModelNodeId is None:
@@ -1324,6 +1694,7 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
         #segmentedNodeName = self.currentVolume.GetID() + '_segmentedlm'
         segmentedNodeName = self.__PREFIX_INPUTVOLUME__ + self.currentVolume.GetID()
         self.cliOutputScalarNode = slicer.util.getNode(segmentedNodeName)
+        self.cliInputScalarNode = slicer.util.getNode(segmentedNodeName + "_input")
 
     def __createFiducialsListNode__(self, fiducialsNodeName, onModifiedCallback=None):
         """ Create a new fiducials list node for the current volume
@@ -1415,12 +1786,26 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
             self.cliOutputScalarNode.SetName(segmentedNodeName)
             slicer.mrmlScene.AddNode(self.cliOutputScalarNode)
 
+        # Just a region around the seeds is sent to the CLI
+        if self.cliInputScalarNode is None:
+            self.cliInputScalarNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLScalarVolumeNode")
+            self.cliInputScalarNode.SetName(self.cliOutputScalarNode.GetName() + "_input")
+            slicer.mrmlScene.AddNode(self.cliInputScalarNode)
+        fiducialsNode = self.getCurrentFiducialsNode()
+        seeds = []
+        for i in range(fiducialsNode.GetNumberOfMarkups()):
+            coords = [0, 0, 0]
+            fiducialsNode.GetNthFiducialPosition(i, coords)
+            seeds.append(coords)
+        self.cliOutputOffset = self.__cropVolumeAroundSeeds__(seeds, maximumRadius, self.cliInputScalarNode)
+
         parameters = {}
         print("Calling CLI...")
-        parameters["inputImage"] = inputVolumeID
+        parameters["inputImage"] = self.cliInputScalarNode
         parameters["outputLevelSet"] = self.cliOutputScalarNode
         parameters["seedsFiducials"] = self.getFiducialsListNode(inputVolumeID)
         parameters["maximumRadius"] = maximumRadius
+        # The output will have the same size as the crop
         parameters["fullSizeOutput"] = True
         self.invokedCLI = False  # Semaphore to avoid duplicated events
 
@@ -1434,16 +1819,120 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
 
         return result
 
+    ##############################
+    # Multiple nodules
+    ##############################
+    def getSeedNoduleId(self, fiducialsNode, index):
+        """ Nodule that a seed belongs to (stored in the description of the seed).
+        The seeds without a nodule belong to the nodule 1
+        :param fiducialsNode: fiducials node
+        :param index: index of the seed in the node
+        :return: nodule id (int)
+        """
+        description = fiducialsNode.GetNthMarkupDescription(index)
+        if description.startswith(self.NODULE_DESCRIPTION_PREFIX):
+            return int(description[len(self.NODULE_DESCRIPTION_PREFIX):])
+        return 1
+
+    def setSeedNoduleId(self, fiducialsNode, index, noduleId):
+        """ Assign a seed to a nodule
+        :param fiducialsNode: fiducials node
+        :param index: index of the seed in the node
+        :param noduleId: nodule id (int)
+        """
+        fiducialsNode.SetNthMarkupDescription(index, "{0}{1}".format(self.NODULE_DESCRIPTION_PREFIX, noduleId))
+
+    def getSeedGroups(self):
+        """ Visible seeds of the current volume grouped by nodule
+        :return: OrderedDict of NoduleId-list of RAS coordinates, sorted by NoduleId
+        """
+        groups = dict()
+        fiducialsNode = self.getCurrentFiducialsNode()
+        for i in range(fiducialsNode.GetNumberOfMarkups()):
+            if fiducialsNode.GetNthFiducialVisibility(i):
+                coords = [0, 0, 0]
+                fiducialsNode.GetNthFiducialPosition(i, coords)
+                groups.setdefault(self.getSeedNoduleId(fiducialsNode, i), []).append(coords)
+        return collections.OrderedDict((noduleId, groups[noduleId]) for noduleId in sorted(groups))
+
+    def getNoduleIds(self, labelmapNode):
+        """ Nodules contained in a labelmap that was created segmenting several nodules
+        :param labelmapNode: labelmap node
+        :return: list of nodule ids (one label per nodule) or None if it is a regular (single nodule) labelmap
+        """
+        if labelmapNode is None or labelmapNode.GetAttribute(self.NODULE_IDS_ATTRIBUTE) is None:
+            return None
+        return [int(n) for n in labelmapNode.GetAttribute(self.NODULE_IDS_ATTRIBUTE).split(",")]
+
+    def getLabelCounts(self, labelmapNode):
+        """ Number of voxels of every label of a labelmap (see FeatureExtractionLib.ParenchymalVolume.getLabelCounts).
+        The counts are cached until the labelmap is modified, so that all the spheres and all the analysis over the
+        same labelmap (ex: emphysema labelmap) share them
+        :param labelmapNode: labelmap node
+        :return: tuple (sorted array with the labels present in the labelmap; number of voxels of each one)
+        """
+        modifiedTime = labelmapNode.GetImageData().GetMTime()
+        cached = self.__labelCounts__.get(labelmapNode.GetID())
+        if cached is None or cached[0] != modifiedTime:
+            counts = FeatureExtractionLib.ParenchymalVolume.getLabelCounts(slicer.util.array(labelmapNode.GetName()))
+            cached = self.__labelCounts__[labelmapNode.GetID()] = (modifiedTime, counts)
+        return cached[1]
+
+    def callMultiNoduleSegmentationCLI(self, inputVolumeID, maximumRadius, onFinishedCallback=None):
+        """ Segment all the nodules (seed groups) of a volume. The Lesion Segmentation CLI is invoked for every nodule
+        with its own crop of the volume, and all of them run concurrently. When all of them have finished, the
+        nodules are stored in a single labelmap (one label per nodule) with the default threshold
+        :param inputVolumeID: volume id
+        :param maximumRadius: maximum radius of every nodule
+        :param onFinishedCallback: function(errorMessage) that will be invoked when all the CLIs have finished.
+            errorMessage is None if all the nodules have been segmented
+        :return: list of CLI nodes
+        """
+        self.setActiveVolume(inputVolumeID)
+        self.multiNoduleSegmentations = collections.OrderedDict()
+        self.__finishedMultiNoduleSegmentations__ = set()
+        self.__failedMultiNoduleSegmentations__ = []
+        self.__multiNoduleSegmentationObservers__ = []
+        self.onMultiNoduleSegmentationFinishedCallback = onFinishedCallback
+        module = slicer.modules.generatelesionsegmentation
+        cliNodes = []
+        for noduleId, seeds in self.getSeedGroups().iteritems():
+            nodeName = "{0}{1}_n{2}".format(self.__PREFIX_INPUTVOLUME__, self.currentVolume.GetID(), noduleId)
+            inputNode = self.__getOrCreateHiddenNode__("vtkMRMLScalarVolumeNode", nodeName + "_input")
+            outputNode = self.__getOrCreateHiddenNode__("vtkMRMLScalarVolumeNode", nodeName)
+            seedsNode = self.__getOrCreateHiddenNode__("vtkMRMLMarkupsFiducialNode", nodeName + "_seeds")
+            seedsNode.RemoveAllMarkups()
+            for coords in seeds:
+                seedsNode.AddFiducial(*coords)
+            offset = self.__cropVolumeAroundSeeds__(seeds, maximumRadius, inputNode)
+
+            parameters = {}
+            parameters["inputImage"] = inputNode
+            parameters["outputLevelSet"] = outputNode
+            parameters["seedsFiducials"] = seedsNode
+            parameters["maximumRadius"] = maximumRadius
+            parameters["fullSizeOutput"] = True
+            # A new CLI node for every nodule, so that all of them run at the same time
+            result = slicer.cli.run(module, None, parameters)
+            self.multiNoduleSegmentations[result.GetID()] = (noduleId, outputNode, offset)
+            observer = result.AddObserver('ModifiedEvent', self.__onMultiNoduleSegmentationCLIStateUpdated__)
+            self.__multiNoduleSegmentationObservers__.append((result, observer))
+            cliNodes.append(result)
+        return cliNodes
+
     def updateModels(self, newThreshold):
         """ Modify the threshold for the current volume (update the models)
         :param newThreshold: new threshold (all the voxels below this threshold will be considered nodule)
         """
+        if self.levelSetThreshold is None or self.getNoduleIds(self.currentLabelmap) is not None:
+            # There is no single nodule segmentation for the current labelmap
+            return
         print("DEBUG: updating models with threshold={0}....".format(newThreshold))
-        self.thresholdFilter.ThresholdByUpper(newThreshold)
-        self.thresholdFilter.Update()
+        # Just the evolved region of the level set is thresholded and meshed
+        self.levelSetThreshold.fillLabelmap(newThreshold, self.currentLabelmapArray)
+        self.currentLabelmap.GetImageData().Modified()
         self.marchingCubesFilter.SetValue(0, newThreshold)
         self.marchingCubesFilter.Update()
-        self.currentLabelmapArray = slicer.util.array(self.currentLabelmap.GetName())
         # Invalidate distances (the nodule is going to change)
         self.__invalidateDistances__()
         # Refresh 3D view
@@ -1453,47 +1942,38 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
     def getCurrentDistanceMap(self):
         """ Calculate the distance map to the centroid for the current labelmap volume.
         To that end, we have to calculate first the centroid.
+        The distance map is only calculated in the bounding box of the biggest sphere allowed (MAX_TUMOR_RADIUS),
+        and it is the exact euclidean distance (the growth of a fast marching filter would be constant).
         Please note the results could be cached
         :return:
         """
         if self.currentDistanceMap is None:
-            centroid = Util.centroid(self.currentLabelmapArray)
-            # Calculate the distance map for the specified origin
-            # Get the dimensions of the volume in ZYX coords
-            dims = Util.vtk_numpy_coordinate(self.currentVolume.GetImageData().GetDimensions())
-            # Speed map (all ones because the growth will be constant).
-            # The dimensions are reversed because we want the format in ZYX coordinates
-            input = np.ones(dims, np.int32)
-            sitkImage = sitk.GetImageFromArray(input)
-            sitkImage.SetSpacing(self.currentVolume.GetSpacing())
-            fastMarchingFilter = sitk.FastMarchingImageFilter()
-            fastMarchingFilter.SetStoppingValue(self.MAX_TUMOR_RADIUS)
-            # Reverse the coordinate of the centroid
-            seeds = [Util.numpy_itk_coordinate(centroid)]
-            fastMarchingFilter.SetTrialPoints(seeds)
-            output = fastMarchingFilter.Execute(sitkImage)
-            self.currentDistanceMap = sitk.GetArrayFromImage(output)
+            self.currentCentroid = Util.centroid(self.currentLabelmapArray)
+            # Calculate the distance map for the specified origin, just for the bounding box of the biggest sphere.
+            # The offset of the bounding box is in ZYX coords
+            self.currentDistanceMap, self.currentDistanceMapOffset = FeatureExtractionLib.SphereROI.distanceMap(
+                self.currentCentroid, self.MAX_TUMOR_RADIUS, self.currentVolume.GetSpacing(),
+                self.currentLabelmapArray.shape)
 
     def getSphereLabelMapArray(self, radius):
         """ Get a labelmap numpy array that contains a sphere centered in the nodule centroid, with radius "radius" and that
         EXCLUDES the nodule itself.
+        The array is a crop of the volume (bounding box of the distance map), so its offset in the volume is returned too.
         If the results are not cached, this method creates the volume and calculates the labelmap
         :param radius: radius of the sphere
-        :return: labelmap array for a sphere of this radius
+        :return: tuple (labelmap array for a sphere of this radius, offset of the array in the volume (ZYX))
         """
         # If the shere was already calculated, return the results
         if self.spheresLabelmaps.has_key(radius):
             return self.spheresLabelmaps[radius]
-        # Init with the current segmented nodule labelmap
-        # Mask with the voxels that are inside the radius of the sphere
-        array = self.currentDistanceMap <= radius
-        # Exclude the nodule
-        array[self.currentLabelmapArray == 1] = 0
+        # Mask with the voxels that are inside the radius of the sphere, excluding the nodule
+        array = FeatureExtractionLib.SphereROI.sphereLabelmap(self.currentDistanceMap, self.currentDistanceMapOffset,
+                                                              radius, self.currentLabelmapArray, labelId=1)
         # Cache the result
-        self.spheresLabelmaps[radius] = array
+        self.spheresLabelmaps[radius] = (array, self.currentDistanceMapOffset)
         # Create a mrml labelmap node for sphere visualization purposes (this step could be skipped)
-        self.__createLabelmapSphereVolume__(array, radius)
-        return array
+        self.__createLabelmapSphereVolume__(array, self.currentDistanceMapOffset, radius)
+        return self.spheresLabelmaps[radius]
 
     def getSphereLabelMap(self, radius):
         if SlicerUtil.IsDevelopment:
@@ -1526,26 +2006,31 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
         It also creates a numpy array associated with the labelmap (currentLabelmapArray)
         """
         print("DEBUG: processing results from process Nodule CLI...")
-        if self.thresholdFilter is None:
-            # Create vtk filters
-            self.thresholdFilter = vtk.vtkImageThreshold()
-        # The cliOutputScalarNode is new, so we have to set all the values again
-        self.thresholdFilter.SetInputData(self.cliOutputScalarNode.GetImageData())
-        self.thresholdFilter.SetReplaceOut(True)
-        self.thresholdFilter.SetOutValue(0)  # Value of the background
-        self.thresholdFilter.SetInValue(1)  # Value of the segmented nodule
+        # The cliOutputScalarNode is new, so the evolved region and its sorted values are calculated again
+        self.levelSetThreshold = FeatureExtractionLib.LevelSetThreshold(
+            slicer.util.array(self.cliOutputScalarNode.GetName()), self.cliOutputScalarNode.GetSpacing(),
+            self.cliOutputOffset, slicer.util.array(self.currentVolume.GetName()).shape)
 
         labelmapName = self.currentVolume.GetName() + self.__SUFFIX__SEGMENTED_LABELMAP
         self.currentLabelmap = slicer.util.getNode(labelmapName)
         if self.currentLabelmap is None:
-            # Create a labelmap with the same dimensions that the ct volume
-            self.currentLabelmap = SlicerUtil.getLabelmapFromScalar(self.cliOutputScalarNode, labelmapName)
-            self.currentLabelmap.SetImageDataConnection(self.thresholdFilter.GetOutputPort())
+            # Create a labelmap with the same dimensions that the ct volume (the CLI output is just a crop)
+            self.currentLabelmap = SlicerUtil.getLabelmapFromScalar(self.currentVolume, labelmapName)
+        # The labelmap is updated in place by levelSetThreshold (just the evolved region of the crop is pasted)
+        self.currentLabelmapArray = slicer.util.array(self.currentLabelmap.GetName())
 
-        if self.marchingCubesFilter is None:
+        if self.levelSetVOIFilter is None:
+            # Create vtk filters. The crop is placed in the IJK coordinates of the whole volume, so that the model
+            # has always the same transformation as the labelmap
+            self.levelSetTranslationFilter = vtk.vtkImageChangeInformation()
+            self.levelSetVOIFilter = vtk.vtkExtractVOI()
+            self.levelSetVOIFilter.SetInputConnection(self.levelSetTranslationFilter.GetOutputPort())
             self.marchingCubesFilter = vtk.vtkMarchingCubes()
+            self.marchingCubesFilter.SetInputConnection(self.levelSetVOIFilter.GetOutputPort())
         # The cliOutputScalarNode is new, so we have to set all the values again
-        self.marchingCubesFilter.SetInputData(self.cliOutputScalarNode.GetImageData())
+        self.levelSetTranslationFilter.SetInputData(self.cliOutputScalarNode.GetImageData())
+        self.levelSetTranslationFilter.SetExtentTranslation(list(self.cliOutputOffset[::-1]))
+        self.levelSetVOIFilter.SetVOI(self.levelSetThreshold.extent)
         self.marchingCubesFilter.SetValue(0, self.defaultThreshold)
 
         newNode = self.currentModelNode is None
@@ -1577,22 +2062,134 @@ class CIP_LesionModelLogic(ScriptedLoadableModuleLogic):
             threeDView = threeDWidget.threeDView()
             threeDView.resetFocalPoint()
 
+    def __onMultiNoduleSegmentationCLIStateUpdated__(self, caller, event):
+        """ Event triggered when the status of one of the CLIs of callMultiNoduleSegmentationCLI changes
+        """
+        if caller.GetID() not in self.multiNoduleSegmentations \
+                or caller.GetID() in self.__finishedMultiNoduleSegmentations__:
+            return
+        if caller.GetStatus() == caller.Completed:
+            self.__finishedMultiNoduleSegmentations__.add(caller.GetID())
+        elif caller.GetStatus() in (caller.CompletedWithErrors, caller.Cancelled):
+            # The failure is reported when all the CLIs have finished
+            self.__finishedMultiNoduleSegmentations__.add(caller.GetID())
+            self.__failedMultiNoduleSegmentations__.append(self.multiNoduleSegmentations[caller.GetID()][0])
+        else:
+            return
+        if len(self.__finishedMultiNoduleSegmentations__) == len(self.multiNoduleSegmentations):
+            self.__processMultiNoduleSegmentationCLIResults__()
+
+    def __processMultiNoduleSegmentationCLIResults__(self):
+        """ All the CLIs of callMultiNoduleSegmentationCLI have finished.
+        Paste the nodules in a labelmap of the whole volume (one label per nodule) that becomes the current labelmap,
+        unless the CLI failed for some nodule
+        """
+        # The CLI nodes are not needed anymore
+        for cliNode, observer in self.__multiNoduleSegmentationObservers__:
+            cliNode.RemoveObserver(observer)
+            slicer.mrmlScene.RemoveNode(cliNode)
+        self.__multiNoduleSegmentationObservers__ = []
+
+        if len(self.__failedMultiNoduleSegmentations__) > 0:
+            if self.onMultiNoduleSegmentationFinishedCallback is not None:
+                self.onMultiNoduleSegmentationFinishedCallback(
+                    "The Nodule Segmentation CLI failed for the nodules {0}".format(
+                        ", ".join(str(n) for n in sorted(self.__failedMultiNoduleSegmentations__))))
+            return
+
+        labelmapName = self.currentVolume.GetName() + "_nodules" + self.__SUFFIX__SEGMENTED_LABELMAP
+        labelmapNode = slicer.util.getNode(labelmapName)
+        if labelmapNode is None:
+            labelmapNode = SlicerUtil.getLabelmapFromScalar(self.currentVolume, labelmapName)
+        labelmapArray = slicer.util.array(labelmapNode.GetName())
+        labelmapArray[:] = 0
+        noduleIds = []
+        for noduleId, outputNode, offset in self.multiNoduleSegmentations.itervalues():
+            # Just the evolved region of each crop is pasted
+            levelSetThreshold = FeatureExtractionLib.LevelSetThreshold(slicer.util.array(outputNode.GetName()),
+                                            outputNode.GetSpacing(), offset, labelmapArray.shape)
+            mask, slices = levelSetThreshold.getNoduleMask(self.defaultThreshold)
+            labelmapArray[slices][mask] = noduleId
+            noduleIds.append(noduleId)
+        labelmapNode.GetImageData().Modified()
+        labelmapNode.SetAttribute(self.NODULE_IDS_ATTRIBUTE, ",".join(str(n) for n in noduleIds))
+
+        self.currentLabelmap = labelmapNode
+        self.currentLabelmapArray = labelmapArray
+        # The threshold of the last single nodule segmentation does not apply to the new labelmap (it would paint
+        # that nodule with the label 1)
+        self.levelSetThreshold = None
+        self.__invalidateDistances__()
+        if self.onMultiNoduleSegmentationFinishedCallback is not None:
+            self.onMultiNoduleSegmentationFinishedCallback(None)
+
+    def __getOrCreateHiddenNode__(self, className, nodeName):
+        """ Get a node by name, or create it if it does not exist. The node is not displayed in the selectors
+        :param className: class of the node (ex: vtkMRMLScalarVolumeNode)
+        :param nodeName: name of the node (it should start with __PREFIX_INPUTVOLUME__)
+        :return: node
+        """
+        node = slicer.util.getNode(nodeName)
+        if node is None:
+            node = slicer.mrmlScene.CreateNodeByClass(className)
+            node.SetName(nodeName)
+            node.SetHideFromEditors(True)
+            slicer.mrmlScene.AddNode(node)
+        return node
+
+    def __cropVolumeAroundSeeds__(self, seeds, maximumRadius, cropNode):
+        """ Crop the current volume around some seeds (bounding box of all the seeds plus the maximum radius
+        of the nodule and a small margin) to send just that region to the CLI.
+        The crop keeps the same RAS position as in the whole volume
+        :param seeds: list of RAS coordinates of the seeds
+        :param maximumRadius: maximum radius of the nodule in mm
+        :param cropNode: scalar node where the crop is stored
+        :return: offset (ZYX) of the crop in the volume
+        """
+        # Seeds and margins in ZYX order
+        seeds = np.array([Util.ras_to_ijk(self.currentVolume, coords) for coords in seeds])[:, ::-1]
+        margin = np.ceil(maximumRadius / np.array(self.currentVolume.GetSpacing()[::-1])).astype(np.int) + 5
+        volumeArray = slicer.util.array(self.currentVolume.GetName())
+        lower = np.maximum(seeds.min(axis=0) - margin, 0)
+        upper = np.minimum(seeds.max(axis=0) + margin + 1, volumeArray.shape)
+
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions([int(i) for i in (upper - lower)[::-1]])
+        imageData.AllocateScalars(self.currentVolume.GetImageData().GetScalarType(), 1)
+        # Same orientation and spacing as the volume, with the origin in the first voxel of the crop
+        ijkToRAS = vtk.vtkMatrix4x4()
+        self.currentVolume.GetIJKToRASMatrix(ijkToRAS)
+        origin = Util.ijk_to_ras(self.currentVolume, lower[::-1])
+        for i in range(3):
+            ijkToRAS.SetElement(i, 3, origin[i])
+        cropNode.SetIJKToRASMatrix(ijkToRAS)
+        cropNode.SetAndObserveImageData(imageData)
+        slicer.util.array(cropNode.GetName())[:] = \
+            volumeArray[FeatureExtractionLib.SphereROI.cropSlices(lower, upper - lower)]
+        imageData.Modified()
+        return tuple(int(i) for i in lower)
+
     def __invalidateDistances__(self):
         """ Invalidate the current nodule centroid, distance maps, etc.
         """
         self.currentDistanceMap = None
+        self.currentDistanceMapOffset = None
         self.currentCentroid = None
         self.spheresLabelmaps = dict()
+        # The analyzed ROIs are not valid anymore
+        self.roiContextCache.clear()
 
-    def __createLabelmapSphereVolume__(self, array, radius):
+    def __createLabelmapSphereVolume__(self, array, offset, radius):
         """ Create a Labelmap volume cloning the current global labelmap with the ROI sphere for visualization purposes
-        :param array: labelmap array
+        :param array: labelmap array (crop of the volume)
+        :param offset: offset of the array in the volume (ZYX)
         :param radius: radius of the sphere (used for naming the volume)
         :return: volume created
         """
         node = SlicerUtil.cloneVolume(self.currentLabelmap, "{0}_r{1}".format(self.currentVolume.GetName(), radius))
         arr = slicer.util.array(node.GetName())
-        arr[:] = array
+        arr[:] = 0
+        arr[FeatureExtractionLib.SphereROI.cropSlices(offset, array.shape)] = array
         node.GetImageData().Modified()
         # Set a different colormap for visualization purposes
         colorNode = slicer.util.getFirstNodeByClassByName("vtkMRMLColorTableNode", "HotToColdRainbow")
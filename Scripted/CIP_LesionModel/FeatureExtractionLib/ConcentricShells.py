@@ -0,0 +1,327 @@
+import numpy as np
+import collections
+import time
+
+from FeatureProfiler import FeatureProfiler, KIND_PREPROCESSING, KIND_FEATURE
+from FirstOrderStatistics import FirstOrderStatistics
+from MorphologyStatistics import MorphologyStatistics
+from ParenchymalVolume import ParenchymalVolume
+from SphereROI import SphereROI
+from TextureGLCM import TextureGLCM
+
+class ConcentricShells:
+    """ Incremental analysis of several spheres with the same center (ex: 15, 20 and 25 mm around a nodule).
+    The neighborhood is partitioned just once into nested shells (the smallest sphere, the ring between the first
+    and the second radius, etc.) and the additive statistics of each shell are accumulated, so that the statistics of
+    each sphere are the sum of the shells that it contains:
+        - Histogram of intensities and number of voxels of each emphysema type: every voxel is counted in its shell
+        - Exposed faces (surface): a face of a voxel of shell s is exposed in the spheres from s until the sphere
+          that contains the neighbor voxel (all the spheres when the neighbor is never in them or its intensity is 0)
+        - Co-occurrences (GLCM): every pair of neighbor voxels is counted in the outer shell of both voxels
+    Features obtained from the accumulated statistics (see getIncrementalFeatureKeys):
+        - All the First-Order Statistics (they only depend on the histogram of the sphere)
+        - Volume mm^3, Volume cc, Surface Area mm^2 and the features that only depend on them (Morphology and Shape)
+        - All the GLCM features, also with a GrayLevelQuantization (the gray levels of a sphere only depend on its
+          intensities, so the pairs of intensities are accumulated and then mapped to the gray levels of each sphere)
+        - Parenchymal Volume
+    The rest of the features (diameters, GLRL, geometrical measures, Renyi dimensions) are not sums over voxels, faces
+    or pairs (ex: a run crossing the boundary between two shells is a single run in the outer sphere but two shorter
+    runs in the inner one), so they must be recalculated for every sphere with FeatureExtractionEngine.
+    All the arrays and coordinates are in numpy (ZYX) order, while the spacing is in ITK/VTK (XYZ) order
+    """
+    def __init__(self, volumeArray, distanceMap, offset, radii, labelmapArray, spacing, labelId=None,
+                 parenchymaLabelmapArray=None, parenchymaLabelCounts=None, quantization=None):
+        """
+        :param volumeArray: whole intensities volume array
+        :param distanceMap: distances in the bounding box of the biggest sphere (see SphereROI.distanceMap)
+        :param offset: offset (ZYX) of the bounding box in the volume
+        :param radii: radii in mm of the spheres to analyze
+        :param labelmapArray: whole labelmap array with the voxels that will be excluded from the spheres (ex: nodule)
+        :param spacing: spacing of the volume (XYZ)
+        :param labelId: label of the excluded voxels. When None, all the voxels different from 0 are excluded
+        :param parenchymaLabelmapArray: emphysema labelmap for the whole volume (needed for "Parenchymal Volume")
+        :param parenchymaLabelCounts: number of voxels of every label of parenchymaLabelmapArray (see
+            ParenchymalVolume.getLabelCounts). When None, it is calculated when needed
+        :param quantization: GrayLevelQuantization of the intensities for the GLCM features (None for no quantization)
+        """
+        self.radii = sorted(set(radii))
+        self.spacing = spacing
+        self.parenchymaLabelmapArray = parenchymaLabelmapArray
+        self.parenchymaLabelCounts = parenchymaLabelCounts
+        self.quantization = quantization
+        self.cubicMMPerVoxel = reduce(lambda x, y: x * y, spacing)
+        self.ccPerCubicMM = 0.001
+
+        crop = SphereROI.cropSlices(offset, distanceMap.shape)
+        # Index of the shell of each voxel (0 for the smallest sphere). The radii are compared in the same precision
+        # as the distance map, so that every shell matches exactly SphereROI.sphereLabelmap
+        shells = np.searchsorted(np.array(self.radii, np.float32), distanceMap)
+        labelmapCrop = labelmapArray[crop]
+        if labelId is None:
+            shells[labelmapCrop != 0] = len(self.radii)
+        else:
+            shells[labelmapCrop == labelId] = len(self.radii)
+        self.__insideMask__ = shells < len(self.radii)
+        self.__shells__ = shells[self.__insideMask__]
+        self.__shellsMap__ = shells
+        self.__crop__ = crop
+        self.__volumeCrop__ = volumeArray[crop]
+
+        # Accumulated histogram of intensities for each sphere (one row per radius)
+        values = self.__volumeCrop__[self.__insideMask__].astype(np.int64)
+        if values.size == 0:
+            self.minValue = 0
+            self.histograms = np.zeros((len(self.radii), 1), np.int64)
+        else:
+            self.minValue = values.min()
+            numLevels = values.max() - self.minValue + 1
+            self.histograms = np.bincount(self.__shells__ * numLevels + (values - self.minValue),
+                                          minlength=len(self.radii) * numLevels).reshape(len(self.radii), numLevels)
+            self.histograms = np.cumsum(self.histograms, axis=0)
+
+        # Accumulated number of voxels of each label of the parenchyma labelmap for each sphere (calculated on demand)
+        self.__parenchymaHistograms__ = None
+        # Accumulated surface and co-occurrences for each sphere (calculated on demand)
+        self.__surfaceAreas__ = None
+        self.__cooccurrenceLevels__ = None
+        self.__cooccurrenceKeys__ = None
+        self.__cooccurrences__ = None
+
+    # Morphology features that only depend on the volume and the surface of the sphere
+    morphologyFeatureKeys = ("Volume mm^3", "Volume cc", "Surface Area mm^2", "Surface:Volume Ratio", "Compactness 1",
+                             "Compactness 2", "Spherical Disproportion", "Sphericity")
+
+    @staticmethod
+    def getIncrementalFeatureKeys():
+        """ Features that are calculated from the accumulated statistics of the shells
+        :return: set of feature keys
+        """
+        keys = set(FirstOrderStatistics.registry.features.keys())
+        keys.update(ConcentricShells.morphologyFeatureKeys)
+        keys.update(TextureGLCM.registry.features.keys())
+        keys.update(ParenchymalVolume.getAllEmphysemaDescriptions())
+        return keys
+
+    def getSphereHistogram(self, radius):
+        """ Histogram of intensities of a sphere
+        :param radius: radius of the sphere (one of the radii)
+        :return: tuple (bins from the minimum to the maximum intensity; array with the gray levels of the sphere)
+        """
+        histogram = self.histograms[self.radii.index(radius)]
+        levels = np.nonzero(histogram)[0]
+        if levels.size == 0:
+            return (np.array([], np.int64), np.array([], np.int64))
+        return (histogram[levels[0]:levels[-1] + 1], levels + self.minValue)
+
+    def getParenchymaVoxels(self, code):
+        """ Number of voxels of an emphysema type in each sphere and in the whole volume
+        :param code: numeric code of the emphysema type
+        :return: tuple (array with the accumulated number of voxels for each radius; total number of voxels)
+        """
+        if self.__parenchymaHistograms__ is None:
+            # All the labels of all the shells are counted at once
+            parenchyma = self.parenchymaLabelmapArray[self.__crop__][self.__insideMask__].astype(np.int64)
+            # Just the labels of the emphysema types are counted (there can be negative labels or big codes)
+            numLabels = max(ParenchymalVolume.getAllEmphysemaTypes().values()) + 1
+            valid = (parenchyma >= 0) & (parenchyma < numLabels)
+            histograms = np.bincount(self.__shells__[valid] * numLabels + parenchyma[valid],
+                                     minlength=len(self.radii) * numLabels)
+            self.__parenchymaHistograms__ = np.cumsum(histograms.reshape(len(self.radii), numLabels), axis=0)
+            if self.parenchymaLabelCounts is None:
+                self.parenchymaLabelCounts = ParenchymalVolume.getLabelCounts(self.parenchymaLabelmapArray)
+        if code < self.__parenchymaHistograms__.shape[1]:
+            sphereVoxels = self.__parenchymaHistograms__[:, code]
+        else:
+            sphereVoxels = np.zeros(len(self.radii), np.int64)
+        return (sphereVoxels, ParenchymalVolume.countLabel(self.parenchymaLabelCounts, code))
+
+    def getSurfaceAreas(self):
+        """ Surface area of every sphere, with the same criterion as MorphologyStatistics.surfaceArea (a face of a
+        voxel of the sphere is exposed when the neighbor voxel is out of the sphere or its intensity is 0)
+        :return: array with the surface area in mm^2 for each radius
+        """
+        if self.__surfaceAreas__ is None:
+            numRadii = len(self.radii)
+            # The voxels out of the crop are not in any sphere
+            shells = np.pad(self.__shellsMap__, 1, "constant", constant_values=numRadii)
+            # First sphere where every voxel hides the faces of its neighbors
+            hidingShells = np.pad(np.where(self.__volumeCrop__ != 0, self.__shellsMap__, numRadii), 1, "constant",
+                                  constant_values=numRadii)
+            exposedFaces = []
+            for axis in xrange(3):
+                lower = [slice(None)] * 3
+                upper = [slice(None)] * 3
+                lower[axis] = slice(None, -1)
+                upper[axis] = slice(1, None)
+                faces = np.zeros(numRadii + 1, np.int64)
+                for voxels, neighbors in ((tuple(lower), tuple(upper)), (tuple(upper), tuple(lower))):
+                    # The face is exposed from the shell of the voxel until the shell that hides it
+                    start = shells[voxels]
+                    end = hidingShells[neighbors]
+                    exposed = start < end
+                    faces += np.bincount(start[exposed], minlength=numRadii + 1)
+                    faces -= np.bincount(end[exposed], minlength=numRadii + 1)
+                exposedFaces.append(np.cumsum(faces)[:numRadii])
+            x, y, z = self.spacing
+            fxy, fyz, fxz = exposedFaces
+            self.__surfaceAreas__ = (fxz * (x * z)) + (fyz * (y * z)) + (fxy * (x * y))
+        return self.__surfaceAreas__
+
+    def getSphereGLCM(self, radius):
+        """ GLCM matrices of a sphere, as calculated by TextureGLCM for the same sphere
+        :param radius: radius of the sphere (one of the radii)
+        :return: tuple (gray levels of the sphere; GLCM matrices (Ng x Ng x 1 x 26))
+        """
+        if self.__cooccurrences__ is None:
+            self.__accumulateCooccurrences__()
+        bins, grayLevels = self.getSphereHistogram(radius)
+        if self.quantization is None:
+            sphereGrayLevels = grayLevels
+        else:
+            # The gray levels depend just on the range of intensities of the sphere, so the intensities that are
+            # present are enough to quantize all the voxels
+            levelIndexes, sphereGrayLevels = self.quantization.quantize(grayLevels)
+            levelIndexes = levelIndexes - 1
+        numGrayLevels = sphereGrayLevels.size
+        numDirections = len(TextureGLCM.angles)
+        counts = self.__cooccurrences__[self.radii.index(radius)]
+        pairs = np.nonzero(counts)[0]
+        # Decode the direction and the intensities of every pair
+        numLevels = self.__cooccurrenceLevels__.size
+        directions, intensityPairs = np.divmod(self.__cooccurrenceKeys__[pairs], numLevels * numLevels)
+        i = np.searchsorted(grayLevels, self.__cooccurrenceLevels__[intensityPairs // numLevels])
+        j = np.searchsorted(grayLevels, self.__cooccurrenceLevels__[intensityPairs % numLevels])
+        if self.quantization is not None:
+            i = levelIndexes[i]
+            j = levelIndexes[j]
+        # Same precision as TextureGLCM.glcmMatrix
+        dtype = np.float32 if bins.sum() < 2 ** 24 else np.float64
+        P_glcm = np.bincount((i * numGrayLevels + j) * numDirections + directions, weights=counts[pairs],
+                             minlength=numGrayLevels * numGrayLevels * numDirections)
+        return (sphereGrayLevels, P_glcm.astype(dtype).reshape(numGrayLevels, numGrayLevels, 1, numDirections))
+
+    def __accumulateCooccurrences__(self):
+        """ Number of pairs of neighbor voxels of each direction and pair of intensities in every sphere.
+        Just the combinations that are present in the biggest sphere are kept (in __cooccurrenceKeys__)
+        """
+        numRadii = len(self.radii)
+        levels = np.unique(self.__volumeCrop__[self.__insideMask__])
+        numLevels = levels.size
+        levelIndexes = np.zeros(self.__volumeCrop__.shape, np.int64)
+        levelIndexes[self.__insideMask__] = np.searchsorted(levels, self.__volumeCrop__[self.__insideMask__])
+        shape = self.__volumeCrop__.shape
+        keys = []
+        pairShells = []
+        for direction, offset in enumerate(TextureGLCM.angles):
+            # Same pairs as TextureGLCM.calculate_glcm
+            iSlices = tuple(slice(max(0, -o), n - max(0, o)) for o, n in zip(offset, shape))
+            jSlices = tuple(slice(max(0, o), n - max(0, -o)) for o, n in zip(offset, shape))
+            validPairs = self.__insideMask__[iSlices] & self.__insideMask__[jSlices]
+            keys.append((direction * numLevels + levelIndexes[iSlices][validPairs]) * numLevels +
+                        levelIndexes[jSlices][validPairs])
+            # The pair is in the spheres that contain both voxels
+            pairShells.append(np.maximum(self.__shellsMap__[iSlices][validPairs],
+                                         self.__shellsMap__[jSlices][validPairs]))
+        keys, pairIndexes = np.unique(np.concatenate(keys), return_inverse=True)
+        counts = np.bincount(np.concatenate(pairShells) * keys.size + pairIndexes, minlength=numRadii * keys.size)
+        self.__cooccurrenceLevels__ = levels
+        self.__cooccurrenceKeys__ = keys
+        self.__cooccurrences__ = np.cumsum(counts.reshape(numRadii, keys.size), axis=0)
+
+    def EvaluateFeatures(self, radius, featureKeys, printTiming=False, checkStopProcessFunction=None, profiler=None):
+        """ Evaluate the incremental features for one of the spheres
+        :param radius: radius of the sphere (one of the radii)
+        :param featureKeys: features to analyze. The features that are not incremental are ignored
+        :param printTiming: calculate the time elapsed for each feature
+        :param checkStopProcessFunction: function that raises StopIteration if the process must be stopped
+        :param profiler: FeatureProfiler where every feature calculated is recorded (optional)
+        :return:
+            If printTiming==False: Dictionary of Feature-Value
+            else: tuple with 2 dictionaries (1 of Feature-Value and another one with Feature-Timing)
+        """
+        if profiler is None:
+            profiler = FeatureProfiler(enabled=False)
+        results = collections.OrderedDict()
+        timings = collections.OrderedDict()
+        with profiler.measure("Concentric Shells", "Sphere histogram", KIND_PREPROCESSING):
+            bins, grayLevels = self.getSphereHistogram(radius)
+
+        firstOrderKeys = set(featureKeys).intersection(FirstOrderStatistics.registry.features.keys())
+        if len(firstOrderKeys) > 0:
+            if grayLevels.size == 0:
+                # Nothing to analyze
+                for key in firstOrderKeys:
+                    results[key] = 0
+                    timings[key] = 0
+            else:
+                # The statistics are calculated from the histogram, without rebuilding the intensities of the sphere
+                firstOrderStatistics = FirstOrderStatistics(None, bins, grayLevels.size, firstOrderKeys,
+                                                            histogram=(grayLevels, bins[grayLevels - grayLevels[0]]))
+                r = firstOrderStatistics.EvaluateFeatures(True, checkStopProcessFunction, profiler)
+                results.update(r[0])
+                timings.update(r[1])
+
+        morphologyKeys = set(featureKeys).intersection(self.morphologyFeatureKeys)
+        if len(morphologyKeys) > 0:
+            if grayLevels.size == 0:
+                # Nothing to analyze
+                for key in morphologyKeys:
+                    results[key] = 0
+                    timings[key] = 0
+            else:
+                # Volume and surface of the sphere, that are enough for the rest of the features
+                numVoxels = bins.sum()
+                values = {"Volume mm^3": numVoxels * self.cubicMMPerVoxel,
+                          "Volume cc": numVoxels * self.cubicMMPerVoxel * self.ccPerCubicMM}
+                morphologyStatistics = MorphologyStatistics(self.spacing, None, None, None, morphologyKeys)
+                for key in self.morphologyFeatureKeys:
+                    if key not in morphologyKeys:
+                        continue
+                    t1 = time.time()
+                    with profiler.measure("Morphology and Shape", key, KIND_FEATURE):
+                        if key not in values and "Surface Area mm^2" not in values:
+                            values["Surface Area mm^2"] = self.getSurfaceAreas()[self.radii.index(radius)]
+                        if key not in values:
+                            descriptor = MorphologyStatistics.registry.features[key]
+                            values[key] = descriptor.function(morphologyStatistics,
+                                                              *[values[d] for d in descriptor.dependencies])
+                    results[key] = values[key]
+                    timings[key] = time.time() - t1
+
+        glcmKeys = set(featureKeys).intersection(TextureGLCM.registry.features.keys())
+        if len(glcmKeys) > 0:
+            if grayLevels.size == 0:
+                # Nothing to analyze
+                for key in glcmKeys:
+                    results[key] = 0
+                    timings[key] = 0
+            else:
+                t1 = time.time()
+                with profiler.measure("Concentric Shells", "Sphere GLCM", KIND_PREPROCESSING):
+                    textureGrayLevels, P_glcm = self.getSphereGLCM(radius)
+                glcmTime = time.time() - t1
+                textureFeaturesGLCM = TextureGLCM(textureGrayLevels, textureGrayLevels.size, None, None, None, glcmKeys,
+                                                  checkStopProcessFunction, P_glcm=P_glcm)
+                r = textureFeaturesGLCM.EvaluateFeatures(True, checkStopProcessFunction, profiler)
+                results.update(r[0])
+                timings.update(r[1])
+                # The time elapsed accumulating the matrices is added to the first feature
+                timings[r[1].keys()[0]] += glcmTime
+            if checkStopProcessFunction is not None:
+                checkStopProcessFunction()
+
+        types = ParenchymalVolume.getAllEmphysemaTypes()
+        for key in set(featureKeys).intersection(types.keys()):
+            t1 = time.time()
+            with profiler.measure("Parenchymal Volume", key, KIND_FEATURE):
+                sphereVoxels, totalVoxels = self.getParenchymaVoxels(types[key])
+                # Result: SV / PV
+                results[key] = 0 if totalVoxels == 0 else float(sphereVoxels[self.radii.index(radius)]) / totalVoxels
+            timings[key] = time.time() - t1
+            if checkStopProcessFunction is not None:
+                checkStopProcessFunction()
+
+        if not printTiming:
+            return results
+        else:
+            return results, timings
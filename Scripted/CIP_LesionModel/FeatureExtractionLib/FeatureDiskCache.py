@@ -0,0 +1,108 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+
+class FeatureDiskCache:
+    # Version of the format of the keys and the files. Increasing it invalidates the whole cache
+    FORMAT_VERSION = 1
+
+    def __init__(self, directory):
+        """ Persistent cache of the values of the features, stored in a directory with one json file per ROI.
+        A ROI is identified by its content (intensities of its voxels, their positions relative to the bounding box of
+        the ROI and the spacing), so a case that is analyzed again (in another session, from another volume node or
+        from the batch analysis) gets its features from the cache without calculating them.
+        Every value is stored with the signature of the calculation (category, version of its registry and the
+        parameters that affect it, like the quantization), and it is reused only when the signature matches. Increasing
+        the version of a FeatureRegistry invalidates all the cached values of its features
+        :param directory: directory of the cache. It is created if it does not exist
+        """
+        self.directory = directory
+
+    @staticmethod
+    def getROIKey(voxelValues, voxelCoordinates, spacing):
+        """ Key of a ROI, that depends only on its content
+        :param voxelValues: intensities of the voxels of the ROI
+        :param voxelCoordinates: tuple of arrays (ZYX) with the coordinates of the voxels (in the same order as
+            voxelValues, ex: as returned by numpy.where)
+        :param spacing: spacing of the volume
+        :return: hexadecimal sha1 of the ROI
+        """
+        sha = hashlib.sha1()
+        sha.update(str(FeatureDiskCache.FORMAT_VERSION))
+        sha.update(repr(tuple(float(s) for s in spacing)))
+        coordinates = np.asarray(voxelCoordinates, np.int64)
+        if coordinates.size > 0:
+            # The same ROI in a crop of the volume has the same key
+            coordinates = coordinates - coordinates.min(axis=1)[:, None]
+        sha.update(np.ascontiguousarray(coordinates).data)
+        sha.update(np.ascontiguousarray(voxelValues, np.int64).data)
+        return sha.hexdigest()
+
+    def load(self, roiKey, signatures):
+        """ Features of a ROI stored in the cache
+        :param roiKey: key of the ROI (see getROIKey)
+        :param signatures: dictionary Feature-Signature with the features requested
+        :return: dictionary Feature-Value with the features found with the same signature
+        """
+        entries = self.__read__(roiKey)
+        return dict((key, entries[key]["value"]) for key, signature in signatures.iteritems()
+                    if key in entries and entries[key]["signature"] == signature)
+
+    def save(self, roiKey, results, signatures):
+        """ Store the features of a ROI (together with the ones already stored for it).
+        The values that cannot be stored in json (ex: arrays) are ignored. A failure writing the cache is logged,
+        but it does not stop the analysis
+        :param roiKey: key of the ROI (see getROIKey)
+        :param results: dictionary Feature-Value
+        :param signatures: dictionary Feature-Signature. The features without signature are not stored
+        """
+        entries = self.__read__(roiKey)
+        for key, value in results.iteritems():
+            if isinstance(value, np.generic):
+                value = value.item()
+            if key in signatures and isinstance(value, (int, long, float)):
+                entries[key] = {"value": value, "signature": signatures[key]}
+        path = self.__getPath__(roiKey)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # Write a temporary file and rename it, so that other processes never read a half written file
+            fd, tempPath = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            if os.name == "nt" and os.path.exists(path):
+                os.remove(path)
+            os.rename(tempPath, path)
+        except (IOError, OSError) as ex:
+            logging.warning("The features could not be stored in the cache {0}: {1}".format(self.directory, ex))
+
+    def clear(self):
+        """ Remove all the features stored
+        """
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+
+    def __getPath__(self, roiKey):
+        """ Path of the file of a ROI (the files are distributed in subdirectories by the first 2 characters)
+        """
+        return os.path.join(self.directory, roiKey[:2], roiKey + ".json")
+
+    def __read__(self, roiKey):
+        """ Entries stored for a ROI
+        :return: dictionary Feature-{"value": value, "signature": signature}. Empty if the file does not exist or
+            it cannot be read
+        """
+        path = self.__getPath__(roiKey)
+        if not os.path.exists(path):
+            return dict()
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as ex:
+            logging.warning("The cached features in {0} could not be read: {1}".format(path, ex))
+            return dict()
@@ -0,0 +1,421 @@
+import math
+import operator
+import numpy as np
+import collections
+import time
+
+from FirstOrderStatistics import FirstOrderStatistics
+from MorphologyStatistics import MorphologyStatistics
+from TextureGLCM import TextureGLCM
+from TextureGLRL import TextureGLRL
+from GeometricalMeasures import GeometricalMeasures
+from RenyiDimensions import RenyiDimensions
+from ParenchymalVolume import ParenchymalVolume
+from ROIContextCache import ROIContext
+from ProgressReporter import ProgressReporter, AnalysisCancelled
+from FeatureProfiler import FeatureProfiler, KIND_PREPROCESSING, KIND_CATEGORY
+
+class FeatureExtractionEngine:
+    def __init__(self, volumeArray, labelmapROIArray, spacing, featureCategoriesKeys, featureKeys,
+                 labelmapWholeVolumeArray=None, roiContext=None, progressReporter=None, labelmapROIOffset=(0, 0, 0),
+                 profiler=None, quantization=None, diskCache=None, labelmapWholeVolumeCounts=None):
+        """ Calculation of the features for a ROI, without any dependency on Slicer/Qt, so that it can be used
+        from the GUI or from a headless process (ex: batch analysis)
+        :param volumeArray: numpy array of the intensities volume
+        :param labelmapROIArray: numpy array with the labelmap of the area to study (ex: tumor). volumeArray and
+            labelmapROIArray can be crops of the whole volume (see labelmapROIOffset)
+        :param spacing: spacing of the volume
+        :param featureCategoriesKeys: main categories that have some feature that is going to be analyzed
+        :param featureKeys: features that are going to be analyzed
+        :param labelmapWholeVolumeArray: numpy array that represents a labelmap for the whole volume (different
+            from 'labelMapROIArray' that represents just the area of interest that is going to be analyzed)
+        :param roiContext: ROIContext with the preprocessed data and the features already calculated for this ROI.
+            When None, everything is calculated from scratch
+        :param progressReporter: ProgressReporter that is notified before each category is calculated and that
+            stops the process when it is cancelled (see run). When None, nothing is reported
+        :param labelmapROIOffset: position (ZYX) of labelmapROIArray in the whole volume, when it is a crop.
+            It is needed to compare the ROI with labelmapWholeVolumeArray
+        :param profiler: FeatureProfiler where the cost of every preprocessing step, category, intermediate value and
+            feature is recorded. When None, nothing is measured
+        :param quantization: GrayLevelQuantization applied to the intensities before the texture features (GLCM and
+            GLRL) are calculated. When None, every different intensity is a gray level
+        :param diskCache: FeatureDiskCache where the features of the ROI are looked for before calculating them, and
+            where the features calculated are stored. When None, the features are not persisted
+        :param labelmapWholeVolumeCounts: number of voxels of every label of labelmapWholeVolumeArray (see
+            ParenchymalVolume.getLabelCounts), shared by all the ROIs analyzed over the same labelmap. When None, it
+            is calculated if the Parenchymal Volume is analyzed
+        """
+        self.volumeArray = volumeArray
+        self.labelmapROIArray = labelmapROIArray
+        self.spacing = spacing
+        self.featureCategoriesKeys = featureCategoriesKeys
+        self.featureKeys = featureKeys
+        self.labelmapWholeVolumeArray = labelmapWholeVolumeArray
+        self.labelmapWholeVolumeCounts = labelmapWholeVolumeCounts
+        self.roiContext = roiContext if roiContext is not None else ROIContext(None)
+        self.progressReporter = progressReporter if progressReporter is not None else ProgressReporter()
+        self.labelmapROIOffset = labelmapROIOffset
+        self.profiler = profiler if profiler is not None else FeatureProfiler(enabled=False)
+        self.quantization = quantization
+        self.diskCache = diskCache
+        self.__diskCacheKey__ = None
+
+        self.__analysisResultsDict__ = None
+        self.__analysisTimingDict__ = None
+
+    @staticmethod
+    def getAllFeatureClasses():
+        """ Dictionary that contains all MainFeature-ChildFeatures values, including the features registered by plugins
+        in the registry of each feature class
+        :return: OrderedDict of MainFeature-list of ChildFeatures
+        """
+        featureClasses = collections.OrderedDict()
+        for featureClass in (FirstOrderStatistics, MorphologyStatistics, TextureGLCM, TextureGLRL, GeometricalMeasures,
+                             RenyiDimensions):
+            featureClasses[featureClass.registry.category] = featureClass.registry.features.keys()
+        featureClasses["Parenchymal Volume"] = ParenchymalVolume.getAllEmphysemaDescriptions()
+        return featureClasses
+
+    def run(self, resultsStorage, printTiming=False, resultsStorageTiming=None):
+        """ Run all the selected analysis.
+        Every feature is stored (in resultsStorage and in the ROI context) as soon as it is calculated, so if the
+        process is stopped the features already completed are not lost: an AnalysisCancelled exception (a
+        StopIteration) is raised with them and with the features skipped, and a later run with the same ROI context
+        just calculates the missing features
+        :param resultsStorage: dictionary where the Feature-Value results will be stored
+        :param printTiming: calculate (and print) the time elapsed for each feature
+        :param resultsStorageTiming: dictionary where the Feature-Timing results will be stored (if printTiming)
+        :return:
+            If printTiming==False: Dictionary of Feature-Value with all the features analyzed
+            else: tuple with 2 dictionaries (1 of Feature-Value and another one with Feature-Timing)
+        """
+        self.__analysisResultsDict__ = resultsStorage
+        if printTiming:
+            self.__analysisTimingDict__ = resultsStorageTiming
+
+        # The texture features calculated in a previous run for this ROI are not valid if the quantization changed
+        textureQuantization = str(self.quantization) if self.quantization is not None else None
+        if self.roiContext.get("textureQuantization", lambda: textureQuantization) != textureQuantization:
+            self.roiContext.discardResults(TextureGLCM.registry.features.keys() +
+                                           TextureGLRL.registry.features.keys())
+            self.roiContext.set("textureQuantization", textureQuantization)
+
+        # Features already calculated in a previous run for this same ROI (it may have been cancelled)
+        self.__analysisResultsDict__.update(self.roiContext.results)
+        if printTiming:
+            self.__analysisTimingDict__.update(self.roiContext.timings)
+        # Features that still need to be calculated
+        self.__pendingFeatureKeys__ = set(self.featureKeys).difference(self.roiContext.results.keys())
+
+        try:
+            self.__runPendingFeatures__(printTiming)
+            self.updateProgress("Populating Summary Table")
+        except StopIteration as ex:
+            self.__saveToDiskCache__()
+            results = collections.OrderedDict((k, self.__analysisResultsDict__[k]) for k in self.featureKeys
+                                              if k in self.__analysisResultsDict__)
+            timings = collections.OrderedDict()
+            if printTiming:
+                timings.update((k, self.__analysisTimingDict__[k]) for k in results
+                               if k in self.__analysisTimingDict__)
+            raise AnalysisCancelled(str(ex), results, timings, [k for k in self.featureKeys if k not in results])
+        self.__saveToDiskCache__()
+
+        # filter for user-queried features only
+        self.__analysisResultsDict__ = collections.OrderedDict((k, self.__analysisResultsDict__[k]) for k in self.featureKeys)
+
+        if not printTiming:
+            return self.__analysisResultsDict__
+        else:
+            return self.__analysisResultsDict__, self.__analysisTimingDict__
+
+    def __runPendingFeatures__(self, printTiming):
+        """ Preprocess the ROI and calculate the pending features, category by category.
+        StopIteration is raised if the process is stopped
+        :param printTiming: calculate (and print) the time elapsed for each feature
+        """
+        pendingFeatureKeys = self.__pendingFeatureKeys__
+        t1 = time.time()
+        # extract voxel coordinates (ijk) and values from the volume within the ROI defined by the labelmap
+        with self.profiler.measure("Preprocessing", "tumorVoxelsAndCoordinates", KIND_PREPROCESSING):
+            self.targetVoxels, self.targetVoxelsCoordinates = self.roiContext.get("tumorVoxelsAndCoordinates",
+                lambda: self.tumorVoxelsAndCoordinates(self.labelmapROIArray, self.volumeArray))
+        if printTiming:
+            print("Time to calculate tumorVoxelsAndCoordinates: {0} seconds".format(time.time() - t1))
+        self.checkStopProcess()
+
+        # Features stored on disk for a ROI with the same content (ex: in a previous session)
+        if self.diskCache is not None:
+            with self.profiler.measure("Preprocessing", "diskCache", KIND_PREPROCESSING):
+                self.__diskCacheKey__ = self.roiContext.get("diskCacheKey", lambda: self.diskCache.getROIKey(
+                    self.targetVoxels, self.targetVoxelsCoordinates, self.spacing))
+                cachedResults = self.diskCache.load(self.__diskCacheKey__,
+                                                    self.getFeatureSignatures(pendingFeatureKeys))
+            for key, value in cachedResults.iteritems():
+                self.__storeResult__(key, value, 0 if printTiming else None)
+                pendingFeatureKeys.discard(key)
+        if len(pendingFeatureKeys) == 0:
+            # Everything was already calculated
+            return
+
+        # create a padded, rectangular matrix with shape equal to the shape of the tumor
+        t1 = time.time()
+        with self.profiler.measure("Preprocessing", "paddedTumorMatrixAndCoordinates", KIND_PREPROCESSING):
+            self.matrix, self.matrixCoordinates = self.roiContext.get("paddedTumorMatrixAndCoordinates",
+                lambda: self.paddedTumorMatrixAndCoordinates(self.targetVoxels, self.targetVoxelsCoordinates))
+        if printTiming:
+            print("Time to calculate paddedTumorMatrixAndCoordinates: {0} seconds".format(time.time() - t1))
+        self.checkStopProcess()
+
+        # get Histogram data
+        t1 = time.time()
+        with self.profiler.measure("Preprocessing", "histogram", KIND_PREPROCESSING):
+            self.bins, self.grayLevels, self.numGrayLevels = self.roiContext.get("histogram",
+                lambda: self.getHistogramData(self.targetVoxels))
+        if printTiming:
+            print("Time to calculate histogram: {0} seconds".format(time.time() - t1))
+        self.checkStopProcess()
+
+        # Gray levels for the texture features
+        if self.quantization is not None and (self.__hasPendingFeatures__("Texture: GLCM") or
+                                              self.__hasPendingFeatures__("Texture: GLRL")):
+            with self.profiler.measure("Preprocessing", "quantization", KIND_PREPROCESSING):
+                self.textureMatrix, self.textureVoxels, self.textureGrayLevels = self.roiContext.get(
+                    ("quantization", str(self.quantization)), lambda: self.quantizeMatrix(self.matrix,
+                        self.matrixCoordinates, self.targetVoxels, self.quantization))
+            self.textureNumGrayLevels = self.textureGrayLevels.size
+        else:
+            self.textureMatrix, self.textureVoxels = self.matrix, self.targetVoxels
+            self.textureGrayLevels, self.textureNumGrayLevels = self.grayLevels, self.numGrayLevels
+        self.checkStopProcess()
+
+        # First Order Statistics
+        if self.__hasPendingFeatures__("First-Order Statistics"):
+            self.updateProgress("First-Order Statistics")
+            self.firstOrderStatistics = FirstOrderStatistics(self.targetVoxels, self.bins, self.numGrayLevels, pendingFeatureKeys)
+            t1 = time.time()
+            with self.profiler.measure("First-Order Statistics", "First-Order Statistics", KIND_CATEGORY):
+                results = self.firstOrderStatistics.EvaluateFeatures(printTiming, self.checkStopProcess, self.profiler,
+                                                                     self.__storeResult__)
+            self.__storeResults__(results, pendingFeatureKeys)
+            if printTiming:
+                print("Time to calculate First Order Statistics: {0} seconds".format(time.time() - t1))
+
+        # Shape/Size and Morphological Features)
+        if self.__hasPendingFeatures__("Morphology and Shape"):
+            self.updateProgress("Morphology and Shape Statistics")
+            # extend padding by one row/column for all 6 directions
+            if len(self.matrix) == 0:
+                matrixSA = self.matrix
+                matrixSACoordinates = self.matrixCoordinates
+            else:
+                maxDimsSA = tuple(map(operator.add, self.matrix.shape, ([2,2,2])))
+                with self.profiler.measure("Preprocessing", "padMatrix (surface)", KIND_PREPROCESSING):
+                    matrixSA, matrixSACoordinates = self.roiContext.get(("padMatrix", maxDimsSA),
+                        lambda: self.padMatrix(self.matrix, self.matrixCoordinates, maxDimsSA, self.targetVoxels))
+            self.morphologyStatistics = MorphologyStatistics(self.spacing, matrixSA, matrixSACoordinates, self.targetVoxels, pendingFeatureKeys)
+            t1 = time.time()
+            with self.profiler.measure("Morphology and Shape", "Morphology and Shape", KIND_CATEGORY):
+                results = self.morphologyStatistics.EvaluateFeatures(printTiming, self.checkStopProcess, self.profiler,
+                                                                     self.__storeResult__)
+            self.__storeResults__(results, pendingFeatureKeys)
+            if printTiming:
+                print("Time to calculate Morphology and Shape: {0} seconds".format(time.time() - t1))
+
+        # Texture Features(GLCM)
+        if self.__hasPendingFeatures__("Texture: GLCM"):
+            self.updateProgress("GLCM Texture Features")
+            self.textureFeaturesGLCM = TextureGLCM(self.textureGrayLevels, self.textureNumGrayLevels, self.textureMatrix, self.matrixCoordinates, self.textureVoxels, pendingFeatureKeys, self.checkStopProcess)
+            t1 = time.time()
+            with self.profiler.measure("Texture: GLCM", "Texture: GLCM", KIND_CATEGORY):
+                results = self.textureFeaturesGLCM.EvaluateFeatures(printTiming, self.checkStopProcess, self.profiler,
+                                                                    self.__storeResult__)
+            self.__storeResults__(results, pendingFeatureKeys)
+            if printTiming:
+                print("Time to calculate Texture: GLCM: {0} seconds".format(time.time() - t1))
+
+        # Texture Features(GLRL)
+        if self.__hasPendingFeatures__("Texture: GLRL"):
+            self.updateProgress("GLRL Texture Features")
+            self.textureFeaturesGLRL = TextureGLRL(self.textureGrayLevels, self.textureNumGrayLevels, self.textureMatrix, self.matrixCoordinates, self.textureVoxels, pendingFeatureKeys)
+            t1 = time.time()
+            with self.profiler.measure("Texture: GLRL", "Texture: GLRL", KIND_CATEGORY):
+                results = self.textureFeaturesGLRL.EvaluateFeatures(printTiming, self.checkStopProcess, self.profiler,
+                                                                    self.__storeResult__)
+            self.__storeResults__(results, pendingFeatureKeys)
+            if printTiming:
+                print("Time to calculate Texture: GLRL: {0} seconds".format(time.time() - t1))
+
+        # Geometrical Measures
+        if self.__hasPendingFeatures__("Geometrical Measures"):
+            self.updateProgress("Geometrical Measures")
+            self.geometricalMeasures = GeometricalMeasures(self.spacing, self.matrix, self.matrixCoordinates, self.targetVoxels, pendingFeatureKeys)
+            t1 = time.time()
+            with self.profiler.measure("Geometrical Measures", "Geometrical Measures", KIND_CATEGORY):
+                results = self.geometricalMeasures.EvaluateFeatures(printTiming, self.checkStopProcess, self.profiler,
+                                                                    self.__storeResult__)
+            self.__storeResults__(results, pendingFeatureKeys)
+            if printTiming:
+                print("Time to calculate Geometrical Measures: {0} seconds".format(time.time() - t1))
+
+        # Renyi Dimensions
+        if self.__hasPendingFeatures__("Renyi Dimensions"):
+            self.updateProgress("Renyi Dimensions")
+            # extend padding to dimension lengths equal to next power of 2
+            maxDims = tuple( [int(pow(2, math.ceil(np.log2(np.max(self.matrix.shape)))))] * 3 )
+            with self.profiler.measure("Preprocessing", "padMatrix (power of 2)", KIND_PREPROCESSING):
+                matrixPadded, matrixPaddedCoordinates = self.roiContext.get(("padMatrix", maxDims),
+                    lambda: self.padMatrix(self.matrix, self.matrixCoordinates, maxDims, self.targetVoxels))
+            self.renyiDimensions = RenyiDimensions(matrixPadded, matrixPaddedCoordinates, pendingFeatureKeys)
+            t1 = time.time()
+            with self.profiler.measure("Renyi Dimensions", "Renyi Dimensions", KIND_CATEGORY):
+                results = self.renyiDimensions.EvaluateFeatures(printTiming, self.checkStopProcess, self.profiler,
+                                                                self.__storeResult__)
+            self.__storeResults__(results, pendingFeatureKeys)
+            if printTiming:
+                print("Time to calculate Renyi Dimensions: {0} seconds".format(time.time() - t1))
+
+        # Parenchymal Volume
+        if self.__hasPendingFeatures__("Parenchymal Volume"):
+            self.updateProgress("Parenchymal Volume")
+            self.parenchymalVolume = ParenchymalVolume(self.labelmapWholeVolumeArray, self.labelmapROIArray,
+                                                       self.spacing, self.featureKeys, self.labelmapROIOffset,
+                                                       self.labelmapWholeVolumeCounts)
+            t1 = time.time()
+            with self.profiler.measure("Parenchymal Volume", "Parenchymal Volume", KIND_CATEGORY):
+                results = self.parenchymalVolume.EvaluateFeatures(printTiming, self.checkStopProcess, self.profiler,
+                                                                  self.__storeParenchymalResult__)
+            # These results depend on the parenchyma labelmap too, so they are not stored in the ROI context
+            if printTiming:
+                self.__analysisResultsDict__.update(results[0])
+                self.__analysisTimingDict__.update(results[1])
+                print("Time to calculate Parenchymal Volume: {0} seconds".format(time.time() - t1))
+            else:
+                self.__analysisResultsDict__.update(results)
+
+    def getFeatureSignatures(self, featureKeys):
+        """ Signature of the calculation of every feature (category, version of the registry and parameters that
+        change its value), used to validate the values stored in the FeatureDiskCache.
+        The Parenchymal Volume features depend on the parenchyma labelmap, so they have no signature (not cached)
+        :param featureKeys: features
+        :return: dictionary Feature-Signature
+        """
+        signatures = dict()
+        for featureClass in (FirstOrderStatistics, MorphologyStatistics, TextureGLCM, TextureGLRL, GeometricalMeasures,
+                             RenyiDimensions):
+            signature = "{0} v{1}".format(featureClass.registry.category, featureClass.registry.version)
+            if featureClass in (TextureGLCM, TextureGLRL):
+                signature += " quantization:{0}".format(self.quantization if self.quantization is not None else "none")
+            for key in featureClass.registry.features:
+                if key in featureKeys:
+                    signatures[key] = signature
+        return signatures
+
+    def __hasPendingFeatures__(self, category):
+        """ The category was requested and some of its features were not calculated yet
+        :param category: main category
+        """
+        return category in self.featureCategoriesKeys and \
+            len(self.__pendingFeatureKeys__.intersection(self.getAllFeatureClasses()[category])) > 0
+
+    def __saveToDiskCache__(self):
+        """ Store in the FeatureDiskCache (if any) all the features of the ROI calculated so far
+        """
+        if self.diskCache is None or self.__diskCacheKey__ is None:
+            return
+        results = dict((k, self.__analysisResultsDict__[k]) for k in self.featureKeys if k in self.__analysisResultsDict__)
+        self.diskCache.save(self.__diskCacheKey__, results, self.getFeatureSignatures(results.keys()))
+
+    def __storeResults__(self, results, pendingFeatureKeys):
+        """ Add the results of a feature category to the results dictionaries and to the ROI context
+        :param results: results returned by EvaluateFeatures (tuple of 2 dictionaries when the timing is returned)
+        :param pendingFeatureKeys: features requested in this run that were not calculated yet
+        """
+        if isinstance(results, tuple):
+            results, timings = results
+        else:
+            timings = {}
+        for key in pendingFeatureKeys.intersection(results.keys()):
+            self.__storeResult__(key, results[key], timings.get(key))
+
+    def __storeResult__(self, key, value, timing=None):
+        """ Checkpoint of a feature: it is added to the results dictionaries and to the ROI context as soon as it is
+        calculated, so that it is kept if the process is stopped before the category is finished
+        :param key: feature
+        :param value: value of the feature
+        :param timing: seconds elapsed calculating the feature (None if the timing was not calculated)
+        """
+        if key not in self.__pendingFeatureKeys__:
+            return
+        self.__analysisResultsDict__[key] = value
+        self.roiContext.results[key] = value
+        if timing is not None:
+            self.__analysisTimingDict__[key] = timing
+            self.roiContext.timings[key] = timing
+
+    def __storeParenchymalResult__(self, key, value, timing=None):
+        """ Checkpoint of a Parenchymal Volume feature. These results depend on the parenchyma labelmap too, so they
+        are not stored in the ROI context
+        """
+        self.__analysisResultsDict__[key] = value
+        if timing is not None:
+            self.__analysisTimingDict__[key] = timing
+
+    def tumorVoxelsAndCoordinates(self, arrayROI, arrayDataNode):
+        coordinates = np.where(arrayROI != 0) # can define specific label values to target or avoid
+        values = arrayDataNode[coordinates]
+        if values.dtype.kind not in "iu":
+            # The intensities are analyzed as integers. Integer volumes (ex: int16) keep their native type
+            values = values.astype('int64')
+        return(values, coordinates)
+
+    def paddedTumorMatrixAndCoordinates(self, targetVoxels, targetVoxelsCoordinates):
+        if len(targetVoxels) == 0:
+            # Nothing to analyze
+            empty = np.array([])
+            return (empty, (empty, empty, empty))
+
+        ijkMinBounds = np.min(targetVoxelsCoordinates, 1)
+        ijkMaxBounds = np.max(targetVoxelsCoordinates, 1)
+        matrix = np.zeros(ijkMaxBounds - ijkMinBounds + 1)
+        matrixCoordinates = tuple(map(operator.sub, targetVoxelsCoordinates, tuple(ijkMinBounds)))
+        matrix[matrixCoordinates] = targetVoxels
+        return (matrix, matrixCoordinates)
+
+    def getHistogramData(self, voxelArray):
+        # one bin per intensity from the minimum to the maximum (frequencies)
+        minimum = voxelArray.min()
+        bins = np.bincount(np.subtract(voxelArray, minimum, dtype=np.int64))
+        grayLevels = np.nonzero(bins)[0] + np.int64(minimum) # discrete gray levels
+        numGrayLevels = grayLevels.size
+        return (bins, grayLevels, numGrayLevels)
+
+    def quantizeMatrix(self, matrix, matrixCoordinates, voxelArray, quantization):
+        """ Quantize the intensities of the ROI (see GrayLevelQuantization)
+        :return: tuple (matrix with the gray level of every voxel of the ROI and 0 elsewhere; gray level of every voxel
+            of the ROI; all the gray levels)
+        """
+        voxelGrayLevels, grayLevels = quantization.quantize(voxelArray)
+        if len(voxelArray) == 0:
+            return (matrix, voxelGrayLevels, grayLevels)
+        quantizedMatrix = np.zeros(matrix.shape, np.int32)
+        quantizedMatrix[matrixCoordinates] = voxelGrayLevels
+        return (quantizedMatrix, voxelGrayLevels, grayLevels)
+
+    def padMatrix(self, a, matrixCoordinates, dims, voxelArray):
+        # pads matrix 'a' with zeros and resizes 'a' to a cube with dimensions increased to the next greatest power of 2
+        # numpy version 1.7 has np.pad function
+
+        # center coordinates onto padded matrix    # consider padding with NaN or eps = np.spacing(1)
+        pad = tuple(map(operator.div, tuple(map(operator.sub, dims, a.shape)), ([2,2,2])))
+        matrixCoordinatesPadded = tuple(map(operator.add, matrixCoordinates, pad))
+        matrix2 = np.zeros(dims)
+        matrix2[matrixCoordinatesPadded] = voxelArray
+        return (matrix2, matrixCoordinatesPadded)
+
+    def updateProgress(self, nextFeatureString):
+        self.checkStopProcess()
+        self.progressReporter.update(nextFeatureString, len(self.__analysisResultsDict__))
+
+    def checkStopProcess(self):
+        self.progressReporter.checkStopProcess()
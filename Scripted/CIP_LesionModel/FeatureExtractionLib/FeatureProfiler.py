@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import collections
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    # Not available in Windows. The memory is not measured
+    resource = None
+
+# Kinds of steps measured
+KIND_PREPROCESSING = "preprocessing"
+KIND_CATEGORY = "category"
+KIND_INTERMEDIATE = "intermediate"
+KIND_FEATURE = "feature"
+
+# Measure of a step of the analysis:
+#   - category: main category of the feature (ex: "Texture: GLCM") or "Preprocessing"
+#   - name: name of the feature, the intermediate value (ex: "P_glcm") or the preprocessing step
+#   - kind: one of the KIND_ constants
+#   - wallTime: seconds elapsed
+#   - cpuTime: seconds of cpu (user + system) consumed by the whole process while the step was running
+#   - peakMemory: peak resident memory of the process (MB) at the end of the step (None if it cannot be measured)
+#   - peakMemoryIncrease: MB that the peak resident memory of the process grew during the step. It is 0 when the
+#       step did not need more memory than any previous step
+ProfileRecord = collections.namedtuple("ProfileRecord", ["category", "name", "kind", "wallTime", "cpuTime",
+                                                         "peakMemory", "peakMemoryIncrease"])
+
+
+class FeatureProfiler:
+    def __init__(self, enabled=True):
+        """ Structured record of the cost (wall time, cpu time and peak memory) of every step of the feature
+        extraction: preprocessing, categories, intermediate values and features.
+        Unlike the timings returned with printTiming (where the time of the intermediate values is added to the
+        first feature that needs them), every intermediate value is measured on its own.
+        A disabled profiler does not measure anything (it is the default in FeatureExtractionEngine)
+        :param enabled: measure the steps
+        """
+        self.enabled = enabled
+        self.records = []
+
+    @staticmethod
+    def getCPUTime():
+        """ Seconds of cpu (user + system) consumed by the process
+        """
+        t = os.times()
+        return t[0] + t[1]
+
+    @staticmethod
+    def getPeakMemory():
+        """ Peak resident memory of the process in MB (None if it cannot be measured in this platform)
+        """
+        if resource is None:
+            return None
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes in Mac, KB in Linux
+        return maxrss / (1024.0 * 1024.0) if sys.platform == "darwin" else maxrss / 1024.0
+
+    @contextlib.contextmanager
+    def measure(self, category, name, kind):
+        """ Measure the code in a with block. The step is recorded when the block finishes without exceptions
+        :param category: main category of the feature (or "Preprocessing")
+        :param name: name of the step
+        :param kind: one of the KIND_ constants
+        """
+        if not self.enabled:
+            yield
+            return
+        memory = self.getPeakMemory()
+        cpu = self.getCPUTime()
+        t1 = time.time()
+        yield
+        wallTime = time.time() - t1
+        cpuTime = self.getCPUTime() - cpu
+        peakMemory = self.getPeakMemory()
+        self.records.append(ProfileRecord(category, name, kind, wallTime, cpuTime, peakMemory,
+                                          None if memory is None else peakMemory - memory))
+
+    def clear(self):
+        """ Remove all the records
+        """
+        self.records = []
+
+    def getRecords(self, kind=None, category=None):
+        """ Records of some kind and/or category
+        :param kind: one of the KIND_ constants (all the kinds when None)
+        :param category: main category (all the categories when None)
+        :return: list of ProfileRecord
+        """
+        return [r for r in self.records if (kind is None or r.kind == kind)
+                and (category is None or r.category == category)]
+
+    def getSummary(self):
+        """ Aggregate the records of the same step (ex: when several ROIs are profiled with the same profiler)
+        :return: OrderedDict of (category, name, kind)-dictionary with "count", "wallTime" (total), "cpuTime"
+            (total), "minWallTime" and "peakMemoryIncrease" (maximum)
+        """
+        summary = collections.OrderedDict()
+        for r in self.records:
+            key = (r.category, r.name, r.kind)
+            if key not in summary:
+                summary[key] = {"count": 0, "wallTime": 0.0, "cpuTime": 0.0, "minWallTime": r.wallTime,
+                                "peakMemoryIncrease": r.peakMemoryIncrease}
+            s = summary[key]
+            s["count"] += 1
+            s["wallTime"] += r.wallTime
+            s["cpuTime"] += r.cpuTime
+            s["minWallTime"] = min(s["minWallTime"], r.wallTime)
+            if r.peakMemoryIncrease is not None:
+                s["peakMemoryIncrease"] = max(s["peakMemoryIncrease"], r.peakMemoryIncrease)
+        return summary
+
+    def report(self, kinds=(KIND_PREPROCESSING, KIND_CATEGORY, KIND_INTERMEDIATE, KIND_FEATURE)):
+        """ Human readable table with the summary of the records
+        :param kinds: kinds of steps included
+        :return: string
+        """
+        lines = ["{0:<24}{1:<40}{2:<14}{3:>6}{4:>12}{5:>12}{6:>12}".format(
+            "Category", "Name", "Kind", "Count", "Wall (s)", "CPU (s)", "Mem (MB)")]
+        for (category, name, kind), s in self.getSummary().iteritems():
+            if kind in kinds:
+                lines.append("{0:<24}{1:<40}{2:<14}{3:>6}{4:>12.4f}{5:>12.4f}{6:>12}".format(
+                    category, name, kind, s["count"], s["wallTime"], s["cpuTime"],
+                    "-" if s["peakMemoryIncrease"] is None else "{0:.1f}".format(s["peakMemoryIncrease"])))
+        return "\n".join(lines)
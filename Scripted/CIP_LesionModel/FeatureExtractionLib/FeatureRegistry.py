@@ -0,0 +1,140 @@
+import collections
+import time
+
+from FeatureProfiler import FeatureProfiler, KIND_INTERMEDIATE, KIND_FEATURE
+
+class FeatureDescriptor:
+    def __init__(self, name, category, function, dependencies, kwargs):
+        """ Description of a feature or of an intermediate value shared by several features
+        :param name: name of the feature (ex: "Contrast") or of the intermediate value (ex: "P_glcm")
+        :param category: main category of the feature (ex: "Texture: GLCM")
+        :param function: function(featureClassInstance, *dependencyValues, **kwargs) that calculates the value
+        :param dependencies: names of the values needed by the function, in the same order as its arguments.
+            Each one of them can be a registered intermediate value, another feature or an attribute of the
+            feature class instance (input data)
+        :param kwargs: additional constant keyword arguments for the function
+        """
+        self.name = name
+        self.category = category
+        self.function = function
+        self.dependencies = dependencies
+        self.kwargs = kwargs
+
+
+class FeatureRegistry:
+    def __init__(self, category, version=1):
+        """ Registry of all the features of a category and the intermediate values that they need.
+        When some features are evaluated, just the intermediate values that they need are calculated, and each
+        one of them just once (in dependency order).
+        New features can be registered from outside the module (plugins) and they will be available in the GUI
+        and in the batch analysis
+        :param category: main category of the features (ex: "Texture: GLCM")
+        :param version: version of the calculation of the features. It must be increased when the code changes the
+            value of any feature of the category, so that the values stored in a FeatureDiskCache are calculated again
+        """
+        self.category = category
+        self.version = version
+        self.features = collections.OrderedDict()
+        self.intermediates = dict()
+
+    def feature(self, name, function, *dependencies, **kwargs):
+        """ Register a feature
+        :param name: name of the feature (ex: "Contrast")
+        :param function: function(featureClassInstance, *dependencyValues, **kwargs) that calculates the feature
+        :param dependencies: names of the values needed by the function
+        :param kwargs: constant keyword arguments for the function
+        """
+        self.features[name] = FeatureDescriptor(name, self.category, function, dependencies, kwargs)
+
+    def intermediate(self, name, function, *dependencies, **kwargs):
+        """ Register an intermediate value that is shared by different features.
+        The value will be stored as an attribute of the feature class instance
+        :param name: name of the value (ex: "P_glcm")
+        :param function: function(featureClassInstance, *dependencyValues, **kwargs) that calculates the value
+        :param dependencies: names of the values needed by the function
+        :param kwargs: constant keyword arguments for the function
+        """
+        self.intermediates[name] = FeatureDescriptor(name, self.category, function, dependencies, kwargs)
+
+    def getEvaluationOrder(self, featureKeys):
+        """ Sort topologically all the features and intermediate values needed to calculate some features
+        :param featureKeys: features that are going to be evaluated
+        :return: list of FeatureDescriptor, where every descriptor goes after all its dependencies
+        """
+        order = []
+        visited = set()
+        visiting = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise Exception("Circular dependency in {0}: {1}".format(self.category, name))
+            descriptor = self.features.get(name, self.intermediates.get(name))
+            if descriptor is None:
+                # Input data of the feature class
+                visited.add(name)
+                return
+            visiting.add(name)
+            for dependency in descriptor.dependencies:
+                visit(dependency)
+            visiting.remove(name)
+            visited.add(name)
+            order.append(descriptor)
+
+        for key in self.features:
+            if key in featureKeys:
+                visit(key)
+        return order
+
+    def evaluate(self, instance, featureKeys, printTiming=False, checkStopProcessFunction=None, profiler=None,
+                 checkpointFunction=None):
+        """ Evaluate some features for an instance of a feature class.
+        The evaluation goes in chunks (each feature, preceded by the intermediate values that it needs and that were
+        not calculated yet), and the process can be stopped between chunks.
+        The intermediate values already calculated for this instance are reused
+        :param instance: feature class instance that contains the input data
+        :param featureKeys: features that are going to be evaluated
+        :param printTiming: calculate the time elapsed for each feature. The time elapsed calculating the
+            intermediate values is added to the first feature that needs them
+        :param checkStopProcessFunction: function that raises StopIteration if the process must be stopped
+        :param profiler: FeatureProfiler where every intermediate value and feature calculated is recorded (optional)
+        :param checkpointFunction: function(featureKey, value, timing) called as soon as each feature is calculated,
+            so that the features already completed are kept if the process is stopped. timing is None when
+            printTiming is False
+        :return:
+            If printTiming==False: Dictionary of Feature-Value
+            else: tuple with 2 dictionaries (1 of Feature-Value and another one with Feature-Timing)
+        """
+        if profiler is None:
+            profiler = FeatureProfiler(enabled=False)
+        results = collections.OrderedDict()
+        timings = collections.OrderedDict()
+        values = dict()
+        t1 = time.time()
+        for descriptor in self.getEvaluationOrder(featureKeys):
+            if descriptor.name in self.intermediates and descriptor.name in instance.__dict__:
+                # Already calculated in a previous evaluation
+                continue
+            args = [values[d] if d in values else getattr(instance, d) for d in descriptor.dependencies]
+            kind = KIND_INTERMEDIATE if descriptor.name in self.intermediates else KIND_FEATURE
+            with profiler.measure(self.category, descriptor.name, kind):
+                value = descriptor.function(instance, *args, **descriptor.kwargs)
+            if descriptor.name in self.intermediates:
+                setattr(instance, descriptor.name, value)
+            else:
+                values[descriptor.name] = value
+                if descriptor.name in featureKeys:
+                    results[descriptor.name] = value
+                    if printTiming:
+                        timings[descriptor.name] = time.time() - t1
+                        t1 = time.time()
+                    if checkpointFunction is not None:
+                        checkpointFunction(descriptor.name, value, timings.get(descriptor.name))
+            if checkStopProcessFunction is not None:
+                checkStopProcessFunction()
+
+        if not printTiming:
+            return results
+        else:
+            return results, timings
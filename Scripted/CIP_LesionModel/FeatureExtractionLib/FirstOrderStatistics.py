@@ -1,158 +1,168 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
 import operator
 import collections
-import time
+from FeatureRegistry import FeatureRegistry
 
 class FirstOrderStatistics:
-    def __init__(self, parameterValues, bins, grayLevels, allKeys):
+    # Version 2: statistics calculated from the histogram of intensities (the Root Mean Square was truncated before)
+    registry = FeatureRegistry("First-Order Statistics", version=2)
+
+    def __init__(self, parameterValues, bins, grayLevels, allKeys, histogram=None):
         """
-        :param parameterValues: 3D array with the coordinates of the voxels where the labelmap is not 0
-        :param bins: bins for histogram
+        :param parameterValues: array with the intensities of the voxels where the labelmap is not 0
+        :param bins: bins for histogram (for integer intensities, one bin per intensity from the minimum to the maximum)
         :param grayLevels: number of different gray levels
         :param allKeys: all feature keys that have been selected for analysis
+        :param histogram: tuple (sorted array with the different intensities; number of voxels of each one), when it
+            is already known (ex: accumulated from the concentric shells). Then parameterValues is not used
         """
-        self.firstOrderStatistics = collections.OrderedDict()
-        self.firstOrderStatisticsTiming = collections.OrderedDict()
-        self.firstOrderStatistics["Voxel Count"] = "self.voxelCount(self.parameterValues)"
-        self.firstOrderStatistics["Gray Levels"] = "self.grayLevelCount(self.grayLevels)"
-        self.firstOrderStatistics["Energy"] = "self.energyValue(self.parameterValues)"
-        self.firstOrderStatistics["Entropy"] = "self.entropyValue(self.bins)"
-        self.firstOrderStatistics["Minimum Intensity"] = "self.minIntensity(self.parameterValues)"
-        self.firstOrderStatistics["Maximum Intensity"] = "self.maxIntensity(self.parameterValues)"
-        self.firstOrderStatistics["Mean Intensity"] = "self.meanIntensity(self.parameterValues)"
-        self.firstOrderStatistics["Median Intensity"] = "self.medianIntensity(self.parameterValues)"
-        self.firstOrderStatistics["Range"] = "self.rangeIntensity(self.parameterValues)"
-        self.firstOrderStatistics["Mean Deviation"] = "self.meanDeviation(self.parameterValues)"
-        self.firstOrderStatistics["Root Mean Square"] = "self.rootMeanSquared(self.parameterValues)"
-        self.firstOrderStatistics["Standard Deviation"] = "self.standardDeviation(self.parameterValues)"
-        self.firstOrderStatistics["Ventilation Heterogeneity"] = "self.ventilationHeterogeneity(self.parameterValues)"
-        self.firstOrderStatistics["Skewness"] = "self.skewnessValue(self.parameterValues)"
-        self.firstOrderStatistics["Kurtosis"] = "self.kurtosisValue(self.parameterValues)"
-        self.firstOrderStatistics["Variance"] = "self.varianceValue(self.parameterValues)"
-        self.firstOrderStatistics["Uniformity"] = "self.uniformityValue(self.bins)"
-
         self.parameterValues = parameterValues
         self.bins = bins
         self.grayLevels = grayLevels
-        self.keys = set(allKeys).intersection(self.firstOrderStatistics.keys())
+        self.keys = set(allKeys).intersection(self.registry.features.keys())
+        if histogram is not None:
+            # Intermediate value already calculated (see FeatureRegistry.evaluate)
+            self.histogram = histogram
+
+    def valueHistogram(self, parameterValues, bins):
+        """ Different intensities of the ROI and number of voxels of each one.
+        All the statistics are calculated from it, so the voxels are read just once and never sorted nor converted
+        :return: tuple (sorted int64/float64 array with the intensities; int64 array with the number of voxels)
+        """
+        if parameterValues.dtype.kind in "iu" and bins.size == int(parameterValues.max()) - int(parameterValues.min()) + 1:
+            levels = numpy.nonzero(bins)[0]
+            return (levels + numpy.int64(parameterValues.min()), bins[levels].astype(numpy.int64))
+        levels, counts = numpy.unique(parameterValues, return_counts=True)
+        return (levels.astype(numpy.float64), counts.astype(numpy.int64))
+
+    def moments(self, histogram):
+        """ Mean and central moments (2 to 4) of the intensities, calculated at once from the histogram
+        :return: tuple (mean, m2, m3, m4)
+        """
+        levels, counts = histogram
+        total = float(counts.sum())
+        mean = numpy.dot(counts, levels) / total
+        deviations = levels - mean
+        weighted = counts * deviations ** 2
+        m2 = weighted.sum() / total
+        weighted *= deviations
+        m3 = weighted.sum() / total
+        weighted *= deviations
+        m4 = weighted.sum() / total
+        return (mean, m2, m3, m4)
+
+    def percentileValue(self, histogram, percentile):
+        """ Percentile of the intensities (linear interpolation between the closest ranks, like numpy.percentile),
+        found in the cumulative histogram instead of sorting the voxels
+        :param histogram: tuple (intensities; number of voxels of each one)
+        :param percentile: percentile (0-100)
+        """
+        levels, counts = histogram
+        cumulative = numpy.cumsum(counts)
+        position = (cumulative[-1] - 1) * percentile / 100.0
+        lower, upper = levels[numpy.searchsorted(cumulative, [math.floor(position) + 1, math.ceil(position) + 1])]
+        return lower + (upper - lower) * (position - math.floor(position))
 
-    def voxelCount(self, parameterArray):
-        return (parameterArray.size)
+    def voxelCount(self, histogram):
+        return (histogram[1].sum())
 
     def grayLevelCount(self, grayLevels):
         return (grayLevels)
 
-    def energyValue(self, parameterArray):
-        return (numpy.sum(parameterArray ** 2))
+    def energyValue(self, histogram):
+        levels, counts = histogram
+        return (numpy.dot(counts, levels ** 2))
 
     def entropyValue(self, bins):
         return (numpy.sum(bins * numpy.where(bins != 0, numpy.log2(bins), 0)))
 
-    def minIntensity(self, parameterArray):
-        return (numpy.min(parameterArray))
+    def minIntensity(self, histogram):
+        return (histogram[0][0])
 
-    def maxIntensity(self, parameterArray):
-        return (numpy.max(parameterArray))
+    def maxIntensity(self, histogram):
+        return (histogram[0][-1])
 
-    def meanIntensity(self, parameterArray):
-        return (numpy.mean(parameterArray))
+    def meanIntensity(self, moments):
+        return (moments[0])
 
-    def medianIntensity(self, parameterArray):
-        return (numpy.median(parameterArray))
+    def medianIntensity(self, histogram):
+        return (self.percentileValue(histogram, 50))
 
-    def rangeIntensity(self, parameterArray):
-        return (numpy.max(parameterArray) - numpy.min(parameterArray))
+    def rangeIntensity(self, histogram):
+        return (histogram[0][-1] - histogram[0][0])
 
-    def meanDeviation(self, parameterArray):
-        return (numpy.mean(numpy.absolute((numpy.mean(parameterArray) - parameterArray))))
+    def meanDeviation(self, histogram, moments):
+        levels, counts = histogram
+        return (numpy.dot(counts, numpy.absolute(levels - moments[0])) / float(counts.sum()))
 
-    def rootMeanSquared(self, parameterArray):
-        return (((numpy.sum(parameterArray ** 2)) / (parameterArray.size)) ** (1 / 2.0))
+    def rootMeanSquared(self, histogram, energy):
+        return ((energy / float(histogram[1].sum())) ** (1 / 2.0))
 
-    def standardDeviation(self, parameterArray):
-        return (numpy.std(parameterArray))
+    def standardDeviation(self, moments):
+        return (numpy.sqrt(moments[1]))
 
-    def ventilationHeterogeneity(self, parameterArray):
+    def ventilationHeterogeneity(self, histogram):
+        levels, counts = histogram
         # Keep just the points that are in the range (-1000, 0]
-        arr = parameterArray[((parameterArray > -1000) & (parameterArray <= 0))]
-        # Convert to float to apply the formula
-        arr = arr.astype(numpy.float)
+        inRange = (levels > -1000) & (levels <= 0)
+        levels = levels[inRange].astype(numpy.float)
+        counts = counts[inRange]
+        if counts.sum() == 0:
+            return numpy.nan
         # Apply formula
-        arr = -arr / (arr + 1000)
-        arr **= (1/3.0)
-        return arr.std()
-
-    def _moment(self, a, moment=1, axis=0):
-        # Modified from SciPy module
-        if moment == 1:
-            return numpy.float64(0.0)
-        else:
-            mn = numpy.expand_dims(numpy.mean(a, axis), axis)
-            s = numpy.power((a - mn), moment)
-            return numpy.mean(s, axis)
-
-    def skewnessValue(self, a, axis=0):
-        # Modified from SciPy module
-        # Computes the skewness of a dataset
-
-        m2 = self._moment(a, 2, axis)
-        m3 = self._moment(a, 3, axis)
-
-        # Control Flow: if m2==0 then vals = 0; else vals = m3/m2**1.5
-        zero = (m2 == 0)
-        vals = numpy.where(zero, 0, m3 / m2 ** 1.5)
-
-        if vals.ndim == 0:
-            return vals.item()
-        return vals
-
-    def kurtosisValue(self, a, axis=0, fisher=True):
-        # Modified from SciPy module
-
-        m2 = self._moment(a, 2, axis)
-        m4 = self._moment(a, 4, axis)
-        zero = (m2 == 0)
-
-        # Set Floating-Point Error Handling
-        olderr = numpy.seterr(all='ignore')
-        try:
-            vals = numpy.where(zero, 0, m4 / m2 ** 2.0)
-        finally:
-            numpy.seterr(**olderr)
-        if vals.ndim == 0:
-            vals = vals.item()  # array scalar
-
+        values = (-levels / (levels + 1000)) ** (1/3.0)
+        mean = numpy.dot(counts, values) / float(counts.sum())
+        return (numpy.sqrt(numpy.dot(counts, (values - mean) ** 2) / float(counts.sum())))
+
+    def skewnessValue(self, moments):
+        # Computes the skewness of a dataset (as in SciPy)
+        m2, m3 = moments[1], moments[2]
+        if m2 == 0:
+            return 0
+        return (m3 / m2 ** 1.5)
+
+    def kurtosisValue(self, moments, fisher=True):
+        # Computes the kurtosis of a dataset (as in SciPy)
+        m2, m4 = moments[1], moments[3]
+        vals = 0 if m2 == 0 else m4 / m2 ** 2.0
         if fisher:
             return vals - 3
         else:
             return vals
 
-    def varianceValue(self, parameterArray):
-        return (numpy.std(parameterArray) ** 2)
+    def varianceValue(self, moments):
+        return (moments[1])
 
     def uniformityValue(self, bins):
         return (numpy.sum(bins ** 2))
 
-    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None):
-        # Evaluate dictionary elements corresponding to user-selected keys
-        if not self.keys:
-            return (self.firstOrderStatistics)
-
-        if printTiming:
-            for key in self.keys:
-                t1 = time.time()
-                self.firstOrderStatistics[key] = eval(self.firstOrderStatistics[key])
-                self.firstOrderStatisticsTiming[key] = time.time() - t1
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
-
-            return self.firstOrderStatistics, self.firstOrderStatisticsTiming
-        else:
-            for key in self.keys:
-                self.firstOrderStatistics[key] = eval(self.firstOrderStatistics[key])
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
-            return self.firstOrderStatistics
+    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None, profiler=None,
+                         checkpointFunction=None):
+        # Evaluate the features corresponding to user-selected keys
+        return self.registry.evaluate(self, self.keys, printTiming, checkStopProcessFunction, profiler,
+                                      checkpointFunction)
+
+
+FirstOrderStatistics.registry.intermediate("histogram", FirstOrderStatistics.valueHistogram, "parameterValues", "bins")
+FirstOrderStatistics.registry.intermediate("moments", FirstOrderStatistics.moments, "histogram")
+
+FirstOrderStatistics.registry.feature("Voxel Count", FirstOrderStatistics.voxelCount, "histogram")
+FirstOrderStatistics.registry.feature("Gray Levels", FirstOrderStatistics.grayLevelCount, "grayLevels")
+FirstOrderStatistics.registry.feature("Energy", FirstOrderStatistics.energyValue, "histogram")
+FirstOrderStatistics.registry.feature("Entropy", FirstOrderStatistics.entropyValue, "bins")
+FirstOrderStatistics.registry.feature("Minimum Intensity", FirstOrderStatistics.minIntensity, "histogram")
+FirstOrderStatistics.registry.feature("Maximum Intensity", FirstOrderStatistics.maxIntensity, "histogram")
+FirstOrderStatistics.registry.feature("Mean Intensity", FirstOrderStatistics.meanIntensity, "moments")
+FirstOrderStatistics.registry.feature("Median Intensity", FirstOrderStatistics.medianIntensity, "histogram")
+FirstOrderStatistics.registry.feature("Range", FirstOrderStatistics.rangeIntensity, "histogram")
+FirstOrderStatistics.registry.feature("Mean Deviation", FirstOrderStatistics.meanDeviation, "histogram", "moments")
+FirstOrderStatistics.registry.feature("Root Mean Square", FirstOrderStatistics.rootMeanSquared, "histogram", "Energy")
+FirstOrderStatistics.registry.feature("Standard Deviation", FirstOrderStatistics.standardDeviation, "moments")
+FirstOrderStatistics.registry.feature("Ventilation Heterogeneity", FirstOrderStatistics.ventilationHeterogeneity,
+                                      "histogram")
+FirstOrderStatistics.registry.feature("Skewness", FirstOrderStatistics.skewnessValue, "moments")
+FirstOrderStatistics.registry.feature("Kurtosis", FirstOrderStatistics.kurtosisValue, "moments")
+FirstOrderStatistics.registry.feature("Variance", FirstOrderStatistics.varianceValue, "moments")
+FirstOrderStatistics.registry.feature("Uniformity", FirstOrderStatistics.uniformityValue, "bins")
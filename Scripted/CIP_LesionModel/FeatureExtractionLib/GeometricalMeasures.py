@@ -1,36 +1,24 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
 import operator
 import collections
+from FeatureRegistry import FeatureRegistry
 
 
 class GeometricalMeasures:
+    registry = FeatureRegistry("Geometrical Measures")
+
     def __init__(self, labelNodeSpacing, parameterMatrix, parameterMatrixCoordinates, parameterValues, allKeys):
         # need non-linear scaling of surface heights for normalization (reduce computational time)
-        self.GeometricalMeasures = collections.OrderedDict()
-        self.GeometricalMeasuresTiming = collections.OrderedDict()
-        self.GeometricalMeasures[
-            "Extruded Surface Area"] = "self.extrudedSurfaceArea(self.labelNodeSpacing, self.extrudedMatrix, self.extrudedMatrixCoordinates, self.parameterValues)"
-        self.GeometricalMeasures[
-            "Extruded Volume"] = "self.extrudedVolume(self.extrudedMatrix, self.extrudedMatrixCoordinates, self.cubicMMPerVoxel)"
-        self.GeometricalMeasures[
-            "Extruded Surface:Volume Ratio"] = "self.extrudedSurfaceVolumeRatio(self.labelNodeSpacing, self.extrudedMatrix, self.extrudedMatrixCoordinates, self.parameterValues, self.cubicMMPerVoxel)"
-
         self.labelNodeSpacing = labelNodeSpacing
         self.parameterMatrix = parameterMatrix
         self.parameterMatrixCoordinates = parameterMatrixCoordinates
         self.parameterValues = parameterValues
-        self.keys = set(allKeys).intersection(self.GeometricalMeasures.keys())
+        self.keys = set(allKeys).intersection(self.registry.features.keys())
+        self.cubicMMPerVoxel = reduce(lambda x, y: x * y, labelNodeSpacing)
 
-        if self.keys:
-            self.cubicMMPerVoxel = reduce(lambda x, y: x * y, labelNodeSpacing)
-            self.extrudedMatrix, self.extrudedMatrixCoordinates = self.extrudeMatrix(self.parameterMatrix,
-                                                                                     self.parameterMatrixCoordinates,
-                                                                                     self.parameterValues)
-
-    def extrudedSurfaceArea(self, labelNodeSpacing, extrudedMatrix, extrudedMatrixCoordinates, parameterValues):
+    def extrudedSurfaceArea(self, labelNodeSpacing, heightMatrix):
         x, y, z = labelNodeSpacing
 
         # surface areas of directional connections
@@ -39,75 +27,53 @@ class GeometricalMeasures:
         xy = x * y
         fourD = (2 * xy + 2 * xz + 2 * yz)
 
-        totalVoxelSurfaceArea4D = (2 * xy + 2 * xz + 2 * yz + 2 * fourD)
-        totalSA = parameterValues.size * totalVoxelSurfaceArea4D
-
-        # in matrixSACoordinates
         # i: height (z), j: vertical (y), k: horizontal (x), l: 4th or extrusion dimension
-        i, j, k, l = 0, 0, 0, 0
-        extrudedSurfaceArea = 0
-
-        # vectorize
-        for i, j, k, l_slice in zip(*extrudedMatrixCoordinates):
-            for l in xrange(l_slice.start, l_slice.stop):
-                fxy = numpy.array([extrudedMatrix[i + 1, j, k, l], extrudedMatrix[i - 1, j, k, l]]) == 0
-                fyz = numpy.array([extrudedMatrix[i, j + 1, k, l], extrudedMatrix[i, j - 1, k, l]]) == 0
-                fxz = numpy.array([extrudedMatrix[i, j, k + 1, l], extrudedMatrix[i, j, k - 1, l]]) == 0
-                f4d = numpy.array([extrudedMatrix[i, j, k, l + 1], extrudedMatrix[i, j, k, l - 1]]) == 0
-
-                extrudedElementSurface = (numpy.sum(fxz) * xz) + (numpy.sum(fyz) * yz) + (numpy.sum(fxy) * xy) + (
-                numpy.sum(f4d) * fourD)
-                extrudedSurfaceArea += extrudedElementSurface
+        # Every column with a height > 0 exposes its 2 ends in the 4th dimension.
+        # Between two neighbor columns in the same 3D axis, the exposed elements are the difference of their heights
+        # (the matrix is padded with 0, so the columns in the border of the ROI are also taken into account)
+        f4d = 2 * numpy.count_nonzero(heightMatrix)
+        fxy = numpy.sum(numpy.abs(numpy.diff(heightMatrix, axis=0)))
+        fyz = numpy.sum(numpy.abs(numpy.diff(heightMatrix, axis=1)))
+        fxz = numpy.sum(numpy.abs(numpy.diff(heightMatrix, axis=2)))
+
+        extrudedSurfaceArea = (fxz * xz) + (fyz * yz) + (fxy * xy) + (f4d * fourD)
         return (extrudedSurfaceArea)
 
-    def extrudedVolume(self, extrudedMatrix, extrudedMatrixCoordinates, cubicMMPerVoxel):
-        extrudedElementsSize = extrudedMatrix[numpy.where(extrudedMatrix == 1)].size
+    def extrudedVolume(self, heightMatrix, cubicMMPerVoxel):
+        extrudedElementsSize = numpy.sum(heightMatrix)
         return (extrudedElementsSize * cubicMMPerVoxel)
 
-    def extrudedSurfaceVolumeRatio(self, labelNodeSpacing, extrudedMatrix, extrudedMatrixCoordinates, parameterValues,
-                                   cubicMMPerVoxel):
-        extrudedSurfaceArea = self.extrudedSurfaceArea(labelNodeSpacing, extrudedMatrix, extrudedMatrixCoordinates,
-                                                       parameterValues)
-        extrudedVolume = self.extrudedVolume(extrudedMatrix, extrudedMatrixCoordinates, cubicMMPerVoxel)
+    def extrudedSurfaceVolumeRatio(self, labelNodeSpacing, heightMatrix, cubicMMPerVoxel):
+        extrudedSurfaceArea = self.extrudedSurfaceArea(labelNodeSpacing, heightMatrix)
+        extrudedVolume = self.extrudedVolume(heightMatrix, cubicMMPerVoxel)
         return (extrudedSurfaceArea / extrudedVolume)
 
-    def extrudeMatrix(self, parameterMatrix, parameterMatrixCoordinates, parameterValues):
-        # extrude 3D image into a binary 4D array with the intensity or parameter value as the 4th Dimension
+    def extrusionHeights(self, parameterMatrix, parameterMatrixCoordinates, parameterValues):
+        # extrude 3D image into a binary 4D array with the intensity or parameter value as the 4th Dimension.
+        # The 4D array is never built: every extruded column is filled from the bottom, so it is fully described
+        # by its height, which is all the information needed to calculate the extruded surface and volume
         # need to normalize CT images with a shift of 120 Hounsfield units
 
         parameterValues = numpy.abs(parameterValues)
 
-        # maximum intensity/parameter value appended as shape of 4th dimension
-        extrudedShape = parameterMatrix.shape + (numpy.max(parameterValues),)
-
-        # pad shape by 1 unit in all 8 directions
-        extrudedShape = tuple(map(operator.add, extrudedShape, [2, 2, 2, 2]))
-
-        extrudedMatrix = numpy.zeros(extrudedShape)
-        extrudedMatrixCoordinates = tuple(map(operator.add, parameterMatrixCoordinates, ([1, 1, 1]))) + (
-        numpy.array([slice(1, value + 1) for value in parameterValues]),)
-        for slice4D in zip(*extrudedMatrixCoordinates):
-            extrudedMatrix[slice4D] = 1
-        return (extrudedMatrix, extrudedMatrixCoordinates)
-
-    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None):
-        # Evaluate dictionary elements corresponding to user-selected keys
-        if not self.keys:
-            return (self.GeometricalMeasures)
-
-        if printTiming:
-            import time
-            for key in self.keys:
-                t1 = time.time()
-                self.GeometricalMeasures[key] = eval(self.GeometricalMeasures[key])
-                self.GeometricalMeasuresTiming[key] = time.time() - t1
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
-
-            return self.GeometricalMeasures, self.GeometricalMeasuresTiming
-        else:
-            for key in self.keys:
-                self.GeometricalMeasures[key] = eval(self.GeometricalMeasures[key])
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
-            return self.GeometricalMeasures
+        # pad shape by 1 unit in all 6 directions
+        heightMatrix = numpy.zeros(tuple(map(operator.add, parameterMatrix.shape, [2, 2, 2])), dtype=numpy.int64)
+        heightMatrix[tuple(map(operator.add, parameterMatrixCoordinates, ([1, 1, 1])))] = parameterValues
+        return (heightMatrix)
+
+    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None, profiler=None,
+                         checkpointFunction=None):
+        # Evaluate the features corresponding to user-selected keys
+        return self.registry.evaluate(self, self.keys, printTiming, checkStopProcessFunction, profiler,
+                                      checkpointFunction)
+
+
+GeometricalMeasures.registry.intermediate("heightMatrix", GeometricalMeasures.extrusionHeights, "parameterMatrix",
+                                          "parameterMatrixCoordinates", "parameterValues")
+
+GeometricalMeasures.registry.feature("Extruded Surface Area", GeometricalMeasures.extrudedSurfaceArea,
+                                     "labelNodeSpacing", "heightMatrix")
+GeometricalMeasures.registry.feature("Extruded Volume", GeometricalMeasures.extrudedVolume, "heightMatrix",
+                                     "cubicMMPerVoxel")
+GeometricalMeasures.registry.feature("Extruded Surface:Volume Ratio", GeometricalMeasures.extrudedSurfaceVolumeRatio,
+                                     "labelNodeSpacing", "heightMatrix", "cubicMMPerVoxel")
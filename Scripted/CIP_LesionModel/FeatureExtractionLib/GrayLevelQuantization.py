@@ -0,0 +1,100 @@
+import numpy as np
+
+class GrayLevelQuantization:
+    # Quantization schemes
+    FIXED_BIN_WIDTH = "width"
+    FIXED_BIN_COUNT = "count"
+    HU_WINDOW = "window"
+
+    def __init__(self, scheme, binWidth=None, binCount=None, window=None):
+        """ Quantization of the intensities of a ROI in a small number of gray levels, applied before the texture
+        features (GLCM and GLRL) are calculated. Otherwise, every different HU value is a gray level and the
+        texture matrices can have thousands of rows and columns.
+        The gray levels are the numbers 1..Ng of the bins of the scheme, including the empty bins between the
+        minimum and the maximum, so that the texture features are comparable between ROIs and scanners:
+            - FIXED_BIN_WIDTH: bins of binWidth HU aligned to the multiples of binWidth (ex: [-50, -25), [-25, 0)...).
+                Ng depends on the range of intensities of the ROI
+            - FIXED_BIN_COUNT: the range [minimum, maximum] of the ROI is divided in binCount bins (Ng = binCount)
+            - HU_WINDOW: the intensities are clipped to window=(lower, upper) and divided in bins of binWidth HU
+                starting at lower (Ng is the same for all the ROIs)
+        :param scheme: one of FIXED_BIN_WIDTH, FIXED_BIN_COUNT, HU_WINDOW
+        :param binWidth: width of the bins in HU (FIXED_BIN_WIDTH and HU_WINDOW)
+        :param binCount: number of bins (FIXED_BIN_COUNT)
+        :param window: tuple (lower, upper) in HU (HU_WINDOW)
+        """
+        if scheme in (self.FIXED_BIN_WIDTH, self.HU_WINDOW):
+            if binWidth is None or binWidth <= 0:
+                raise ValueError("The bin width must be a positive number")
+        elif scheme == self.FIXED_BIN_COUNT:
+            if binCount is None or int(binCount) < 1:
+                raise ValueError("The number of bins must be a positive integer")
+            binCount = int(binCount)
+        else:
+            raise ValueError("Unknown quantization scheme: {0}".format(scheme))
+        if scheme == self.HU_WINDOW and (window is None or window[0] >= window[1]):
+            raise ValueError("The window must be a tuple (lower, upper) with lower < upper")
+        self.scheme = scheme
+        self.binWidth = binWidth
+        self.binCount = binCount
+        self.window = tuple(window) if window is not None else None
+
+    @staticmethod
+    def fromString(text):
+        """ Create a quantization from its text representation (see __str__):
+        "width:25", "count:32", "window:-1000:400:25" or "none"
+        :param text: text representation
+        :return: GrayLevelQuantization, or None for "none" (every HU value is a gray level)
+        """
+        parts = text.strip().lower().split(":")
+        try:
+            if parts[0] in ("", "none"):
+                return None
+            if parts[0] == GrayLevelQuantization.FIXED_BIN_WIDTH and len(parts) == 2:
+                return GrayLevelQuantization(parts[0], binWidth=float(parts[1]))
+            if parts[0] == GrayLevelQuantization.FIXED_BIN_COUNT and len(parts) == 2:
+                return GrayLevelQuantization(parts[0], binCount=int(parts[1]))
+            if parts[0] == GrayLevelQuantization.HU_WINDOW and len(parts) == 4:
+                return GrayLevelQuantization(parts[0], binWidth=float(parts[3]),
+                                             window=(float(parts[1]), float(parts[2])))
+        except ValueError as ex:
+            raise ValueError("Invalid quantization '{0}': {1}".format(text, ex))
+        raise ValueError("Invalid quantization '{0}'. Expected width:W, count:N, window:LOWER:UPPER:W or none"
+                         .format(text))
+
+    def __str__(self):
+        """ Text representation of the scheme (it is stored in the reports)
+        """
+        if self.scheme == self.FIXED_BIN_WIDTH:
+            return "width:{0:g}".format(self.binWidth)
+        if self.scheme == self.FIXED_BIN_COUNT:
+            return "count:{0}".format(self.binCount)
+        return "window:{0:g}:{1:g}:{2:g}".format(self.window[0], self.window[1], self.binWidth)
+
+    def quantize(self, values):
+        """ Gray level of every intensity
+        :param values: numpy array of intensities of the ROI
+        :return: tuple (numpy int32 array with the gray level (1..Ng) of every value; array with all the gray
+            levels 1..Ng)
+        """
+        if values.size == 0:
+            return (np.zeros(0, np.int32), np.zeros(0, np.int32))
+        values = values.astype(np.float64)
+        if self.scheme == self.FIXED_BIN_WIDTH:
+            bins = np.floor(values / self.binWidth)
+            grayLevels = bins - bins.min() + 1
+            numGrayLevels = int(grayLevels.max())
+        elif self.scheme == self.FIXED_BIN_COUNT:
+            minimum = values.min()
+            valuesRange = values.max() - minimum
+            if valuesRange == 0:
+                grayLevels = np.ones(values.shape)
+            else:
+                grayLevels = np.floor(self.binCount * (values - minimum) / valuesRange) + 1
+            numGrayLevels = self.binCount
+        else:
+            lower, upper = self.window
+            numGrayLevels = max(1, int(np.ceil((upper - lower) / self.binWidth)))
+            grayLevels = np.floor((np.clip(values, lower, upper) - lower) / self.binWidth) + 1
+        # The maximum of the range goes to the last bin
+        grayLevels = np.minimum(grayLevels, numGrayLevels).astype(np.int32)
+        return (grayLevels, np.arange(1, numGrayLevels + 1, dtype=np.int32))
@@ -0,0 +1,91 @@
+import numpy as np
+
+from SphereROI import SphereROI
+
+class LevelSetThreshold:
+    """ Threshold of the level set returned by the lesion segmentation CLI. The nodule is made of the voxels where
+    the level set is greater or equal than the threshold.
+    Just the region where the level set was evolved (bounding box of the voxels different from the background value)
+    is thresholded, and its values are sorted once, so that the number of voxels/volume of the nodule for any threshold
+    is a binary search (fast enough to be refreshed while the user moves the threshold slider).
+    All the arrays and coordinates are in numpy (ZYX) order, while the spacing is in ITK/VTK (XYZ) order
+    """
+    def __init__(self, levelSetArray, spacing, offset=(0, 0, 0), shape=None, backgroundValue=None):
+        """
+        :param levelSetArray: level set array (whole volume or a crop of it)
+        :param spacing: spacing of the volume (XYZ)
+        :param offset: offset (ZYX) of levelSetArray in the whole volume
+        :param shape: shape of the whole volume (default: shape of levelSetArray)
+        :param backgroundValue: value of the voxels where the level set was not evolved (default: value of the first
+            corner of levelSetArray, which is out of the region evolved around the seeds)
+        """
+        self.shape = tuple(shape) if shape is not None else levelSetArray.shape
+        self.cubicMMPerVoxel = reduce(lambda x, y: x * y, spacing)
+        self.backgroundValue = levelSetArray[0, 0, 0] if backgroundValue is None else backgroundValue
+
+        # Bounding box of the evolved region, with a margin of 1 voxel so that the surface of the nodule is closed
+        foreground = levelSetArray != self.backgroundValue
+        lower = []
+        upper = []
+        for axis in range(3):
+            indexes = np.nonzero(foreground.any(axis=tuple(a for a in range(3) if a != axis)))[0]
+            if indexes.size == 0:
+                lower.append(0)
+                upper.append(0)
+            else:
+                lower.append(max(indexes[0] - 1, 0))
+                upper.append(min(indexes[-1] + 2, levelSetArray.shape[axis]))
+        self.levelSetCrop = np.array(levelSetArray[tuple(slice(l, u) for l, u in zip(lower, upper))])
+        self.offset = tuple(o + l for o, l in zip(offset, lower))
+
+        self.sortedValues = np.sort(self.levelSetCrop[self.levelSetCrop != self.backgroundValue], axis=None)
+        self.numBackgroundVoxels = reduce(lambda x, y: x * y, self.shape) - self.sortedValues.size
+        self.__lastBackgroundInNodule__ = None
+
+    @property
+    def extent(self):
+        """ Extent (VTK order: xmin, xmax, ymin, ymax, zmin, zmax) of the evolved region in the whole volume
+        """
+        extent = []
+        for axis in (2, 1, 0):
+            extent.extend((self.offset[axis], self.offset[axis] + self.levelSetCrop.shape[axis] - 1))
+        return extent
+
+    def getVoxelCount(self, threshold):
+        """ Number of voxels of the nodule for a threshold
+        :param threshold: threshold of the level set
+        :return: number of voxels
+        """
+        count = self.sortedValues.size - np.searchsorted(self.sortedValues, threshold, side="left")
+        if threshold <= self.backgroundValue:
+            count += self.numBackgroundVoxels
+        return int(count)
+
+    def getVolume(self, threshold):
+        """ Volume of the nodule in mm^3 for a threshold
+        :param threshold: threshold of the level set
+        :return: volume in mm^3
+        """
+        return self.getVoxelCount(threshold) * self.cubicMMPerVoxel
+
+    def getNoduleMask(self, threshold):
+        """ Nodule in the evolved region for a threshold
+        :param threshold: threshold of the level set
+        :return: tuple (boolean array with the shape of the evolved region; slices of the region in the whole volume)
+        """
+        return (self.levelSetCrop >= threshold, SphereROI.cropSlices(self.offset, self.levelSetCrop.shape))
+
+    def fillLabelmap(self, threshold, labelmapArray, labelValue=1):
+        """ Update a labelmap of the whole volume with the nodule for a threshold.
+        The voxels outside the evolved region are just written when they enter or leave the nodule
+        (threshold crossing the background value), so in general just the evolved region is updated
+        :param threshold: threshold of the level set
+        :param labelmapArray: labelmap array of the whole volume. It is modified in place
+        :param labelValue: value for the voxels of the nodule
+        """
+        backgroundInNodule = threshold <= self.backgroundValue
+        if backgroundInNodule != self.__lastBackgroundInNodule__:
+            labelmapArray[:] = labelValue if backgroundInNodule else 0
+            self.__lastBackgroundInNodule__ = backgroundInNodule
+        mask, slices = self.getNoduleMask(threshold)
+        labelmapArray[slices] = np.where(mask, labelValue, 0)
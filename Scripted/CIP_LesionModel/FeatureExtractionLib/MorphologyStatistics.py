@@ -1,34 +1,16 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
 import operator
 import collections
+from FeatureRegistry import FeatureRegistry
 
 
 class MorphologyStatistics:
+    registry = FeatureRegistry("Morphology and Shape", version=2)
+
     def __init__(self, labelNodeSpacing, matrixSA, matrixSACoordinates, matrixSAValues, allKeys):
-        self.morphologyStatistics = collections.OrderedDict()
-        self.morphologyStatisticsTiming = collections.OrderedDict()
-        self.morphologyStatistics["Volume mm^3"] = 'self.volumeMM3(self.matrixSAValues, self.cubicMMPerVoxel)'
-        self.morphologyStatistics[
-            "Volume cc"] = 'self.volumeCC(self.matrixSAValues, self.cubicMMPerVoxel, self.ccPerCubicMM)'
-        self.morphologyStatistics[
-            "Surface Area mm^2"] = 'self.surfaceArea(self.matrixSA, self.matrixSACoordinates, self.matrixSAValues, self.labelNodeSpacing)'
-        self.morphologyStatistics[
-            "Surface:Volume Ratio"] = 'self.surfaceVolumeRatio(self.morphologyStatistics["Surface Area mm^2"], self.morphologyStatistics["Volume mm^3"])'
-        self.morphologyStatistics[
-            "Compactness 1"] = 'self.compactness1(self.morphologyStatistics["Surface Area mm^2"], self.morphologyStatistics["Volume mm^3"])'
-        self.morphologyStatistics[
-            "Compactness 2"] = 'self.compactness2(self.morphologyStatistics["Surface Area mm^2"], self.morphologyStatistics["Volume mm^3"])'
-        self.morphologyStatistics[
-            "Maximum 3D Diameter"] = 'self.maximum3DDiameter(self.labelNodeSpacing, self.matrixSA, self.matrixSACoordinates)'
-        self.morphologyStatistics[
-            "Spherical Disproportion"] = 'self.sphericalDisproportion(self.morphologyStatistics["Surface Area mm^2"], self.morphologyStatistics["Volume mm^3"])'
-        self.morphologyStatistics[
-            "Sphericity"] = 'self.sphericityValue(self.morphologyStatistics["Surface Area mm^2"], self.morphologyStatistics["Volume mm^3"])'
-
-        self.keys = set(allKeys).intersection(self.morphologyStatistics.keys())
+        self.keys = set(allKeys).intersection(self.registry.features.keys())
 
         self.labelNodeSpacing = labelNodeSpacing
         self.matrixSA = matrixSA
@@ -50,24 +32,30 @@ class MorphologyStatistics:
         xz = x * z
         yz = y * z
         xy = x * y
-        voxelTotalSA = (2 * xy + 2 * xz + 2 * yz)
-        totalSA = matrixSAValues.size * voxelTotalSA
 
         # in matrixSACoordinates
         # i corresponds to height (z)
         # j corresponds to vertical (y)
         # k corresponds to horizontal (x)
 
-        i, j, k = 0, 0, 0
-        surfaceArea = 0
-        for voxel in xrange(0, matrixSAValues.size):
-            i, j, k = matrixSACoordinates[0][voxel], matrixSACoordinates[1][voxel], matrixSACoordinates[2][voxel]
-            fxy = (numpy.array([a[i + 1, j, k], a[i - 1, j, k]]) == 0)  # evaluate to 1 if true, 0 if false
-            fyz = (numpy.array([a[i, j + 1, k], a[i, j - 1, k]]) == 0)  # evaluate to 1 if true, 0 if false
-            fxz = (numpy.array([a[i, j, k + 1], a[i, j, k - 1]]) == 0)  # evaluate to 1 if true, 0 if false
-            surface = (numpy.sum(fxz) * xz) + (numpy.sum(fyz) * yz) + (numpy.sum(fxy) * xy)
-            surfaceArea += surface
-        return (surfaceArea)
+        # A face of a voxel of the ROI is exposed when the neighbor voxel in that direction is 0.
+        # Count all the exposed faces in both directions of every axis at once comparing the matrix with
+        # a shifted view of itself
+        roi = numpy.zeros(a.shape, dtype=bool)
+        roi[matrixSACoordinates] = True
+        background = (a == 0)
+        exposedFaces = []
+        for axis in xrange(3):
+            lower = [slice(None)] * 3
+            upper = [slice(None)] * 3
+            lower[axis] = slice(None, -1)
+            upper[axis] = slice(1, None)
+            lower = tuple(lower)
+            upper = tuple(upper)
+            exposedFaces.append(numpy.count_nonzero(roi[lower] & background[upper]) +
+                                numpy.count_nonzero(roi[upper] & background[lower]))
+        fxy, fyz, fxz = exposedFaces
+        return ((fxz * xz) + (fyz * yz) + (fxy * xy))
 
     def surfaceVolumeRatio(self, surfaceArea, volumeMM3):
         return (surfaceArea / volumeMM3)
@@ -79,30 +67,101 @@ class MorphologyStatistics:
         return ((36 * math.pi) * ((volumeMM3) ** 2) / ((surfaceArea) ** 3))
 
     def maximum3DDiameter(self, labelNodeSpacing, matrixSA, matrixSACoordinates):
-        # largest pairwise euclidean distance between tumor surface voxels
-
+        # largest pairwise euclidean distance between tumor surface voxels (measured between the corners of the voxels)
         x, y, z = labelNodeSpacing
-
-        minBounds = numpy.array(
-            [numpy.min(matrixSACoordinates[0]), numpy.min(matrixSACoordinates[1]), numpy.min(matrixSACoordinates[2])])
-        maxBounds = numpy.array(
-            [numpy.max(matrixSACoordinates[0]), numpy.max(matrixSACoordinates[1]), numpy.max(matrixSACoordinates[2])])
-
-        a = numpy.array(zip(*matrixSACoordinates))
-        edgeVoxelsMinCoords = numpy.vstack(
-            [a[a[:, 0] == minBounds[0]], a[a[:, 1] == minBounds[1]], a[a[:, 2] == minBounds[2]]]) * [z, y, x]
-        edgeVoxelsMaxCoords = numpy.vstack(
-            [(a[a[:, 0] == maxBounds[0]] + 1), (a[a[:, 1] == maxBounds[1]] + 1), (a[a[:, 2] == maxBounds[2]] + 1)]) * [
-                                  z, y, x]
-
-        maxDiameter = 1
-        for voxel1 in edgeVoxelsMaxCoords:
-            for voxel2 in edgeVoxelsMinCoords:
-                voxelDistance = numpy.sqrt(numpy.sum((voxel2 - voxel1) ** 2))
-                if voxelDistance > maxDiameter:
-                    maxDiameter = voxelDistance
+        corners = self.__surfaceCorners__(matrixSA, matrixSACoordinates)
+        # The farthest pair of points are always vertices of the convex hull, so the points that cannot be part of it
+        # are discarded before computing the pairwise distances
+        for axis in xrange(3):
+            corners = self.__lineExtremes__(corners, axis)
+        hull = self.__convexHullVertices__(corners)
+        return (self.__maximumPairwiseDistance__(hull * [z, y, x]))
+
+    def maximum2DDiameter(self, labelNodeSpacing, matrixSA, matrixSACoordinates, planeAxis):
+        # largest pairwise euclidean distance between tumor surface voxels contained in the same plane.
+        # planeAxis is the axis of the matrix that is orthogonal to the plane (0: axial, 1: coronal, 2: sagittal)
+        x, y, z = labelNodeSpacing
+        # The corners of each plane are built just from the voxels of that slice (index k in planeAxis), so all the
+        # corners of a slice have the coordinate k in planeAxis
+        corners = self.__surfaceCorners__(matrixSA, matrixSACoordinates, planeAxis)
+        for axis in xrange(3):
+            if axis != planeAxis:
+                corners = self.__lineExtremes__(corners, axis)
+        corners = corners[numpy.argsort(corners[:, planeAxis], kind='mergesort')]
+        planes, planeStarts = numpy.unique(corners[:, planeAxis], return_index=True)
+        planeEnds = numpy.append(planeStarts[1:], corners.shape[0])
+        maxDiameter = 0
+        for start, end in zip(planeStarts, planeEnds):
+            maxDiameter = max(maxDiameter, self.__maximumPairwiseDistance__(corners[start:end] * [z, y, x]))
         return (maxDiameter)
 
+    def __surfaceCorners__(self, matrixSA, matrixSACoordinates, planeAxis=None):
+        """ Corners (in voxel coordinates) of all the voxels in the surface of the ROI
+        :param planeAxis: when it is not None, the corners of the contour of every slice orthogonal to this axis,
+            just in the plane of the slice (the corners of a voxel with index k in planeAxis have the coordinate k)
+        :return: numpy array of unique points with shape (n, 3)
+        """
+        roi = numpy.zeros(matrixSA.shape, dtype=bool)
+        roi[matrixSACoordinates] = True
+        # Surface voxels: at least one of the 6 neighbors (4 in plane) is outside the ROI (the matrix is padded)
+        interior = roi.copy()
+        inner = [slice(1, -1)] * 3
+        for axis in xrange(3):
+            if axis == planeAxis:
+                continue
+            inner[axis] = slice(None, -2)
+            lowerNeighbors = roi[tuple(inner)]
+            inner[axis] = slice(2, None)
+            upperNeighbors = roi[tuple(inner)]
+            inner[axis] = slice(1, -1)
+            interior[tuple(inner)] &= lowerNeighbors & upperNeighbors
+        surfaceVoxels = numpy.transpose(numpy.nonzero(roi & ~interior))
+        offsets = numpy.array([(i, j, k) for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+        if planeAxis is not None:
+            offsets = offsets[offsets[:, planeAxis] == 0]
+        corners = (surfaceVoxels[:, None, :] + offsets[None, :, :]).reshape(-1, 3)
+        # Remove duplicated corners shared by neighbor voxels
+        shape = numpy.array(matrixSA.shape) + 1
+        keys = numpy.unique(numpy.ravel_multi_index(corners.T, shape))
+        return (numpy.transpose(numpy.unravel_index(keys, shape)))
+
+    def __lineExtremes__(self, points, axis):
+        """ Keep only the first and the last point of every line parallel to 'axis' (the points in between
+        can never be vertices of the convex hull)
+        :param points: numpy array of integer points with shape (n, 3)
+        :return: filtered points
+        """
+        if points.shape[0] == 0:
+            return points
+        otherAxes = [a for a in xrange(3) if a != axis]
+        order = numpy.lexsort((points[:, axis], points[:, otherAxes[1]], points[:, otherAxes[0]]))
+        points = points[order]
+        lineChange = numpy.any(points[1:, otherAxes] != points[:-1, otherAxes], axis=1)
+        first = numpy.concatenate(([True], lineChange))
+        last = numpy.concatenate((lineChange, [True]))
+        return (points[first | last])
+
+    def __convexHullVertices__(self, points):
+        """ Vertices of the convex hull of the points when scipy is available.
+        Otherwise, all the points are returned (the results are the same, just slower)
+        """
+        try:
+            from scipy.spatial import ConvexHull
+            return (points[ConvexHull(points).vertices])
+        except Exception:
+            # scipy not available or degenerated hull (ex: flat ROI)
+            return (points)
+
+    def __maximumPairwiseDistance__(self, points, blockSize=1024):
+        """ Maximum euclidean distance between any pair of points (computed by blocks to bound the memory usage)
+        """
+        maxDistance2 = 0
+        for start in xrange(0, points.shape[0], blockSize):
+            block = points[start:start + blockSize]
+            distances2 = numpy.sum((block[:, None, :] - points[None, start:, :]) ** 2, axis=2)
+            maxDistance2 = max(maxDistance2, distances2.max())
+        return (math.sqrt(maxDistance2))
+
     def sphericalDisproportion(self, surfaceArea, volumeMM3):
         R = ((0.75 * (volumeMM3)) / (math.pi) ** (1 / 3.0))
         return ((surfaceArea) / (4 * math.pi * (R ** 2)))
@@ -110,39 +169,39 @@ class MorphologyStatistics:
     def sphericityValue(self, surfaceArea, volumeMM3):
         return (((math.pi) ** (1 / 3.0) * (6 * volumeMM3) ** (2 / 3.0)) / (surfaceArea))
 
-    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None):
-        # Evaluate dictionary elements corresponding to user-selected keys
-        if not self.keys:
-            return (self.morphologyStatistics)
+    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None, profiler=None,
+                         checkpointFunction=None):
+        # Evaluate the features corresponding to user-selected keys
         if len(self.matrixSA) == 0:
-            for key in self.keys:
-                self.morphologyStatistics[key] = 0
-        else:
-            # Volume and Surface Area are pre-calculated even if only one morphology metric is user-selected
-            if printTiming:
-                import time
-                t1 = time.time()
-            self.morphologyStatistics["Volume mm^3"] = eval(self.morphologyStatistics["Volume mm^3"])
-            if printTiming:
-                self.morphologyStatisticsTiming["Volume mm^3"] = time.time() - t1
-            self.morphologyStatistics["Surface Area mm^2"] = eval(self.morphologyStatistics["Surface Area mm^2"])
-            if printTiming:
-                t1 = time.time()
-                self.morphologyStatisticsTiming["Surface Area mm^2"] = time.time() - t1
-
-            if printTiming:
-                for key in self.keys:
-                    if isinstance(self.morphologyStatistics[key], basestring):
-                        t1 = time.time()
-                        self.morphologyStatistics[key] = eval(self.morphologyStatistics[key])
-                        self.morphologyStatisticsTiming[key] = time.time() - t1
-                        if checkStopProcessFunction is not None:
-                            checkStopProcessFunction()
-                return self.morphologyStatistics, self.morphologyStatisticsTiming
-            else:
-                for key in self.keys:
-                    if isinstance(self.morphologyStatistics[key], basestring):
-                        self.morphologyStatistics[key] = eval(self.morphologyStatistics[key])
-                        if checkStopProcessFunction is not None:
-                            checkStopProcessFunction()
-                return self.morphologyStatistics
+            # Nothing to analyze
+            results = collections.OrderedDict((key, 0) for key in self.registry.features if key in self.keys)
+            if not printTiming:
+                return results
+            return results, collections.OrderedDict((key, 0) for key in results)
+        return self.registry.evaluate(self, self.keys, printTiming, checkStopProcessFunction, profiler,
+                                      checkpointFunction)
+
+
+MorphologyStatistics.registry.feature("Volume mm^3", MorphologyStatistics.volumeMM3, "matrixSAValues", "cubicMMPerVoxel")
+MorphologyStatistics.registry.feature("Volume cc", MorphologyStatistics.volumeCC, "matrixSAValues", "cubicMMPerVoxel",
+                                      "ccPerCubicMM")
+MorphologyStatistics.registry.feature("Surface Area mm^2", MorphologyStatistics.surfaceArea, "matrixSA",
+                                      "matrixSACoordinates", "matrixSAValues", "labelNodeSpacing")
+MorphologyStatistics.registry.feature("Surface:Volume Ratio", MorphologyStatistics.surfaceVolumeRatio,
+                                      "Surface Area mm^2", "Volume mm^3")
+MorphologyStatistics.registry.feature("Compactness 1", MorphologyStatistics.compactness1, "Surface Area mm^2",
+                                      "Volume mm^3")
+MorphologyStatistics.registry.feature("Compactness 2", MorphologyStatistics.compactness2, "Surface Area mm^2",
+                                      "Volume mm^3")
+MorphologyStatistics.registry.feature("Maximum 3D Diameter", MorphologyStatistics.maximum3DDiameter,
+                                      "labelNodeSpacing", "matrixSA", "matrixSACoordinates")
+MorphologyStatistics.registry.feature("Maximum 2D Diameter Axial", MorphologyStatistics.maximum2DDiameter,
+                                      "labelNodeSpacing", "matrixSA", "matrixSACoordinates", planeAxis=0)
+MorphologyStatistics.registry.feature("Maximum 2D Diameter Coronal", MorphologyStatistics.maximum2DDiameter,
+                                      "labelNodeSpacing", "matrixSA", "matrixSACoordinates", planeAxis=1)
+MorphologyStatistics.registry.feature("Maximum 2D Diameter Sagittal", MorphologyStatistics.maximum2DDiameter,
+                                      "labelNodeSpacing", "matrixSA", "matrixSACoordinates", planeAxis=2)
+MorphologyStatistics.registry.feature("Spherical Disproportion", MorphologyStatistics.sphericalDisproportion,
+                                      "Surface Area mm^2", "Volume mm^3")
+MorphologyStatistics.registry.feature("Sphericity", MorphologyStatistics.sphericityValue, "Surface Area mm^2",
+                                      "Volume mm^3")
@@ -0,0 +1,152 @@
+import numpy as np
+import collections
+import multiprocessing
+
+from FeatureExtractionEngine import FeatureExtractionEngine
+from ParenchymalVolume import ParenchymalVolume
+from ProgressReporter import ProgressReporter, AnalysisCancelled
+from SphereROI import SphereROI
+
+def analyzeNodule(params):
+    """ Calculate the features of a nodule and of the spheres around it, in a crop of the volume.
+    It is a module function so that it can be run in a worker process
+    :param params: tuple (noduleId, volumeArray, labelmapArray, spacing, featureCategoriesKeys, featureKeys, radii,
+        quantization, diskCache, analyzeNodule), where volumeArray and labelmapArray are crops that contain the nodule
+        and all its spheres
+    :return: tuple (noduleId, OrderedDict of Region-Results, dictionary of Radius-(sphere labelmap, sphere offset))
+    """
+    noduleId, volumeArray, labelmapArray, spacing, featureCategoriesKeys, featureKeys, radii, quantization, \
+        diskCache, analyzeNodule = params
+    results = collections.OrderedDict()
+    spheres = dict()
+    noduleArray = labelmapArray == noduleId
+    if analyzeNodule:
+        engine = FeatureExtractionEngine(volumeArray, noduleArray, spacing, featureCategoriesKeys, featureKeys,
+                                         quantization=quantization, diskCache=diskCache)
+        results["Nodule"] = engine.run(collections.OrderedDict())
+
+    if len(radii) > 0:
+        centroid = np.asarray(np.round(np.mean(np.where(noduleArray), axis=1), 0), np.int)
+        distanceMap, offset = SphereROI.distanceMap(centroid, max(radii), spacing, labelmapArray.shape)
+        volumeCropArray = volumeArray[SphereROI.cropSlices(offset, distanceMap.shape)]
+        for radius in radii:
+            # All the nodules are excluded from the sphere
+            sphereArray = SphereROI.sphereLabelmap(distanceMap, offset, radius, labelmapArray)
+            if not sphereArray.any():
+                # Nothing to analyze
+                results[radius] = collections.OrderedDict((key, 0) for key in featureKeys)
+            else:
+                engine = FeatureExtractionEngine(volumeCropArray, sphereArray, spacing, featureCategoriesKeys,
+                                                 featureKeys, labelmapROIOffset=offset, quantization=quantization,
+                                                 diskCache=diskCache)
+                results[radius] = engine.run(collections.OrderedDict())
+            spheres[radius] = (sphereArray, offset)
+    return (noduleId, results, spheres)
+
+
+class MultiNoduleAnalysis:
+    def __init__(self, volumeArray, labelmapArray, spacing, featureCategoriesKeys, featureKeys, radii=(),
+                 parenchymaLabelmapArray=None, noduleIds=None, quantization=None, diskCache=None,
+                 analyzeNodules=True):
+        """ Feature extraction for several nodules of the same volume. Every label of the labelmap is a different
+        nodule, and every nodule (and the spheres around it) is analyzed in its own crop of the volume, so the
+        nodules can be analyzed in parallel in a pool of worker processes
+        :param volumeArray: numpy array of the intensities volume
+        :param labelmapArray: numpy array of the labelmap with all the nodules (one label per nodule)
+        :param spacing: spacing of the volume (XYZ)
+        :param featureCategoriesKeys: main categories that have some feature that is going to be analyzed
+        :param featureKeys: features that are going to be analyzed
+        :param radii: radii in mm of the spheres around each nodule (the spheres exclude all the nodules)
+        :param parenchymaLabelmapArray: emphysema labelmap for the whole volume (needed for "Parenchymal Volume")
+        :param noduleIds: labels to analyze. When None, all the labels different from 0
+        :param quantization: GrayLevelQuantization applied before the texture features are calculated
+        :param diskCache: FeatureDiskCache shared by the workers to reuse and store the features of every ROI
+        :param analyzeNodules: analyze the nodules themselves. When False, just the spheres around them are analyzed
+        """
+        self.volumeArray = volumeArray
+        self.labelmapArray = labelmapArray
+        self.spacing = spacing
+        self.featureCategoriesKeys = set(featureCategoriesKeys)
+        self.featureKeys = set(featureKeys)
+        self.radii = list(radii)
+        self.parenchymaLabelmapArray = parenchymaLabelmapArray
+        if noduleIds is None:
+            noduleIds = [n for n in np.unique(labelmapArray) if n != 0]
+        self.noduleIds = list(noduleIds)
+        self.quantization = quantization
+        self.diskCache = diskCache
+        self.analyzeNodules = analyzeNodules
+
+    def getNoduleCrop(self, noduleId):
+        """ Bounding box of a nodule, with a margin big enough to contain all its spheres
+        :param noduleId: label of the nodule
+        :return: tuple (offset (ZYX), shape) of the crop
+        """
+        coordinates = np.where(self.labelmapArray == noduleId)
+        margin = np.ceil(max(self.radii + [0]) / np.array(self.spacing[::-1], np.float64)).astype(np.int) + 1
+        lower = np.maximum(np.min(coordinates, axis=1) - margin, 0)
+        upper = np.minimum(np.max(coordinates, axis=1) + margin + 1, self.labelmapArray.shape)
+        return (tuple(lower), tuple(upper - lower))
+
+    def run(self, processes=None, progressReporter=None):
+        """ Analyze all the nodules
+        :param processes: number of worker processes (default: number of cpus). When 1, the nodules are
+            analyzed in the current process
+        :param progressReporter: ProgressReporter that is notified when each nodule is finished and that stops
+            the process when it is cancelled. Then an AnalysisCancelled exception is raised with the results of the
+            nodules already finished (and the ids of the rest of nodules as skipped)
+        :return: OrderedDict of NoduleId-(OrderedDict of Region-Results), where Region is "Nodule" (when
+            analyzeNodules is True) or a radius
+        """
+        if progressReporter is None:
+            progressReporter = ProgressReporter()
+        # The parenchymal volume is calculated here, because it needs the labelmap of the whole volume
+        workerCategoriesKeys = self.featureCategoriesKeys.difference(["Parenchymal Volume"])
+        parenchymaKeys = self.featureKeys.intersection(ParenchymalVolume.getAllEmphysemaDescriptions())
+        workerFeatureKeys = self.featureKeys.difference(parenchymaKeys)
+
+        crops = dict()
+        params = []
+        for noduleId in self.noduleIds:
+            crops[noduleId] = self.getNoduleCrop(noduleId)
+            slices = SphereROI.cropSlices(*crops[noduleId])
+            params.append((noduleId, self.volumeArray[slices], self.labelmapArray[slices], self.spacing,
+                           workerCategoriesKeys, workerFeatureKeys, self.radii, self.quantization,
+                           self.diskCache, self.analyzeNodules))
+
+        if "Parenchymal Volume" in self.featureCategoriesKeys:
+            # The voxels of every emphysema type are counted just once for all the spheres
+            parenchymaLabelCounts = ParenchymalVolume.getLabelCounts(self.parenchymaLabelmapArray)
+
+        results = dict()
+        if processes == 1:
+            pool = None
+            iterator = (analyzeNodule(p) for p in params)
+        else:
+            pool = multiprocessing.Pool(processes)
+            iterator = pool.imap_unordered(analyzeNodule, params)
+        try:
+            for noduleId, noduleResults, spheres in iterator:
+                if "Parenchymal Volume" in self.featureCategoriesKeys:
+                    for radius, (sphereArray, offset) in spheres.iteritems():
+                        offset = tuple(o + c for o, c in zip(offset, crops[noduleId][0]))
+                        parenchymalVolume = ParenchymalVolume(self.parenchymaLabelmapArray, sphereArray,
+                                                              self.spacing, parenchymaKeys, offset,
+                                                              parenchymaLabelCounts)
+                        noduleResults[radius].update(parenchymalVolume.EvaluateFeatures())
+                results[noduleId] = noduleResults
+                progressReporter.update("Nodule {0}".format(noduleId), len(results))
+                progressReporter.checkStopProcess()
+            if pool is not None:
+                pool.close()
+        except StopIteration as ex:
+            raise AnalysisCancelled(str(ex), collections.OrderedDict((noduleId, results[noduleId])
+                                                                     for noduleId in self.noduleIds
+                                                                     if noduleId in results),
+                                    skipped=[noduleId for noduleId in self.noduleIds if noduleId not in results])
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        return collections.OrderedDict((noduleId, results[noduleId]) for noduleId in self.noduleIds)
@@ -1,22 +1,32 @@
-from __main__ import vtk, qt, ctk, slicer
 import numpy as np
+import time
 from collections import OrderedDict
 
+from FeatureProfiler import FeatureProfiler, KIND_FEATURE
+
 class ParenchymalVolume:
-    def __init__(self, parenchymaLabelmapArray, sphereWithoutTumorLabelmapArray, spacing, keysToAnalyze=None):
+    def __init__(self, parenchymaLabelmapArray, sphereWithoutTumorLabelmapArray, spacing, keysToAnalyze=None,
+                 sphereOffset=(0, 0, 0), labelCounts=None):
         """ Parenchymal volume study.
         Compare each ones of the different labels in the original labelmap with the volume of the area of interest
         :param parenchymaLabelmapArray: original labelmap for the whole volume node
-        :param sphereWithoutTumorLabelmapArray: labelmap array that contains the sphere to study without the tumor
+        :param sphereWithoutTumorLabelmapArray: labelmap array that contains the sphere to study without the tumor.
+            It can be a crop of the whole volume (see sphereOffset)
         :param spacing: tuple of volume spacing
         :param keysToAnalyze: list of strings with the types of emphysema it's going to be analyzed. When None,
             all the types will be analyzed
+        :param sphereOffset: position (ZYX) of sphereWithoutTumorLabelmapArray in the whole volume
+        :param labelCounts: number of voxels of every label of parenchymaLabelmapArray (see getLabelCounts). It can
+            be shared by all the ROIs analyzed over the same labelmap. When None, it is calculated
         """
         self.parenchymaLabelmapArray = parenchymaLabelmapArray
         self.sphereWithoutTumorLabelmapArray = sphereWithoutTumorLabelmapArray
         self.spacing = spacing
+        self.sphereSlices = tuple(slice(o, o + s) for o, s in zip(sphereOffset, sphereWithoutTumorLabelmapArray.shape))
         self.parenchymalVolumeStatistics = OrderedDict()
         self.parenchymalVolumeStatisticsTiming = OrderedDict()
+        self.labelCounts = labelCounts
+        self.__sphereLabelCounts__ = None
 
         allKeys = self.getAllEmphysemaTypes().keys()
         if keysToAnalyze is not None:
@@ -46,36 +56,75 @@ class ParenchymalVolume:
     def getAllEmphysemaDescriptions():
         return ParenchymalVolume.getAllEmphysemaTypes().keys()
 
+    @staticmethod
+    def getLabelCounts(labelmapArray):
+        """ Number of voxels of every label of a labelmap. The negative labels are ignored
+        :param labelmapArray: numpy array of the labelmap
+        :return: tuple (sorted array with the labels present in the labelmap; number of voxels of each one)
+        """
+        labels = labelmapArray.ravel()
+        if labels.dtype.kind not in "iu":
+            labels = labels.astype(np.int64)
+        if labels.size > 0 and labels.min() < 0:
+            labels = labels[labels >= 0]
+        if labels.size == 0:
+            return (np.zeros(0, np.int64), np.zeros(0, np.int64))
+        if labels.max() < 2 ** 16:
+            # Usual labelmaps: a single pass over the array
+            counts = np.bincount(labels)
+            present = np.nonzero(counts)[0]
+            return (present, counts[present])
+        # Big label codes: just the labels present are counted, without an array as big as the maximum label
+        return np.unique(labels, return_counts=True)
+
+    @staticmethod
+    def countLabel(labelCounts, code):
+        """ Number of voxels of a label
+        :param labelCounts: tuple returned by getLabelCounts
+        :param code: label
+        """
+        labels, counts = labelCounts
+        i = np.searchsorted(labels, code)
+        return counts[i] if i < labels.size and labels[i] == code else 0
+
     def analyzeType(self, code):
-        print("DEBUG: analyze code {0}.".format(code))
+        # The voxels of every label are counted just once for all the emphysema types
+        if self.labelCounts is None:
+            self.labelCounts = self.getLabelCounts(self.parenchymaLabelmapArray)
         # Calculate volume for the studied ROI (tumor)
-        totalVolume = np.sum(self.parenchymaLabelmapArray == code)
+        totalVolume = self.countLabel(self.labelCounts, code)
         if totalVolume == 0:
             return 0
 
         # Calculate total volume in the sphere for this emphysema type
-        sphereVolume = np.sum(self.parenchymaLabelmapArray[self.sphereWithoutTumorLabelmapArray] == code)
+        if self.__sphereLabelCounts__ is None:
+            self.__sphereLabelCounts__ = self.getLabelCounts(
+                self.parenchymaLabelmapArray[self.sphereSlices][self.sphereWithoutTumorLabelmapArray])
+        sphereVolume = self.countLabel(self.__sphereLabelCounts__, code)
 
         # Result: SV / PV
         return float(sphereVolume) / totalVolume
 
-    def EvaluateFeatures(self, printTiming = False, checkStopProcessFunction=None):
+    def EvaluateFeatures(self, printTiming = False, checkStopProcessFunction=None, profiler=None,
+                         checkpointFunction=None):
         # Evaluate dictionary elements corresponding to user-selected keys
         types = self.getAllEmphysemaTypes()
+        if profiler is None:
+            profiler = FeatureProfiler(enabled=False)
 
-        if not printTiming:
-            for key in self.keysToAnalyze:
-                self.parenchymalVolumeStatistics[key] = self.analyzeType(types[key])
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
-            return self.parenchymalVolumeStatistics
-
-        else:
-            import time
+        for key in self.keysToAnalyze:
             t1 = time.time()
-            for key in self.keysToAnalyze:
+            with profiler.measure("Parenchymal Volume", key, KIND_FEATURE):
                 self.parenchymalVolumeStatistics[key] = self.analyzeType(types[key])
+            if printTiming:
                 self.parenchymalVolumeStatisticsTiming[key] = time.time() - t1
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
+            if checkpointFunction is not None:
+                checkpointFunction(key, self.parenchymalVolumeStatistics[key],
+                                   self.parenchymalVolumeStatisticsTiming.get(key))
+            if checkStopProcessFunction is not None:
+                checkStopProcessFunction()
+
+        if not printTiming:
+            return self.parenchymalVolumeStatistics
+        else:
             return self.parenchymalVolumeStatistics, self.parenchymalVolumeStatisticsTiming
@@ -0,0 +1,159 @@
+import sys
+import threading
+import logging
+import collections
+
+class AnalysisCancelled(StopIteration):
+    def __init__(self, message="Progress cancelled!!!", results=None, timings=None, skipped=()):
+        """ The process was cancelled. It is a StopIteration (the exception raised by checkStopProcess), so the
+        existing handlers keep working, but it also carries the partial results that were completed before the
+        cancellation, so that they are not lost
+        :param message: description
+        :param results: OrderedDict of Key-Value with the results that were completed (ex: features or nodules)
+        :param timings: OrderedDict of Key-Timing of the completed results (when the timing was calculated)
+        :param skipped: keys that were not calculated because of the cancellation
+        """
+        StopIteration.__init__(self, message)
+        self.results = results if results is not None else collections.OrderedDict()
+        self.timings = timings if timings is not None else collections.OrderedDict()
+        self.skipped = list(skipped)
+
+
+class CancelToken:
+    def __init__(self, event=None):
+        """ Cooperative cancellation flag that can be shared between threads.
+        The process checks it periodically and stops when it has been cancelled
+        :param event: threading.Event or multiprocessing.Event used as the flag (ex: to share the token with worker
+            processes). When None, a new threading.Event is created
+        """
+        self.__event__ = event if event is not None else threading.Event()
+
+    def cancel(self):
+        """ Request the process to stop
+        """
+        self.__event__.set()
+
+    @property
+    def cancelled(self):
+        return self.__event__.is_set()
+
+
+class ProgressReporter:
+    def __init__(self, cancelToken=None):
+        """ Progress/cancellation interface used by FeatureExtractionEngine.
+        This base class does not report anything (no-op), but it stops the process when the cancelToken
+        (if any) is cancelled
+        :param cancelToken: CancelToken (optional)
+        """
+        self.cancelToken = cancelToken
+
+    def start(self, description, maximum):
+        """ A new process starts
+        :param description: description of the process
+        :param maximum: total number of steps of the process
+        """
+        pass
+
+    def update(self, description, value):
+        """ The process progressed
+        :param description: description of the current step
+        :param value: number of steps already finished
+        """
+        pass
+
+    def finish(self):
+        """ The process finished (or was cancelled)
+        """
+        pass
+
+    def checkStopProcess(self):
+        """ Raise StopIteration if the process must be stopped
+        """
+        if self.cancelToken is not None and self.cancelToken.cancelled:
+            raise StopIteration("Progress cancelled!!!")
+
+
+class LoggingProgressReporter(ProgressReporter):
+    def __init__(self, cancelToken=None, logger=None):
+        """ Report the progress to a logger
+        :param cancelToken: CancelToken (optional)
+        :param logger: logger to use (default: root logger)
+        """
+        ProgressReporter.__init__(self, cancelToken)
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.description = ""
+        self.maximum = 0
+
+    def start(self, description, maximum):
+        self.description = description
+        self.maximum = maximum
+        self.logger.info("{0}: started".format(description))
+
+    def update(self, description, value):
+        self.logger.info("{0}: {1} ({2}/{3})".format(self.description, description, value, self.maximum))
+
+    def finish(self):
+        self.logger.info("{0}: finished".format(self.description))
+
+
+class ThreadProgressReporter(ProgressReporter):
+    def __init__(self, cancelToken=None):
+        """ Store the last progress reported by a worker thread, so that the GUI thread can poll it
+        (ex: to refresh a progress bar) without touching any widget from the worker thread
+        :param cancelToken: CancelToken (optional)
+        """
+        ProgressReporter.__init__(self, cancelToken)
+        self.__lock__ = threading.Lock()
+        self.__state__ = ("", 0, 0, False)
+
+    @property
+    def state(self):
+        """ Last progress reported
+        :return: tuple (description, value, maximum, finished)
+        """
+        with self.__lock__:
+            return self.__state__
+
+    def start(self, description, maximum):
+        with self.__lock__:
+            self.__state__ = (description, 0, maximum, False)
+
+    def update(self, description, value):
+        with self.__lock__:
+            self.__state__ = (description, value, self.__state__[2], False)
+
+    def finish(self):
+        with self.__lock__:
+            self.__state__ = self.__state__[:3] + (True,)
+
+
+class BackgroundTask(threading.Thread):
+    def __init__(self, function, *args, **kwargs):
+        """ Run a function in a daemon worker thread and keep its result (or the exception raised, with its traceback)
+        :param function: function to run
+        :param args: positional arguments for the function
+        :param kwargs: keyword arguments for the function
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.__result__ = None
+        self.__excInfo__ = None
+
+    def run(self):
+        try:
+            self.__result__ = self.function(*self.args, **self.kwargs)
+        except Exception:
+            self.__excInfo__ = sys.exc_info()
+
+    @property
+    def result(self):
+        """ Result of the function. If the function raised an exception, the original exception is raised again in
+        the calling thread, with the traceback of the worker thread
+        """
+        if self.__excInfo__ is not None:
+            excType, excValue, excTraceback = self.__excInfo__
+            raise excType, excValue, excTraceback
+        return self.__result__
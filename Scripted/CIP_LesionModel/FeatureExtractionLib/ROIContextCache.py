@@ -0,0 +1,89 @@
+import hashlib
+import collections
+import numpy as np
+
+
+class ROIContext:
+    def __init__(self, key):
+        """ Preprocessed data for a concrete ROI (a labelmap over an intensities volume) that can be shared by
+        different feature extraction runs: voxel coordinates, cropped/padded matrices, histogram...
+        and the values of the features already calculated for this ROI
+        :param key: key of the context in the cache
+        """
+        self.key = key
+        self.__items__ = dict()
+        # Feature-Value for the features already calculated for this ROI
+        self.results = collections.OrderedDict()
+        # Feature-Timing for the features already calculated for this ROI
+        self.timings = collections.OrderedDict()
+
+    def get(self, itemKey, calculateFunction):
+        """ Get a preprocessed item for this ROI. If it was not calculated yet, calculate it and store it.
+        :param itemKey: hashable key of the item (ex: "histogram" or ("padMatrix", (16,16,16)))
+        :param calculateFunction: function without arguments that calculates the item
+        :return: item value
+        """
+        if itemKey not in self.__items__:
+            self.__items__[itemKey] = calculateFunction()
+        return self.__items__[itemKey]
+
+    def set(self, itemKey, value):
+        """ Store (or replace) a preprocessed item for this ROI
+        :param itemKey: hashable key of the item
+        :param value: item value
+        """
+        self.__items__[itemKey] = value
+
+    def discardResults(self, featureKeys):
+        """ Remove some features already calculated, so that they are calculated again in the next run
+        (ex: when they depend on a parameter that changed)
+        :param featureKeys: features to remove
+        """
+        for key in featureKeys:
+            self.results.pop(key, None)
+            self.timings.pop(key, None)
+
+
+class ROIContextCache:
+    def __init__(self, maxSize=10):
+        """ LRU cache of ROIContext objects, identified by the volume id, the content of the labelmap and the spacing
+        :param maxSize: maximum number of contexts stored. When exceeded, the least recently used context is removed
+        """
+        self.maxSize = maxSize
+        self.__contexts__ = collections.OrderedDict()
+
+    @staticmethod
+    def getKey(volumeID, labelmapArray, spacing, offset=(0, 0, 0)):
+        """ Key that identifies a ROI context
+        :param volumeID: id of the intensities volume node
+        :param labelmapArray: numpy array of the labelmap that defines the ROI
+        :param spacing: spacing of the volume
+        :param offset: position of labelmapArray in the volume, when it is a crop
+        :return: tuple (volumeID, labelmap content hash, spacing, offset)
+        """
+        sha = hashlib.sha1()
+        sha.update(str(labelmapArray.shape))
+        sha.update(str(labelmapArray.dtype))
+        sha.update(np.ascontiguousarray(labelmapArray).data)
+        return (volumeID, sha.hexdigest(), tuple(spacing), tuple(offset))
+
+    def getContext(self, volumeID, labelmapArray, spacing, offset=(0, 0, 0)):
+        """ Get the context for this ROI, creating a new empty one if it was not cached
+        :return: ROIContext
+        """
+        key = self.getKey(volumeID, labelmapArray, spacing, offset)
+        if key in self.__contexts__:
+            # Most recently used context goes to the end
+            context = self.__contexts__.pop(key)
+        else:
+            context = ROIContext(key)
+            while len(self.__contexts__) >= self.maxSize:
+                # Remove the least recently used context
+                self.__contexts__.popitem(last=False)
+        self.__contexts__[key] = context
+        return context
+
+    def clear(self):
+        """ Remove all the cached contexts
+        """
+        self.__contexts__.clear()
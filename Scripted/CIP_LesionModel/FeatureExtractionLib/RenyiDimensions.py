@@ -1,97 +1,94 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
 import operator
 import collections
+from FeatureRegistry import FeatureRegistry
 
 class RenyiDimensions:
+    registry = FeatureRegistry("Renyi Dimensions", version=2)
 
     def __init__(self, matrixPadded, matrixPaddedCoordinates, allKeys):
-        self.renyiDimensions = collections.OrderedDict()
-        self.renyiDimensions["Box-Counting Dimension"] = "self.renyiDimension(self.matrixPadded, self.matrixPaddedCoordinates, 0)"
-        self.renyiDimensions["Information Dimension"] = "self.renyiDimension(self.matrixPadded, self.matrixPaddedCoordinates, 1)"
-        self.renyiDimensions["Correlation Dimension"] = "self.renyiDimension(self.matrixPadded, self.matrixPaddedCoordinates, 2)"
-        
-        self.renyiDimensionTiming = collections.OrderedDict()
-        
         self.matrixPadded = matrixPadded
         self.matrixPaddedCoordinates = matrixPaddedCoordinates
         self.allKeys = allKeys
+        self.checkStopProcessFunction = None
         
              
-    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None):
+    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None, profiler=None,
+                         checkpointFunction=None):
         self.checkStopProcessFunction=checkStopProcessFunction
-        keys = set(self.allKeys).intersection(self.renyiDimensions.keys())
-        if not printTiming:
-            if not keys:
-                return self.renyiDimensions
-            
-            #Evaluate dictionary elements corresponding to user selected keys
-            for key in keys:
-                self.renyiDimensions[key] = eval(self.renyiDimensions[key])
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
-            return self.renyiDimensions
-        else:
-            if not keys:
-                return self.renyiDimensions, self.renyiDimensionTiming
+        keys = set(self.allKeys).intersection(self.registry.features.keys())
+        # Evaluate the features corresponding to user selected keys
+        return self.registry.evaluate(self, keys, printTiming, checkStopProcessFunction, profiler,
+                                      checkpointFunction)
 
-            import time
-            #Evaluate dictionary elements corresponding to user selected keys
-            for key in keys:
-                t1 = time.time()
-                self.renyiDimensions[key] = eval(self.renyiDimensions[key])
-                self.renyiDimensionTiming[key] = time.time() - t1
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
-            return self.renyiDimensions, self.renyiDimensionTiming
-        
-            
-    def renyiDimension(self, c, matrixCoordinatesPadded, q=0): 
+    def renyiDimension(self, boxPyramid, q=0):
         # computes renyi dimensions for q = 0,1,2 (box-count(default, q=0), information(q=1), and correlation dimensions(q=2))
-        # for a padded 3D input array or matrix, c, and the coordinates of values in c, matrixCoordinatesPadded.
-        # c must be padded to a cube with shape equal to next greatest power of two 
-        # i.e. a 3D array with shape: (3,13,9) is padded to shape: (16,16,16)    
-         
-        # exception for numpy.sum(c) = 0?
-        c = c/float(numpy.sum(c))
-        maxDim = c.shape[0]
-        p = int(numpy.log2(maxDim))
+        # (or any other q) from the box pyramid of a padded 3D input array or matrix, c (see buildBoxPyramid).
+        # c must be padded to a cube with shape equal to next greatest power of two
+        # i.e. a 3D array with shape: (3,13,9) is padded to shape: (16,16,16)
+        # The box pyramid of c is shared by all the dimensions, so it is only built once
+
+        massPyramid, occupancyPyramid = boxPyramid
+        p = len(massPyramid) - 1
         n = numpy.zeros(p+1)
         eps = numpy.spacing(1)
-        
-        # Initialize N(s) value at the finest/voxel-level scale
-        if (q==1):
-            n[p] = numpy.sum(c[matrixCoordinatesPadded] * numpy.log(1/(c[matrixCoordinatesPadded] + eps)))
-        else:
-            n[p] = numpy.sum(c[matrixCoordinatesPadded]**q)
-                    
-        for g in xrange(p-1, -1, -1):
-            siz = 2**(p-g)
-            siz2 = round(siz/2)
-            for i in xrange(0, maxDim-siz+1, siz):
-                for j in xrange(0, maxDim-siz+1, siz):
-                    for k in xrange(0, maxDim-siz+1, siz):
-                        box = numpy.array([ c[i,j,k], c[i+siz2,j,k], c[i,j+siz2,k], c[i+siz2,j+siz2,k], c[i,j,k+siz2], c[i+siz2,j,k+siz2], c[i,j+siz2,k+siz2], c[i+siz2,j+siz2,k+siz2] ])
-                        c[i,j,k] =    numpy.any(box != 0) if (q==0) else numpy.sum(box)**q
-                    if self.checkStopProcessFunction is not None:
-                        self.checkStopProcessFunction()
-                        #print (i, j, k, '                ', c[i,j,k])
-            pi = c[0:(maxDim-siz+1):siz, 0:(maxDim-siz+1):siz, 0:(maxDim-siz+1):siz]                            
-            if (q == 1):             
-                n[g] = numpy.sum(pi * numpy.log(1/(pi+eps)))
+
+        # N(s) value for every scale (n[p] is the finest/voxel-level scale). Only the occupied boxes are taken into
+        # account (see buildBoxPyramid)
+        for g in xrange(p+1):
+            if (q == 0):
+                n[g] = numpy.count_nonzero(occupancyPyramid[g])
             else:
-                n[g] = numpy.sum(pi) 
-            #print ('p, g, siz, siz2', p, g, siz, siz2, '         n[g]: ', n[g])
-        
+                pi = massPyramid[g][occupancyPyramid[g]]
+                if (q == 1):
+                    n[g] = numpy.sum(pi * numpy.log(1/(pi+eps)))
+                else:
+                    n[g] = numpy.sum(pi**q)
+
         r = numpy.log(2.0**(numpy.arange(p+1))) # log(1/scale)
-        scaleMatrix = numpy.array([r, numpy.ones(p+1)])             
-        #print ('n(s): ', n)
-        #print ('log (1/s): ', r)
-        
-        if (q != 1):     
+        scaleMatrix = numpy.array([r, numpy.ones(p+1)])
+
+        if (q != 1):
             n = (1/float(1-q)) * numpy.log(n)
         renyiDimension = numpy.linalg.lstsq(scaleMatrix.T, n)[0][0]
-        
+
         return (renyiDimension)
+
+    def buildBoxPyramid(self, c, matrixCoordinatesPadded):
+        """ Build the pyramid of boxes of size 2x2x2, 4x4x4... for the padded matrix c.
+        :return: tuple with 2 lists, where the element g of each list has 2**g boxes per axis:
+            - massPyramid: normalized sum of the values of c in every box
+            - occupancyPyramid: boolean mask with the occupied boxes. At the voxel level, the voxels of the ROI.
+              At the coarser scales, the boxes that contain at least one voxel with a nonzero intensity (so the
+              Box-Counting Dimension of a ROI with zero intensities is the same as in the original box by box loop)
+        """
+        # exception for numpy.sum(c) = 0?
+        mass = c / float(numpy.sum(c))
+        occupancy = numpy.zeros(c.shape, dtype=bool)
+        occupancy[matrixCoordinatesPadded] = True
+        nonzero = (c != 0)
+
+        massPyramid = [mass]
+        occupancyPyramid = [occupancy]
+        size = c.shape[0]
+        while size > 1:
+            size //= 2
+            # Group every 2x2x2 box of the previous scale in the axis 1, 3 and 5
+            mass = mass.reshape(size, 2, size, 2, size, 2).sum(axis=(1, 3, 5))
+            occupancy = nonzero = nonzero.reshape(size, 2, size, 2, size, 2).any(axis=(1, 3, 5))
+            massPyramid.insert(0, mass)
+            occupancyPyramid.insert(0, occupancy)
+            if self.checkStopProcessFunction is not None:
+                self.checkStopProcessFunction()
+
+        return (massPyramid, occupancyPyramid)
+
+
+RenyiDimensions.registry.intermediate("boxPyramid", RenyiDimensions.buildBoxPyramid, "matrixPadded",
+                                      "matrixPaddedCoordinates")
+
+RenyiDimensions.registry.feature("Box-Counting Dimension", RenyiDimensions.renyiDimension, "boxPyramid", q=0)
+RenyiDimensions.registry.feature("Information Dimension", RenyiDimensions.renyiDimension, "boxPyramid", q=1)
+RenyiDimensions.registry.feature("Correlation Dimension", RenyiDimensions.renyiDimension, "boxPyramid", q=2)
@@ -0,0 +1,53 @@
+import numpy as np
+
+class SphereROI:
+    """ Spheres around a point of a volume (ex: nodule centroid), calculated just in the bounding box of the sphere.
+    All the arrays and coordinates are in numpy (ZYX) order, while the spacing is in ITK/VTK (XYZ) order
+    """
+    @staticmethod
+    def distanceMap(center, radius, spacing, shape):
+        """ Euclidean distance in mm to the center for all the voxels in the bounding box of a sphere.
+        The distance is calculated analytically (it is what a fast marching with constant speed approximates)
+        :param center: center of the sphere (ZYX voxel coordinates)
+        :param radius: radius of the sphere in mm
+        :param spacing: spacing of the volume (XYZ)
+        :param shape: shape of the whole volume (ZYX)
+        :return: tuple (float32 array with the distances in the bounding box of the sphere, clipped to the volume;
+            offset (ZYX) of the bounding box in the volume)
+        """
+        spacing = np.array(spacing[::-1], np.float64)
+        center = np.asarray(center, np.int)
+        halfSize = np.ceil(radius / spacing).astype(np.int)
+        lower = np.maximum(center - halfSize, 0)
+        upper = np.minimum(center + halfSize + 1, shape)
+        z, y, x = np.ogrid[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+        distances = ((z - center[0]) * spacing[0]) ** 2 + ((y - center[1]) * spacing[1]) ** 2 \
+                    + ((x - center[2]) * spacing[2]) ** 2
+        return (np.sqrt(distances).astype(np.float32), tuple(lower))
+
+    @staticmethod
+    def sphereLabelmap(distanceMap, offset, radius, labelmapArray, labelId=None):
+        """ Labelmap of a sphere that EXCLUDES the voxels of a labelmap (ex: the nodule itself)
+        :param distanceMap: distances in the bounding box of a sphere (see distanceMap)
+        :param offset: offset of the bounding box in the volume
+        :param radius: radius of the sphere in mm (it can be smaller than the radius used to build the distance map)
+        :param labelmapArray: whole labelmap array with the voxels that will be excluded
+        :param labelId: label of the excluded voxels. When None, all the voxels different from 0 are excluded
+        :return: boolean array with the same shape and offset as distanceMap
+        """
+        array = distanceMap <= radius
+        labelmapCrop = labelmapArray[SphereROI.cropSlices(offset, distanceMap.shape)]
+        if labelId is None:
+            array[labelmapCrop != 0] = False
+        else:
+            array[labelmapCrop == labelId] = False
+        return array
+
+    @staticmethod
+    def cropSlices(offset, shape):
+        """ Slices that extract a crop from a whole volume array
+        :param offset: offset of the crop (ZYX)
+        :param shape: shape of the crop
+        :return: tuple of slices
+        """
+        return tuple(slice(o, o + s) for o, s in zip(offset, shape))
@@ -1,173 +1,189 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
 import operator
 import collections
-import time
 
 
+from FeatureRegistry import FeatureRegistry
+
 # from decimal import *
 
 class TextureGLCM:
-    def __init__(self, grayLevels, numGrayLevels, parameterMatrix, parameterMatrixCoordinates, parameterValues,
-                 allKeys, checkStopProcessFunction):
-        self.textureFeaturesGLCM = collections.OrderedDict()
-        self.textureFeaturesGLCMTiming = collections.OrderedDict()
-
-        self.textureFeaturesGLCM["Autocorrelation"] = "self.autocorrelationGLCM(self.P_glcm, self.prodMatrix)"
-        self.textureFeaturesGLCM[
-            "Cluster Prominence"] = "self.clusterProminenceGLCM(self.P_glcm, self.sumMatrix, self.ux, self.uy)"
-        self.textureFeaturesGLCM[
-            "Cluster Shade"] = "self.clusterShadeGLCM(self.P_glcm, self.sumMatrix, self.ux, self.uy)"
-        self.textureFeaturesGLCM[
-            "Cluster Tendency"] = "self.clusterTendencyGLCM(self.P_glcm, self.sumMatrix, self.ux, self.uy)"
-        self.textureFeaturesGLCM["Contrast"] = "self.contrastGLCM(self.P_glcm, self.diffMatrix)"
-        self.textureFeaturesGLCM[
-            "Correlation"] = "self.correlationGLCM(self.P_glcm, self.prodMatrix, self.ux, self.uy, self.sigx, self.sigy)"
-        self.textureFeaturesGLCM["Difference Entropy"] = "self.differenceEntropyGLCM(self.pxSuby, self.eps)"
-        self.textureFeaturesGLCM["Dissimilarity"] = "self.dissimilarityGLCM(self.P_glcm, self.diffMatrix)"
-        self.textureFeaturesGLCM["Energy (GLCM)"] = "self.energyGLCM(self.P_glcm)"
-        self.textureFeaturesGLCM["Entropy(GLCM)"] = "self.entropyGLCM(self.P_glcm, self.pxy, self.eps)"
-        self.textureFeaturesGLCM["Homogeneity 1"] = "self.homogeneity1GLCM(self.P_glcm, self.diffMatrix)"
-        self.textureFeaturesGLCM["Homogeneity 2"] = "self.homogeneity2GLCM(self.P_glcm, self.diffMatrix)"
-        self.textureFeaturesGLCM["IMC1"] = "self.imc1GLCM(self.HXY, self.HXY1, self.HX, self.HY)"
-        # self.textureFeaturesGLCM["IMC2"] = "sum(imc2)/len(imc2)" #"self.imc2GLCM(self,)"  # produces a calculation error
-        self.textureFeaturesGLCM["IDMN"] = "self.idmnGLCM(self.P_glcm, self.diffMatrix, self.Ng)"
-        self.textureFeaturesGLCM["IDN"] = "self.idnGLCM(self.P_glcm, self.diffMatrix, self.Ng)"
-        self.textureFeaturesGLCM["Inverse Variance"] = "self.inverseVarianceGLCM(self.P_glcm, self.diffMatrix, self.Ng)"
-        self.textureFeaturesGLCM["Maximum Probability"] = "self.maximumProbabilityGLCM(self.P_glcm)"
-        self.textureFeaturesGLCM["Sum Average"] = "self.sumAverageGLCM(self.pxAddy, self.kValuesSum)"
-        self.textureFeaturesGLCM["Sum Entropy"] = "self.sumEntropyGLCM(self.pxAddy, self.eps)"
-        self.textureFeaturesGLCM["Sum Variance"] = "self.sumVarianceGLCM(self.pxAddy, self.kValuesSum)"
-        self.textureFeaturesGLCM["Variance (GLCM)"] = "self.varianceGLCM(self.P_glcm, self.ivector, self.u)"
+    registry = FeatureRegistry("Texture: GLCM")
+    # Offset (ZYX) of the neighbor voxel for each one of the 26 directions of the GLCM matrices
+    angles = numpy.array([(1, 0, 0),
+                          (-1, 0, 0),
+                          (0, 1, 0),
+                          (0, -1, 0),
+                          (0, 0, 1),
+                          (0, 0, -1),
+                          (1, 1, 0),
+                          (-1, 1, 0),
+                          (1, -1, 0),
+                          (-1, -1, 0),
+                          (1, 0, 1),
+                          (-1, 0, 1),
+                          (1, 0, -1),
+                          (-1, 0, -1),
+                          (0, 1, 1),
+                          (0, -1, 1),
+                          (0, 1, -1),
+                          (0, -1, -1),
+                          (1, 1, 1),
+                          (-1, 1, 1),
+                          (1, -1, 1),
+                          (1, 1, -1),
+                          (-1, -1, 1),
+                          (-1, 1, -1),
+                          (1, -1, -1),
+                          (-1, -1, -1)])
 
+    def __init__(self, grayLevels, numGrayLevels, parameterMatrix, parameterMatrixCoordinates, parameterValues,
+                 allKeys, checkStopProcessFunction, P_glcm=None):
+        """
+        :param P_glcm: GLCM matrices (Ng x Ng x distances x directions), when they are already known (ex: accumulated
+            from the concentric shells). Then parameterMatrix, parameterMatrixCoordinates and parameterValues are
+            not used
+        """
         self.grayLevels = grayLevels
         self.parameterMatrix = parameterMatrix
         self.parameterMatrixCoordinates = parameterMatrixCoordinates
         self.parameterValues = parameterValues
         self.Ng = numGrayLevels
-        self.keys = set(allKeys).intersection(self.textureFeaturesGLCM.keys())
-        # Callback function to stop the process if the user decided so. CalculateCoefficients can take a long time to run...
+        self.eps = numpy.spacing(1)
+        self.keys = set(allKeys).intersection(self.registry.features.keys())
+        # Callback function to stop the process if the user decided so. The GLCM matrix can take a long time to run...
         self.checkStopProcessFunction = checkStopProcessFunction
-
-    def CalculateCoefficients(self, printTiming=False):
-        """ Calculate generic coefficients that will be reused in different markers
-        IMPORTANT!! This method is VERY inefficient when the nodule is big (because
-        of the function calculate_glcm at least). If these
-        statistics are required it would probably need some optimizations
-        :return:
-        """
-        # generate container for GLCM Matrices, self.P_glcm
+        if P_glcm is not None:
+            self.P_glcm = P_glcm
+
+    # Generic coefficients that are reused in different markers. Each one of them is calculated only if some of
+    # the selected features needs it.
+    # P_glcm is the biggest array (Ng x Ng x distances x directions), so the coefficients avoid creating temporary
+    # arrays with its shape: the values that only depend on i+j or |i-j| are calculated from pxAddy and pxSuby,
+    # the sums weighted by a (Ng x Ng) matrix are contractions (einsum), and the logarithms are calculated
+    # direction by direction
+    def glcmMatrix(self, grayLevels, parameterMatrix, parameterMatrixCoordinates, Ng):
+        # generate container for GLCM Matrices, P_glcm
         # make distance an optional parameter, as in: distances = numpy.arange(parameter)
         distances = numpy.array([1])
         directions = 26
-        self.P_glcm = numpy.zeros((self.Ng, self.Ng, distances.size, directions))
-        t1 = time.time()
-        self.P_glcm = self.calculate_glcm(self.grayLevels, self.parameterMatrix, self.parameterMatrixCoordinates,
-                                          distances, directions, self.Ng, self.P_glcm)
-        if printTiming:
-            print("- Time to calculate glmc matrix: {0} secs".format(time.time() - t1))
+        # The matrices contain counts of pairs of voxels, that are exact in float32 while they are lower than 2^24
+        # (every count is lower than the number of voxels of the ROI). The sums are accumulated in float64
+        dtype = numpy.float32 if len(parameterMatrixCoordinates[0]) < 2 ** 24 else numpy.float64
+        P_glcm = numpy.zeros((Ng, Ng, distances.size, directions), dtype=dtype)
+        P_glcm = self.calculate_glcm(grayLevels, parameterMatrix, parameterMatrixCoordinates, distances, directions,
+                                     Ng, P_glcm)
         # make each GLCM symmetric an optional parameter
         # if symmetric:
         # Pt = numpy.transpose(P, (1, 0, 2, 3))
         # P = P + Pt
+        return P_glcm
 
-        ##Calculate GLCM Coefficients
-        self.ivector = numpy.arange(1, self.Ng + 1)  # shape = (self.Ng, distances.size, directions)
-        self.jvector = numpy.arange(1, self.Ng + 1)  # shape = (self.Ng, distances.size, directions)
-        self.eps = numpy.spacing(1)
+    def grayLevelVector(self, Ng):
+        # shape = (Ng)
+        return numpy.arange(1, Ng + 1)
 
-        self.prodMatrix = numpy.multiply.outer(self.ivector, self.jvector)  # shape = (self.Ng, self.Ng)
-        self.sumMatrix = numpy.add.outer(self.ivector, self.jvector)  # shape = (self.Ng, self.Ng)
-        self.diffMatrix = numpy.absolute(numpy.subtract.outer(self.ivector, self.jvector))  # shape = (self.Ng, self.Ng)
-        self.kValuesSum = numpy.arange(2, (self.Ng * 2) + 1)  # shape = (2*self.Ng-1)
-        self.kValuesDiff = numpy.arange(0, self.Ng)  # shape = (self.Ng-1)
+    def productMatrix(self, ivector, jvector):
+        # shape = (Ng, Ng)
+        return numpy.multiply.outer(ivector, jvector)
 
-        # shape = (distances.size, directions)
-        self.u = self.P_glcm.mean(0).mean(0)
-        # marginal row probabilities #shape = (self.Ng, distances.size, directions)
-        self.px = self.P_glcm.sum(1)
-        # marginal column probabilities #shape = (self.Ng, distances.size, directions)
-        self.py = self.P_glcm.sum(0)
+    def additionMatrix(self, ivector, jvector):
+        # shape = (Ng, Ng)
+        return numpy.add.outer(ivector, jvector)
 
+    def differenceMatrix(self, ivector, jvector):
+        # shape = (Ng, Ng)
+        return numpy.absolute(numpy.subtract.outer(ivector, jvector))
+
+    def kValuesSumVector(self, Ng):
+        # shape = (2*Ng-1)
+        return numpy.arange(2, (Ng * 2) + 1)
+
+    def kValuesDiffVector(self, Ng):
+        # shape = (Ng)
+        return numpy.arange(0, Ng)
+
+    def meanValue(self, P_glcm):
         # shape = (distances.size, directions)
-        self.ux = self.px.mean(0)
-        # shape = (distances.size, directions)
-        self.uy = self.py.mean(0)
+        return P_glcm.mean(0, dtype=numpy.float64).mean(0)
+
+    def marginalRowProbabilities(self, P_glcm):
+        # shape = (Ng, distances.size, directions)
+        return P_glcm.sum(1, dtype=numpy.float64)
 
+    def marginalColumnProbabilities(self, P_glcm):
+        # shape = (Ng, distances.size, directions)
+        return P_glcm.sum(0, dtype=numpy.float64)
+
+    def marginalMean(self, p):
         # shape = (distances.size, directions)
-        self.sigx = self.px.std(0)
+        return p.mean(0)
+
+    def marginalStd(self, p):
         # shape = (distances.size, directions)
-        self.sigy = self.py.std(0)
+        return p.std(0)
+
+    def sumProbabilities(self, P_glcm, sumMatrix, kValuesSum):
+        # shape = (2*Ng-1, distances.size, directions)
+        return self.__sumByIndex__(P_glcm, sumMatrix - kValuesSum[0], kValuesSum.size)
+
+    def differenceProbabilities(self, P_glcm, diffMatrix, kValuesDiff):
+        # shape = (Ng, distances.size, directions)
+        return self.__sumByIndex__(P_glcm, diffMatrix - kValuesDiff[0], kValuesDiff.size)
 
-        # shape = (2*self.Ng-1, distances.size, directions)
-        self.pxAddy = numpy.array([numpy.sum(self.P_glcm[self.sumMatrix == k], 0) for k in self.kValuesSum])
-        # shape = (self.Ng, distances.size, directions)
-        self.pxSuby = numpy.array([numpy.sum(self.P_glcm[self.diffMatrix == k], 0) for k in self.kValuesDiff])
+    def marginalEntropy(self, p):
+        # entropy of px or py. shape = (distances.size, directions)
+        return (-1) * numpy.sum(self.__pLog2p__(p), 0)
 
-        # entropy of self.px #shape = (distances.size, directions)
-        self.HX = (-1) * numpy.sum((self.px * numpy.where(self.px != 0, numpy.log2(self.px), numpy.log2(self.eps))), 0)
-        # entropy of py #shape = (distances.size, directions)
-        self.HY = (-1) * numpy.sum((self.py * numpy.where(self.py != 0, numpy.log2(self.py), numpy.log2(self.eps))), 0)
+    def jointEntropy(self, P_glcm):
         # shape = (distances.size, directions)
-        self.HXY = (-1) * numpy.sum(
-            numpy.sum((self.P_glcm * numpy.where(self.P_glcm != 0, numpy.log2(self.P_glcm), numpy.log2(self.eps))), 0),
-            0)
-
-        self.pxy = numpy.zeros(self.P_glcm.shape)  # shape = (self.Ng, self.Ng, distances.size, directions)
-        for a in xrange(directions):
-            for g in xrange(distances.size):
-                self.pxy[:, :, g, a] = numpy.multiply.outer(self.px[:, g, a], self.py[:, g, a])
-
-        self.HXY1 = (-1) * numpy.sum(
-            numpy.sum((self.P_glcm * numpy.where(self.pxy != 0, numpy.log2(self.pxy), numpy.log2(self.eps))), 0),
-            0)  # shape = (distances.size, directions)
-        self.HXY2 = (-1) * numpy.sum(
-            numpy.sum((self.pxy * numpy.where(self.pxy != 0, numpy.log2(self.pxy), numpy.log2(self.eps))), 0),
-            0)  # shape = (distances.size, directions)
-        if printTiming:
-            print("- Time to calculate total glmc coefficients: {0} secs".format(time.time() - t1))
+        # Calculated direction by direction, so that the logarithm is never a full copy of P_glcm
+        P = self.__flatMatrices__(P_glcm)
+        hxy = numpy.array([(-1) * numpy.sum(self.__pLog2p__(P[:, c])) for c in xrange(P.shape[1])])
+        return hxy.reshape(P_glcm.shape[2:])
+
+    def crossEntropy(self, HX, HY):
+        # shape = (distances.size, directions)
+        # -sum(P_glcm * log2(px * py)) = -sum(px * log2(px)) - sum(py * log2(py)), because px and py are the sums
+        # of the rows and columns of P_glcm (and P_glcm is 0 where px * py is 0), so the (Ng, Ng) matrix px * py is
+        # not needed
+        return HX + HY
 
     def autocorrelationGLCM(self, P_glcm, prodMatrix, meanFlag=True):
-        ac = numpy.sum(numpy.sum(P_glcm * prodMatrix[:, :, None, None], 0), 0)
+        ac = self.__weightedSum__(P_glcm, prodMatrix)
         if meanFlag:
             return (ac.mean())
         else:
             return ac
 
-    def clusterProminenceGLCM(self, P_glcm, sumMatrix, ux, uy, meanFlag=True):
+    def clusterProminenceGLCM(self, pxAddy, kValuesSum, ux, uy, meanFlag=True):
         # Need to validate function
-        cp = numpy.sum(
-            numpy.sum((P_glcm * ((sumMatrix[:, :, None, None] - ux[None, None, :, :] - uy[None, None, :, :]) ** 4)), 0),
-            0)
+        cp = numpy.sum((pxAddy * ((kValuesSum[:, None, None] - ux[None, :, :] - uy[None, :, :]) ** 4)), 0)
         if meanFlag:
             return (cp.mean())
         else:
             return cp
 
-    def clusterShadeGLCM(self, P_glcm, sumMatrix, ux, uy, meanFlag=True):
+    def clusterShadeGLCM(self, pxAddy, kValuesSum, ux, uy, meanFlag=True):
         # Need to validate function
-        cs = numpy.sum(
-            numpy.sum((P_glcm * ((sumMatrix[:, :, None, None] - ux[None, None, :, :] - uy[None, None, :, :]) ** 3)), 0),
-            0)
+        cs = numpy.sum((pxAddy * ((kValuesSum[:, None, None] - ux[None, :, :] - uy[None, :, :]) ** 3)), 0)
         if meanFlag:
             return (cs.mean())
         else:
             return cs
 
-    def clusterTendencyGLCM(self, P_glcm, sumMatrix, ux, uy, meanFlag=True):
+    def clusterTendencyGLCM(self, pxAddy, kValuesSum, ux, uy, meanFlag=True):
         # Need to validate function
-        ct = numpy.sum(
-            numpy.sum((P_glcm * ((sumMatrix[:, :, None, None] - ux[None, None, :, :] - uy[None, None, :, :]) ** 2)), 0),
-            0)
+        ct = numpy.sum((pxAddy * ((kValuesSum[:, None, None] - ux[None, :, :] - uy[None, :, :]) ** 2)), 0)
         if meanFlag:
             return (ct.mean())
         else:
             return ct
 
-    def contrastGLCM(self, P_glcm, diffMatrix, meanFlag=True):
-        cont = numpy.sum(numpy.sum((P_glcm * (diffMatrix[:, :, None, None] ** 2)), 0), 0)
+    def contrastGLCM(self, pxSuby, kValuesDiff, meanFlag=True):
+        cont = numpy.sum((pxSuby * (kValuesDiff[:, None, None] ** 2)), 0)
         if meanFlag:
             return (cont.mean())
         else:
@@ -177,58 +193,59 @@ class TextureGLCM:
         # Need to validate function
         uxy = ux * uy
         sigxy = sigx * sigy
-        corr = numpy.sum(
-            numpy.sum(((P_glcm * prodMatrix[:, :, None, None] - uxy[None, None, :, :]) / (sigxy[None, None, :, :])), 0),
-            0)
+        # sum((P_glcm * prodMatrix - uxy) / sigxy) over the Ng x Ng elements
+        corr = (self.__weightedSum__(P_glcm, prodMatrix) - prodMatrix.size * uxy) / sigxy
         if meanFlag:
             return (corr.mean())
         else:
             return corr
 
-    def differenceEntropyGLCM(self, pxSuby, eps, meanFlag=True):
-        difent = numpy.sum((pxSuby * numpy.where(pxSuby != 0, numpy.log2(pxSuby), numpy.log2(eps))), 0)
+    def differenceEntropyGLCM(self, pxSuby, meanFlag=True):
+        difent = numpy.sum(self.__pLog2p__(pxSuby), 0)
         if meanFlag:
             return (difent.mean())
         else:
             return difent
 
-    def dissimilarityGLCM(self, P_glcm, diffMatrix, meanFlag=True):
-        dis = numpy.sum(numpy.sum((P_glcm * diffMatrix[:, :, None, None]), 0), 0)
+    def dissimilarityGLCM(self, pxSuby, kValuesDiff, meanFlag=True):
+        dis = numpy.sum((pxSuby * kValuesDiff[:, None, None]), 0)
         if meanFlag:
             return (dis.mean())
         else:
             return dis
 
     def energyGLCM(self, P_glcm, meanFlag=True):
-        ene = numpy.sum(numpy.sum((P_glcm ** 2), 0), 0)
+        P = self.__flatMatrices__(P_glcm)
+        ene = numpy.einsum("kc,kc->c", P, P, dtype=numpy.float64).reshape(P_glcm.shape[2:])
         if meanFlag:
             return (ene.mean())
         else:
             return ene
 
-    def entropyGLCM(self, P_glcm, pxy, eps, meanFlag=True):
-        ent = -1 * numpy.sum(numpy.sum((P_glcm * numpy.where(pxy != 0, numpy.log2(pxy), numpy.log2(eps))), 0), 0)
+    def entropyGLCM(self, HXY1, meanFlag=True):
+        # Same value as the cross entropy of P_glcm and the product of the marginal probabilities
+        ent = HXY1
         if meanFlag:
             return (ent.mean())
         else:
             return ent
 
-    def homogeneity1GLCM(self, P_glcm, diffMatrix, meanFlag=True):
-        homo1 = numpy.sum(numpy.sum((P_glcm / (1 + diffMatrix[:, :, None, None])), 0), 0)
+    def homogeneity1GLCM(self, pxSuby, kValuesDiff, meanFlag=True):
+        homo1 = numpy.sum((pxSuby / (1 + kValuesDiff[:, None, None])), 0)
         if meanFlag:
             return (homo1.mean())
         else:
             return homo1
 
-    def homogeneity2GLCM(self, P_glcm, diffMatrix, meanFlag=True):
-        homo2 = numpy.sum(numpy.sum((P_glcm / (1 + diffMatrix[:, :, None, None] ** 2)), 0), 0)
+    def homogeneity2GLCM(self, pxSuby, kValuesDiff, meanFlag=True):
+        homo2 = numpy.sum((pxSuby / (1 + kValuesDiff[:, None, None] ** 2)), 0)
         if meanFlag:
             return (homo2.mean())
         else:
             return homo2
 
     def imc1GLCM(self, HXY, HXY1, HX, HY, meanFlag=True):
-        imc1 = (self.HXY - self.HXY1) / numpy.max(([self.HX, self.HY]), 0)
+        imc1 = (HXY - HXY1) / numpy.max(([HX, HY]), 0)
         if meanFlag:
             return (imc1.mean())
         else:
@@ -246,31 +263,30 @@ class TextureGLCM:
             # else:
             # return homo2
 
-    def idmnGLCM(self, P_glcm, diffMatrix, Ng, meanFlag=True):
-        idmn = numpy.sum(numpy.sum((P_glcm / (1 + ((diffMatrix[:, :, None, None] ** 2) / (Ng ** 2)))), 0), 0)
+    def idmnGLCM(self, pxSuby, kValuesDiff, Ng, meanFlag=True):
+        idmn = numpy.sum((pxSuby / (1 + ((kValuesDiff[:, None, None] ** 2) / (Ng ** 2)))), 0)
         if meanFlag:
             return (idmn.mean())
         else:
             return idmn
 
-    def idnGLCM(self, P_glcm, diffMatrix, Ng, meanFlag=True):
-        idn = numpy.sum(numpy.sum((P_glcm / (1 + (diffMatrix[:, :, None, None] / Ng))), 0), 0)
+    def idnGLCM(self, pxSuby, kValuesDiff, Ng, meanFlag=True):
+        idn = numpy.sum((pxSuby / (1 + (kValuesDiff[:, None, None] / Ng))), 0)
         if meanFlag:
             return (idn.mean())
         else:
             return idn
 
-    def inverseVarianceGLCM(self, P_glcm, diffMatrix, Ng, meanFlag=True):
-        maskDiags = numpy.ones(diffMatrix.shape, dtype=bool)
-        maskDiags[numpy.diag_indices(Ng)] = False
-        inv = numpy.sum((P_glcm[maskDiags] / (diffMatrix[:, :, None, None] ** 2)[maskDiags]), 0)
+    def inverseVarianceGLCM(self, pxSuby, kValuesDiff, meanFlag=True):
+        # The diagonal (i == j, k = 0) is excluded
+        inv = numpy.sum((pxSuby[1:] / (kValuesDiff[1:, None, None] ** 2)), 0)
         if meanFlag:
             return (inv.mean())
         else:
             return inv
 
     def maximumProbabilityGLCM(self, P_glcm, meanFlag=True):
-        maxprob = P_glcm.max(0).max(0)
+        maxprob = P_glcm.max(0).max(0).astype(numpy.float64)
         if meanFlag:
             return (maxprob.mean())
         else:
@@ -283,8 +299,8 @@ class TextureGLCM:
         else:
             return sumavg
 
-    def sumEntropyGLCM(self, pxAddy, eps, meanFlag=True):
-        sumentr = (-1) * numpy.sum((pxAddy * numpy.where(pxAddy != 0, numpy.log2(pxAddy), numpy.log2(eps))), 0)
+    def sumEntropyGLCM(self, pxAddy, meanFlag=True):
+        sumentr = (-1) * numpy.sum(self.__pLog2p__(pxAddy), 0)
         if meanFlag:
             return (sumentr.mean())
         else:
@@ -297,116 +313,145 @@ class TextureGLCM:
         else:
             return sumvar
 
-    def varianceGLCM(self, P_glcm, ivector, u, meanFlag=True):
-        vari = numpy.sum(numpy.sum((P_glcm * ((ivector[:, None] - u) ** 2)[:, None, None, :]), 0), 0)
+    def varianceGLCM(self, px, ivector, u, meanFlag=True):
+        # sum(P_glcm * (i - u)^2) over i and j. The sum over j is px
+        vari = numpy.sum((px * ((ivector[:, None] - u) ** 2)[:, None, :]), 0)
         if meanFlag:
             return (vari.mean())
         else:
             return vari
 
+    def __flatMatrices__(self, P_glcm):
+        """ View of P_glcm with one column for every distance and direction
+        :param P_glcm: array (Ng, Ng, distances.size, directions)
+        :return: array (Ng * Ng, distances.size * directions)
+        """
+        return P_glcm.reshape(P_glcm.shape[0] * P_glcm.shape[1], -1)
+
+    def __weightedSum__(self, P_glcm, weights):
+        """ Sum of P_glcm * weights over i and j for every distance and direction, without broadcasting the weights
+        to the shape of P_glcm
+        :param P_glcm: array (Ng, Ng, distances.size, directions)
+        :param weights: array (Ng, Ng)
+        :return: array (distances.size, directions)
+        """
+        return numpy.einsum("k,kc->c", weights.ravel(), self.__flatMatrices__(P_glcm),
+                            dtype=numpy.float64).reshape(P_glcm.shape[2:])
+
+    def __sumByIndex__(self, P_glcm, indexes, size):
+        """ Sum of the elements of P_glcm that share the same index (ex: i+j or |i-j|) for every distance and
+        direction, with one bincount per direction
+        :param P_glcm: array (Ng, Ng, distances.size, directions)
+        :param indexes: int array (Ng, Ng) with values in 0..size-1
+        :param size: number of different indexes
+        :return: array (size, distances.size, directions)
+        """
+        P = self.__flatMatrices__(P_glcm)
+        indexes = indexes.ravel()
+        result = numpy.empty((size, P.shape[1]))
+        for c in xrange(P.shape[1]):
+            result[:, c] = numpy.bincount(indexes, weights=P[:, c], minlength=size)
+        return result.reshape((size,) + P_glcm.shape[2:])
+
+    def __pLog2p__(self, p):
+        """ p * log2(p), with 0 where p is 0. The logarithm is calculated in place just for the values that are not 0
+        :param p: array
+        :return: float64 array with the shape of p
+        """
+        # The logarithm of float32 values is calculated in float32, so p is converted first
+        p = numpy.asarray(p, dtype=numpy.float64)
+        result = numpy.zeros(p.shape)
+        numpy.log2(p, out=result, where=(p != 0))
+        result *= p
+        return result
+
     def calculate_glcm(self, grayLevels, matrix, matrixCoordinates, distances, directions, numGrayLevels, out):
-        # VERY INEFFICIENT!!
         # 26 GLCM matrices for each image for every direction from the voxel
         # (26 for each neighboring voxel from a reference voxel centered in a 3x3 cube)
         # for GLCM matrices P(i,j;gamma, a), gamma = 1, a = 1...13
-
-        angles_idx = 0
-        distances_idx = 0
-        r = 0
-        c = 0
-        h = 0
-        rows = matrix.shape[2]
-        cols = matrix.shape[1]
-        height = matrix.shape[0]
-        row = 0
-        col = 0
-        height = 0
-
-        angles = numpy.array([(1, 0, 0),
-                              (-1, 0, 0),
-                              (0, 1, 0),
-                              (0, -1, 0),
-                              (0, 0, 1),
-                              (0, 0, -1),
-                              (1, 1, 0),
-                              (-1, 1, 0),
-                              (1, -1, 0),
-                              (-1, -1, 0),
-                              (1, 0, 1),
-                              (-1, 0, 1),
-                              (1, 0, -1),
-                              (-1, 0, -1),
-                              (0, 1, 1),
-                              (0, -1, 1),
-                              (0, 1, -1),
-                              (0, -1, -1),
-                              (1, 1, 1),
-                              (-1, 1, 1),
-                              (1, -1, 1),
-                              (1, 1, -1),
-                              (-1, -1, 1),
-                              (-1, 1, -1),
-                              (1, -1, -1),
-                              (-1, -1, -1)])
-
-        indices = zip(*matrixCoordinates)
-
-
-        for iteration in range(len(indices)):
-        #for h, c, r in indices:
-            h, c, r = indices[iteration]
-            for angles_idx in xrange(directions):
-                angle = angles[angles_idx]
-
-                for distances_idx in xrange(distances.size):
-                    distance = distances[distances_idx]
-
-                    i = matrix[h, c, r]
-                    i_idx = numpy.nonzero(grayLevels == i)
-
-                    row = r + angle[2]
-                    col = c + angle[1]
-                    height = h + angle[0]
-
-                    # Can introduce Parameter Option for reference voxel(i) and neighbor voxel(j):
-                    # Intratumor only: i and j both must be in tumor ROI
-                    # Tumor+Surrounding: i must be in tumor ROI but J does not have to be
-                    if row >= 0 and row < rows and col >= 0 and col < cols:
-                        if tuple((height, col, row)) in indices:
-                            j = matrix[height, col, row]
-                            j_idx = numpy.nonzero(grayLevels == j)
-                            # if i >= grayLevels.min and i <= grayLevels.max and j >= grayLevels.min and j <= grayLevels.max:
-                            out[i_idx, j_idx, distances_idx, angles_idx] += 1
+        # Instead of visiting every voxel, the whole ROI is compared with a copy of itself shifted in each one of
+        # the directions, so that all the (i, j) pairs for a direction are counted at once with numpy.bincount
+
+        angles = self.angles
+
+        if len(matrixCoordinates[0]) == 0:
+            # Nothing to analyze
+            return (out)
+
+        # Can introduce Parameter Option for reference voxel(i) and neighbor voxel(j):
+        # Intratumor only: i and j both must be in tumor ROI
+        # Tumor+Surrounding: i must be in tumor ROI but J does not have to be
+        roiMask = numpy.zeros(matrix.shape, dtype=bool)
+        roiMask[matrixCoordinates] = True
+        # Index of the gray level of every voxel in the ROI (position in grayLevels)
+        grayLevelIndexes = numpy.zeros(matrix.shape, dtype=numpy.int64)
+        grayLevelIndexes[matrixCoordinates] = numpy.searchsorted(grayLevels, matrix[matrixCoordinates])
+
+        for angles_idx in xrange(directions):
+            for distances_idx in xrange(distances.size):
+                offset = angles[angles_idx] * distances[distances_idx]
+                # Reference voxels (i) and their neighbors (j) in this direction, as views of the ROI
+                iSlices = tuple(slice(max(0, -o), n - max(0, o)) for o, n in zip(offset, matrix.shape))
+                jSlices = tuple(slice(max(0, o), n - max(0, -o)) for o, n in zip(offset, matrix.shape))
+                validPairs = roiMask[iSlices] & roiMask[jSlices]
+                pairIndexes = grayLevelIndexes[iSlices][validPairs] * numGrayLevels + grayLevelIndexes[jSlices][validPairs]
+                out[:, :, distances_idx, angles_idx] += numpy.bincount(
+                    pairIndexes, minlength=numGrayLevels * numGrayLevels).reshape(numGrayLevels, numGrayLevels)
             # Check if the user has cancelled the process
-            if iteration % 10 == 0:
-                self.checkStopProcessFunction()
+            self.checkStopProcessFunction()
 
         return (out)
 
-    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None):
-        if not self.keys:
-            if not printTiming:
-                return self.textureFeaturesGLCM
-            else:
-                self.textureFeaturesGLCMTiming.update
-                return self.textureFeaturesGLCM, self.textureFeaturesGLCMTiming
-        # normalization step:
-        self.CalculateCoefficients(printTiming)
-
-        if not printTiming:
-            # Evaluate dictionary elements corresponding to user selected keys
-            for key in self.keys:
-                self.textureFeaturesGLCM[key] = eval(self.textureFeaturesGLCM[key])
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
-            return self.textureFeaturesGLCM
-        else:
-            # Evaluate dictionary elements corresponding to user selected keys
-            for key in self.keys:
-                t1 = time.time()
-                self.textureFeaturesGLCM[key] = eval(self.textureFeaturesGLCM[key])
-                self.textureFeaturesGLCMTiming[key] = time.time() - t1
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
-            return self.textureFeaturesGLCM, self.textureFeaturesGLCMTiming
-
+    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None, profiler=None,
+                         checkpointFunction=None):
+        # Evaluate the features corresponding to user selected keys (and just the coefficients that they need)
+        return self.registry.evaluate(self, self.keys, printTiming, checkStopProcessFunction, profiler,
+                                      checkpointFunction)
+
+
+TextureGLCM.registry.intermediate("P_glcm", TextureGLCM.glcmMatrix, "grayLevels", "parameterMatrix",
+                                  "parameterMatrixCoordinates", "Ng")
+TextureGLCM.registry.intermediate("ivector", TextureGLCM.grayLevelVector, "Ng")
+TextureGLCM.registry.intermediate("jvector", TextureGLCM.grayLevelVector, "Ng")
+TextureGLCM.registry.intermediate("prodMatrix", TextureGLCM.productMatrix, "ivector", "jvector")
+TextureGLCM.registry.intermediate("sumMatrix", TextureGLCM.additionMatrix, "ivector", "jvector")
+TextureGLCM.registry.intermediate("diffMatrix", TextureGLCM.differenceMatrix, "ivector", "jvector")
+TextureGLCM.registry.intermediate("kValuesSum", TextureGLCM.kValuesSumVector, "Ng")
+TextureGLCM.registry.intermediate("kValuesDiff", TextureGLCM.kValuesDiffVector, "Ng")
+TextureGLCM.registry.intermediate("u", TextureGLCM.meanValue, "P_glcm")
+TextureGLCM.registry.intermediate("px", TextureGLCM.marginalRowProbabilities, "P_glcm")
+TextureGLCM.registry.intermediate("py", TextureGLCM.marginalColumnProbabilities, "P_glcm")
+TextureGLCM.registry.intermediate("ux", TextureGLCM.marginalMean, "px")
+TextureGLCM.registry.intermediate("uy", TextureGLCM.marginalMean, "py")
+TextureGLCM.registry.intermediate("sigx", TextureGLCM.marginalStd, "px")
+TextureGLCM.registry.intermediate("sigy", TextureGLCM.marginalStd, "py")
+TextureGLCM.registry.intermediate("pxAddy", TextureGLCM.sumProbabilities, "P_glcm", "sumMatrix", "kValuesSum")
+TextureGLCM.registry.intermediate("pxSuby", TextureGLCM.differenceProbabilities, "P_glcm", "diffMatrix", "kValuesDiff")
+TextureGLCM.registry.intermediate("HX", TextureGLCM.marginalEntropy, "px")
+TextureGLCM.registry.intermediate("HY", TextureGLCM.marginalEntropy, "py")
+TextureGLCM.registry.intermediate("HXY", TextureGLCM.jointEntropy, "P_glcm")
+TextureGLCM.registry.intermediate("HXY1", TextureGLCM.crossEntropy, "HX", "HY")
+
+TextureGLCM.registry.feature("Autocorrelation", TextureGLCM.autocorrelationGLCM, "P_glcm", "prodMatrix")
+TextureGLCM.registry.feature("Cluster Prominence", TextureGLCM.clusterProminenceGLCM, "pxAddy", "kValuesSum", "ux", "uy")
+TextureGLCM.registry.feature("Cluster Shade", TextureGLCM.clusterShadeGLCM, "pxAddy", "kValuesSum", "ux", "uy")
+TextureGLCM.registry.feature("Cluster Tendency", TextureGLCM.clusterTendencyGLCM, "pxAddy", "kValuesSum", "ux", "uy")
+TextureGLCM.registry.feature("Contrast", TextureGLCM.contrastGLCM, "pxSuby", "kValuesDiff")
+TextureGLCM.registry.feature("Correlation", TextureGLCM.correlationGLCM, "P_glcm", "prodMatrix", "ux", "uy", "sigx",
+                             "sigy")
+TextureGLCM.registry.feature("Difference Entropy", TextureGLCM.differenceEntropyGLCM, "pxSuby")
+TextureGLCM.registry.feature("Dissimilarity", TextureGLCM.dissimilarityGLCM, "pxSuby", "kValuesDiff")
+TextureGLCM.registry.feature("Energy (GLCM)", TextureGLCM.energyGLCM, "P_glcm")
+TextureGLCM.registry.feature("Entropy(GLCM)", TextureGLCM.entropyGLCM, "HXY1")
+TextureGLCM.registry.feature("Homogeneity 1", TextureGLCM.homogeneity1GLCM, "pxSuby", "kValuesDiff")
+TextureGLCM.registry.feature("Homogeneity 2", TextureGLCM.homogeneity2GLCM, "pxSuby", "kValuesDiff")
+TextureGLCM.registry.feature("IMC1", TextureGLCM.imc1GLCM, "HXY", "HXY1", "HX", "HY")
+# IMC2 produces a calculation error
+TextureGLCM.registry.feature("IDMN", TextureGLCM.idmnGLCM, "pxSuby", "kValuesDiff", "Ng")
+TextureGLCM.registry.feature("IDN", TextureGLCM.idnGLCM, "pxSuby", "kValuesDiff", "Ng")
+TextureGLCM.registry.feature("Inverse Variance", TextureGLCM.inverseVarianceGLCM, "pxSuby", "kValuesDiff")
+TextureGLCM.registry.feature("Maximum Probability", TextureGLCM.maximumProbabilityGLCM, "P_glcm")
+TextureGLCM.registry.feature("Sum Average", TextureGLCM.sumAverageGLCM, "pxAddy", "kValuesSum")
+TextureGLCM.registry.feature("Sum Entropy", TextureGLCM.sumEntropyGLCM, "pxAddy")
+TextureGLCM.registry.feature("Sum Variance", TextureGLCM.sumVarianceGLCM, "pxAddy", "kValuesSum")
+TextureGLCM.registry.feature("Variance (GLCM)", TextureGLCM.varianceGLCM, "px", "ivector", "u")
@@ -1,55 +1,39 @@
-from __main__ import vtk, qt, ctk, slicer
 import string
 import numpy
 import math
 import operator
 import collections
 import FeatureExtractionLib
+from FeatureRegistry import FeatureRegistry
 
 
 class TextureGLRL:
+    registry = FeatureRegistry("Texture: GLRL", version=2)
+
     def __init__(self, grayLevels, numGrayLevels, parameterMatrix, parameterMatrixCoordinates, parameterValues,
                  allKeys):
-        self.textureFeaturesGLRL = collections.OrderedDict()
-        self.textureFeaturesGLRLTiming = collections.OrderedDict()
-        self.textureFeaturesGLRL["SRE"] = "self.shortRunEmphasis(self.P_glrl, self.jvector, self.sumP_glrl)"
-        self.textureFeaturesGLRL["LRE"] = "self.longRunEmphasis(self.P_glrl, self.jvector, self.sumP_glrl)"
-        self.textureFeaturesGLRL["GLN"] = "self.grayLevelNonUniformity(self.P_glrl, self.sumP_glrl)"
-        self.textureFeaturesGLRL["RLN"] = "self.runLengthNonUniformity(self.P_glrl, self.sumP_glrl)"
-        self.textureFeaturesGLRL["RP"] = "self.runPercentage(self.P_glrl, self.Np)"
-        self.textureFeaturesGLRL["LGLRE"] = "self.lowGrayLevelRunEmphasis(self.P_glrl, self.ivector, self.sumP_glrl)"
-        self.textureFeaturesGLRL["HGLRE"] = "self.highGrayLevelRunEmphasis(self.P_glrl, self.ivector, self.sumP_glrl)"
-        self.textureFeaturesGLRL[
-            "SRLGLE"] = "self.shortRunLowGrayLevelEmphasis(self.P_glrl, self.ivector, self.jvector, self.sumP_glrl)"
-        self.textureFeaturesGLRL[
-            "SRHGLE"] = "self.shortRunHighGrayLevelEmphasis(self.P_glrl, self.ivector, self.jvector, self.sumP_glrl)"
-        self.textureFeaturesGLRL[
-            "LRLGLE"] = "self.longRunLowGrayLevelEmphasis(self.P_glrl, self.ivector, self.jvector, self.sumP_glrl)"
-        self.textureFeaturesGLRL[
-            "LRHGLE"] = "self.longRunHighGrayLevelEmphasis(self.P_glrl, self.ivector, self.jvector, self.sumP_glrl)"
-
         self.grayLevels = grayLevels
         self.parameterMatrix = parameterMatrix
         self.parameterMatrixCoordinates = parameterMatrixCoordinates
         self.parameterValues = parameterValues
         self.numGrayLevels = numGrayLevels
-        self.keys = set(allKeys).intersection(self.textureFeaturesGLRL.keys())
-
-    def CalculateCoefficients(self):
-        self.angles = 13
-        self.Ng = self.numGrayLevels
-        self.Nr = numpy.max(self.parameterMatrix.shape)
-        self.Np = self.parameterValues.size
+        self.Ng = numGrayLevels
+        self.Np = parameterValues.size
         self.eps = numpy.spacing(1)
+        self.angles = 13
+        self.keys = set(allKeys).intersection(self.registry.features.keys())
 
-        self.P_glrl = numpy.zeros(
-            (self.Ng, self.Nr, self.angles))  # maximum run length in P matrix initialized to highest gray level
-        self.P_glrl = self.calculate_glrl(self.grayLevels, self.Ng, self.parameterMatrix,
-                                          self.parameterMatrixCoordinates, self.angles, self.P_glrl)
+    # Generic coefficients that are reused in different markers
+    def sumGLRL(self, P_glrl, eps):
+        return numpy.sum(numpy.sum(P_glrl, 0), 0) + eps
 
-        self.sumP_glrl = numpy.sum(numpy.sum(self.P_glrl, 0), 0) + self.eps
-        self.ivector = numpy.arange(self.Ng) + 1
-        self.jvector = numpy.arange(self.Nr) + 1
+    def grayLevelVector(self, Ng):
+        return numpy.arange(Ng) + 1
+
+    def runLengthVector(self, P_glrl):
+        # maximum run length in P matrix
+        Nr = P_glrl.shape[1]
+        return numpy.arange(Nr) + 1
 
     def shortRunEmphasis(self, P_glrl, jvector, sumP_glrl, meanFlag=True):
         try:
@@ -167,164 +151,106 @@ class TextureGLRL:
         else:
             return lrhgle
 
-    def calculate_glrl(self, grayLevels, numGrayLevels, matrix, matrixCoordinates, angles, P_out):
+    def calculate_glrl(self, grayLevels, numGrayLevels, matrix, matrixCoordinates, angles):
+        """ Run-length encoding of the matrix for the 13 3D directions (every direction and its opposite one
+        produce the same runs).
+        The matrix is never split in Python lists. For each direction, the length of the run that finishes in every
+        voxel is accumulated sweeping the matrix slab by slab along one of the axes of the direction, and the runs
+        are counted at once with numpy.bincount from the voxels where a run ends.
+        :return: P_glrl matrix with shape (numGrayLevels, Nr, angles), where Nr is the longest run found in the matrix
+        """
         padVal = 0  # use eps or NaN to pad matrix
-        matrixDiagonals = list()
-
-        # TODO: try using itertools list merging with lists of GLRL diagonal    
-        # i.e.: self.heterogeneityFeatureWidgets = list(itertools.chain.from_iterable(self.featureWidgets.values()))
-
-        # For a single direction or diagonal (aDiags, bDiags...lDiags, mDiags):   
-        # Generate a 1D array for each valid offset of the diagonal, a, in the range specified by lowBound and highBound  
-        # Convert each 1D array to a python list ( matrix.diagonal(a,,).tolist() ) 
-        # Join lists using reduce(lamda x,y: x+y, ...) to represent all 1D arrays for the direction/diagonal       
-        # Use filter(lambda x: numpy.nonzero(x)[0].size>1, ....) to filter 1D arrays of size < 2 or value == 0 or padValue
-
-        # Should change from nonzero() to filter for the padValue specifically (NaN, eps, etc)
-
-        # (1,0,0), #(-1,0,0),
-        aDiags = reduce(lambda x, y: x + y, [a.tolist() for a in numpy.transpose(matrix, (1, 2, 0))])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, aDiags))
-
-        # (0,1,0), #(0,-1,0),
-        bDiags = reduce(lambda x, y: x + y, [a.tolist() for a in numpy.transpose(matrix, (0, 2, 1))])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, bDiags))
-
-        # (0,0,1), #(0,0,-1), 
-        cDiags = reduce(lambda x, y: x + y, [a.tolist() for a in numpy.transpose(matrix, (0, 1, 2))])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, cDiags))
-
-        # (1,1,0),#(-1,-1,0),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-
-        dDiags = reduce(lambda x, y: x + y, [matrix.diagonal(a, 0, 1).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, dDiags))
-
-        # (1,0,1), #(-1,0-1),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[2]
-
-        eDiags = reduce(lambda x, y: x + y, [matrix.diagonal(a, 0, 2).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, eDiags))
-
-        # (0,1,1), #(0,-1,-1),
-        lowBound = -matrix.shape[1] + 1
-        highBound = matrix.shape[2]
-
-        fDiags = reduce(lambda x, y: x + y, [matrix.diagonal(a, 1, 2).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, fDiags))
-
-        # (1,-1,0), #(-1,1,0),    
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-
-        gDiags = reduce(lambda x, y: x + y,
-                        [matrix[:, ::-1, :].diagonal(a, 0, 1).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, gDiags))
-
-        # (-1,0,1), #(1,0,-1),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[2]
-
-        hDiags = reduce(lambda x, y: x + y,
-                        [matrix[:, :, ::-1].diagonal(a, 0, 2).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, hDiags))
-
-        # (0,1,-1), #(0,-1,1),
-        lowBound = -matrix.shape[1] + 1
-        highBound = matrix.shape[2]
-
-        iDiags = reduce(lambda x, y: x + y,
-                        [matrix[:, :, ::-1].diagonal(a, 1, 2).tolist() for a in xrange(lowBound, highBound)])
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, iDiags))
-
-        # (1,1,1), #(-1,-1,-1)
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-
-        jDiags = [numpy.diagonal(h, x, 0, 1).tolist() for h in
-                  [matrix.diagonal(a, 0, 1) for a in xrange(lowBound, highBound)] for x in
-                  xrange(-h.shape[0] + 1, h.shape[1])]
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, jDiags))
-
-        # (-1,1,-1), #(1,-1,1),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-
-        kDiags = [numpy.diagonal(h, x, 0, 1).tolist() for h in
-                  [matrix[:, ::-1, :].diagonal(a, 0, 1) for a in xrange(lowBound, highBound)] for x in
-                  xrange(-h.shape[0] + 1, h.shape[1])]
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, kDiags))
-
-        # (1,1,-1), #(-1,-1,1),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-
-        lDiags = [numpy.diagonal(h, x, 0, 1).tolist() for h in
-                  [matrix[:, :, ::-1].diagonal(a, 0, 1) for a in xrange(lowBound, highBound)] for x in
-                  xrange(-h.shape[0] + 1, h.shape[1])]
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, lDiags))
-
-        # (-1,1,1), #(1,-1,-1),
-        lowBound = -matrix.shape[0] + 1
-        highBound = matrix.shape[1]
-    
-        mDiags = [numpy.diagonal(h, x, 0, 1).tolist() for h in
-                  [matrix[:, ::-1, ::-1].diagonal(a, 0, 1) for a in xrange(lowBound, highBound)] for x in
-                  xrange(-h.shape[0] + 1, h.shape[1])]
-        matrixDiagonals.append(filter(lambda x: numpy.nonzero(x)[0].size > 1, mDiags))
-
-        # [n for n in mDiags if numpy.nonzero(n)[0].size>1] instead of filter(lambda x: numpy.nonzero(x)[0].size>1, mDiags)?
-
-        # Run-Length Encoding (rle) for the 13 list of diagonals (1 list per 3D direction/angle)
-        for angle in xrange(0, len(matrixDiagonals)):
-            P = P_out[:, :, angle]
-            for diagonal in matrixDiagonals[angle]:
-                diagonal = numpy.array(diagonal, dtype='int')
-                pos, = numpy.where(
-                    numpy.diff(diagonal) != 0)  # can use instead of using map operator._ on np.where tuples
-                pos = numpy.concatenate(([0], pos + 1, [len(diagonal)]))
-
-                # a or pos[:-1] = run start #b or pos[1:] = run stop #diagonal[a] is matrix value       
-                # adjust condition for pos[:-1] != padVal = 0 to != padVal = eps or NaN or whatever pad value
-                rle = zip([n for n in diagonal[pos[:-1]] if n != padVal], pos[1:] - pos[:-1])
-                rle = [[numpy.where(grayLevels == x)[0][0], y - 1] for x, y in
-                       rle]  # rle = map(lambda (x,y): [voxelToIndexDict[x],y-1], rle)
-
-                # Increment GLRL matrix counter at coordinates defined by the run-length encoding               
-                P[zip(*rle)] += 1
-
+        directions = [(1, 0, 0),
+                      (0, 1, 0),
+                      (0, 0, 1),
+                      (1, 1, 0),
+                      (1, 0, 1),
+                      (0, 1, 1),
+                      (1, -1, 0),
+                      (1, 0, -1),
+                      (0, 1, -1),
+                      (1, 1, 1),
+                      (1, -1, 1),
+                      (1, 1, -1),
+                      (1, -1, -1)][:angles]
+
+        runs = list()
+        for direction in directions:
+            runValues, runLengths = self.__runLengthEncoding__(matrix, direction, padVal)
+            runs.append((numpy.searchsorted(grayLevels, runValues), runLengths))
+
+        # Maximum run length bounded to the longest run actually found
+        Nr = max([1] + [runLengths.max() for _, runLengths in runs if runLengths.size > 0])
+        P_out = numpy.zeros((numGrayLevels, Nr, angles))
+
+        # Increment GLRL matrix counter at coordinates defined by the run-length encoding
+        for angle in xrange(len(runs)):
+            grayLevelIndexes, runLengths = runs[angle]
+            P_out[:, :, angle] = numpy.bincount(grayLevelIndexes * Nr + runLengths - 1,
+                                                minlength=numGrayLevels * Nr).reshape(numGrayLevels, Nr)
         return (P_out)
 
-    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None):
-        if not self.keys:
-            if not printTiming:
-                return self.textureFeaturesGLRL
-            else:
-                return self.textureFeaturesGLRL, self.textureFeaturesGLRLTiming
-        
-        if not printTiming:
-            self.CalculateCoefficients()
-        else:
-            import time
-            t1 = time.time()
-            self.CalculateCoefficients()
-            print("- Time to calculate coefficients in GLRL: {0} seconds".format(time.time() - t1))
-
-        if not printTiming:
-            # Evaluate dictionary elements corresponding to user selected keys
-            for key in self.keys:
-                self.textureFeaturesGLRL[key] = eval(self.textureFeaturesGLRL[key])
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
-            return self.textureFeaturesGLRL
-        else:
-            # Evaluate dictionary elements corresponding to user selected keys
-            for key in self.keys:
-                t1 = time.time()
-                self.textureFeaturesGLRL[key] = eval(self.textureFeaturesGLRL[key])
-                self.textureFeaturesGLRLTiming[key] = time.time() - t1
-                if checkStopProcessFunction is not None:
-                    checkStopProcessFunction()
-            return self.textureFeaturesGLRL, self.textureFeaturesGLRLTiming
+    def __runLengthEncoding__(self, matrix, direction, padVal):
+        """ Get all the runs in the matrix for one 3D direction
+        :param matrix: padded tumor matrix
+        :param direction: tuple with the step in every axis (-1, 0 or 1)
+        :param padVal: value used to pad the matrix (these voxels do not belong to any run)
+        :return: tuple with the gray level and the length of every run
+        """
+        # Flip the axes with a negative step so that all the runs advance in positive direction
+        matrix = matrix[tuple(slice(None, None, -1) if step < 0 else slice(None) for step in direction)]
+        steps = numpy.abs(direction)
+        activeAxes = numpy.nonzero(steps)[0]
+        sweepAxis = activeAxes[0]
+        roi = matrix != padVal
+
+        # Length of the run up to every voxel, computed slab by slab along sweepAxis
+        lengths = roi.astype(numpy.int32)
+        for t in xrange(1, matrix.shape[sweepAxis]):
+            current = [slice(None)] * 3
+            previous = [slice(None)] * 3
+            current[sweepAxis] = t
+            previous[sweepAxis] = t - 1
+            for axis in activeAxes[1:]:
+                current[axis] = slice(1, None)
+                previous[axis] = slice(None, -1)
+            current = tuple(current)
+            previous = tuple(previous)
+            continuesRun = roi[current] & (matrix[current] == matrix[previous])
+            lengths[current][continuesRun] += lengths[previous][continuesRun]
+
+        # A run finishes in a voxel when the next one in the direction is out of the matrix or has a different value
+        runEnds = roi.copy()
+        voxels = tuple(slice(0, n - step) for n, step in zip(matrix.shape, steps))
+        nextVoxels = tuple(slice(step, n) for n, step in zip(matrix.shape, steps))
+        runEnds[voxels] &= matrix[voxels] != matrix[nextVoxels]
+        return (matrix[runEnds], lengths[runEnds])
+
+    def EvaluateFeatures(self, printTiming=False, checkStopProcessFunction=None, profiler=None,
+                         checkpointFunction=None):
+        # Evaluate the features corresponding to user selected keys
+        return self.registry.evaluate(self, self.keys, printTiming, checkStopProcessFunction, profiler,
+                                      checkpointFunction)
+
+
+TextureGLRL.registry.intermediate("P_glrl", TextureGLRL.calculate_glrl, "grayLevels", "Ng", "parameterMatrix",
+                                  "parameterMatrixCoordinates", "angles")
+TextureGLRL.registry.intermediate("sumP_glrl", TextureGLRL.sumGLRL, "P_glrl", "eps")
+TextureGLRL.registry.intermediate("ivector", TextureGLRL.grayLevelVector, "Ng")
+TextureGLRL.registry.intermediate("jvector", TextureGLRL.runLengthVector, "P_glrl")
+
+TextureGLRL.registry.feature("SRE", TextureGLRL.shortRunEmphasis, "P_glrl", "jvector", "sumP_glrl")
+TextureGLRL.registry.feature("LRE", TextureGLRL.longRunEmphasis, "P_glrl", "jvector", "sumP_glrl")
+TextureGLRL.registry.feature("GLN", TextureGLRL.grayLevelNonUniformity, "P_glrl", "sumP_glrl")
+TextureGLRL.registry.feature("RLN", TextureGLRL.runLengthNonUniformity, "P_glrl", "sumP_glrl")
+TextureGLRL.registry.feature("RP", TextureGLRL.runPercentage, "P_glrl", "Np")
+TextureGLRL.registry.feature("LGLRE", TextureGLRL.lowGrayLevelRunEmphasis, "P_glrl", "ivector", "sumP_glrl")
+TextureGLRL.registry.feature("HGLRE", TextureGLRL.highGrayLevelRunEmphasis, "P_glrl", "ivector", "sumP_glrl")
+TextureGLRL.registry.feature("SRLGLE", TextureGLRL.shortRunLowGrayLevelEmphasis, "P_glrl", "ivector", "jvector",
+                             "sumP_glrl")
+TextureGLRL.registry.feature("SRHGLE", TextureGLRL.shortRunHighGrayLevelEmphasis, "P_glrl", "ivector", "jvector",
+                             "sumP_glrl")
+TextureGLRL.registry.feature("LRLGLE", TextureGLRL.longRunLowGrayLevelEmphasis, "P_glrl", "ivector", "jvector",
+                             "sumP_glrl")
+TextureGLRL.registry.feature("LRHGLE", TextureGLRL.longRunHighGrayLevelEmphasis, "P_glrl", "ivector", "jvector",
+                             "sumP_glrl")
@@ -4,4 +4,15 @@ from RenyiDimensions import*
 from GeometricalMeasures import*
 from TextureGLCM import*
 from TextureGLRL import*
+from FeatureProfiler import *
+from FeatureDiskCache import *
+from FeatureRegistry import *
+from GrayLevelQuantization import *
 from ParenchymalVolume import *
+from ROIContextCache import *
+from ProgressReporter import *
+from SphereROI import *
+from ConcentricShells import *
+from LevelSetThreshold import *
+from MultiNoduleAnalysis import *
+from FeatureExtractionEngine import *
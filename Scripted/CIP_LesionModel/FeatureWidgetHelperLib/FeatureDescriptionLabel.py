@@ -62,6 +62,12 @@ class FeatureDescriptionLabel(qt.QLabel):
       self.description += "Compactness 2 is a dimensionless measure, independent of scale and orientation. This is a measure of the compactness of the shape of the image ROI."
     elif featureName == "Maximum 3D Diameter":
       self.description += "Maximum 3D Diameter is the maximum, pairwise euclidean distance between surface voxels of the image ROI."
+    elif featureName == "Maximum 2D Diameter Axial":
+      self.description += "Maximum 2D Diameter Axial is the maximum, pairwise euclidean distance between surface voxels of the image ROI contained in the same axial plane."
+    elif featureName == "Maximum 2D Diameter Coronal":
+      self.description += "Maximum 2D Diameter Coronal is the maximum, pairwise euclidean distance between surface voxels of the image ROI contained in the same coronal plane."
+    elif featureName == "Maximum 2D Diameter Sagittal":
+      self.description += "Maximum 2D Diameter Sagittal is the maximum, pairwise euclidean distance between surface voxels of the image ROI contained in the same sagittal plane."
     elif featureName == "Spherical Disproportion":
       self.description += "Spherical Disproportion is defined as the ratio of the surface area of the image ROI to the surface area of a sphere with the same volume as the image ROI."
     elif featureName == "Sphericity":
@@ -1,20 +1,61 @@
 from __main__ import vtk, qt, ctk, slicer
 
-import math
-import operator
-import numpy as np
-import collections
-import time
-import logging
 from . import *
 import FeatureExtractionLib
 
+class QtProgressReporter(FeatureExtractionLib.ProgressReporter):
+    def __init__(self, cancelToken=None):
+        """ Report the progress in a Qt progress dialog. It must be used from the GUI thread.
+        The process is stopped when the user clicks the Cancel button or when the cancelToken is cancelled
+        :param cancelToken: CancelToken (optional)
+        """
+        FeatureExtractionLib.ProgressReporter.__init__(self, cancelToken)
+        self.progressBar = None
+        self.description = ""
+
+    def start(self, description, maximum):
+        self.description = description
+        self.progressBar = qt.QProgressDialog(slicer.util.mainWindow())
+        self.progressBar.minimumDuration = 0
+        self.progressBar.show()
+        self.progressBar.setValue(0)
+        self.progressBar.setMaximum(maximum)
+        self.progressBar.labelText = 'Calculating for {0}: '.format(description)
+
+    def update(self, description, value):
+        self.progressBar.labelText = 'Calculating %s: %s' % (self.description, description)
+        self.progressBar.setValue(value)
+
+    def finish(self):
+        if self.progressBar is not None:
+            self.progressBar.close()
+            self.progressBar.deleteLater()
+            self.progressBar = None
+
+    @property
+    def wasCanceled(self):
+        """ The user clicked the Cancel button
+        """
+        return self.progressBar is not None and self.progressBar.wasCanceled
+
+    def checkStopProcess(self):
+        slicer.app.processEvents()
+        if self.wasCanceled:
+            raise StopIteration("Progress cancelled!!!")
+        FeatureExtractionLib.ProgressReporter.checkStopProcess(self)
+
+
 class FeatureExtractionLogic:
+    # Seconds between refreshes of the progress dialog while the analysis runs in a background thread
+    REFRESH_INTERVAL = 0.05
+
     def __init__(self, volumeNode, volumeNodeArray, labelmapROIArray, featureCategoriesKeys, featureKeys,
-                 additionalProgressbarDesc="", labelmapWholeVolumeArray = None):
+                 additionalProgressbarDesc="", labelmapWholeVolumeArray = None, roiContextCache=None,
+                 runInBackground=True, labelmapROIOffset=(0, 0, 0), quantization=None, diskCache=None,
+                 labelmapWholeVolumeCounts=None):
         """
         :param volumeNode: VTK intensities volume node
-        :param volumeNodeArray: numpy array that represents volumeNode
+        :param volumeNodeArray: numpy array that represents volumeNode (or a crop of it, see labelmapROIOffset)
         :param labelmapROIArray: numpy array with the labelmap of the area to study (ex: tumor)
         :param featureCategoriesKeys: main categories that have some feature that is going to be analyzed
         :param featureKeys: features that are going to be analyzed
@@ -22,6 +63,18 @@ class FeatureExtractionLogic:
             for each one of the main categories while the analysis is performed
         :param labelmapWholeVolumeArray: numpy array that represents a labelmap for the whole volume (different
             from 'labelMapROIArray' that represents just the area of interest that is going to be analyzed)
+        :param roiContextCache: ROIContextCache that stores the preprocessed data and the features already calculated
+            for this ROI in previous runs. When None, everything is calculated from scratch
+        :param runInBackground: calculate the features in a worker thread, so that Slicer keeps responsive while
+            the analysis is performed. Otherwise the features are calculated in the GUI thread
+        :param labelmapROIOffset: position (ZYX) of labelmapROIArray and volumeNodeArray in volumeNode, when they
+            are crops of the whole volume
+        :param quantization: FeatureExtractionLib.GrayLevelQuantization applied before the texture features are
+            calculated. When None, every different intensity is a gray level
+        :param diskCache: FeatureExtractionLib.FeatureDiskCache where the features are reused from and stored in
+            (ex: from previous sessions). When None, the features are not persisted
+        :param labelmapWholeVolumeCounts: number of voxels of every label of labelmapWholeVolumeArray (see
+            FeatureExtractionLib.ParenchymalVolume.getLabelCounts). When None, it is calculated if needed
         :return:
         """
         self.volumeNode = volumeNode
@@ -31,10 +84,12 @@ class FeatureExtractionLogic:
         self.featureKeys = featureKeys
         self.additionalProgressbarDesc = additionalProgressbarDesc
         self.labelmapWholeVolumeArray = labelmapWholeVolumeArray
-
-        # initialize Progress Bar
-        self.progressBar = qt.QProgressDialog(slicer.util.mainWindow())
-        self.progressBar.minimumDuration = 0
+        self.roiContextCache = roiContextCache
+        self.runInBackground = runInBackground
+        self.labelmapROIOffset = labelmapROIOffset
+        self.quantization = quantization
+        self.diskCache = diskCache
+        self.labelmapWholeVolumeCounts = labelmapWholeVolumeCounts
 
         self.__analysisResultsDict__ = None
         self.__analysisTimingDict__ = None
@@ -54,213 +109,123 @@ class FeatureExtractionLogic:
         return self.__analysisTimingDict__
 
     def run(self, resultsStorage, printTiming=False, resultsStorageTiming=None):
-        """ Run all the selected analysis
+        """ Run all the selected analysis.
+        The method returns when the analysis is finished, even if it is run in a background thread.
+        If the user cancels the process, a FeatureExtractionLib.AnalysisCancelled exception (StopIteration) is raised.
+        The features calculated before the cancellation are kept in resultsStorage and in the ROI context cache, so
+        running the analysis again just calculates the missing ones
         :return:
             If printTiming==False: Dictionary of Feature-Value with all the features analyzed
             else: tuple with 2 dictionaries (1 of Feature-Value and another one with Feature-Timing)
         """
-        self.progressBar.show()
-        self.progressBar.setValue(0)
-        self.progressBar.setMaximum(len(self.featureKeys))
-        self.progressBar.labelText = 'Calculating for {0}{1}: '.format(self.volumeNode.GetName(), self.additionalProgressbarDesc)
-
-        #print("DEBUG: running the following categories: ", self.featureCategoriesKeys)
-        #print("DEBUG: running the following features: ", self.featureKeys)
-
-        # create Numpy Arrays
-        # self.nodeArrayVolume = self.createNumpyArray(self.volumeNode)
-        # self.nodeArrayLabelMapROI = self.createNumpyArray(self.labelmapNode)
-        t1 = time.time()
-        # extract voxel coordinates (ijk) and values from self.dataNode within the ROI defined by self.labelmapNode
-        self.targetVoxels, self.targetVoxelsCoordinates = self.tumorVoxelsAndCoordinates(self.labelmapROIArray, self.volumeNodeArray)
-        if printTiming:
-            print("Time to calculate tumorVoxelsAndCoordinates: {0} seconds".format(time.time() - t1))
-        self.checkStopProcess()
-
-        # create a padded, rectangular matrix with shape equal to the shape of the tumor
-        t1 = time.time()
-        self.matrix, self.matrixCoordinates = self.paddedTumorMatrixAndCoordinates(self.targetVoxels, self.targetVoxelsCoordinates)
-        if printTiming:
-            print("Time to calculate paddedTumorMatrixAndCoordinates: {0} seconds".format(time.time() - t1))
-        self.checkStopProcess()
-
-        # get Histogram data
-        t1 = time.time()
-        self.bins, self.grayLevels, self.numGrayLevels = self.getHistogramData(self.targetVoxels)
-        if printTiming:
-            print("Time to calculate histogram: {0} seconds".format(time.time() - t1))
-        self.checkStopProcess()
+        # Preprocessed data and features already calculated for this ROI
+        if self.roiContextCache is not None:
+            roiContext = self.roiContextCache.getContext(self.volumeNode.GetID(), self.labelmapROIArray,
+                                                         self.volumeNode.GetSpacing(), self.labelmapROIOffset)
+        else:
+            roiContext = None
 
-        ########
-        # self.__analysisResultsDict__ = collections.OrderedDict()
-        # self.__analysisTimingDict__ = collections.OrderedDict()
-        self.__analysisResultsDict__ = resultsStorage
-        if printTiming:
-            self.__analysisTimingDict__ = resultsStorageTiming
         progressBarDesc = self.volumeNode.GetName() + self.additionalProgressbarDesc
-
-        # First Order Statistics
-        if "First-Order Statistics" in self.featureCategoriesKeys:
-            self.updateProgressBar(progressBarDesc, "First-Order Statistics", len(self.__analysisResultsDict__))
-            self.firstOrderStatistics = FeatureExtractionLib.FirstOrderStatistics(self.targetVoxels, self.bins, self.numGrayLevels, self.featureKeys)
-            t1 = time.time()
-            results = self.firstOrderStatistics.EvaluateFeatures(printTiming, self.checkStopProcess)
-            if printTiming:
-                self.__analysisResultsDict__.update(results[0])
-                self.__analysisTimingDict__.update(results[1])
-                print("Time to calculate First Order Statistics: {0} seconds".format(time.time() - t1))
-            else:
-                self.__analysisResultsDict__.update(results)
-
-        # Shape/Size and Morphological Features)
-        if "Morphology and Shape" in self.featureCategoriesKeys:
-            self.updateProgressBar(progressBarDesc, "Morphology and Shape Statistics",
-                                   len(self.__analysisResultsDict__))
-            # extend padding by one row/column for all 6 directions
-            if len(self.matrix) == 0:
-                matrixSA = self.matrix
-                matrixSACoordinates = self.matrixCoordinates
-            else:
-                maxDimsSA = tuple(map(operator.add, self.matrix.shape, ([2,2,2])))
-                matrixSA, matrixSACoordinates = self.padMatrix(self.matrix, self.matrixCoordinates, maxDimsSA, self.targetVoxels)
-            self.morphologyStatistics = FeatureExtractionLib.MorphologyStatistics(self.volumeNode.GetSpacing(), matrixSA, matrixSACoordinates, self.targetVoxels, self.featureKeys)
-            t1 = time.time()
-            results = self.morphologyStatistics.EvaluateFeatures(printTiming, self.checkStopProcess)
-            if printTiming:
-                self.__analysisResultsDict__.update(results[0])
-                self.__analysisTimingDict__.update(results[1])
-                print("Time to calculate Morphology and Shape: {0} seconds".format(time.time() - t1))
-            else:
-                self.__analysisResultsDict__.update(results)
-
-        # Texture Features(GLCM)
-        if "Texture: GLCM" in self.featureCategoriesKeys:
-            self.updateProgressBar(progressBarDesc, "GLCM Texture Features", len(self.__analysisResultsDict__))
-            self.textureFeaturesGLCM = FeatureExtractionLib.TextureGLCM(self.grayLevels, self.numGrayLevels, self.matrix, self.matrixCoordinates, self.targetVoxels, self.featureKeys, self.checkStopProcess)
-            t1 = time.time()
-            results =self.textureFeaturesGLCM.EvaluateFeatures(printTiming, self.checkStopProcess)
-            if printTiming:
-                self.__analysisResultsDict__.update(results[0])
-                self.__analysisTimingDict__.update(results[1])
-                print("Time to calculate Texture: GLCM: {0} seconds".format(time.time() - t1))
-            else:
-                self.__analysisResultsDict__.update(results)
-
-        # Texture Features(GLRL)
-        if "Texture: GLRL" in self.featureCategoriesKeys:
-            self.updateProgressBar(progressBarDesc, "GLRL Texture Features", len(self.__analysisResultsDict__))
-            self.textureFeaturesGLRL = FeatureExtractionLib.TextureGLRL(self.grayLevels, self.numGrayLevels, self.matrix, self.matrixCoordinates, self.targetVoxels, self.featureKeys)
-            t1 = time.time()
-            results =self.textureFeaturesGLRL.EvaluateFeatures(printTiming, self.checkStopProcess)
-            if printTiming:
-                self.__analysisResultsDict__.update(results[0])
-                self.__analysisTimingDict__.update(results[1])
-                print("Time to calculate Texture: GLRL: {0} seconds".format(time.time() - t1))
-            else:
-                self.__analysisResultsDict__.update(results)
-
-        # Geometrical Measures
-        if "Geometrical Measures" in self.featureCategoriesKeys:
-            self.updateProgressBar(progressBarDesc, "Geometrical Measures", len(self.__analysisResultsDict__))
-            self.geometricalMeasures = FeatureExtractionLib.GeometricalMeasures(self.volumeNode.GetSpacing(), self.matrix, self.matrixCoordinates, self.targetVoxels, self.featureKeys)
-            t1 = time.time()
-            results =self.geometricalMeasures.EvaluateFeatures(printTiming, self.checkStopProcess)
-            if printTiming:
-                self.__analysisResultsDict__.update(results[0])
-                self.__analysisTimingDict__.update(results[1])
-                print("Time to calculate Geometrical Measures: {0} seconds".format(time.time() - t1))
-            else:
-                self.__analysisResultsDict__.update(results)
-
-        # Renyi Dimensions
-        if "Renyi Dimensions" in self.featureCategoriesKeys:
-            self.updateProgressBar(progressBarDesc, "Renyi Dimensions", len(self.__analysisResultsDict__))
-            # extend padding to dimension lengths equal to next power of 2
-            maxDims = tuple( [int(pow(2, math.ceil(np.log2(np.max(self.matrix.shape)))))] * 3 )
-            matrixPadded, matrixPaddedCoordinates = self.padMatrix(self.matrix, self.matrixCoordinates, maxDims, self.targetVoxels)
-            self.renyiDimensions = FeatureExtractionLib.RenyiDimensions(matrixPadded, matrixPaddedCoordinates, self.featureKeys)
-            t1 = time.time()
-            results =self.renyiDimensions.EvaluateFeatures(printTiming, self.checkStopProcess)
-            if printTiming:
-                self.__analysisResultsDict__.update(results[0])
-                self.__analysisTimingDict__.update(results[1])
-                print("Time to calculate Renyi Dimensions: {0} seconds".format(time.time() - t1))
-            else:
-                self.__analysisResultsDict__.update(results)
-
-        # Parenchymal Volume
-        if "Parenchymal Volume" in self.featureCategoriesKeys:
-            self.updateProgressBar(progressBarDesc, "Parenchymal Volume", len(self.__analysisResultsDict__))
-            self.parenchymalVolume = FeatureExtractionLib.ParenchymalVolume(self.labelmapWholeVolumeArray, self.labelmapROIArray,
-                                                        self.volumeNode.GetSpacing(), self.featureKeys)
-            t1 = time.time()
-            results =self.parenchymalVolume.EvaluateFeatures(printTiming, self.checkStopProcess)
-            if printTiming:
-                self.__analysisResultsDict__.update(results[0])
-                self.__analysisTimingDict__.update(results[1])
-                print("Time to calculate Parenchymal Volume: {0} seconds".format(time.time() - t1))
+        qtProgressReporter = QtProgressReporter(FeatureExtractionLib.CancelToken())
+        if self.runInBackground:
+            progressReporter = FeatureExtractionLib.ThreadProgressReporter(qtProgressReporter.cancelToken)
+        else:
+            progressReporter = qtProgressReporter
+        engine = FeatureExtractionLib.FeatureExtractionEngine(self.volumeNodeArray, self.labelmapROIArray,
+                        self.volumeNode.GetSpacing(), self.featureCategoriesKeys, self.featureKeys,
+                        self.labelmapWholeVolumeArray, roiContext, progressReporter, self.labelmapROIOffset,
+                        quantization=self.quantization, diskCache=self.diskCache,
+                        labelmapWholeVolumeCounts=self.labelmapWholeVolumeCounts)
+
+        qtProgressReporter.start(progressBarDesc, len(self.featureKeys))
+        try:
+            if self.runInBackground:
+                results = self.__runInBackground__(engine.run, qtProgressReporter, progressReporter,
+                                                   resultsStorage, printTiming, resultsStorageTiming)
             else:
-                self.__analysisResultsDict__.update(results)
-
-        # close progress bar
-        self.updateProgressBar(progressBarDesc, "Populating Summary Table", len(self.__analysisResultsDict__))
-        self.progressBar.close()
-        self.progressBar = None
-
-        # filter for user-queried features only
-        self.__analysisResultsDict__ = collections.OrderedDict((k, self.__analysisResultsDict__[k]) for k in self.featureKeys)
+                results = engine.run(resultsStorage, printTiming, resultsStorageTiming)
+        finally:
+            qtProgressReporter.finish()
 
         if not printTiming:
-            return self.__analysisResultsDict__
+            self.__analysisResultsDict__ = results
         else:
-            return self.__analysisResultsDict__, self.__analysisTimingDict__
-
-
-    def tumorVoxelsAndCoordinates(self, arrayROI, arrayDataNode):
-        coordinates = np.where(arrayROI != 0) # can define specific label values to target or avoid
-        values = arrayDataNode[coordinates].astype('int64')
-        return(values, coordinates)
-
-    def paddedTumorMatrixAndCoordinates(self, targetVoxels, targetVoxelsCoordinates):
-        if len(targetVoxels) == 0:
-            # Nothing to analyze
-            empty = np.array([])
-            return (empty, (empty, empty, empty))
-
-        ijkMinBounds = np.min(targetVoxelsCoordinates, 1)
-        ijkMaxBounds = np.max(targetVoxelsCoordinates, 1)
-        matrix = np.zeros(ijkMaxBounds - ijkMinBounds + 1)
-        matrixCoordinates = tuple(map(operator.sub, targetVoxelsCoordinates, tuple(ijkMinBounds)))
-        matrix[matrixCoordinates] = targetVoxels
-        return (matrix, matrixCoordinates)
-
-    def getHistogramData(self, voxelArray):
-        # with np.histogram(), all but the last bin is half-open, so make one extra bin container
-        binContainers = np.arange(voxelArray.min(), voxelArray.max()+2)
-        bins = np.histogram(voxelArray, bins=binContainers)[0] # frequencies
-        grayLevels = np.unique(voxelArray) # discrete gray levels
-        numGrayLevels = grayLevels.size
-        return (bins, grayLevels, numGrayLevels)
-
-    def padMatrix(self, a, matrixCoordinates, dims, voxelArray):
-        # pads matrix 'a' with zeros and resizes 'a' to a cube with dimensions increased to the next greatest power of 2
-        # numpy version 1.7 has np.pad function
-
-        # center coordinates onto padded matrix    # consider padding with NaN or eps = np.spacing(1)
-        pad = tuple(map(operator.div, tuple(map(operator.sub, dims, a.shape)), ([2,2,2])))
-        matrixCoordinatesPadded = tuple(map(operator.add, matrixCoordinates, pad))
-        matrix2 = np.zeros(dims)
-        matrix2[matrixCoordinatesPadded] = voxelArray
-        return (matrix2, matrixCoordinatesPadded)
-
-    def updateProgressBar(self, nodeName, nextFeatureString, totalSteps):
-        self.checkStopProcess()
-        self.progressBar.labelText = 'Calculating %s: %s' % (nodeName, nextFeatureString)
-        self.progressBar.setValue(totalSteps)
-
-    def checkStopProcess(self):
-        slicer.app.processEvents()
-        if self.progressBar.wasCanceled:
-            self.progressBar.deleteLater()
-            raise StopIteration("Progress cancelled!!!")
-
+            self.__analysisResultsDict__, self.__analysisTimingDict__ = results
+        return results
+
+    def __runInBackground__(self, function, qtProgressReporter, threadProgressReporter, *args):
+        """ Run the analysis in a worker thread. Meanwhile, the GUI thread refreshes the progress dialog and processes
+        the Slicer events (waiting on the thread releases the GIL so that the worker can go on)
+        :param function: function that runs the analysis (ex: FeatureExtractionEngine.run)
+        :param qtProgressReporter: QtProgressReporter where the progress is displayed
+        :param threadProgressReporter: ThreadProgressReporter used by the analysis
+        :param args: arguments for the function
+        :return: results of the function
+        """
+        task = FeatureExtractionLib.BackgroundTask(function, *args)
+        task.start()
+        while task.is_alive():
+            task.join(self.REFRESH_INTERVAL)
+            description, value = threadProgressReporter.state[:2]
+            if description:
+                qtProgressReporter.update(description, value)
+            slicer.app.processEvents()
+            if qtProgressReporter.wasCanceled:
+                # The engine will stop next time that it checks the token
+                qtProgressReporter.cancelToken.cancel()
+        return task.result
+
+
+class MultiNoduleExtractionLogic(FeatureExtractionLogic):
+    def __init__(self, volumeNode, volumeNodeArray, labelmapArray, featureCategoriesKeys, featureKeys, radii=(),
+                 labelmapWholeVolumeArray=None, noduleIds=None, runInBackground=True, quantization=None,
+                 diskCache=None, analyzeNodules=True):
+        """ Analysis of all the nodules of a labelmap (one label per nodule), each one in its own crop of the volume.
+        The nodules are analyzed in a pool of worker processes
+        :param volumeNode: VTK intensities volume node
+        :param volumeNodeArray: numpy array that represents volumeNode
+        :param labelmapArray: numpy array with all the nodules (one label per nodule)
+        :param featureCategoriesKeys: main categories that have some feature that is going to be analyzed
+        :param featureKeys: features that are going to be analyzed
+        :param radii: radii in mm of the spheres that are analyzed around each nodule
+        :param labelmapWholeVolumeArray: numpy array that represents the emphysema labelmap for the whole volume
+        :param noduleIds: labels of the nodules to analyze. When None, all the labels different from 0
+        :param runInBackground: run the analysis in a worker thread, so that Slicer keeps responsive
+        :param quantization: FeatureExtractionLib.GrayLevelQuantization applied before the texture features are
+            calculated. When None, every different intensity is a gray level
+        :param diskCache: FeatureExtractionLib.FeatureDiskCache where the features are reused from and stored in
+        :param analyzeNodules: analyze the nodules themselves. When False, just the spheres around them are analyzed
+        """
+        FeatureExtractionLogic.__init__(self, volumeNode, volumeNodeArray, labelmapArray, featureCategoriesKeys,
+                                        featureKeys, labelmapWholeVolumeArray=labelmapWholeVolumeArray,
+                                        runInBackground=runInBackground, quantization=quantization,
+                                        diskCache=diskCache)
+        self.radii = radii
+        self.noduleIds = noduleIds
+        self.analyzeNodules = analyzeNodules
+
+    def run(self, processes=None):
+        """ Run all the selected analysis for all the nodules.
+        If the user cancels the process, a FeatureExtractionLib.AnalysisCancelled exception (StopIteration) is raised
+        with the results of the nodules already finished
+        :param processes: number of worker processes (default: number of cpus)
+        :return: OrderedDict of NoduleId-(OrderedDict of Region-Results), where Region is "Nodule" (when
+            analyzeNodules is True) or a radius
+        """
+        analysis = FeatureExtractionLib.MultiNoduleAnalysis(self.volumeNodeArray, self.labelmapROIArray,
+                        self.volumeNode.GetSpacing(), self.featureCategoriesKeys, self.featureKeys, self.radii,
+                        self.labelmapWholeVolumeArray, self.noduleIds, self.quantization,
+                        self.diskCache, self.analyzeNodules)
+        qtProgressReporter = QtProgressReporter(FeatureExtractionLib.CancelToken())
+        qtProgressReporter.start(self.volumeNode.GetName() + self.additionalProgressbarDesc, len(analysis.noduleIds))
+        try:
+            if self.runInBackground:
+                progressReporter = FeatureExtractionLib.ThreadProgressReporter(qtProgressReporter.cancelToken)
+                results = self.__runInBackground__(analysis.run, qtProgressReporter, progressReporter,
+                                                   processes, progressReporter)
+            else:
+                results = analysis.run(processes, qtProgressReporter)
+        finally:
+            qtProgressReporter.finish()
+        self.__analysisResultsDict__ = results
+        return results
@@ -1,4 +1,3 @@
 from FeatureDescriptionLabel import *
 from FeatureExtractionLogic import *
 from FeatureWidgets import *
-
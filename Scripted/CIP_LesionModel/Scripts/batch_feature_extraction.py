@@ -0,0 +1,369 @@
+"""
+Headless batch extraction of the CIP_LesionModel features for a whole cohort, without Slicer.
+
+Usage:
+    python batch_feature_extraction.py manifest.csv results.csv [--processes N] [--categories ...] [--features ...]
+        [--shells] [--quantization width:W|count:N|window:LOWER:UPPER:W|none] [--cache DIR]
+
+The manifest is a csv file with a header and the following columns:
+    - CaseId: unique identifier of the case
+    - Volume: path to the intensities volume (any format that SimpleITK can read)
+    - Labelmap: path to the nodule labelmap (every voxel different from 0 is part of the nodule)
+    - Radii (optional): radii in mm of the spheres around the nodule centroid to analyze, separated by ";"
+    - ParenchymaLabelmap (optional): path to the emphysema labelmap (needed for "Parenchymal Volume")
+    - Seeds_LPS (optional): seeds used for the segmentation. They are just copied to the results table
+
+All the results are written to a single csv file, with one row for the nodule and one row for each sphere.
+The cases are analyzed in parallel. A case that fails is recorded with Status=ERROR and does not stop the
+rest of the cohort. The results of each case are written as soon as the case is finished, so the process can
+be resumed just running the same command again: the cases with Status=OK in the results file will be skipped.
+With --shells, the first-order statistics, the volume, the surface, the GLCM features and the parenchymal volume of
+all the spheres of a case are obtained at once from the concentric shells between consecutive radii (see
+FeatureExtractionLib.ConcentricShells).
+With --quantization, the intensities are quantized before the texture features are calculated (see
+FeatureExtractionLib.GrayLevelQuantization), and the scheme is recorded in the Quantization column.
+The process can be interrupted with Ctrl+C: the cases that are running are stopped after the feature they are
+calculating, and the features already calculated are written with Status=PARTIAL (the rest of them are listed in
+the SkippedFeatures column). When the process is resumed, just the missing features of those cases are calculated.
+Press Ctrl+C twice to abort immediately.
+With --cache, the features of every region are stored in a directory (see FeatureExtractionLib.FeatureDiskCache)
+and reused when the same region is analyzed again, even by another cohort or by the CIP_LesionModel module.
+"""
+import os, sys
+import csv
+import argparse
+import traceback
+import signal
+import multiprocessing
+import time
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")))
+import FeatureExtractionLib
+
+STATUS_OK = "OK"
+STATUS_ERROR = "ERROR"
+STATUS_PARTIAL = "PARTIAL"
+BASIC_COLUMNS = ["CaseId", "Region", "Status", "Message", "SkippedFeatures", "Seeds_LPS", "Quantization",
+                 "AnalysisTime"]
+
+# Cancellation flag shared by all the worker processes (see initWorker)
+workerCancelToken = None
+
+
+def readManifest(manifestPath):
+    """ Read all the cases of the manifest
+    :param manifestPath: path to the manifest csv file
+    :return: list of dictionaries Column-Value
+    """
+    with open(manifestPath, "rb") as f:
+        cases = list(csv.DictReader(f))
+    for case in cases:
+        for column in ("CaseId", "Volume", "Labelmap"):
+            if not case.get(column):
+                raise Exception("Column {0} is required for all the cases in the manifest".format(column))
+    return cases
+
+
+def readFinishedCases(resultsPath):
+    """ Cases that were already analyzed successfully in a previous execution
+    :param resultsPath: path to the results csv file
+    :return: set of CaseIds
+    """
+    if not os.path.exists(resultsPath):
+        return set()
+    with open(resultsPath, "rb") as f:
+        return set(row["CaseId"] for row in csv.DictReader(f) if row["Status"] == STATUS_OK)
+
+
+def readPartialResults(resultsPath, featureKeys):
+    """ Features already calculated for the cases that were cancelled in a previous execution
+    :param resultsPath: path to the results csv file
+    :param featureKeys: features that are going to be analyzed
+    :return: dictionary of CaseId-(dictionary of Region-(dictionary of Feature-Value))
+    """
+    partialResults = dict()
+    if not os.path.exists(resultsPath):
+        return partialResults
+    with open(resultsPath, "rb") as f:
+        for row in csv.DictReader(f):
+            if row["Status"] != STATUS_PARTIAL:
+                continue
+            skippedFeatures = set((row.get("SkippedFeatures") or "").split(";"))
+            values = dict()
+            for key in featureKeys:
+                if key in skippedFeatures or not row.get(key):
+                    continue
+                try:
+                    values[key] = float(row[key])
+                except ValueError:
+                    pass
+            # The last row of each region is the most complete one
+            partialResults.setdefault(row["CaseId"], dict())[row["Region"]] = values
+    return partialResults
+
+
+def initWorker(cancelEvent):
+    """ Initialize a worker process. Ctrl+C is handled by the main process, that sets cancelEvent so that the
+    workers stop the cases that are running
+    :param cancelEvent: multiprocessing.Event shared by all the processes
+    """
+    global workerCancelToken
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    workerCancelToken = FeatureExtractionLib.CancelToken(cancelEvent)
+
+
+def analyzeCase(params):
+    """ Calculate all the features for a case (nodule and spheres). It never raises an exception, so that a
+    failure in a case does not stop the rest of the cohort.
+    If the process is cancelled, the regions analyzed (even partially) are returned with Status=PARTIAL
+    :param params: tuple (case, featureCategoriesKeys, featureKeys, incrementalSpheres, quantization,
+        partialResults, diskCache), where partialResults is a dictionary of Region-(dictionary of Feature-Value) with
+        the features calculated in a previous execution that was cancelled. They are not calculated again.
+        diskCache is a FeatureExtractionLib.FeatureDiskCache or None
+    :return: tuple (CaseId, list of dictionaries Column-Value with one row for each analyzed region). The list is
+        empty if the process was cancelled before the case started
+    """
+    case, featureCategoriesKeys, featureKeys, incrementalSpheres, quantization, partialResults, diskCache = params
+    caseId = case["CaseId"]
+    rows = []
+    if workerCancelToken is not None and workerCancelToken.cancelled:
+        return (caseId, rows)
+    progressReporter = FeatureExtractionLib.ProgressReporter(workerCancelToken)
+    region = "Nodule"
+    row = dict()
+    t1 = time.time()
+    try:
+        featureClasses = FeatureExtractionLib.FeatureExtractionEngine.getAllFeatureClasses()
+        parenchymaKeys = set(featureClasses["Parenchymal Volume"])
+
+        volume = sitk.ReadImage(case["Volume"])
+        volumeArray = sitk.GetArrayFromImage(volume)
+        spacing = volume.GetSpacing()
+        labelmapArray = sitk.GetArrayFromImage(sitk.ReadImage(case["Labelmap"]))
+        if labelmapArray.shape != volumeArray.shape:
+            raise Exception("The labelmap and the volume have different dimensions")
+
+        # Nodule (the parenchymal volume is only analyzed in the spheres)
+        t1 = time.time()
+        roiContextCache = FeatureExtractionLib.ROIContextCache()
+        roiContext = roiContextCache.getContext(caseId, labelmapArray, spacing)
+        roiContext.results.update(partialResults.get(region, {}))
+        engine = FeatureExtractionLib.FeatureExtractionEngine(volumeArray, labelmapArray, spacing,
+                    set(featureCategoriesKeys).difference(["Parenchymal Volume"]), set(featureKeys).difference(parenchymaKeys),
+                    roiContext=roiContext, progressReporter=progressReporter, quantization=quantization,
+                    diskCache=diskCache)
+        row.update(engine.run(dict()))
+        row["Region"] = region
+        row["AnalysisTime"] = time.time() - t1
+        rows.append(row)
+
+        # Spheres
+        radii = [float(r) for r in case.get("Radii", "").split(";") if r.strip() != ""]
+        if len(radii) > 0:
+            if "Parenchymal Volume" in featureCategoriesKeys:
+                if not case.get("ParenchymaLabelmap"):
+                    raise Exception("Parenchymal Volume analysis requires a ParenchymaLabelmap")
+                labelmapWholeVolumeArray = sitk.GetArrayFromImage(sitk.ReadImage(case["ParenchymaLabelmap"]))
+                # The voxels of every emphysema type are counted just once for all the spheres
+                labelmapWholeVolumeCounts = FeatureExtractionLib.ParenchymalVolume.getLabelCounts(
+                    labelmapWholeVolumeArray)
+            else:
+                labelmapWholeVolumeArray = labelmapWholeVolumeCounts = None
+            # Distance map to the nodule centroid, just in the bounding box of the biggest sphere
+            centroid = np.round(np.mean(np.where(labelmapArray != 0), axis=1)).astype(np.int)
+            distanceMap, offset = FeatureExtractionLib.SphereROI.distanceMap(centroid, max(radii), spacing,
+                                                                              labelmapArray.shape)
+            volumeCropArray = volumeArray[FeatureExtractionLib.SphereROI.cropSlices(offset, distanceMap.shape)]
+            if incrementalSpheres:
+                shells = FeatureExtractionLib.ConcentricShells(volumeArray, distanceMap, offset, radii, labelmapArray,
+                                                               spacing, parenchymaLabelmapArray=labelmapWholeVolumeArray,
+                                                               parenchymaLabelCounts=labelmapWholeVolumeCounts,
+                                                               quantization=quantization)
+            for radius in radii:
+                region = "r{0:g}".format(radius)
+                row = dict()
+                t1 = time.time()
+                sphereArray = FeatureExtractionLib.SphereROI.sphereLabelmap(distanceMap, offset, radius, labelmapArray)
+                if not sphereArray.any():
+                    # Nothing to analyze
+                    row = dict((key, 0) for key in featureKeys)
+                    sphereFeatureKeys = set()
+                elif incrementalSpheres:
+                    row.update(shells.EvaluateFeatures(radius, featureKeys))
+                    sphereFeatureKeys = set(featureKeys).difference(row.keys())
+                else:
+                    sphereFeatureKeys = set(featureKeys)
+                if len(sphereFeatureKeys) > 0:
+                    sphereCategoriesKeys = set(c for c in featureCategoriesKeys
+                                               if len(sphereFeatureKeys.intersection(featureClasses[c])) > 0)
+                    roiContext = roiContextCache.getContext(caseId, sphereArray, spacing, offset)
+                    roiContext.results.update(partialResults.get(region, {}))
+                    engine = FeatureExtractionLib.FeatureExtractionEngine(volumeCropArray, sphereArray, spacing,
+                                sphereCategoriesKeys, sphereFeatureKeys, labelmapWholeVolumeArray, roiContext,
+                                progressReporter, labelmapROIOffset=offset, quantization=quantization,
+                                diskCache=diskCache, labelmapWholeVolumeCounts=labelmapWholeVolumeCounts)
+                    row.update(engine.run(dict()))
+                row["Region"] = region
+                row["AnalysisTime"] = time.time() - t1
+                rows.append(row)
+
+        for row in rows:
+            row["Status"] = STATUS_OK
+    except FeatureExtractionLib.AnalysisCancelled as ex:
+        # Keep the features already calculated. The case will be resumed in the next execution
+        row.update(ex.results)
+        row["Region"] = region
+        row["SkippedFeatures"] = ";".join(ex.skipped)
+        row["AnalysisTime"] = time.time() - t1
+        rows.append(row)
+        for row in rows:
+            row["Status"] = STATUS_PARTIAL
+            row["Message"] = "Cancelled"
+    except Exception as ex:
+        rows = [{"Status": STATUS_ERROR,
+                 "Message": "{0}: {1}".format(type(ex).__name__, " ".join(str(ex).split())),
+                 "Traceback": traceback.format_exc()}]
+
+    for row in rows:
+        row["CaseId"] = caseId
+        row["Seeds_LPS"] = case.get("Seeds_LPS", "")
+        row["Quantization"] = str(quantization) if quantization is not None else "none"
+    return (caseId, rows)
+
+
+def run(manifestPath, resultsPath, featureCategoriesKeys, featureKeys, processes=None, incrementalSpheres=False,
+        quantization=None, cacheDirectory=None):
+    """ Analyze all the pending cases of the manifest and append the results to the results file
+    :param manifestPath: path to the manifest csv file
+    :param resultsPath: path to the results csv file. If it exists, the cases already finished will be skipped
+    :param featureCategoriesKeys: main categories that have some feature that is going to be analyzed
+    :param featureKeys: features that are going to be analyzed
+    :param processes: number of worker processes (default: number of cpus)
+    :param incrementalSpheres: analyze the spheres of each case incrementally (concentric shells)
+    :param quantization: FeatureExtractionLib.GrayLevelQuantization applied before the texture features are calculated
+    :param cacheDirectory: directory of the FeatureExtractionLib.FeatureDiskCache where the features are reused from
+        and stored in. When None, the features are not persisted
+    :return: number of cases that failed or that were cancelled
+    """
+    cases = readManifest(manifestPath)
+    finishedCases = readFinishedCases(resultsPath)
+    pendingCases = [case for case in cases if case["CaseId"] not in finishedCases]
+    partialResults = readPartialResults(resultsPath, featureKeys)
+    diskCache = FeatureExtractionLib.FeatureDiskCache(cacheDirectory) if cacheDirectory is not None else None
+    print("{0} cases in the manifest. {1} already finished. {2} pending ({3} partially calculated)".format(
+        len(cases), len(cases) - len(pendingCases), len(pendingCases),
+        len([case for case in pendingCases if case["CaseId"] in partialResults])))
+
+    writeHeader = not os.path.exists(resultsPath) or os.path.getsize(resultsPath) == 0
+    if writeHeader:
+        columns = list(BASIC_COLUMNS)
+        columns.extend(featureKeys)
+    else:
+        # Keep the columns of the existing results file, so that the resumed rows are aligned with its header
+        with open(resultsPath, "rb") as f:
+            columns = csv.reader(f).next()
+    errors = 0
+    cancelled = 0
+    cancelEvent = multiprocessing.Event()
+    pool = multiprocessing.Pool(processes, initWorker, (cancelEvent,), maxtasksperchild=1)
+
+    def onInterrupt(signum, frame):
+        if cancelEvent.is_set():
+            raise KeyboardInterrupt()
+        cancelEvent.set()
+        print("Cancelling... The features already calculated will be saved. Press Ctrl+C again to abort")
+
+    try:
+        previousHandler = signal.signal(signal.SIGINT, onInterrupt)
+    except ValueError:
+        # Not in the main thread. Ctrl+C is not handled
+        previousHandler = None
+    try:
+        with open(resultsPath, "ab") as f:
+            writer = csv.DictWriter(f, columns, extrasaction="ignore")
+            if writeHeader:
+                writer.writeheader()
+            params = ((case, featureCategoriesKeys, featureKeys, incrementalSpheres, quantization,
+                       partialResults.get(case["CaseId"], {}), diskCache) for case in pendingCases)
+            results = waitResults(pool.imap_unordered(analyzeCase, params), len(pendingCases))
+            for i, (caseId, rows) in enumerate(results):
+                writer.writerows(rows)
+                f.flush()
+                if len(rows) == 0 or rows[0]["Status"] == STATUS_PARTIAL:
+                    cancelled += 1
+                    print("[{0}/{1}] {2}: cancelled".format(i + 1, len(pendingCases), caseId))
+                elif rows[0]["Status"] == STATUS_OK:
+                    print("[{0}/{1}] {2}: OK".format(i + 1, len(pendingCases), caseId))
+                else:
+                    errors += 1
+                    print("[{0}/{1}] {2}: {3}".format(i + 1, len(pendingCases), caseId, rows[0]["Message"]))
+                    print(rows[0]["Traceback"])
+        pool.close()
+    finally:
+        if previousHandler is not None:
+            signal.signal(signal.SIGINT, previousHandler)
+        pool.terminate()
+        pool.join()
+    if cancelled > 0:
+        print("{0} cases were cancelled. Run the same command again to resume them".format(cancelled))
+    return errors + cancelled
+
+
+def waitResults(iterator, count):
+    """ Results of a pool.imap iterator, waited with a timeout, because in Python 2 a wait without timeout cannot
+    be interrupted and Ctrl+C would not be handled until the next case is finished
+    :param iterator: iterator returned by pool.imap or pool.imap_unordered
+    :param count: number of results
+    :return: generator of results
+    """
+    for i in xrange(count):
+        while True:
+            try:
+                result = iterator.next(1)
+                break
+            except multiprocessing.TimeoutError:
+                pass
+        yield result
+
+
+if __name__ == "__main__":
+    featureClasses = FeatureExtractionLib.FeatureExtractionEngine.getAllFeatureClasses()
+    parser = argparse.ArgumentParser(description="Batch extraction of the CIP_LesionModel features")
+    parser.add_argument("manifest", help="csv file with the cases (CaseId, Volume, Labelmap, [Radii], "
+                                         "[ParenchymaLabelmap], [Seeds_LPS])")
+    parser.add_argument("results", help="csv file where the results will be written (or resumed)")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes (default: number of cpus)")
+    parser.add_argument("--categories", nargs="+", choices=featureClasses.keys(),
+                        default=[c for c in featureClasses.iterkeys() if c != "Parenchymal Volume"],
+                        help="Feature categories to analyze (default: all but Parenchymal Volume)")
+    parser.add_argument("--features", nargs="+", default=None,
+                        help="Concrete features to analyze (default: all the features in the selected categories)")
+    parser.add_argument("--shells", action="store_true",
+                        help="Calculate the first-order statistics, the volume, the surface, the GLCM features and the "
+                             "parenchymal volume of all the spheres of a case at once, accumulating the statistics of "
+                             "the concentric shells")
+    parser.add_argument("--quantization", default="none",
+                        help="Quantization of the intensities before the texture features: width:W (fixed bin width "
+                             "in HU), count:N (fixed number of bins), window:LOWER:UPPER:W (HU window and bin width) "
+                             "or none (every HU value is a gray level, default)")
+    parser.add_argument("--cache", default=None, metavar="DIR",
+                        help="Directory where the features of every region are stored, so that they are reused "
+                             "when the same region is analyzed again")
+    args = parser.parse_args()
+    try:
+        quantization = FeatureExtractionLib.GrayLevelQuantization.fromString(args.quantization)
+    except ValueError as ex:
+        parser.error(str(ex))
+
+    featureKeys = [key for c in args.categories for key in featureClasses[c]]
+    if args.features is not None:
+        unknownFeatures = set(args.features).difference(featureKeys)
+        if len(unknownFeatures) > 0:
+            parser.error("Unknown features for the selected categories: {0}".format(", ".join(unknownFeatures)))
+        featureKeys = [key for key in featureKeys if key in args.features]
+
+    errors = run(args.manifest, args.results, args.categories, featureKeys, args.processes, args.shells, quantization,
+                 args.cache)
+    sys.exit(1 if errors > 0 else 0)
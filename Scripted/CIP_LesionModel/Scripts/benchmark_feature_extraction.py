@@ -0,0 +1,227 @@
+"""
+Benchmark of the CIP_LesionModel features on synthetic lesions of increasing size, without Slicer.
+
+Usage:
+    python benchmark_feature_extraction.py [--shapes ...] [--radii ...] [--spacing X Y Z] [--repeat N] [--seed S]
+        [--categories ...] [--features ...] [--quantization ...] [--details] [--output profile.csv]
+
+Synthetic lesions:
+    - sphere: homogeneous sphere
+    - ellipsoid: homogeneous ellipsoid with semi-axes (r, 0.7r, 0.45r)
+    - noisy: lobulated lesion (the surface is modulated by random lobes) with heterogeneous intensities
+
+Every lesion is analyzed with FeatureExtractionLib.FeatureExtractionEngine and a FeatureProfiler (see
+FeatureExtractionLib.FeatureProfiler) "repeat" times. For every step (category, and with --details also the
+preprocessing, the intermediate values and the features) the benchmark reports the best wall time for each size and
+the scaling exponent k fitted as time ~ voxels^k (least squares in log-log scale), so that it can be used to catch
+performance regressions and to choose which features are affordable for the lesion sizes of a study.
+The peak memory is the high-water mark of the whole process, so the sizes are always analyzed in increasing order.
+With --quantization, the texture features are calculated with quantized gray levels (see
+FeatureExtractionLib.GrayLevelQuantization), so that different schemes can be compared.
+With --output, all the measures are written to a csv file (one row per shape, size and step).
+"""
+import os, sys
+import csv
+import argparse
+import numpy as np
+
+sys.path.append(os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")))
+import FeatureExtractionLib
+
+SHAPES = ("sphere", "ellipsoid", "noisy")
+KIND_TOTAL = "total"
+CSV_COLUMNS = ["Shape", "Radius", "Voxels", "Category", "Name", "Kind", "Count", "BestWallTime", "MeanCPUTime",
+               "PeakMemory", "PeakMemoryIncrease"]
+
+
+def createLesion(shape, radius, spacing, randomState, margin=3):
+    """ Synthetic volume with a lesion in the center
+    :param shape: one of SHAPES
+    :param radius: radius (biggest semi-axis) of the lesion in mm
+    :param spacing: spacing of the volume (XYZ)
+    :param randomState: numpy RandomState used for the noise
+    :param margin: voxels between the lesion and the border of the volume
+    :return: tuple (volume array (int16), labelmap array (uint8)), both in numpy (ZYX) order
+    """
+    if shape == "ellipsoid":
+        semiAxes = np.array([radius, 0.7 * radius, 0.45 * radius])
+    elif shape == "noisy":
+        # The lobes can grow the lesion up to 30%
+        semiAxes = np.array([1.3 * radius] * 3)
+    else:
+        semiAxes = np.array([radius] * 3)
+    # Semi-axes and spacing in ZYX order
+    semiAxes = semiAxes[::-1]
+    spacingZYX = np.array(spacing[::-1], np.float64)
+    halfSize = np.ceil(semiAxes / spacingZYX).astype(np.int) + margin
+    z, y, x = np.ogrid[-halfSize[0]:halfSize[0] + 1, -halfSize[1]:halfSize[1] + 1, -halfSize[2]:halfSize[2] + 1]
+    z = z * spacingZYX[0]
+    y = y * spacingZYX[1]
+    x = x * spacingZYX[2]
+
+    if shape == "noisy":
+        # Radius modulated by a few random lobes in random directions
+        distance = np.sqrt(z ** 2 + y ** 2 + x ** 2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            directions = [z / distance, y / distance, x / distance]
+        modulation = np.zeros(distance.shape)
+        for i in range(6):
+            lobe = randomState.normal(size=3)
+            lobe /= np.linalg.norm(lobe)
+            cosine = np.nan_to_num(lobe[0] * directions[0] + lobe[1] * directions[1] + lobe[2] * directions[2])
+            modulation += randomState.uniform(0.05, 0.15) * np.cos(randomState.randint(2, 5) * np.arccos(cosine))
+        labelmapArray = distance <= radius * (1 + modulation)
+    else:
+        labelmapArray = (z / semiAxes[0]) ** 2 + (y / semiAxes[1]) ** 2 + (x / semiAxes[2]) ** 2 <= 1
+
+    # Lung parenchyma around a soft tissue lesion
+    volumeArray = randomState.normal(-850, 40, labelmapArray.shape)
+    if shape == "noisy":
+        # Heterogeneous lesion: noise plus some darker areas (ex: necrosis)
+        lesion = randomState.normal(20, 120, labelmapArray.shape)
+        lesion[randomState.uniform(size=labelmapArray.shape) < 0.1] -= 300
+    else:
+        lesion = randomState.normal(20, 30, labelmapArray.shape)
+    volumeArray[labelmapArray] = lesion[labelmapArray]
+    return (np.round(volumeArray).astype(np.int16), labelmapArray.astype(np.uint8))
+
+
+def profileLesion(volumeArray, labelmapArray, spacing, featureCategoriesKeys, featureKeys, repeat, quantization=None):
+    """ Analyze a lesion several times with a FeatureProfiler
+    :param volumeArray: intensities volume array
+    :param labelmapArray: lesion labelmap array
+    :param spacing: spacing of the volume (XYZ)
+    :param featureCategoriesKeys: main categories that have some feature that is going to be analyzed
+    :param featureKeys: features that are going to be analyzed
+    :param repeat: number of times that the lesion is analyzed
+    :param quantization: GrayLevelQuantization applied before the texture features are calculated
+    :return: FeatureProfiler with the records of all the repetitions
+    """
+    profiler = FeatureExtractionLib.FeatureProfiler()
+    for i in range(repeat):
+        # A new engine each time, so that nothing is reused from the previous repetition
+        engine = FeatureExtractionLib.FeatureExtractionEngine(volumeArray, labelmapArray, spacing,
+                                                              featureCategoriesKeys, featureKeys, profiler=profiler,
+                                                              quantization=quantization)
+        with profiler.measure("All", "Total", KIND_TOTAL):
+            engine.run(dict())
+    return profiler
+
+
+def scalingExponent(voxels, times):
+    """ Exponent k of the fit time ~ voxels^k (least squares in log-log scale)
+    :param voxels: number of voxels of each lesion
+    :param times: time elapsed for each lesion
+    :return: exponent, or None if there are not enough measures
+    """
+    points = [(v, t) for v, t in zip(voxels, times) if v > 0 and t > 0]
+    if len(points) < 2 or len(set(v for v, t in points)) < 2:
+        return None
+    logVoxels, logTimes = np.log(np.array(points, np.float64)).T
+    return np.polyfit(logVoxels, logTimes, 1)[0]
+
+
+def printScalingCurves(shape, voxels, summaries, kinds):
+    """ Print a table with the best wall time of every step for all the sizes of a shape
+    :param shape: name of the shape
+    :param voxels: number of voxels of each lesion
+    :param summaries: summary of the FeatureProfiler of each lesion (see FeatureProfiler.getSummary)
+    :param kinds: kinds of steps to print
+    """
+    steps = []
+    for summary in summaries:
+        for key in summary:
+            if key[2] in kinds and key not in steps:
+                steps.append(key)
+    print("")
+    print("{0}: best wall time (ms) by number of voxels of the lesion".format(shape))
+    print("{0:<60}".format("Step") + "".join("{0:>12}".format(v) for v in voxels) + "{0:>8}".format("k"))
+    for key in steps:
+        times = [summary[key]["minWallTime"] if key in summary else 0 for summary in summaries]
+        k = scalingExponent(voxels, times)
+        name = key[1] if key[0] == key[1] else "{0} / {1}".format(key[0], key[1])
+        print("{0:<60}".format(name[:59]) + "".join("{0:>12.2f}".format(t * 1000) for t in times) +
+              "{0:>8}".format("-" if k is None else "{0:.2f}".format(k)))
+
+
+def run(shapes, radii, spacing, featureCategoriesKeys, featureKeys, repeat=3, seed=0, details=False,
+        outputPath=None, quantization=None):
+    """ Benchmark all the shapes and sizes
+    :param shapes: shapes of the lesions (see SHAPES)
+    :param radii: radii in mm of the lesions
+    :param spacing: spacing of the volume (XYZ)
+    :param featureCategoriesKeys: main categories that have some feature that is going to be analyzed
+    :param featureKeys: features that are going to be analyzed
+    :param repeat: number of times that each lesion is analyzed (the best time is reported)
+    :param seed: seed for the random noise, so that the lesions are the same in different executions
+    :param details: print also the preprocessing, the intermediate values and the features (not just the categories)
+    :param outputPath: csv file where all the measures are written (optional)
+    :param quantization: GrayLevelQuantization applied before the texture features are calculated
+    :return: list of dictionaries Column-Value with all the measures (see CSV_COLUMNS)
+    """
+    rows = []
+    kinds = [KIND_TOTAL, FeatureExtractionLib.KIND_CATEGORY]
+    if details:
+        kinds.extend([FeatureExtractionLib.KIND_PREPROCESSING, FeatureExtractionLib.KIND_INTERMEDIATE,
+                      FeatureExtractionLib.KIND_FEATURE])
+    for shape in shapes:
+        voxels = []
+        summaries = []
+        for radius in sorted(radii):
+            volumeArray, labelmapArray = createLesion(shape, radius, spacing, np.random.RandomState(seed))
+            profiler = profileLesion(volumeArray, labelmapArray, spacing, featureCategoriesKeys, featureKeys, repeat,
+                                     quantization)
+            voxels.append(int(np.count_nonzero(labelmapArray)))
+            summaries.append(profiler.getSummary())
+            peakMemory = FeatureExtractionLib.FeatureProfiler.getPeakMemory()
+            for (category, name, kind), s in summaries[-1].iteritems():
+                rows.append({"Shape": shape, "Radius": radius, "Voxels": voxels[-1], "Category": category,
+                             "Name": name, "Kind": kind, "Count": s["count"], "BestWallTime": s["minWallTime"],
+                             "MeanCPUTime": s["cpuTime"] / s["count"], "PeakMemory": peakMemory,
+                             "PeakMemoryIncrease": s["peakMemoryIncrease"]})
+        printScalingCurves(shape, voxels, summaries, kinds)
+
+    if outputPath is not None:
+        with open(outputPath, "wb") as f:
+            writer = csv.DictWriter(f, CSV_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+if __name__ == "__main__":
+    featureClasses = FeatureExtractionLib.FeatureExtractionEngine.getAllFeatureClasses()
+    parser = argparse.ArgumentParser(description="Benchmark of the CIP_LesionModel features on synthetic lesions")
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES), help="Shapes of the lesions")
+    parser.add_argument("--radii", nargs="+", type=float, default=[4, 6, 9, 13],
+                        help="Radii in mm of the lesions (default: 4 6 9 13)")
+    parser.add_argument("--spacing", nargs=3, type=float, default=[0.7, 0.7, 1.25],
+                        help="Spacing of the volume (XYZ) (default: 0.7 0.7 1.25)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of times that each lesion is analyzed")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the random noise")
+    parser.add_argument("--categories", nargs="+", choices=[c for c in featureClasses if c != "Parenchymal Volume"],
+                        default=[c for c in featureClasses.iterkeys() if c != "Parenchymal Volume"],
+                        help="Feature categories to analyze (default: all but Parenchymal Volume)")
+    parser.add_argument("--features", nargs="+", default=None,
+                        help="Concrete features to analyze (default: all the features in the selected categories)")
+    parser.add_argument("--quantization", default="none",
+                        help="Quantization of the intensities before the texture features: width:W, count:N, "
+                             "window:LOWER:UPPER:W or none (default)")
+    parser.add_argument("--details", action="store_true",
+                        help="Print also the preprocessing steps, the intermediate values and the features")
+    parser.add_argument("--output", default=None, help="csv file where all the measures will be written")
+    args = parser.parse_args()
+    try:
+        quantization = FeatureExtractionLib.GrayLevelQuantization.fromString(args.quantization)
+    except ValueError as ex:
+        parser.error(str(ex))
+
+    featureKeys = [key for c in args.categories for key in featureClasses[c]]
+    if args.features is not None:
+        unknownFeatures = set(args.features).difference(featureKeys)
+        if len(unknownFeatures) > 0:
+            parser.error("Unknown features for the selected categories: {0}".format(", ".join(unknownFeatures)))
+        featureKeys = [key for key in featureKeys if key in args.features]
+
+    run(args.shapes, args.radii, tuple(args.spacing), args.categories, featureKeys, args.repeat, args.seed,
+        args.details, args.output, quantization)
@@ -0,0 +1,64 @@
+import os, sys
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import ConcentricShells, FeatureExtractionEngine, GrayLevelQuantization, SphereROI, \
+    TextureGLCM
+
+SPACING = (0.8, 1.0, 1.25)
+RADII = [2, 3, 4.5]
+
+
+def getCase():
+    """ Volume with a small nodule in the center. Some voxels of the neighborhood are 0, so that they expose the faces
+    of their neighbors
+    """
+    volume = np.random.RandomState(17).randint(-30, 30, (11, 13, 14)).astype(np.int16)
+    labelmap = np.zeros(volume.shape, np.uint8)
+    labelmap[4:7, 5:8, 6:9] = 1
+    distanceMap, offset = SphereROI.distanceMap((5, 6, 7), max(RADII), SPACING, volume.shape)
+    return volume, labelmap, distanceMap, offset
+
+
+def engineFeatures(volume, labelmap, distanceMap, offset, radius, featureKeys, quantization):
+    """ Features of a sphere calculated from scratch
+    """
+    sphereArray = SphereROI.sphereLabelmap(distanceMap, offset, radius, labelmap)
+    volumeCrop = volume[SphereROI.cropSlices(offset, distanceMap.shape)]
+    categories = [c for c, keys in FeatureExtractionEngine.getAllFeatureClasses().iteritems()
+                  if len(set(keys).intersection(featureKeys)) > 0]
+    engine = FeatureExtractionEngine(volumeCrop, sphereArray, SPACING, categories, featureKeys,
+                                     labelmapROIOffset=offset, quantization=quantization)
+    return engine.run(dict())
+
+
+def checkShells(quantization):
+    volume, labelmap, distanceMap, offset = getCase()
+    featureKeys = ["Volume mm^3", "Volume cc", "Surface Area mm^2", "Surface:Volume Ratio", "Compactness 1",
+                   "Compactness 2", "Spherical Disproportion", "Sphericity"] + \
+                  list(TextureGLCM.registry.features.keys())
+    shells = ConcentricShells(volume, distanceMap, offset, RADII, labelmap, SPACING, quantization=quantization)
+    for radius in RADII:
+        expected = engineFeatures(volume, labelmap, distanceMap, offset, radius, featureKeys, quantization)
+        results = shells.EvaluateFeatures(radius, featureKeys)
+        assert set(results.keys()) == set(featureKeys)
+        for key in featureKeys:
+            assert np.allclose(results[key], expected[key], rtol=1e-5, equal_nan=True), (radius, key)
+
+
+def test_shells_match_the_engine():
+    checkShells(None)
+
+
+def test_shells_match_the_engine_with_quantization():
+    checkShells(GrayLevelQuantization.fromString("width:7"))
+    checkShells(GrayLevelQuantization.fromString("count:8"))
+
+
+def test_glcm_and_surface_are_incremental():
+    keys = ConcentricShells.getIncrementalFeatureKeys()
+    assert "Surface Area mm^2" in keys and "Sphericity" in keys
+    assert set(TextureGLCM.registry.features.keys()).issubset(keys)
+    assert "Maximum 3D Diameter" not in keys
@@ -0,0 +1,100 @@
+import os, sys
+import shutil
+import tempfile
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import FeatureDiskCache, FeatureExtractionEngine, GrayLevelQuantization
+
+SPACING = (0.7, 0.7, 1.25)
+CATEGORIES = ["First-Order Statistics", "Morphology and Shape", "Texture: GLCM"]
+FEATURE_KEYS = ["Mean Intensity", "Energy", "Volume mm^3", "Surface Area mm^2", "Contrast", "Homogeneity 1"]
+
+
+def getCase():
+    volume = np.random.RandomState(8).randint(-900, 100, (10, 12, 12)).astype(np.int16)
+    labelmap = np.zeros(volume.shape, np.uint8)
+    labelmap[3:7, 2:8, 4:9] = 1
+    return volume, labelmap
+
+
+class TemporaryCache:
+    """ FeatureDiskCache in a temporary directory that is removed at the end
+    """
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp()
+        return FeatureDiskCache(os.path.join(self.directory, "cache"))
+
+    def __exit__(self, excType, excValue, traceback):
+        shutil.rmtree(self.directory)
+
+
+class ForbiddenCalculation(FeatureExtractionEngine):
+    """ Engine that fails if some feature has to be calculated (everything must come from the cache)
+    """
+    def paddedTumorMatrixAndCoordinates(self, targetVoxels, targetVoxelsCoordinates):
+        raise AssertionError("The features should have been read from the cache")
+
+
+def test_roi_key_depends_only_on_the_content():
+    volume, labelmap = getCase()
+    coordinates = np.where(labelmap)
+    key = FeatureDiskCache.getROIKey(volume[coordinates], coordinates, SPACING)
+    # The same ROI in a crop of the volume
+    crop = labelmap[2:, 1:, 3:]
+    cropCoordinates = np.where(crop)
+    assert FeatureDiskCache.getROIKey(volume[2:, 1:, 3:][cropCoordinates], cropCoordinates, SPACING) == key
+    # Different intensities, shape or spacing
+    values = volume[coordinates].copy()
+    values[0] += 1
+    assert FeatureDiskCache.getROIKey(values, coordinates, SPACING) != key
+    labelmap[0, 0, 0] = 1
+    otherCoordinates = np.where(labelmap)
+    assert FeatureDiskCache.getROIKey(volume[otherCoordinates], otherCoordinates, SPACING) != key
+    assert FeatureDiskCache.getROIKey(volume[coordinates], coordinates, (0.7, 0.7, 1.0)) != key
+
+
+def test_load_and_save():
+    with TemporaryCache() as cache:
+        assert cache.load("abc", {"Mean Intensity": "sig1"}) == {}
+        cache.save("abc", {"Mean Intensity": np.float64(2.5), "Energy": 7, "Array": np.zeros(3), "Other": 1.0},
+                   {"Mean Intensity": "sig1", "Energy": "sig1", "Array": "sig1"})
+        # The values without signature or that are not numbers are not stored
+        assert cache.load("abc", {"Mean Intensity": "sig1", "Energy": "sig1", "Array": "sig1", "Other": "sig1"}) == \
+            {"Mean Intensity": 2.5, "Energy": 7}
+        # A different signature (ex: new version of the registry) invalidates the value
+        assert cache.load("abc", {"Mean Intensity": "sig2", "Energy": "sig1"}) == {"Energy": 7}
+        # The values are added to the ones already stored
+        cache.save("abc", {"Mean Intensity": 3.5}, {"Mean Intensity": "sig2"})
+        assert cache.load("abc", {"Mean Intensity": "sig2", "Energy": "sig1"}) == {"Mean Intensity": 3.5, "Energy": 7}
+        cache.clear()
+        assert cache.load("abc", {"Energy": "sig1"}) == {}
+
+
+def test_corrupted_file_is_ignored():
+    with TemporaryCache() as cache:
+        cache.save("abc", {"Energy": 7}, {"Energy": "sig1"})
+        with open(os.path.join(cache.directory, "ab", "abc.json"), "w") as f:
+            f.write("{not json")
+        assert cache.load("abc", {"Energy": "sig1"}) == {}
+
+
+def test_engine_reuses_the_cached_features():
+    volume, labelmap = getCase()
+    with TemporaryCache() as cache:
+        expected = FeatureExtractionEngine(volume, labelmap, SPACING, CATEGORIES, FEATURE_KEYS).run(dict())
+        results = FeatureExtractionEngine(volume, labelmap, SPACING, CATEGORIES, FEATURE_KEYS,
+                                          diskCache=cache).run(dict())
+        assert results == expected
+        # The same ROI in a crop of the volume is read from the cache, without calculating anything
+        results = ForbiddenCalculation(volume[1:, 1:, 2:], labelmap[1:, 1:, 2:], SPACING, CATEGORIES, FEATURE_KEYS,
+                                       diskCache=cache).run(dict())
+        assert results == expected
+        # The texture features with another quantization are calculated again
+        quantization = GrayLevelQuantization.fromString("width:25")
+        results = FeatureExtractionEngine(volume, labelmap, SPACING, CATEGORIES, FEATURE_KEYS,
+                                          quantization=quantization, diskCache=cache).run(dict())
+        assert results["Mean Intensity"] == expected["Mean Intensity"]
+        assert results["Contrast"] != expected["Contrast"]
@@ -0,0 +1,76 @@
+import os, sys
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import GeometricalMeasures
+
+SPACING = (0.7, 0.9, 1.25)
+FEATURE_KEYS = ["Extruded Surface Area", "Extruded Volume", "Extruded Surface:Volume Ratio"]
+
+
+def getROI(seed):
+    """ Random ROI with negative, positive and 0 intensities, in the format used by the feature classes
+    :return: tuple (matrix, matrixCoordinates, values)
+    """
+    rs = np.random.RandomState(seed)
+    mask = rs.rand(5, 6, 4) > 0.35
+    coordinates = np.where(mask)
+    values = rs.randint(-25, 20, size=len(coordinates[0]))
+    values[::9] = 0
+    matrix = np.zeros(mask.shape)
+    matrix[coordinates] = values
+    return matrix, coordinates, values
+
+
+def baselineFeatures(matrix, matrixCoordinates, values, spacing=SPACING):
+    """ Surface and volume of the dense binary 4D extrusion of the ROI, element by element, as it was done before
+    the height matrix
+    """
+    values = np.abs(values)
+    extrudedMatrix = np.zeros(tuple(n + 2 for n in matrix.shape) + (values.max() + 2,))
+    for i, j, k, value in zip(*(matrixCoordinates + (values,))):
+        extrudedMatrix[i + 1, j + 1, k + 1, 1:value + 1] = 1
+
+    x, y, z = spacing
+    xz = x * z
+    yz = y * z
+    xy = x * y
+    fourD = (2 * xy + 2 * xz + 2 * yz)
+    surfaceArea = 0
+    for i, j, k, l in zip(*np.where(extrudedMatrix == 1)):
+        fxy = np.sum(np.array([extrudedMatrix[i + 1, j, k, l], extrudedMatrix[i - 1, j, k, l]]) == 0)
+        fyz = np.sum(np.array([extrudedMatrix[i, j + 1, k, l], extrudedMatrix[i, j - 1, k, l]]) == 0)
+        fxz = np.sum(np.array([extrudedMatrix[i, j, k + 1, l], extrudedMatrix[i, j, k - 1, l]]) == 0)
+        f4d = np.sum(np.array([extrudedMatrix[i, j, k, l + 1], extrudedMatrix[i, j, k, l - 1]]) == 0)
+        surfaceArea += (fxz * xz) + (fyz * yz) + (fxy * xy) + (f4d * fourD)
+    volume = np.count_nonzero(extrudedMatrix) * x * y * z
+    return {"Extruded Surface Area": surfaceArea, "Extruded Volume": volume,
+            "Extruded Surface:Volume Ratio": surfaceArea / volume}
+
+
+def test_features_match_the_dense_extrusion():
+    for seed in range(4):
+        matrix, matrixCoordinates, values = getROI(seed)
+        assert (values < 0).any() and (values == 0).any()
+        results = GeometricalMeasures(SPACING, matrix, matrixCoordinates, values, FEATURE_KEYS).EvaluateFeatures()
+        expected = baselineFeatures(matrix, matrixCoordinates, values)
+        assert set(results.keys()) == set(FEATURE_KEYS)
+        for key in FEATURE_KEYS:
+            assert np.isclose(results[key], expected[key], rtol=1e-12), (seed, key)
+
+
+def test_single_voxel():
+    # A 4D box of 1x1x1x7 elements
+    matrix = np.zeros((1, 1, 1))
+    coordinates = (np.array([0]), np.array([0]), np.array([0]))
+    values = np.array([-7])
+    results = GeometricalMeasures(SPACING, matrix, coordinates, values, FEATURE_KEYS).EvaluateFeatures()
+    x, y, z = SPACING
+    assert np.isclose(results["Extruded Volume"], 7 * x * y * z)
+    # 7 elements exposed in the 3 spatial axes, and the 2 ends of the column in the 4th dimension
+    fourD = 2 * (x * y + x * z + y * z)
+    assert np.isclose(results["Extruded Surface Area"], 7 * fourD + 2 * fourD)
+    assert np.isclose(results["Extruded Surface Area"],
+                      baselineFeatures(matrix, coordinates, values)["Extruded Surface Area"])
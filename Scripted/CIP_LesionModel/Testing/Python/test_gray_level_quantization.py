@@ -0,0 +1,58 @@
+import os, sys
+import math
+import numpy as np
+import pytest
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import GrayLevelQuantization
+
+
+def getValues():
+    return np.random.RandomState(11).randint(-1000, 200, 500).astype(np.int16)
+
+
+def test_fixed_bin_width():
+    values = getValues()
+    grayLevels, allGrayLevels = GrayLevelQuantization.fromString("width:25").quantize(values)
+    # Bins aligned to the multiples of the width, numbered from the bin of the minimum
+    firstBin = int(math.floor(values.min() / 25.0))
+    expected = [int(math.floor(v / 25.0)) - firstBin + 1 for v in values]
+    assert grayLevels.tolist() == expected
+    assert allGrayLevels.tolist() == range(1, max(expected) + 1)
+
+
+def test_fixed_bin_count():
+    values = getValues()
+    grayLevels, allGrayLevels = GrayLevelQuantization.fromString("count:16").quantize(values)
+    minimum, maximum = float(values.min()), float(values.max())
+    # The maximum goes to the last bin
+    expected = [min(int(math.floor(16 * (v - minimum) / (maximum - minimum))) + 1, 16) for v in values]
+    assert grayLevels.tolist() == expected
+    assert allGrayLevels.tolist() == range(1, 17)
+    # A constant ROI has a single gray level
+    assert GrayLevelQuantization.fromString("count:16").quantize(np.full(5, 40))[0].tolist() == [1] * 5
+
+
+def test_hu_window():
+    values = getValues()
+    grayLevels, allGrayLevels = GrayLevelQuantization.fromString("window:-1000:400:50").quantize(values)
+    # Same gray levels for all the ROIs: the values are clipped to the window
+    expected = [min(int(math.floor((min(max(v, -1000), 400) + 1000) / 50.0)) + 1, 28) for v in values]
+    assert grayLevels.tolist() == expected
+    assert allGrayLevels.tolist() == range(1, 29)
+
+
+def test_empty_roi():
+    grayLevels, allGrayLevels = GrayLevelQuantization.fromString("width:25").quantize(np.zeros(0, np.int16))
+    assert grayLevels.size == 0 and allGrayLevels.size == 0
+
+
+def test_text_representation():
+    for text in ("width:25", "count:32", "window:-1000:400:25"):
+        assert str(GrayLevelQuantization.fromString(text)) == text
+    assert GrayLevelQuantization.fromString("none") is None
+    for text in ("width:0", "count:x", "window:400:-1000:25", "other:3"):
+        with pytest.raises(ValueError):
+            GrayLevelQuantization.fromString(text)
@@ -0,0 +1,69 @@
+import os, sys
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import LevelSetThreshold
+
+SPACING = (0.7, 0.7, 1.25)
+BACKGROUND = -4.0
+
+
+def getLevelSet():
+    """ Level set evolved just in a region around the seeds (the rest of the volume has the background value)
+    """
+    levelSet = np.full((12, 15, 14), BACKGROUND, np.float32)
+    levelSet[3:9, 4:11, 5:12] = np.random.RandomState(3).uniform(-6, 6, (6, 7, 7))
+    return levelSet
+
+
+# Thresholds around the background value and in the evolved region
+THRESHOLDS = [-10, -5, BACKGROUND, -3.5, -1, 0, 0.5, 2, 5.9, 10]
+
+
+def test_voxel_count_and_volume():
+    levelSet = getLevelSet()
+    levelSetThreshold = LevelSetThreshold(levelSet, SPACING)
+    cubicMMPerVoxel = SPACING[0] * SPACING[1] * SPACING[2]
+    for threshold in THRESHOLDS:
+        # Baseline: threshold of the whole level set
+        expected = np.count_nonzero(levelSet >= threshold)
+        assert levelSetThreshold.getVoxelCount(threshold) == expected, threshold
+        assert np.isclose(levelSetThreshold.getVolume(threshold), expected * cubicMMPerVoxel)
+
+
+def test_fill_labelmap():
+    levelSet = getLevelSet()
+    levelSetThreshold = LevelSetThreshold(levelSet, SPACING)
+    labelmap = np.zeros(levelSet.shape, np.uint8)
+    # The labelmap is updated in place, also when the threshold crosses the background value in both directions
+    for threshold in THRESHOLDS + THRESHOLDS[::-1]:
+        levelSetThreshold.fillLabelmap(threshold, labelmap, labelValue=3)
+        assert np.array_equal(labelmap, np.where(levelSet >= threshold, 3, 0)), threshold
+
+
+def test_empty_level_set():
+    levelSet = np.full((4, 5, 6), BACKGROUND, np.float32)
+    levelSetThreshold = LevelSetThreshold(levelSet, SPACING)
+    assert levelSetThreshold.getVoxelCount(0) == 0
+    assert levelSetThreshold.getVoxelCount(BACKGROUND) == levelSet.size
+    labelmap = np.zeros(levelSet.shape, np.uint8)
+    levelSetThreshold.fillLabelmap(BACKGROUND, labelmap)
+    assert labelmap.all()
+
+
+def test_level_set_of_a_crop():
+    # The segmentation CLI is run on a crop of the volume around the seeds. The nodule in the whole volume must be
+    # the same as if the whole volume had been segmented
+    levelSet = getLevelSet()
+    offset = (2, 1, 3)
+    crop = levelSet[2:11, 1:13, 3:14]
+    levelSetThreshold = LevelSetThreshold(crop, SPACING, offset=offset, shape=levelSet.shape)
+    # Evolved region (with a margin of 1 voxel) in VTK order
+    assert levelSetThreshold.extent == [4, 12, 3, 11, 2, 9]
+    labelmap = np.zeros(levelSet.shape, np.uint8)
+    for threshold in THRESHOLDS + THRESHOLDS[::-1]:
+        assert levelSetThreshold.getVoxelCount(threshold) == np.count_nonzero(levelSet >= threshold), threshold
+        levelSetThreshold.fillLabelmap(threshold, labelmap)
+        assert np.array_equal(labelmap, levelSet >= threshold), threshold
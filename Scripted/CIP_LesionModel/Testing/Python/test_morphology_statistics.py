@@ -0,0 +1,75 @@
+import os, sys
+import itertools
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import MorphologyStatistics
+
+
+def getDiameters(mask, spacing=(1.0, 1.0, 1.0)):
+    """ Maximum 2D diameters (axial, coronal, sagittal) and maximum 3D diameter of a binary mask
+    """
+    matrix = np.pad(mask, 1, 'constant')
+    coordinates = np.where(matrix != 0)
+    morphology = MorphologyStatistics(spacing, matrix, coordinates, matrix[coordinates], [])
+    return [morphology.maximum2DDiameter(spacing, matrix, coordinates, axis) for axis in range(3)], \
+        morphology.maximum3DDiameter(spacing, matrix, coordinates)
+
+
+def bruteForceDiameter(points, spacing):
+    """ Maximum distance between all the pairs of points (ZYX voxel coordinates)
+    """
+    x, y, z = spacing
+    points = np.array(sorted(points), float) * [z, y, x]
+    return np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2)).max()
+
+
+def bruteForce2DDiameter(mask, spacing, planeAxis):
+    """ Maximum distance between the in-plane corners of the voxels of every slice
+    """
+    result = 0
+    for k in range(mask.shape[planeAxis]):
+        voxels = np.transpose(np.nonzero(np.take(mask, k, planeAxis)))
+        corners = set()
+        for voxel in voxels:
+            for offset in itertools.product((0, 1), (0, 1)):
+                corner = list(voxel + offset)
+                corner.insert(planeAxis, k)
+                corners.add(tuple(corner))
+        if corners:
+            result = max(result, bruteForceDiameter(corners, spacing))
+    return result
+
+
+def bruteForce3DDiameter(mask, spacing):
+    """ Maximum distance between the corners of all the voxels
+    """
+    corners = set()
+    for voxel in np.transpose(np.nonzero(mask)):
+        for offset in itertools.product((0, 1), (0, 1), (0, 1)):
+            corners.add(tuple(voxel + offset))
+    return bruteForceDiameter(corners, spacing)
+
+
+def test_maximum_2D_diameter_voxels_in_different_slices():
+    """ Two voxels in consecutive axial slices are not in the same axial plane
+    """
+    mask = np.zeros((4, 9, 3), np.uint8)
+    mask[1, 1, 1] = 1
+    mask[2, 7, 1] = 1
+    diameters2D, diameter3D = getDiameters(mask)
+    assert abs(diameters2D[0] - np.sqrt(2)) < 1e-9
+    assert abs(diameter3D - np.sqrt(2 ** 2 + 7 ** 2 + 1)) < 1e-9
+
+
+def test_diameters_match_brute_force():
+    rs = np.random.RandomState(0)
+    for i in range(10):
+        mask = (rs.rand(5, 6, 7) > 0.6).astype(np.uint8)
+        spacing = tuple(rs.rand(3) + 0.5)
+        diameters2D, diameter3D = getDiameters(mask, spacing)
+        for axis in range(3):
+            assert abs(diameters2D[axis] - bruteForce2DDiameter(mask, spacing, axis)) < 1e-9
+        assert abs(diameter3D - bruteForce3DDiameter(mask, spacing)) < 1e-9
@@ -0,0 +1,67 @@
+import os, sys
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import FeatureExtractionEngine, MultiNoduleAnalysis, SphereROI
+
+SPACING = (1.0, 1.0, 1.5)
+RADII = [3]
+CATEGORIES = ["First-Order Statistics", "Morphology and Shape"]
+FEATURE_KEYS = ["Mean Intensity", "Energy", "Volume mm^3", "Surface Area mm^2"]
+
+
+def getCase():
+    """ Volume with 2 nodules (labels 1 and 2)
+    """
+    volume = np.random.RandomState(5).randint(-900, 100, (14, 30, 30)).astype(np.int16)
+    labelmap = np.zeros(volume.shape, np.uint8)
+    labelmap[5:8, 4:8, 4:9] = 1
+    labelmap[6:9, 20:25, 18:22] = 2
+    return volume, labelmap
+
+
+def engineResults(volume, labelmap, noduleId):
+    """ Features of a nodule and its spheres calculated in the whole volume
+    """
+    results = dict()
+    noduleArray = labelmap == noduleId
+    results["Nodule"] = FeatureExtractionEngine(volume, noduleArray, SPACING, CATEGORIES, FEATURE_KEYS).run(dict())
+    centroid = np.round(np.mean(np.where(noduleArray), axis=1)).astype(np.int)
+    for radius in RADII:
+        distanceMap, offset = SphereROI.distanceMap(centroid, radius, SPACING, volume.shape)
+        # All the nodules are excluded from the sphere
+        sphereArray = SphereROI.sphereLabelmap(distanceMap, offset, radius, labelmap)
+        results[radius] = FeatureExtractionEngine(volume[SphereROI.cropSlices(offset, distanceMap.shape)],
+                                                  sphereArray, SPACING, CATEGORIES, FEATURE_KEYS,
+                                                  labelmapROIOffset=offset).run(dict())
+    return results
+
+
+def checkResults(results, expected):
+    assert sorted(results.keys()) == sorted(expected.keys())
+    for region in expected:
+        for key in FEATURE_KEYS:
+            assert np.isclose(results[region][key], expected[region][key]), (region, key)
+
+
+def test_nodules_match_the_whole_volume_analysis():
+    volume, labelmap = getCase()
+    analysis = MultiNoduleAnalysis(volume, labelmap, SPACING, CATEGORIES, FEATURE_KEYS, RADII)
+    for processes in (1, 2):
+        results = analysis.run(processes)
+        assert list(results.keys()) == [1, 2]
+        for noduleId in (1, 2):
+            checkResults(results[noduleId], engineResults(volume, labelmap, noduleId))
+
+
+def test_just_the_spheres():
+    volume, labelmap = getCase()
+    analysis = MultiNoduleAnalysis(volume, labelmap, SPACING, CATEGORIES, FEATURE_KEYS, RADII, noduleIds=[2],
+                                   analyzeNodules=False)
+    results = analysis.run(1)
+    assert list(results.keys()) == [2]
+    expected = engineResults(volume, labelmap, 2)
+    del expected["Nodule"]
+    checkResults(results[2], expected)
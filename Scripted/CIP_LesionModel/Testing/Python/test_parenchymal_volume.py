@@ -0,0 +1,55 @@
+import os, sys
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import ConcentricShells, ParenchymalVolume, SphereROI
+
+
+def countLabels(labelmapArray):
+    """ Number of voxels of every label, one label at a time
+    """
+    return dict((label, np.count_nonzero(labelmapArray == label)) for label in np.unique(labelmapArray))
+
+
+def test_label_counts():
+    labelmap = np.random.RandomState(2).choice([0, 5, 10, 17, 21], (6, 7, 8)).astype(np.uint16)
+    expected = countLabels(labelmap)
+    labelCounts = ParenchymalVolume.getLabelCounts(labelmap)
+    for label in range(25):
+        assert ParenchymalVolume.countLabel(labelCounts, label) == expected.get(label, 0)
+
+
+def test_label_counts_with_negative_and_big_labels():
+    labelmap = np.random.RandomState(2).choice([-1024, -1, 0, 5, 17, 2 ** 30], (6, 7, 8)).astype(np.int32)
+    expected = countLabels(labelmap)
+    labelCounts = ParenchymalVolume.getLabelCounts(labelmap)
+    for label in (0, 5, 17, 2 ** 30):
+        assert ParenchymalVolume.countLabel(labelCounts, label) == expected[label]
+    # The negative labels are ignored
+    assert ParenchymalVolume.countLabel(labelCounts, -1) == 0
+    assert ParenchymalVolume.countLabel(labelCounts, 3) == 0
+    labelCounts = ParenchymalVolume.getLabelCounts(np.full((2, 2, 2), -3, np.int16))
+    assert ParenchymalVolume.countLabel(labelCounts, 0) == 0
+
+
+def test_shells_with_negative_and_big_labels():
+    shape = (12, 13, 14)
+    spacing = (1.0, 1.0, 1.0)
+    volume = np.zeros(shape, np.int16)
+    labelmap = np.zeros(shape, np.uint8)
+    labelmap[5:7, 5:8, 6:8] = 1
+    parenchyma = np.random.RandomState(4).choice([-1, 0, 5, 16, 300, 2 ** 20], shape).astype(np.int32)
+    radii = [2, 4]
+    distanceMap, offset = SphereROI.distanceMap((6, 6, 7), max(radii), spacing, shape)
+    shells = ConcentricShells(volume, distanceMap, offset, radii, labelmap, spacing,
+                              parenchymaLabelmapArray=parenchyma)
+    keys = ["Emphysema", "Mild centrilobular emphysema"]
+    for radius in radii:
+        sphereArray = SphereROI.sphereLabelmap(distanceMap, offset, radius, labelmap)
+        expected = ParenchymalVolume(parenchyma, sphereArray, spacing, set(keys), offset).EvaluateFeatures()
+        results = shells.EvaluateFeatures(radius, keys)
+        for key in keys:
+            assert expected[key] > 0
+            assert np.isclose(results[key], expected[key]), (radius, key)
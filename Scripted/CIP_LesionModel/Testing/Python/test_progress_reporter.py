@@ -0,0 +1,44 @@
+import os, sys
+import traceback
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import BackgroundTask, AnalysisCancelled
+
+
+def failingFeature():
+    raise KeyError("feature")
+
+
+def test_background_task_result():
+    task = BackgroundTask(lambda a, b=0: a + b, 1, b=2)
+    task.start()
+    task.join()
+    assert task.result == 3
+
+
+def test_background_task_raises_the_original_exception_with_its_traceback():
+    task = BackgroundTask(failingFeature)
+    task.start()
+    task.join()
+    try:
+        task.result
+        assert False, "The exception was not raised"
+    except KeyError:
+        functions = [frame[2] for frame in traceback.extract_tb(sys.exc_info()[2])]
+        assert functions[-1] == "failingFeature"
+
+
+def test_background_task_keeps_the_cancelled_results():
+    def cancelledAnalysis():
+        raise AnalysisCancelled(results={"Energy": 1.0}, skipped=["Entropy"])
+    task = BackgroundTask(cancelledAnalysis)
+    task.start()
+    task.join()
+    try:
+        task.result
+        assert False, "The exception was not raised"
+    except AnalysisCancelled as ex:
+        assert ex.results == {"Energy": 1.0}
+        assert ex.skipped == ["Entropy"]
@@ -0,0 +1,73 @@
+import os, sys
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import RenyiDimensions
+
+
+def getPaddedROI(seed, size=16):
+    """ Random ROI padded to a cube with a power of 2 size. Some voxels of the ROI have intensity 0
+    """
+    rs = np.random.RandomState(seed)
+    mask = np.zeros((size, size, size), bool)
+    mask[2:11, 3:13, 1:9] = rs.rand(9, 10, 8) > 0.3
+    coordinates = np.where(mask)
+    matrix = np.zeros(mask.shape)
+    matrix[coordinates] = rs.randint(0, 4, size=len(coordinates[0]))
+    return matrix, coordinates
+
+
+def baselineRenyiDimension(c, matrixCoordinatesPadded, q):
+    """ Box by box loop of the original implementation (q = 0 or 1)
+    """
+    c = c / float(np.sum(c))
+    maxDim = c.shape[0]
+    p = int(np.log2(maxDim))
+    n = np.zeros(p + 1)
+    eps = np.spacing(1)
+    if q == 1:
+        n[p] = np.sum(c[matrixCoordinatesPadded] * np.log(1 / (c[matrixCoordinatesPadded] + eps)))
+    else:
+        n[p] = np.sum(c[matrixCoordinatesPadded] ** q)
+    for g in xrange(p - 1, -1, -1):
+        siz = 2 ** (p - g)
+        siz2 = siz // 2
+        for i in xrange(0, maxDim - siz + 1, siz):
+            for j in xrange(0, maxDim - siz + 1, siz):
+                for k in xrange(0, maxDim - siz + 1, siz):
+                    box = np.array([c[i, j, k], c[i + siz2, j, k], c[i, j + siz2, k], c[i + siz2, j + siz2, k],
+                                    c[i, j, k + siz2], c[i + siz2, j, k + siz2], c[i, j + siz2, k + siz2],
+                                    c[i + siz2, j + siz2, k + siz2]])
+                    c[i, j, k] = np.any(box != 0) if q == 0 else np.sum(box) ** q
+        pi = c[0:(maxDim - siz + 1):siz, 0:(maxDim - siz + 1):siz, 0:(maxDim - siz + 1):siz]
+        if q == 1:
+            n[g] = np.sum(pi * np.log(1 / (pi + eps)))
+        else:
+            n[g] = np.sum(pi)
+    r = np.log(2.0 ** (np.arange(p + 1)))
+    scaleMatrix = np.array([r, np.ones(p + 1)])
+    if q != 1:
+        n = (1 / float(1 - q)) * np.log(n)
+    return np.linalg.lstsq(scaleMatrix.T, n)[0][0]
+
+
+def test_box_counting_and_information_dimensions_match_baseline():
+    for seed in range(3):
+        matrix, coordinates = getPaddedROI(seed)
+        assert np.any(matrix[coordinates] == 0)
+        renyi = RenyiDimensions(matrix, coordinates, [])
+        boxPyramid = renyi.buildBoxPyramid(matrix, coordinates)
+        for q in (0, 1):
+            expected = baselineRenyiDimension(matrix.copy(), coordinates, q)
+            assert abs(renyi.renyiDimension(boxPyramid, q) - expected) < 1e-9
+
+
+def test_box_pyramid_does_not_modify_the_matrix():
+    matrix, coordinates = getPaddedROI(0)
+    original = matrix.copy()
+    renyi = RenyiDimensions(matrix, coordinates, [])
+    for q in (0, 1, 2):
+        renyi.renyiDimension(renyi.buildBoxPyramid(matrix, coordinates), q)
+    assert np.array_equal(matrix, original)
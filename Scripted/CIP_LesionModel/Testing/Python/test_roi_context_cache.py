@@ -0,0 +1,49 @@
+import os, sys
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import ROIContextCache
+
+
+def test_context_is_reused_for_the_same_roi():
+    labelmap = np.zeros((4, 5, 6), np.uint8)
+    labelmap[1:3, 2:4, 1:5] = 1
+    cache = ROIContextCache()
+    context = cache.getContext("vtkMRMLScalarVolumeNode1", labelmap, (1.0, 1.0, 2.0))
+    calls = []
+    assert context.get("histogram", lambda: calls.append(1) or "value") == "value"
+    # The same content (even in a different array) gets the same context, and the items are not calculated again
+    sameContext = cache.getContext("vtkMRMLScalarVolumeNode1", labelmap.copy(), (1.0, 1.0, 2.0))
+    assert sameContext is context
+    assert sameContext.get("histogram", lambda: calls.append(1) or "other") == "value"
+    assert len(calls) == 1
+
+
+def test_context_depends_on_volume_labelmap_and_spacing():
+    labelmap = np.zeros((4, 5, 6), np.uint8)
+    labelmap[1:3, 2:4, 1:5] = 1
+    modifiedLabelmap = labelmap.copy()
+    modifiedLabelmap[0, 0, 0] = 1
+    cache = ROIContextCache()
+    context = cache.getContext("vtkMRMLScalarVolumeNode1", labelmap, (1.0, 1.0, 2.0))
+    assert cache.getContext("vtkMRMLScalarVolumeNode2", labelmap, (1.0, 1.0, 2.0)) is not context
+    assert cache.getContext("vtkMRMLScalarVolumeNode1", modifiedLabelmap, (1.0, 1.0, 2.0)) is not context
+    assert cache.getContext("vtkMRMLScalarVolumeNode1", labelmap, (1.0, 1.0, 1.0)) is not context
+    # The labelmap must have the same shape too (not only the same bytes)
+    assert cache.getContext("vtkMRMLScalarVolumeNode1", labelmap.reshape(5, 4, 6), (1.0, 1.0, 2.0)) is not context
+
+
+def test_least_recently_used_context_is_removed():
+    cache = ROIContextCache(maxSize=2)
+    labelmaps = [np.full((2, 2, 2), i, np.uint8) for i in range(3)]
+    first = cache.getContext("volume", labelmaps[0], (1, 1, 1))
+    second = cache.getContext("volume", labelmaps[1], (1, 1, 1))
+    # Use the first one again, so the second one is the least recently used
+    assert cache.getContext("volume", labelmaps[0], (1, 1, 1)) is first
+    cache.getContext("volume", labelmaps[2], (1, 1, 1))
+    assert cache.getContext("volume", labelmaps[0], (1, 1, 1)) is first
+    assert cache.getContext("volume", labelmaps[1], (1, 1, 1)) is not second
+    cache.clear()
+    assert cache.getContext("volume", labelmaps[0], (1, 1, 1)) is not first
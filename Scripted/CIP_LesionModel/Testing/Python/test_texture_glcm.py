@@ -0,0 +1,131 @@
+import os, sys
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import TextureGLCM
+
+
+def getROI(seed, shape=(9, 11, 10), numGrayLevels=6):
+    """ Random blob with a few gray levels, in the format used by the feature classes
+    :return: tuple (grayLevels, matrix, matrixCoordinates, values)
+    """
+    rs = np.random.RandomState(seed)
+    z, y, x = np.indices(shape)
+    center = np.array(shape) / 2.0
+    mask = (z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 + rs.randn(*shape) * 3 < 12
+    coordinates = np.where(mask)
+    values = rs.randint(0, numGrayLevels, size=len(coordinates[0])) * 10 - 20
+    origin = np.min(coordinates, 1)
+    matrixCoordinates = tuple(c - o for c, o in zip(coordinates, origin))
+    matrix = np.zeros(np.max(coordinates, 1) - origin + 1)
+    matrix[matrixCoordinates] = values
+    return np.unique(values), matrix, matrixCoordinates, values
+
+
+# Directions of the neighbors, in the same order as TextureGLCM.calculate_glcm
+ANGLES = [(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1),
+          (1, 1, 0), (-1, 1, 0), (1, -1, 0), (-1, -1, 0), (1, 0, 1), (-1, 0, 1), (1, 0, -1), (-1, 0, -1),
+          (0, 1, 1), (0, -1, 1), (0, 1, -1), (0, -1, -1), (1, 1, 1), (-1, 1, 1), (1, -1, 1), (1, 1, -1),
+          (-1, -1, 1), (-1, 1, -1), (1, -1, -1), (-1, -1, -1)]
+
+
+def baselineGLCM(grayLevels, matrix, matrixCoordinates, angles=ANGLES):
+    """ Voxel by voxel accumulation, as it was done before the vectorization
+    """
+    out = np.zeros((len(grayLevels), len(grayLevels), 1, len(angles)))
+    indices = set(zip(*matrixCoordinates))
+    for h, c, r in indices:
+        i_idx = np.nonzero(grayLevels == matrix[h, c, r])
+        for angles_idx, angle in enumerate(angles):
+            neighbor = (h + angle[0], c + angle[1], r + angle[2])
+            if neighbor in indices:
+                j_idx = np.nonzero(grayLevels == matrix[neighbor])
+                out[i_idx, j_idx, 0, angles_idx] += 1
+    return out
+
+
+def test_calculate_glcm_matches_baseline():
+    """ The vectorized GLCM must count exactly the same pairs as the voxel by voxel loop
+    """
+    for seed in range(3):
+        grayLevels, matrix, matrixCoordinates, values = getROI(seed)
+        Ng = len(grayLevels)
+        glcm = TextureGLCM(grayLevels, Ng, matrix, matrixCoordinates, values, [], lambda: None)
+        out = glcm.calculate_glcm(grayLevels, matrix, matrixCoordinates, np.array([1]), 26, Ng,
+                                  np.zeros((Ng, Ng, 1, 26)))
+        expected = baselineGLCM(grayLevels, matrix, matrixCoordinates)
+        assert out.sum() > 0
+        assert np.array_equal(out, expected)
+
+
+def baselineFeatures(P_glcm, Ng):
+    """ GLCM features with the original formulas, evaluated over the whole Ng x Ng x distances x directions matrices
+    :return: dictionary of Feature-Value
+    """
+    eps = np.spacing(1)
+    log2 = lambda p: np.where(p != 0, np.log2(np.where(p != 0, p, 1)), np.log2(eps))
+    ivector = np.arange(1, Ng + 1)
+    prodMatrix = np.multiply.outer(ivector, ivector)
+    sumMatrix = np.add.outer(ivector, ivector)
+    diffMatrix = np.absolute(np.subtract.outer(ivector, ivector))
+    kValuesSum = np.arange(2, (Ng * 2) + 1)
+    kValuesDiff = np.arange(0, Ng)
+    u = P_glcm.mean(0).mean(0)
+    px = P_glcm.sum(1)
+    py = P_glcm.sum(0)
+    ux = px.mean(0)
+    uy = py.mean(0)
+    sigx = px.std(0)
+    sigy = py.std(0)
+    pxAddy = np.array([np.sum(P_glcm[sumMatrix == k], 0) for k in kValuesSum])
+    pxSuby = np.array([np.sum(P_glcm[diffMatrix == k], 0) for k in kValuesDiff])
+    HX = (-1) * np.sum(px * log2(px), 0)
+    HY = (-1) * np.sum(py * log2(py), 0)
+    HXY = (-1) * np.sum(np.sum(P_glcm * log2(P_glcm), 0), 0)
+    pxy = px[:, None] * py[None, :]
+    HXY1 = (-1) * np.sum(np.sum(P_glcm * log2(pxy), 0), 0)
+    sum2 = lambda a: np.sum(np.sum(a, 0), 0)
+    clusterBase = sumMatrix[:, :, None, None] - ux[None, None, :, :] - uy[None, None, :, :]
+    offDiagonal = ~np.eye(Ng, dtype=bool)
+    features = {
+        "Autocorrelation": sum2(P_glcm * prodMatrix[:, :, None, None]),
+        "Cluster Prominence": sum2(P_glcm * clusterBase ** 4),
+        "Cluster Shade": sum2(P_glcm * clusterBase ** 3),
+        "Cluster Tendency": sum2(P_glcm * clusterBase ** 2),
+        "Contrast": sum2(P_glcm * (diffMatrix[:, :, None, None] ** 2)),
+        "Correlation": sum2((P_glcm * prodMatrix[:, :, None, None] - (ux * uy)[None, None, :, :]) /
+                            (sigx * sigy)[None, None, :, :]),
+        "Difference Entropy": np.sum(pxSuby * log2(pxSuby), 0),
+        "Dissimilarity": sum2(P_glcm * diffMatrix[:, :, None, None]),
+        "Energy (GLCM)": sum2(P_glcm ** 2),
+        "Entropy(GLCM)": HXY1,
+        "Homogeneity 1": sum2(P_glcm / (1 + diffMatrix[:, :, None, None])),
+        "Homogeneity 2": sum2(P_glcm / (1 + diffMatrix[:, :, None, None] ** 2)),
+        "IMC1": (HXY - HXY1) / np.max(([HX, HY]), 0),
+        "IDMN": sum2(P_glcm / (1 + ((diffMatrix[:, :, None, None] ** 2) / (Ng ** 2)))),
+        "IDN": sum2(P_glcm / (1 + (diffMatrix[:, :, None, None] / Ng))),
+        "Inverse Variance": np.sum(P_glcm[offDiagonal] / (diffMatrix[:, :, None, None] ** 2)[offDiagonal], 0),
+        "Maximum Probability": P_glcm.max(0).max(0),
+        "Sum Average": np.sum(kValuesSum[:, None, None] * pxAddy, 0),
+        "Sum Entropy": (-1) * np.sum(pxAddy * log2(pxAddy), 0),
+        "Sum Variance": np.sum(pxAddy * ((kValuesSum[:, None, None] - kValuesSum[:, None, None] * pxAddy) ** 2), 0),
+        "Variance (GLCM)": sum2(P_glcm * ((ivector[:, None] - u) ** 2)[:, None, None, :]),
+    }
+    return dict((key, value.mean()) for key, value in features.items())
+
+
+def test_features_match_baseline():
+    """ The features calculated from the shared coefficients must match the original formulas
+    """
+    for seed in range(3):
+        grayLevels, matrix, matrixCoordinates, values = getROI(seed)
+        Ng = len(grayLevels)
+        keys = TextureGLCM.registry.features.keys()
+        glcm = TextureGLCM(grayLevels, Ng, matrix, matrixCoordinates, values, keys, lambda: None)
+        results = glcm.EvaluateFeatures()
+        expected = baselineFeatures(glcm.P_glcm.astype(np.float64), Ng)
+        assert set(results.keys()) == set(expected.keys())
+        for key in keys:
+            assert np.isclose(results[key], expected[key], rtol=1e-6), (seed, key)
@@ -0,0 +1,101 @@
+import os, sys
+import itertools
+import numpy as np
+
+# Add manually the module folder to the pythonpath
+this_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.normpath(os.path.join(this_dir, "..", "..")))
+from FeatureExtractionLib import TextureGLRL
+
+# Directions in the same order as TextureGLRL.calculate_glrl
+DIRECTIONS = [(1, 0, 0), (0, 1, 0), (0, 0, 1), (1, 1, 0), (1, 0, 1), (0, 1, 1), (1, -1, 0), (1, 0, -1), (0, 1, -1),
+              (1, 1, 1), (1, -1, 1), (1, 1, -1), (1, -1, -1)]
+
+
+def getROI(seed, shape=(8, 9, 10), numGrayLevels=4):
+    """ Random blob with a few gray levels (not 0, that is the padding value), in the format used by the feature
+    classes. The borders of the blob have lines with just one voxel of the ROI
+    :return: tuple (grayLevels, matrix, matrixCoordinates, values)
+    """
+    rs = np.random.RandomState(seed)
+    z, y, x = np.indices(shape)
+    center = np.array(shape) / 2.0
+    mask = (z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2 + rs.randn(*shape) * 3 < 12
+    coordinates = np.where(mask)
+    values = rs.randint(1, numGrayLevels + 1, size=len(coordinates[0])) * 10 - 25
+    return getMatrix(coordinates, values)
+
+
+def getMatrix(coordinates, values):
+    origin = np.min(coordinates, 1)
+    matrixCoordinates = tuple(c - o for c, o in zip(coordinates, origin))
+    matrix = np.zeros(np.max(coordinates, 1) - origin + 1)
+    matrix[matrixCoordinates] = values
+    return np.unique(values), matrix, matrixCoordinates, values
+
+
+def baselineGLRL(grayLevels, matrix, directions=DIRECTIONS):
+    """ Run count walking every line of the matrix voxel by voxel
+    """
+    runs = []
+    for direction in directions:
+        directionRuns = []
+        for start in itertools.product(*[range(n) for n in matrix.shape]):
+            previous = tuple(p - d for p, d in zip(start, direction))
+            if all(0 <= p < n for p, n in zip(previous, matrix.shape)):
+                # Not the first voxel of a line
+                continue
+            # Walk the line splitting it in runs of the same value
+            line = []
+            voxel = start
+            while all(0 <= p < n for p, n in zip(voxel, matrix.shape)):
+                line.append(matrix[voxel])
+                voxel = tuple(p + d for p, d in zip(voxel, direction))
+            for value, run in itertools.groupby(line):
+                if value != 0:
+                    directionRuns.append((value, len(list(run))))
+        runs.append(directionRuns)
+
+    Nr = max([1] + [length for directionRuns in runs for _, length in directionRuns])
+    out = np.zeros((len(grayLevels), Nr, len(directions)))
+    for angle, directionRuns in enumerate(runs):
+        for value, length in directionRuns:
+            out[np.nonzero(grayLevels == value)[0][0], length - 1, angle] += 1
+    return out
+
+
+def calculateGLRL(grayLevels, matrix, matrixCoordinates, values):
+    glrl = TextureGLRL(grayLevels, len(grayLevels), matrix, matrixCoordinates, values, [])
+    return glrl.calculate_glrl(grayLevels, len(grayLevels), matrix, matrixCoordinates, glrl.angles)
+
+
+def test_glrl_matches_the_run_count_per_line():
+    for seed in range(4):
+        grayLevels, matrix, matrixCoordinates, values = getROI(seed)
+        P_glrl = calculateGLRL(grayLevels, matrix, matrixCoordinates, values)
+        expected = baselineGLRL(grayLevels, matrix)
+        assert P_glrl.shape == expected.shape, seed
+        assert np.array_equal(P_glrl, expected), seed
+
+
+def test_single_voxels_and_repeated_runs():
+    # Line along X: runs 7 7 | 3 | 7 7 | (gap) 7 | 3 3 3, plus an isolated voxel in another slice
+    coordinates = (np.array([0] * 10 + [2]), np.array([0] * 10 + [1]), np.array(range(5) + range(6, 11) + [4]))
+    values = np.array([7, 7, 3, 7, 7, 7, 3, 3, 3, 5, 3])
+    grayLevels, matrix, matrixCoordinates, values = getMatrix(coordinates, values)
+    P_glrl = calculateGLRL(grayLevels, matrix, matrixCoordinates, values)
+    assert np.array_equal(P_glrl, baselineGLRL(grayLevels, matrix))
+    # Direction X: gray level 3 -> 2 runs of 1 and 1 run of 3; gray level 5 -> 1 run of 1; gray level 7 -> 1 run
+    # of 1 and 2 runs of 2
+    assert P_glrl[:, :, 2].tolist() == [[2, 0, 1], [1, 0, 0], [1, 2, 0]]
+    # Any other direction: every voxel is a run of length 1
+    assert np.array_equal(P_glrl[:, 0, :2], np.array([[5, 5], [1, 1], [5, 5]]))
+    assert P_glrl[:, 1:, :2].sum() == 0
+
+
+def test_empty_matrix():
+    grayLevels = np.array([1.0])
+    matrix = np.zeros((3, 3, 3))
+    P_glrl = calculateGLRL(grayLevels, matrix, (np.array([]),) * 3, np.array([]))
+    assert P_glrl.shape == (1, 1, 13)
+    assert P_glrl.sum() == 0